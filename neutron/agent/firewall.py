@@ -83,6 +83,24 @@ class FirewallDriver(object):
         """Stop filtering port."""
         raise NotImplementedError()
 
+    def update_security_group_members(self, sg_id, member_ips):
+        """Update the member ips of a remote security group.
+
+        Only called on drivers matching the remote groups of the rules
+        themselves (see matches_remote_groups). member_ips is a dict of the
+        lists of member ips by ethertype.
+        """
+        raise NotImplementedError()
+
+    @property
+    def matches_remote_groups(self):
+        """Whether the driver matches the members of remote groups.
+
+        If true, the rules with a remote_group_id are not converted to a
+        rule per member ip by the agent.
+        """
+        return False
+
     def filter_defer_apply_on(self):
         """Defer application of filtering rule."""
         pass
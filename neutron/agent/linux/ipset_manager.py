@@ -0,0 +1,104 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import base64
+import hashlib
+import uuid
+
+from neutron.agent.linux import utils as linux_utils
+from neutron.common import constants
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# Maximum length of an ipset name
+IPSET_NAME_MAX = 31
+IPSET_FAMILY = {constants.IPv4: 'inet',
+                constants.IPv6: 'inet6'}
+
+
+def get_ipset_name(name, ethertype):
+    """Return the name of the ipset of the ethertype members of name.
+
+    name, usually a UUID, doesn't fit in an ipset name: it is compacted to
+    the base64 encoding of the UUID, or hashed if it is not a UUID, rather
+    than truncated, so that the names of the ipsets don't collide.
+    """
+    try:
+        digest = uuid.UUID(name).bytes
+    except ValueError:
+        digest = hashlib.sha1(name.encode('utf-8')).digest()
+    encoded = base64.urlsafe_b64encode(digest).rstrip('=')
+    return ('%s%s' % (ethertype, encoded))[:IPSET_NAME_MAX]
+
+
+class IpsetManager(object):
+    """Wrapper for ipset.
+
+    The members of the ipsets are tracked, so that refreshing an ipset only
+    adds and deletes the members which changed, in a single ipset call.
+    """
+
+    def __init__(self, execute=None, root_helper=None):
+        self.execute = execute or linux_utils.execute
+        self.root_helper = root_helper
+        self.ipsets = {}
+
+    def ipset_exists(self, name):
+        return name in self.ipsets
+
+    def refresh_ipset(self, name, ethertype, members):
+        """Create the ipset if needed and set its members.
+
+        The members are ip addresses or cidrs of the ethertype.
+        """
+        new_members = set(members)
+        old_members = self.ipsets.get(name)
+        commands = []
+        if old_members is None:
+            # The ipset may be left over by a previous run of the agent
+            commands.append('create %s hash:net family %s' %
+                            (name, IPSET_FAMILY[ethertype]))
+            commands.append('flush %s' % name)
+            old_members = set()
+        commands += ['add %s %s' % (name, member)
+                     for member in sorted(new_members - old_members)]
+        commands += ['del %s %s' % (name, member)
+                     for member in sorted(old_members - new_members)]
+        if commands:
+            LOG.debug(_("Refreshing ipset %(name)s: %(count)d changes"),
+                      {'name': name, 'count': len(commands)})
+            self._restore(commands)
+        self.ipsets[name] = new_members
+
+    def destroy_ipset(self, name):
+        """Destroy an ipset, which must not be referenced anymore.
+
+        An ipset still referenced by iptables rules can't be destroyed; it
+        is kept, and False is returned, so that it is destroyed later.
+        """
+        try:
+            self.execute(['ipset', 'destroy', name],
+                         root_helper=self.root_helper)
+        except RuntimeError:
+            LOG.warn(_("Unable to destroy ipset %s, it may still be "
+                       "referenced by iptables rules"), name)
+            return False
+        self.ipsets.pop(name, None)
+        return True
+
+    def _restore(self, commands):
+        self.execute(['ipset', 'restore', '-exist'],
+                     root_helper=self.root_helper,
+                     process_input='\n'.join(commands) + '\n')
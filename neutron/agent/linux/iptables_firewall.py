@@ -17,16 +17,21 @@ import netaddr
 from oslo.config import cfg
 
 from neutron.agent import firewall
+from neutron.agent.linux import ipset_manager
 from neutron.agent.linux import iptables_manager
 from neutron.common import constants
 from neutron.openstack.common import log as logging
 
 
 LOG = logging.getLogger(__name__)
+cfg.CONF.import_opt('enable_ipset', 'neutron.agent.securitygroups_rpc',
+                    group='SECURITYGROUP')
 SG_CHAIN = 'sg-chain'
 INGRESS_DIRECTION = 'ingress'
 EGRESS_DIRECTION = 'egress'
 SPOOF_FILTER = 'spoof-filter'
+IPSET_DIRECTION = {INGRESS_DIRECTION: 'src',
+                   EGRESS_DIRECTION: 'dst'}
 CHAIN_NAME_PREFIX = {INGRESS_DIRECTION: 'i',
                      EGRESS_DIRECTION: 'o',
                      SPOOF_FILTER: 's'}
@@ -47,18 +52,55 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
         self._add_fallback_chain_v4v6()
         self._defer_apply = False
         self._pre_defer_filtered_ports = None
+        self.enable_ipset = cfg.CONF.SECURITYGROUP.enable_ipset
+        self.ipset = ipset_manager.IpsetManager(
+            root_helper=cfg.CONF.AGENT.root_helper)
+        # remote security groups whose members are in ipsets
+        self.sg_members = set()
 
     @property
     def ports(self):
         return self.filtered_ports
 
+    @property
+    def matches_remote_groups(self):
+        return self.enable_ipset
+
+    def update_security_group_members(self, sg_id, member_ips):
+        LOG.debug(_("Updating security group (%s) members"), sg_id)
+        for ethertype in (constants.IPv4, constants.IPv6):
+            members = [str(netaddr.IPNetwork(ip).cidr)
+                       for ip in member_ips.get(ethertype, [])]
+            self.ipset.refresh_ipset(
+                ipset_manager.get_ipset_name(sg_id, ethertype),
+                ethertype, members)
+        self.sg_members.add(sg_id)
+
+    def _remove_unused_security_group_members(self):
+        # The ipsets can only be destroyed once the rules referencing them
+        # are removed
+        used_sg_ids = set()
+        for port in self.filtered_ports.values():
+            used_sg_ids.update(port.get('security_group_source_groups', []))
+        for sg_id in self.sg_members - used_sg_ids:
+            LOG.debug(_("Removing security group (%s) members"), sg_id)
+            destroyed = True
+            for ethertype in (constants.IPv4, constants.IPv6):
+                name = ipset_manager.get_ipset_name(sg_id, ethertype)
+                if self.ipset.ipset_exists(name):
+                    destroyed &= self.ipset.destroy_ipset(name)
+            # the ipsets which are still referenced are destroyed after
+            # the next iptables changes
+            if destroyed:
+                self.sg_members.discard(sg_id)
+
     def prepare_port_filter(self, port):
         LOG.debug(_("Preparing device (%s) filter"), port['device'])
         self._remove_chains()
         self.filtered_ports[port['device']] = port
         # each security group has it own chains
         self._setup_chains()
-        self.iptables.apply()
+        self._apply()
 
     def update_port_filter(self, port):
         LOG.debug(_("Updating device (%s) filter"), port['device'])
@@ -69,7 +111,7 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
         self._remove_chains()
         self.filtered_ports[port['device']] = port
         self._setup_chains()
-        self.iptables.apply()
+        self._apply()
 
     def remove_port_filter(self, port):
         LOG.debug(_("Removing device (%s) filter"), port['device'])
@@ -80,7 +122,12 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
         self._remove_chains()
         self.filtered_ports.pop(port['device'], None)
         self._setup_chains()
+        self._apply()
+
+    def _apply(self):
         self.iptables.apply()
+        if not self._defer_apply:
+            self._remove_unused_security_group_members()
 
     def _setup_chains(self):
         """Setup ingress and egress chain for a port."""
@@ -297,6 +344,7 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
                                    rule.get('protocol'),
                                    rule.get('port_range_min'),
                                    rule.get('port_range_max'))
+            args += self._remote_group_arg(rule)
             args += ['-j RETURN']
             iptables_rules += [' '.join(args)]
 
@@ -351,6 +399,17 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
             return ['-%s' % direction, ip_prefix]
         return []
 
+    def _remote_group_arg(self, rule):
+        # The rules converted to a rule per member ip have an ip prefix
+        remote_group_id = rule.get('remote_group_id')
+        if (not self.enable_ipset or not remote_group_id or
+            rule.get('source_ip_prefix') or rule.get('dest_ip_prefix')):
+            return []
+        ipset_name = ipset_manager.get_ipset_name(remote_group_id,
+                                                  rule['ethertype'])
+        return ['-m set --match-set %s %s' %
+                (ipset_name, IPSET_DIRECTION[rule['direction']])]
+
     def _port_chain_name(self, port, direction):
         return iptables_manager.get_chain_name(
             '%s%s' % (CHAIN_NAME_PREFIX[direction], port['device'][3:]))
@@ -368,6 +427,7 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
             self._pre_defer_filtered_ports = None
             self._setup_chains_apply(self.filtered_ports)
             self.iptables.defer_apply_off()
+            self._remove_unused_security_group_members()
 
 
 class OVSHybridIptablesFirewallDriver(IptablesFirewallDriver):
@@ -19,7 +19,9 @@
 
 """Implements iptables rules using linux utilities."""
 
+import collections
 import inspect
+import itertools
 import os
 import re
 
@@ -85,6 +87,9 @@ class IptablesRule(object):
     def __ne__(self, other):
         return not self == other
 
+    def __hash__(self):
+        return hash((self.chain, self.rule, self.top, self.wrap))
+
     def __str__(self):
         if self.wrap:
             chain = '%s-%s' % (self.wrap_name, self.chain)
@@ -94,16 +99,79 @@ class IptablesRule(object):
 
 
 class IptablesTable(object):
-    """An iptables table."""
+    """An iptables table.
+
+    The rules are kept in insertion order, and indexed by rule, chain, jump
+    target and tag, so that adding and removing rules and chains doesn't
+    depend on the number of rules of the table.
+
+    """
 
     def __init__(self, binary_name=binary_name):
-        self.rules = []
+        # The rules by sequence number, in insertion order
+        self._rules = collections.OrderedDict()
+        self._next_seq = itertools.count()
+        # The sequence numbers of the rules, by rule (in insertion order),
+        # chain, jump target and tag
+        self._rule_seqs = {}
+        self._chain_seqs = {}
+        self._jump_seqs = {}
+        self._tag_seqs = {}
         self.remove_rules = []
         self.chains = set()
         self.unwrapped_chains = set()
         self.remove_chains = set()
         self.wrap_name = binary_name[:16]
 
+    @property
+    def rules(self):
+        """The rules of the table, in insertion order."""
+        return self._rules.values()
+
+    @staticmethod
+    def _get_jump_target(rule):
+        args = rule.split()
+        try:
+            return args[args.index('-j') + 1]
+        except (ValueError, IndexError):
+            return
+
+    def _insert_rule(self, rule):
+        seq = next(self._next_seq)
+        self._rules[seq] = rule
+        self._rule_seqs.setdefault(rule, collections.OrderedDict())[seq] = None
+        self._chain_seqs.setdefault(rule.chain, set()).add(seq)
+        target = self._get_jump_target(rule.rule)
+        if target:
+            self._jump_seqs.setdefault(target, set()).add(seq)
+        if rule.tag:
+            self._tag_seqs.setdefault(rule.tag, set()).add(seq)
+
+    @staticmethod
+    def _discard_seq(index, key, seq):
+        seqs = index[key]
+        if isinstance(seqs, set):
+            seqs.discard(seq)
+        else:
+            del seqs[seq]
+        if not seqs:
+            del index[key]
+
+    def _delete_rules(self, seqs):
+        """Delete rules by sequence number, returning them in order."""
+        rules = []
+        for seq in sorted(seqs):
+            rule = self._rules.pop(seq)
+            self._discard_seq(self._rule_seqs, rule, seq)
+            self._discard_seq(self._chain_seqs, rule.chain, seq)
+            target = self._get_jump_target(rule.rule)
+            if target:
+                self._discard_seq(self._jump_seqs, target, seq)
+            if rule.tag:
+                self._discard_seq(self._tag_seqs, rule.tag, seq)
+            rules.append(rule)
+        return rules
+
     def add_chain(self, name, wrap=True):
         """Adds a named chain to the table.
 
@@ -160,28 +228,23 @@ class IptablesTable(object):
 
         chain_set.remove(name)
 
+        # first, remove the rules that have a matching chain name
+        removed_rules = self._delete_rules(self._chain_seqs.get(name, ()))
+
         if not wrap:
             # non-wrapped chains and rules need to be dealt with specially,
             # so we keep a list of them to be iterated over in apply()
             self.remove_chains.add(name)
-
-            # first, add rules to remove that have a matching chain name
-            self.remove_rules += [r for r in self.rules if r.chain == name]
-
-        # next, remove rules from list that have a matching chain name
-        self.rules = [r for r in self.rules if r.chain != name]
-
-        if not wrap:
-            jump_snippet = '-j %s' % name
-            # next, add rules to remove that have a matching jump chain
-            self.remove_rules += [r for r in self.rules
-                                  if jump_snippet in r.rule]
+            self.remove_rules += removed_rules
+            jump_target = name
         else:
-            jump_snippet = '-j %s-%s' % (self.wrap_name, name)
+            jump_target = '%s-%s' % (self.wrap_name, name)
 
-        # finally, remove rules from list that have a matching jump chain
-        self.rules = [r for r in self.rules
-                      if jump_snippet not in r.rule]
+        # next, remove the rules that jump to the chain
+        removed_rules = self._delete_rules(
+            self._jump_seqs.get(jump_target, ()))
+        if not wrap:
+            self.remove_rules += removed_rules
 
     def add_rule(self, chain, rule, wrap=True, top=False, tag=None):
         """Add a rule to the table.
@@ -202,7 +265,7 @@ class IptablesTable(object):
             rule = ' '.join(
                 self._wrap_target_chain(e, wrap) for e in rule.split(' '))
 
-        self.rules.append(IptablesRule(chain, rule, wrap, top, self.wrap_name,
+        self._insert_rule(IptablesRule(chain, rule, wrap, top, self.wrap_name,
                                        tag))
 
     def _wrap_target_chain(self, s, wrap):
@@ -220,36 +283,33 @@ class IptablesTable(object):
 
         """
         chain = get_chain_name(chain, wrap)
-        try:
-            if '$' in rule:
-                rule = ' '.join(
-                    self._wrap_target_chain(e, wrap) for e in rule.split(' '))
-
-            self.rules.remove(IptablesRule(chain, rule, wrap, top,
-                                           self.wrap_name))
-            if not wrap:
-                self.remove_rules.append(IptablesRule(chain, rule, wrap, top,
-                                                      self.wrap_name))
-        except ValueError:
+        if '$' in rule:
+            rule = ' '.join(
+                self._wrap_target_chain(e, wrap) for e in rule.split(' '))
+
+        iptables_rule = IptablesRule(chain, rule, wrap, top, self.wrap_name)
+        seqs = self._rule_seqs.get(iptables_rule)
+        if not seqs:
             LOG.warn(_('Tried to remove rule that was not there:'
                        ' %(chain)r %(rule)r %(wrap)r %(top)r'),
                      {'chain': chain, 'rule': rule,
                       'top': top, 'wrap': wrap})
+            return
+        # The first occurrence of the rule is removed
+        self._delete_rules([next(iter(seqs))])
+        if not wrap:
+            self.remove_rules.append(iptables_rule)
 
     def empty_chain(self, chain, wrap=True):
         """Remove all rules from a chain."""
         chain = get_chain_name(chain, wrap)
-        chained_rules = [rule for rule in self.rules
-                         if rule.chain == chain and rule.wrap == wrap]
-        for rule in chained_rules:
-            self.rules.remove(rule)
+        self._delete_rules([seq for seq in self._chain_seqs.get(chain, ())
+                            if self._rules[seq].wrap == wrap])
 
     def clear_rules_by_tag(self, tag):
         if not tag:
             return
-        rules = [rule for rule in self.rules if rule.tag == tag]
-        for rule in rules:
-            self.rules.remove(rule)
+        self._delete_rules(self._tag_seqs.get(tag, ()))
 
 
 class IptablesManager(object):
@@ -288,6 +348,8 @@ class IptablesManager(object):
         self.namespace = namespace
         self.iptables_apply_deferred = False
         self.wrap_name = binary_name[:16]
+        # State of the tables as last applied, by command and table name
+        self._applied_state = {}
 
         self.ipv4 = {'filter': IptablesTable(binary_name=self.wrap_name)}
         self.ipv6 = {'filter': IptablesTable(binary_name=self.wrap_name)}
@@ -377,9 +439,13 @@ class IptablesManager(object):
     def _apply_synchronized(self):
         """Apply the current in-memory set of iptables rules.
 
-        This will blow away any rules left over from previous runs of the
-        same component of Nova, and replace them with our current set of
-        rules. This happens atomically, thanks to iptables-restore.
+        The first time, and whenever the chains of this component in the
+        kernel do not match the ones last applied, this will blow away any
+        rules left over from previous runs of the same component of Nova,
+        and replace them with our current set of rules. Otherwise only the
+        chains which changed since the last apply are modified, with
+        iptables-restore --noflush. This happens atomically, thanks to
+        iptables-restore.
 
         """
         s = [('iptables', self.ipv4)]
@@ -392,40 +458,198 @@ class IptablesManager(object):
                 args = ['ip', 'netns', 'exec', self.namespace] + args
             all_tables = self.execute(args, root_helper=self.root_helper)
             all_lines = all_tables.split('\n')
-            for table_name, table in tables.iteritems():
-                start, end = self._find_table(all_lines, table_name)
-                all_lines[start:end] = self._modify_rules(
-                    all_lines[start:end], table, table_name)
-
-            args = ['%s-restore' % (cmd,), '-c']
-            if self.namespace:
-                args = ['ip', 'netns', 'exec', self.namespace] + args
-            try:
-                self.execute(args, process_input='\n'.join(all_lines),
-                             root_helper=self.root_helper)
-            except RuntimeError as r_error:
-                with excutils.save_and_reraise_exception():
-                    try:
-                        line_no = int(re.search(
-                            'iptables-restore: line ([0-9]+?) failed',
-                            str(r_error)).group(1))
-                        context = IPTABLES_ERROR_LINES_OF_CONTEXT
-                        log_start = max(0, line_no - context)
-                        log_end = line_no + context
-                    except AttributeError:
-                        # line error wasn't found, print all lines instead
-                        log_start = 0
-                        log_end = len(all_lines)
-                    log_lines = ('%7d. %s' % (idx, l)
-                                 for idx, l in enumerate(
-                                     all_lines[log_start:log_end],
-                                     log_start + 1)
-                                 )
-                    LOG.error(_("IPTablesManager.apply failed to apply the "
-                                "following set of iptables rules:\n%s"),
-                              '\n'.join(log_lines))
+            states = dict((table_name, self._get_table_state(table))
+                          for table_name, table in tables.iteritems())
+            # The state is only known again once the apply succeeded
+            applied_states = self._applied_state.pop(cmd, None)
+            if not self._apply_incremental(cmd, tables, all_lines,
+                                           applied_states, states):
+                self._apply_full(cmd, tables, all_lines)
+            self._applied_state[cmd] = states
         LOG.debug(_("IPTablesManager.apply completed with success"))
 
+    def _apply_full(self, cmd, tables, all_lines):
+        for table_name, table in tables.iteritems():
+            start, end = self._find_table(all_lines, table_name)
+            all_lines[start:end] = self._modify_rules(
+                all_lines[start:end], table, table_name)
+        self._restore(cmd, all_lines, ['-c'])
+
+    def _apply_incremental(self, cmd, tables, all_lines, applied_states,
+                           states):
+        """Apply the changes of the tables since the last apply.
+
+        Returns False if the changes can't be applied incrementally.
+        """
+        if applied_states is None:
+            return False
+        commands = []
+        for table_name, table in tables.iteritems():
+            if table.remove_rules or table.remove_chains:
+                # Unwrapped chains and rules are removed
+                return False
+            start, end = self._find_table(all_lines, table_name)
+            if not self._table_state_matches(all_lines[start:end],
+                                             applied_states[table_name]):
+                LOG.debug(_("Chains of %(cmd)s table %(table)s were "
+                            "modified, resynchronizing the table"),
+                          {'cmd': cmd, 'table': table_name})
+                return False
+            table_commands = self._get_table_commands(
+                applied_states[table_name], states[table_name])
+            if table_commands is None:
+                return False
+            if table_commands:
+                commands += ['*%s' % table_name] + table_commands
+                commands += ['COMMIT']
+        if not commands:
+            LOG.debug(_("No change in %s tables"), cmd)
+            return True
+        try:
+            self._restore(cmd, commands, ['-n'])
+        except RuntimeError:
+            LOG.warn(_("Failed to apply the changes of %s tables, "
+                       "resynchronizing the tables"), cmd)
+            return False
+        return True
+
+    def _get_table_state(self, table):
+        """Return the chains and rules of a table, as applied to iptables.
+
+        The rules of the wrapped chains are listed by chain, in order, with
+        the duplicates removed.
+        """
+        top_rules = [rule for rule in table.rules if rule.top]
+        bottom_rules = [rule for rule in table.rules if not rule.top]
+        chains = dict(('%s-%s' % (self.wrap_name, name), [])
+                      for name in table.chains)
+        unwrapped_rules = []
+        seen_rules = set()
+        # The last occurrence of a duplicated rule is applied
+        for rule in reversed(top_rules + bottom_rules):
+            rule_str = str(rule)
+            if rule_str in seen_rules:
+                continue
+            seen_rules.add(rule_str)
+            if rule.wrap:
+                chains['%s-%s' % (self.wrap_name, rule.chain)].append(
+                    rule.rule)
+            else:
+                unwrapped_rules.append(rule_str)
+        for rules in chains.values():
+            rules.reverse()
+        unwrapped_rules.reverse()
+        return {'chains': chains,
+                'unwrapped_chains': frozenset(table.unwrapped_chains),
+                'unwrapped_rules': unwrapped_rules}
+
+    def _table_state_matches(self, lines, state):
+        """Check the lines of an iptables-save table against a state.
+
+        The wrapped chains and their rules, in order, and the presence of
+        the unwrapped chains and rules are checked.
+        """
+        wrap_prefix = '%s-' % self.wrap_name
+        chains = {}
+        unwrapped_chains = set()
+        unwrapped_rules = set()
+        for line in lines:
+            if line.startswith(':'):
+                chain = line[1:].split(' ', 1)[0]
+                if chain.startswith(wrap_prefix):
+                    chains.setdefault(chain, [])
+                else:
+                    unwrapped_chains.add(chain)
+                continue
+            if line.startswith('['):
+                line = line.split('] ', 1)[-1]
+            if not line.startswith('-A '):
+                continue
+            line = line.strip()
+            chain, rule = (line.split(' ', 2) + [''])[1:3]
+            if chain.startswith(wrap_prefix):
+                chains.setdefault(chain, []).append(rule)
+            else:
+                unwrapped_rules.add(line)
+        return (chains == state['chains'] and
+                state['unwrapped_chains'] <= unwrapped_chains and
+                unwrapped_rules.issuperset(state['unwrapped_rules']))
+
+    def _get_table_commands(self, old_state, new_state):
+        """Return the iptables-restore commands changing a table state.
+
+        Returns None if the unwrapped chains or rules changed, they are
+        shared with other components and only applied with a full
+        resynchronization.
+        """
+        if (old_state['unwrapped_chains'] != new_state['unwrapped_chains'] or
+                old_state['unwrapped_rules'] !=
+                new_state['unwrapped_rules']):
+            return
+        old_chains = old_state['chains']
+        new_chains = new_state['chains']
+        declare_commands = []
+        rule_commands = []
+        for chain, rules in sorted(new_chains.items()):
+            old_rules = old_chains.get(chain)
+            if old_rules is None:
+                declare_commands.append(':%s - [0:0]' % chain)
+                rule_commands += ['-A %s %s' % (chain, rule)
+                                  for rule in rules]
+            elif old_rules != rules:
+                rule_commands += self._get_chain_commands(chain, old_rules,
+                                                          rules)
+        # The removed chains are deleted once the jumps to them are removed
+        removed_chains = sorted(set(old_chains) - set(new_chains))
+        return (declare_commands + rule_commands +
+                ['-F %s' % chain for chain in removed_chains] +
+                ['-X %s' % chain for chain in removed_chains])
+
+    def _get_chain_commands(self, chain, old_rules, new_rules):
+        old_rules_set = set(old_rules)
+        new_rules_set = set(new_rules)
+        kept_rules = [rule for rule in old_rules if rule in new_rules_set]
+        if kept_rules != [rule for rule in new_rules if rule in old_rules_set]:
+            # The order of the rules changed, the chain is rewritten
+            return (['-F %s' % chain] +
+                    ['-A %s %s' % (chain, rule) for rule in new_rules])
+        # The rules left in place keep their [packet:byte] counts
+        commands = ['-D %s %s' % (chain, rule)
+                    for rule in old_rules if rule not in new_rules_set]
+        commands += ['-I %s %d %s' % (chain, index, rule)
+                     for index, rule in enumerate(new_rules, 1)
+                     if rule not in old_rules_set]
+        return commands
+
+    def _restore(self, cmd, all_lines, restore_args):
+        args = ['%s-restore' % (cmd,)] + restore_args
+        if self.namespace:
+            args = ['ip', 'netns', 'exec', self.namespace] + args
+        try:
+            self.execute(args, process_input='\n'.join(all_lines),
+                         root_helper=self.root_helper)
+        except RuntimeError as r_error:
+            with excutils.save_and_reraise_exception():
+                try:
+                    line_no = int(re.search(
+                        'iptables-restore: line ([0-9]+?) failed',
+                        str(r_error)).group(1))
+                    context = IPTABLES_ERROR_LINES_OF_CONTEXT
+                    log_start = max(0, line_no - context)
+                    log_end = line_no + context
+                except AttributeError:
+                    # line error wasn't found, print all lines instead
+                    log_start = 0
+                    log_end = len(all_lines)
+                log_lines = ('%7d. %s' % (idx, l)
+                             for idx, l in enumerate(
+                                 all_lines[log_start:log_end],
+                                 log_start + 1)
+                             )
+                LOG.error(_("IPTablesManager.apply failed to apply the "
+                            "following set of iptables rules:\n%s"),
+                          '\n'.join(log_lines))
+
     def _find_table(self, lines, table_name):
         if len(lines) < 3:
             # length only <2 when fake iptables
@@ -455,12 +679,27 @@ class IptablesManager(object):
 
         return rules_index
 
-    def _find_last_entry(self, filter_list, match_str):
-        # find a matching entry, starting from the bottom
-        for s in reversed(filter_list):
+    def _get_entry_key(self, line):
+        """Return the key of a chain or rule line, without [packet:byte]."""
+        line = line.strip()
+        if line.startswith(':'):
+            # it's a chain, for example, ":neutron-billing - [0:0]"
+            return line.split(' ', 1)[0]
+        if line.startswith('['):
+            # it's a rule, for example, "[0:0] -A neutron-billing..."
+            line = line.split('] ', 1)[-1]
+        if line.startswith('-A '):
+            return line
+
+    def _get_last_entries(self, filter_list):
+        """Map the keys of the chains and rules to their last entry."""
+        entries = {}
+        for s in filter_list:
             s = s.strip()
-            if match_str in s:
-                return s
+            key = self._get_entry_key(s)
+            if key:
+                entries[key] = s
+        return entries
 
     def _modify_rules(self, current_lines, table, table_name):
         unwrapped_chains = table.unwrapped_chains
@@ -485,6 +724,14 @@ class IptablesManager(object):
 
         rules_index = self._find_rules_index(new_filter)
 
+        # The existing entries are looked up by key, ignoring their
+        # [packet:byte] counts, rather than by scanning the filters for
+        # every chain and rule.  The entries of new_filter which we
+        # replace are removed from it once we are done.
+        old_entries = self._get_last_entries(old_filter)
+        new_entries = self._get_last_entries(new_filter)
+        replaced_keys = set()
+
         all_chains = [':%s' % name for name in unwrapped_chains]
         all_chains += [':%s-%s' % (self.wrap_name, name) for name in chains]
 
@@ -494,10 +741,11 @@ class IptablesManager(object):
         for chain in all_chains:
             chain_str = str(chain).strip()
 
-            old = self._find_last_entry(old_filter, chain_str)
-            if not old:
-                dup = self._find_last_entry(new_filter, chain_str)
-            new_filter = [s for s in new_filter if chain_str not in s.strip()]
+            old = old_entries.get(chain_str)
+            dup = None
+            if not old and chain_str not in replaced_keys:
+                dup = new_entries.get(chain_str)
+            replaced_keys.add(chain_str)
 
             # if no old or duplicates, use original chain
             if old or dup:
@@ -517,10 +765,11 @@ class IptablesManager(object):
             # Further down, we weed out duplicates from the bottom of the
             # list, so here we remove the dupes ahead of time.
 
-            old = self._find_last_entry(old_filter, rule_str)
-            if not old:
-                dup = self._find_last_entry(new_filter, rule_str)
-            new_filter = [s for s in new_filter if rule_str not in s.strip()]
+            old = old_entries.get(rule_str)
+            dup = None
+            if not old and rule_str not in replaced_keys:
+                dup = new_entries.get(rule_str)
+            replaced_keys.add(rule_str)
 
             # if no old or duplicates, use original rule
             if old or dup:
@@ -540,6 +789,8 @@ class IptablesManager(object):
 
         our_rules += bot_rules
 
+        new_filter = [s for s in new_filter
+                      if self._get_entry_key(s) not in replaced_keys]
         new_filter[rules_index:rules_index] = our_rules
         new_filter[rules_index:rules_index] = our_chains
 
@@ -582,21 +833,24 @@ class IptablesManager(object):
             # Leave it alone
             return True
 
+        # The chains and rules to remove, with the number of occurrences
+        # of each rule
+        chains_to_remove = set(remove_chains)
+        rules_to_remove = collections.Counter(
+            _strip_packets_bytes(str(rule)) for rule in remove_rules)
+
         def _weed_out_removes(line):
             # We need to find exact matches here
             if line.startswith(':'):
                 line = _strip_packets_bytes(line)
-                for chain in remove_chains:
-                    if chain == line:
-                        remove_chains.remove(chain)
-                        return False
+                if line in chains_to_remove:
+                    chains_to_remove.remove(line)
+                    return False
             elif line.startswith('['):
                 line = _strip_packets_bytes(line)
-                for rule in remove_rules:
-                    rule_str = _strip_packets_bytes(str(rule))
-                    if rule_str == line:
-                        remove_rules.remove(rule)
-                        return False
+                if rules_to_remove[line] > 0:
+                    rules_to_remove[line] -= 1
+                    return False
 
             # Leave it alone
             return True
@@ -614,8 +868,7 @@ class IptablesManager(object):
 
         # flush lists, just in case we didn't find something
         remove_chains.clear()
-        for rule in remove_rules:
-            remove_rules.remove(rule)
+        del remove_rules[:]
 
         return new_filter
 
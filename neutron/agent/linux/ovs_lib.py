@@ -13,9 +13,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import itertools
+import operator
+import re
+import threading
+
 from oslo.config import cfg
 
 from neutron.agent.linux import ip_lib
+from neutron.agent.linux import ovsdb_native
 from neutron.agent.linux import utils
 from neutron.common import exceptions
 from neutron.common import utils as common_utils
@@ -32,11 +39,28 @@ OPTS = [
     cfg.IntOpt('ovs_vsctl_timeout',
                default=DEFAULT_OVS_VSCTL_TIMEOUT,
                help=_('Timeout in seconds for ovs-vsctl commands')),
+    cfg.StrOpt('ovsdb_interface',
+               default='vsctl', choices=['vsctl', 'native'],
+               help=_('The interface to the OVSDB: vsctl forks ovs-vsctl '
+                      'for each command, native keeps a connection to '
+                      'ovsdb-server and a replica of the Bridge, Port and '
+                      'Interface tables')),
+    cfg.StrOpt('ovsdb_connection',
+               default='tcp:127.0.0.1:6640',
+               help=_('The connection to ovsdb-server used by the native '
+                      'interface, as tcp:IP:PORT or unix:PATH')),
 ]
 cfg.CONF.register_opts(OPTS)
 
 LOG = logging.getLogger(__name__)
 
+# The ovs-ofctl commands of the flow actions, when they are applied one by
+# one and in an atomic bundle
+OFCTL_COMMANDS = {'add': 'add-flow', 'mod': 'mod-flows', 'del': 'del-flows'}
+BUNDLE_COMMANDS = {'add': 'add', 'mod': 'modify', 'del': 'delete'}
+COOKIE_RE = re.compile(r'^\s*cookie=(0x[0-9a-fA-F]+)', re.MULTILINE)
+OFPORT_RE = re.compile(r'(?:in_port=|output:)(\d+)')
+
 
 class VifPort:
     def __init__(self, port_name, ofport, vif_id, vif_mac, switch):
@@ -58,6 +82,11 @@ class BaseOVS(object):
     def __init__(self, root_helper):
         self.root_helper = root_helper
         self.vsctl_timeout = cfg.CONF.ovs_vsctl_timeout
+        if cfg.CONF.ovsdb_interface == 'native':
+            self.ovsdb = ovsdb_native.get_idl(cfg.CONF.ovsdb_connection,
+                                              self.vsctl_timeout)
+        else:
+            self.ovsdb = None
 
     def run_vsctl(self, args, check_error=False):
         full_args = ["ovs-vsctl", "--timeout=%d" % self.vsctl_timeout] + args
@@ -71,6 +100,27 @@ class BaseOVS(object):
                 if not check_error:
                     ctxt.reraise = False
 
+    def _run_ovsdb(self, method, *args, **kwargs):
+        check_error = kwargs.pop('check_error', False)
+        try:
+            return getattr(self.ovsdb, method)(*args)
+        except ovsdb_native.OvsdbError as e:
+            with excutils.save_and_reraise_exception() as ctxt:
+                LOG.error(_("Unable to run OVSDB %(method)s %(args)s. "
+                            "Exception: %(exception)s"),
+                          {'method': method, 'args': args, 'exception': e})
+                if not check_error:
+                    ctxt.reraise = False
+
+    @contextlib.contextmanager
+    def db_transaction(self):
+        """Batch the OVSDB changes made in the block, with native OVSDB."""
+        if self.ovsdb:
+            with self.ovsdb.transaction():
+                yield
+        else:
+            yield
+
     def add_bridge(self, bridge_name):
         self.run_vsctl(["--", "--may-exist", "add-br", bridge_name])
         return OVSBridge(bridge_name, self.root_helper)
@@ -105,7 +155,12 @@ class OVSBridge(BaseOVS):
         super(OVSBridge, self).__init__(root_helper)
         self.br_name = br_name
         self.defer_apply_flows = False
-        self.deferred_flows = {'add': '', 'mod': '', 'del': ''}
+        self.deferred_flows = []
+        # The flow changes deferred by the flow transaction of the current
+        # greenthread, if it has one
+        self._transaction = threading.local()
+        # The cookie of the flows added and modified, if not given
+        self.default_cookie = None
 
     def set_controller(self, controller_names):
         vsctl_command = ['--', 'set-controller', self.br_name]
@@ -151,22 +206,42 @@ class OVSBridge(BaseOVS):
         self.run_vsctl(["--", "--if-exists", "del-port", self.br_name,
                         port_name])
 
+    def _transact_or_vsctl(self, operation, args):
+        # The native OVSDB interface only knows the operations on the
+        # columns of its schema, the others are run by ovs-vsctl
+        if operation:
+            self._run_ovsdb('transact', [operation])
+        else:
+            self.run_vsctl(args)
+
     def set_db_attribute(self, table_name, record, column, value):
         args = ["set", table_name, record, "%s=%s" % (column, value)]
-        self.run_vsctl(args)
+        operation = None
+        if self.ovsdb:
+            operation = self._run_ovsdb('get_set_operation', table_name,
+                                        record, column, str(value))
+        self._transact_or_vsctl(operation, args)
 
     def clear_db_attribute(self, table_name, record, column):
         args = ["clear", table_name, record, column]
-        self.run_vsctl(args)
+        operation = None
+        if self.ovsdb:
+            operation = self._run_ovsdb('get_clear_operation', table_name,
+                                        record, column)
+        self._transact_or_vsctl(operation, args)
 
-    def run_ofctl(self, cmd, args, process_input=None):
+    def run_ofctl(self, cmd, args, process_input=None, check_error=False):
         full_args = ["ovs-ofctl", cmd, self.br_name] + args
         try:
             return utils.execute(full_args, root_helper=self.root_helper,
                                  process_input=process_input)
         except Exception as e:
-            LOG.error(_("Unable to execute %(cmd)s. Exception: %(exception)s"),
-                      {'cmd': full_args, 'exception': e})
+            with excutils.save_and_reraise_exception() as ctxt:
+                LOG.error(_("Unable to execute %(cmd)s. "
+                            "Exception: %(exception)s"),
+                          {'cmd': full_args, 'exception': e})
+                if not check_error:
+                    ctxt.reraise = False
 
     def count_flows(self):
         flow_list = self.run_ofctl("dump-flows", []).split("\n")[1:]
@@ -189,26 +264,30 @@ class OVSBridge(BaseOVS):
         return self.db_get_val('Bridge',
                                self.br_name, 'datapath_id').strip('"')
 
-    def add_flow(self, **kwargs):
-        flow_str = _build_flow_expr_str(kwargs, 'add')
-        if self.defer_apply_flows:
-            self.deferred_flows['add'] += flow_str + '\n'
+    def _apply_flow(self, action, flow_str):
+        transaction_flows = getattr(self._transaction, 'flows', None)
+        if transaction_flows is not None:
+            transaction_flows.append((action, flow_str))
+        elif self.defer_apply_flows:
+            self.deferred_flows.append((action, flow_str))
         else:
-            self.run_ofctl("add-flow", [flow_str])
+            self.run_ofctl(OFCTL_COMMANDS[action], [flow_str])
+
+    def _set_default_cookie(self, flow_dict):
+        if self.default_cookie is not None and 'cookie' not in flow_dict:
+            flow_dict['cookie'] = '%#x' % self.default_cookie
+
+    def add_flow(self, **kwargs):
+        self._set_default_cookie(kwargs)
+        self._apply_flow('add', _build_flow_expr_str(kwargs, 'add'))
 
     def mod_flow(self, **kwargs):
-        flow_str = _build_flow_expr_str(kwargs, 'mod')
-        if self.defer_apply_flows:
-            self.deferred_flows['mod'] += flow_str + '\n'
-        else:
-            self.run_ofctl("mod-flows", [flow_str])
+        # A cookie without mask is the new cookie of the modified flows
+        self._set_default_cookie(kwargs)
+        self._apply_flow('mod', _build_flow_expr_str(kwargs, 'mod'))
 
     def delete_flows(self, **kwargs):
-        flow_expr_str = _build_flow_expr_str(kwargs, 'del')
-        if self.defer_apply_flows:
-            self.deferred_flows['del'] += flow_expr_str + '\n'
-        else:
-            self.run_ofctl("del-flows", [flow_expr_str])
+        self._apply_flow('del', _build_flow_expr_str(kwargs, 'del'))
 
     def dump_flows_for_table(self, table):
         retval = None
@@ -219,27 +298,97 @@ class OVSBridge(BaseOVS):
                                if 'NXST' not in item)
         return retval
 
+    def get_flow_cookies(self):
+        """Return the set of the cookies of the flows of the bridge."""
+        flows = self.run_ofctl("dump-flows", [])
+        if not flows:
+            return set()
+        return set(int(match, 16) for match in COOKIE_RE.findall(flows))
+
+    def get_flow_ofports(self):
+        """Return the set of the ofports matched or output by the flows."""
+        flows = self.run_ofctl("dump-flows", [])
+        if not flows:
+            return set()
+        return set(OFPORT_RE.findall(flows))
+
+    def delete_stale_flows(self):
+        """Delete the flows whose cookie isn't the default cookie.
+
+        The flows left over by a previous run of an agent can be kept
+        forwarding while the agent adds its flows with a new default
+        cookie, and be deleted afterwards.
+        """
+        stale_cookies = self.get_flow_cookies() - set([self.default_cookie])
+        for cookie in stale_cookies:
+            LOG.debug(_("Deleting the flows of cookie %(cookie)#x from "
+                        "bridge %(bridge)s"),
+                      {'cookie': cookie, 'bridge': self.br_name})
+            self.delete_flows(cookie='%#x/-1' % cookie)
+
     def defer_apply_on(self):
         LOG.debug(_('defer_apply_on'))
         self.defer_apply_flows = True
 
-    def defer_apply_off(self):
+    def defer_apply_off(self, atomic=False):
         LOG.debug(_('defer_apply_off'))
         # Note(ethuleau): stash flows and disable deferred mode. Then apply
         # flows from the stashed reference to be sure to not purge flows that
         # were added between two ofctl commands.
-        stashed_deferred_flows, self.deferred_flows = (
-            self.deferred_flows, {'add': '', 'mod': '', 'del': ''}
-        )
+        stashed_deferred_flows, self.deferred_flows = self.deferred_flows, []
         self.defer_apply_flows = False
-        for action, flows in stashed_deferred_flows.items():
-            if flows:
-                LOG.debug(_('Applying following deferred flows '
-                            'to bridge %s'), self.br_name)
-                for line in flows.splitlines():
-                    LOG.debug(_('%(action)s: %(flow)s'),
-                              {'action': action, 'flow': line})
-                self.run_ofctl('%s-flows' % action, ['-'], flows)
+        self._apply_deferred_flows(stashed_deferred_flows, atomic)
+
+    def _apply_deferred_flows(self, deferred_flows, atomic):
+        """Apply deferred flow changes, raising if they can't be applied.
+
+        A batch which fails loses all its changes, the flows must then be
+        programmed again.
+        """
+        if not deferred_flows:
+            return
+        LOG.debug(_('Applying following deferred flows '
+                    'to bridge %s'), self.br_name)
+        for action, flow in deferred_flows:
+            LOG.debug(_('%(action)s: %(flow)s'),
+                      {'action': action, 'flow': flow})
+        if atomic:
+            flows = ''.join('%s %s\n' % (BUNDLE_COMMANDS[action], flow)
+                            for action, flow in deferred_flows)
+            self.run_ofctl('add-flows', ['--bundle', '-'], flows,
+                           check_error=True)
+            return
+        # The consecutive flows of an action are applied together, in the
+        # order they were deferred
+        for action, group in itertools.groupby(deferred_flows,
+                                               operator.itemgetter(0)):
+            flows = ''.join('%s\n' % flow for _action, flow in group)
+            self.run_ofctl('%s-flows' % action, ['-'], flows,
+                           check_error=True)
+
+    @contextlib.contextmanager
+    def flow_transaction(self, atomic=False):
+        """Defer the flow changes made in the block, and apply them at once.
+
+        The changes are applied in order, with one ovs-ofctl call for each
+        run of consecutive changes of the same kind. With atomic, they are
+        applied by a single call in an OpenFlow 1.4 bundle, which needs Open
+        vSwitch 2.4 or later and OpenFlow14 in the protocols of the bridge.
+        A transaction nested in another one of the same greenthread is
+        applied with the outer one, the changes made by other greenthreads
+        meanwhile are not part of it. Exiting the block raises if the
+        changes can't be applied.
+        """
+        if getattr(self._transaction, 'flows', None) is not None:
+            yield
+            return
+        self._transaction.flows = []
+        try:
+            yield
+        finally:
+            deferred_flows, self._transaction.flows = (
+                self._transaction.flows, None)
+            self._apply_deferred_flows(deferred_flows, atomic)
 
     def add_tunnel_port(self, port_name, remote_ip, local_ip,
                         tunnel_type=p_const.TYPE_GRE,
@@ -269,8 +418,8 @@ class OVSBridge(BaseOVS):
         return ofport
 
     def add_patch_port(self, local_name, remote_name):
-        self.run_vsctl(["add-port", self.br_name, local_name,
-                        "--", "set", "Interface", local_name,
+        self.run_vsctl(["--", "--may-exist", "add-port", self.br_name,
+                        local_name, "--", "set", "Interface", local_name,
                         "type=patch", "options:peer=%s" % remote_name])
         return self.get_port_ofport(local_name)
 
@@ -282,6 +431,19 @@ class OVSBridge(BaseOVS):
         return {}
 
     def db_get_val(self, table, record, column, check_error=False):
+        if self.ovsdb:
+            try:
+                value = self._run_ovsdb('get_value', table, record, column,
+                                        check_error=check_error)
+            except KeyError:
+                # not replicated, let ovs-vsctl report the error if any
+                pass
+            else:
+                # format the values as ovs-vsctl does
+                if isinstance(value, (int, long)):
+                    return str(value)
+                if value == []:
+                    return '[]'
         output = self.run_vsctl(["get", table, record, column], check_error)
         if output:
             return output.rstrip("\n\r")
@@ -297,6 +459,9 @@ class OVSBridge(BaseOVS):
         return ret
 
     def get_port_name_list(self):
+        if self.ovsdb:
+            return sorted(port['name'] for port in self._run_ovsdb(
+                'get_bridge_ports', self.br_name, check_error=True))
         res = self.run_vsctl(["list-ports", self.br_name], check_error=True)
         if res:
             return res.strip().split("\n")
@@ -318,13 +483,22 @@ class OVSBridge(BaseOVS):
 
     # returns a VIF object for each VIF port
     def get_vif_ports(self):
+        if self.ovsdb:
+            interfaces = [(row['name'], row['external_ids'], row['ofport'])
+                          for row in self._run_ovsdb('get_bridge_interfaces',
+                                                     self.br_name,
+                                                     check_error=True)]
+        else:
+            interfaces = []
+            for name in self.get_port_name_list():
+                external_ids = self.db_get_map("Interface", name,
+                                               "external_ids",
+                                               check_error=True)
+                ofport = self.db_get_val("Interface", name, "ofport",
+                                         check_error=True)
+                interfaces.append((name, external_ids, ofport))
         edge_ports = []
-        port_names = self.get_port_name_list()
-        for name in port_names:
-            external_ids = self.db_get_map("Interface", name, "external_ids",
-                                           check_error=True)
-            ofport = self.db_get_val("Interface", name, "ofport",
-                                     check_error=True)
+        for name, external_ids, ofport in interfaces:
             if "iface-id" in external_ids and "attached-mac" in external_ids:
                 p = VifPort(name, ofport, external_ids["iface-id"],
                             external_ids["attached-mac"], self)
@@ -340,23 +514,34 @@ class OVSBridge(BaseOVS):
 
         return edge_ports
 
-    def get_vif_port_set(self):
-        port_names = self.get_port_name_list()
-        edge_ports = set()
+    def _get_interfaces(self):
+        """Return (name, external_ids, ofport) of the bridge interfaces."""
+        if self.ovsdb:
+            interfaces = self._run_ovsdb('get_bridge_interfaces',
+                                         self.br_name, check_error=True)
+            return [(row['name'], row['external_ids'], row['ofport'])
+                    for row in interfaces]
+        port_names = set(self.get_port_name_list())
         args = ['--format=json', '--', '--columns=name,external_ids,ofport',
                 'list', 'Interface']
         result = self.run_vsctl(args, check_error=True)
         if not result:
-            return edge_ports
-        for row in jsonutils.loads(result)['data']:
-            name = row[0]
-            if name not in port_names:
-                continue
-            external_ids = dict(row[1][1])
+            return []
+        rows = jsonutils.loads(result)['data']
+        return [(name, dict(external_ids[1]), ofport)
+                for name, external_ids, ofport in rows if name in port_names]
+
+    def get_vif_port_set(self):
+        return self._get_vif_port_ids(self._get_interfaces())
+
+    def _get_vif_port_ids(self, interfaces):
+        """Return the ids of the VIFs of (name, external_ids, ofport)."""
+        edge_ports = set()
+        for row in interfaces:
+            name, external_ids, ofport = row
             # Do not consider VIFs which aren't yet ready
             # This can happen when ofport values are either [] or ["set", []]
             # We will therefore consider only integer values for ofport
-            ofport = row[2]
             try:
                 int_ofport = int(ofport)
             except (ValueError, TypeError):
@@ -393,6 +578,10 @@ class OVSBridge(BaseOVS):
         in the "Interface" table queried by the get_vif_port_set() method.
 
         """
+        if self.ovsdb:
+            ports = self._run_ovsdb('get_bridge_ports', self.br_name,
+                                    check_error=True)
+            return dict((port['name'], port['tag']) for port in ports)
         port_names = self.get_port_name_list()
         args = ['--format=json', '--', '--columns=name,tag', 'list', 'Port']
         result = self.run_vsctl(args, check_error=True)
@@ -409,6 +598,8 @@ class OVSBridge(BaseOVS):
         return port_tag_dict
 
     def get_vif_port_by_id(self, port_id):
+        if self.ovsdb:
+            return self._get_vif_port_by_id_native(port_id)
         args = ['--format=json', '--', '--columns=external_ids,name,ofport',
                 'find', 'Interface',
                 'external_ids:iface-id="%s"' % port_id]
@@ -451,6 +642,59 @@ class OVSBridge(BaseOVS):
             LOG.warn(_("Unable to parse interface details. Exception: %s"), e)
             return
 
+    def _get_vif_port_by_id_native(self, port_id):
+        row = self._run_ovsdb('find_interface', 'external_ids', 'iface-id',
+                              port_id)
+        if not row:
+            return
+        port_name = row['name']
+        switch = self._run_ovsdb('get_bridge_name_for_interface', port_name)
+        if switch != self.br_name:
+            LOG.info(_("Port: %(port_name)s is on %(switch)s,"
+                       " not on %(br_name)s"), {'port_name': port_name,
+                                                'switch': switch,
+                                                'br_name': self.br_name})
+            return
+        ofport = row['ofport']
+        # ofport must be integer otherwise return None
+        if not isinstance(ofport, int) or ofport == -1:
+            LOG.warn(_("ofport: %(ofport)s for VIF: %(vif)s is not a "
+                       "positive integer"), {'ofport': ofport,
+                                             'vif': port_id})
+            return
+        vif_mac = row['external_ids'].get('attached-mac')
+        if not vif_mac:
+            LOG.warn(_("Unable to parse interface details. No attached-mac "
+                       "for VIF: %s"), port_id)
+            return
+        return VifPort(port_name, ofport, port_id, vif_mac, self)
+
+    def get_vif_ports_by_ids(self, port_ids):
+        """Return a dict of the VifPorts of port_ids, by port id.
+
+        The ports which aren't on the bridge or aren't ready are left out.
+        Unlike get_vif_port_by_id, a single listing of the interfaces is
+        needed for all the ports.
+        """
+        port_ids = set(port_ids)
+        vif_ports = {}
+        for name, external_ids, ofport in self._get_interfaces():
+            port_id = external_ids.get('iface-id')
+            if port_id not in port_ids:
+                continue
+            # ofport must be integer otherwise the port is left out
+            if not isinstance(ofport, int) or ofport == -1:
+                LOG.warn(_("ofport: %(ofport)s for VIF: %(vif)s is not a "
+                           "positive integer"), {'ofport': ofport,
+                                                 'vif': port_id})
+                continue
+            if 'attached-mac' not in external_ids:
+                LOG.warn(_("No attached-mac for VIF: %s"), port_id)
+                continue
+            vif_ports[port_id] = VifPort(name, ofport, port_id,
+                                         external_ids['attached-mac'], self)
+        return vif_ports
+
     def delete_ports(self, all_ports=False):
         if all_ports:
             port_names = self.get_port_name_list()
@@ -0,0 +1,399 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Native OVSDB backend, talking the OVSDB JSON-RPC protocol (RFC 7047).
+
+The backend keeps a single connection to ovsdb-server per process, and a
+replica of the Bridge, Port and Interface tables which is kept up to date
+by the monitor updates sent by the server, so that reading them doesn't
+fork ovs-vsctl. The connection is shared by the greenthreads of the
+process, its calls are serialized.
+"""
+
+import contextlib
+import itertools
+import json
+import socket
+import threading
+
+from neutron.common import exceptions
+from neutron.openstack.common import excutils
+from neutron.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+DATABASE = 'Open_vSwitch'
+# The replicated tables and their columns
+MONITORED_TABLES = {
+    'Bridge': ['name', 'ports'],
+    'Port': ['name', 'interfaces', 'tag'],
+    'Interface': ['name', 'ofport', 'external_ids'],
+}
+# The column types whose values can be parsed from ovs-vsctl strings
+PARSERS = {
+    'integer': int,
+    'real': float,
+    'boolean': lambda value: value == 'true',
+    'string': lambda value: value.strip('"'),
+}
+RECV_SIZE = 65536
+
+_idls = {}
+
+
+class OvsdbError(exceptions.NeutronException):
+    message = _("OVSDB %(method)s failed: %(error)s")
+
+
+def from_json(value):
+    """Convert a value of the OVSDB JSON notation to a Python value.
+
+    Sets are converted to lists, maps to dicts and uuids to strings.
+    """
+    if isinstance(value, list) and len(value) == 2:
+        kind, data = value
+        if kind == 'set':
+            return [from_json(item) for item in data]
+        if kind == 'map':
+            return dict((from_json(key), from_json(item))
+                        for key, item in data)
+        if kind in ('uuid', 'named-uuid'):
+            return data
+    return value
+
+
+def as_list(value):
+    """Return the members of a set column, which may hold a single atom."""
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+class Connection(object):
+    """A JSON-RPC connection to ovsdb-server.
+
+    The calls are synchronous, and aren't serialized: the caller has to
+    prevent concurrent calls. The notifications received while waiting for
+    a reply are passed to the notify callback, and the echo requests of the
+    server are replied to.
+    """
+
+    def __init__(self, connection, timeout, notify):
+        self.connection = connection
+        self.timeout = timeout
+        self.notify = notify
+        self._socket = None
+        self._buffer = ''
+        self._ids = itertools.count()
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    def connect(self):
+        kind, _sep, address = self.connection.partition(':')
+        if kind == 'tcp':
+            host, _sep, port = address.rpartition(':')
+            sock = socket.create_connection((host, int(port)), self.timeout)
+        elif kind == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(address)
+        else:
+            raise OvsdbError(method='connect',
+                             error=_('Invalid connection %s') %
+                             self.connection)
+        self.connect_socket(sock)
+
+    def connect_socket(self, sock):
+        """Use an already connected socket."""
+        sock.settimeout(self.timeout)
+        self._socket = sock
+        self._buffer = ''
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, message):
+        self._socket.sendall(json.dumps(message))
+
+    def _receive(self):
+        """Return the next message received."""
+        decoder = json.JSONDecoder()
+        while True:
+            data = self._buffer.lstrip()
+            if data:
+                try:
+                    message, end = decoder.raw_decode(data)
+                except ValueError:
+                    # the message isn't complete yet
+                    pass
+                else:
+                    self._buffer = data[end:]
+                    return message
+            received = self._socket.recv(RECV_SIZE)
+            if not received:
+                raise socket.error(_('Connection closed by ovsdb-server'))
+            self._buffer = data + received
+
+    def call(self, method, params):
+        """Call a method of the server, and return its result."""
+        request_id = next(self._ids)
+        try:
+            self._send({'method': method, 'params': params,
+                        'id': request_id})
+            while True:
+                message = self._receive()
+                if message.get('id') == request_id and 'method' not in message:
+                    break
+                self._handle_request(message)
+        except (socket.error, socket.timeout, ValueError) as e:
+            self.close()
+            raise OvsdbError(method=method, error=e)
+        if message.get('error'):
+            raise OvsdbError(method=method, error=message['error'])
+        return message['result']
+
+    def _handle_request(self, message):
+        method = message.get('method')
+        if method == 'echo':
+            self._send({'result': message['params'], 'error': None,
+                        'id': message['id']})
+        elif method == 'update':
+            self.notify(*message['params'])
+        elif method:
+            LOG.debug(_('Ignoring OVSDB request %s'), method)
+
+
+class OvsdbIdl(object):
+    """A replica of the Bridge, Port and Interface tables of the OVSDB.
+
+    The replica is brought up to date before being read, by an echo round
+    trip to the server which receives the pending monitor updates. The
+    changes are sent as transactions, and can be batched with transaction().
+    """
+
+    def __init__(self, connection, timeout):
+        self.connection = Connection(connection, timeout, self._update)
+        self.schema = None
+        self.tables = {}
+        self._lock = threading.Lock()
+        self._transaction = threading.local()
+
+    def _call(self, method, params):
+        """Call a method of the server, connecting to it if needed.
+
+        The replica is reloaded and monitored again on every connection,
+        the updates sent while disconnected being lost.
+        """
+        with self._lock:
+            if not self.connection.connected:
+                try:
+                    self.connection.connect()
+                except (socket.error, socket.timeout) as e:
+                    self.connection.close()
+                    raise OvsdbError(method='connect', error=e)
+                try:
+                    self._start()
+                except Exception:
+                    with excutils.save_and_reraise_exception():
+                        self.connection.close()
+            return self.connection.call(method, params)
+
+    def _start(self):
+        self.schema = self.connection.call('get_schema', [DATABASE])['tables']
+        requests = dict((table, {'columns': columns})
+                        for table, columns in MONITORED_TABLES.iteritems())
+        self.tables = dict((table, {}) for table in MONITORED_TABLES)
+        self._apply_updates(self.connection.call(
+            'monitor', [DATABASE, None, requests]))
+
+    def _update(self, monitor_id, updates):
+        self._apply_updates(updates)
+
+    def _apply_updates(self, updates):
+        for table, rows in updates.iteritems():
+            table_rows = self.tables.setdefault(table, {})
+            for uuid, row in rows.iteritems():
+                if row.get('new') is None:
+                    table_rows.pop(uuid, None)
+                else:
+                    table_rows[uuid] = dict(
+                        (column, from_json(value))
+                        for column, value in row['new'].iteritems())
+
+    def refresh(self):
+        """Bring the replica up to date."""
+        self._call('echo', [])
+
+    def _get_rows_by_name(self, table):
+        return dict((row['name'], row)
+                    for row in self.tables[table].itervalues())
+
+    def get_bridge_ports(self, br_name):
+        """Return the Port rows of a bridge, but its local port."""
+        self.refresh()
+        for bridge in self.tables['Bridge'].itervalues():
+            if bridge['name'] == br_name:
+                ports = self.tables['Port']
+                return [ports[uuid] for uuid in as_list(bridge['ports'])
+                        if uuid in ports and ports[uuid]['name'] != br_name]
+        return []
+
+    def get_bridge_interfaces(self, br_name):
+        """Return the Interface rows of the ports of a bridge."""
+        ports = self.get_bridge_ports(br_name)
+        interfaces = self.tables['Interface']
+        return [interfaces[uuid]
+                for port in ports
+                for uuid in as_list(port['interfaces'])
+                if uuid in interfaces]
+
+    def get_bridge_name_for_interface(self, name):
+        """Return the name of the bridge of an interface."""
+        self.refresh()
+        interface_uuids = set(uuid for uuid, row in
+                              self.tables['Interface'].iteritems()
+                              if row['name'] == name)
+        port_uuids = set(uuid for uuid, row in self.tables['Port'].iteritems()
+                         if interface_uuids & set(as_list(row['interfaces'])))
+        for bridge in self.tables['Bridge'].itervalues():
+            if port_uuids & set(as_list(bridge['ports'])):
+                return bridge['name']
+
+    def find_interface(self, column, key, value):
+        """Return the Interface row whose map column has key set to value."""
+        self.refresh()
+        for row in self.tables['Interface'].itervalues():
+            if row[column].get(key) == value:
+                return row
+
+    def get_value(self, table, name, column):
+        """Return the value of a replicated column of a record.
+
+        KeyError is raised if the column isn't replicated or the record is
+        not found.
+        """
+        if column not in MONITORED_TABLES.get(table, ()):
+            raise KeyError(column)
+        self.refresh()
+        return self._get_rows_by_name(table)[name][column]
+
+    def _get_column_type(self, table, column):
+        if not self.schema:
+            self.refresh()
+        column_type = self.schema[table]['columns'][column]['type']
+        if not isinstance(column_type, dict):
+            column_type = {'key': column_type}
+        return column_type
+
+    def _parse_atom(self, atom_type, value):
+        if isinstance(atom_type, dict):
+            atom_type = atom_type['type']
+        return PARSERS[atom_type](value)
+
+    def get_set_operation(self, table, name, column, value):
+        """Return the operation setting a column to an ovs-vsctl string.
+
+        Only atomic values, optional atomic values and map keys can be set.
+        None is returned for the other columns.
+        """
+        column, _sep, key = column.partition(':')
+        try:
+            column_type = self._get_column_type(table, column)
+            where = [['name', '==', name]]
+            if key:
+                if 'value' not in column_type:
+                    return
+                return {'op': 'mutate', 'table': table, 'where': where,
+                        'mutations': [
+                            [column, 'delete', ['set', [key]]],
+                            [column, 'insert', ['map', [[key, self._parse_atom(
+                                column_type['value'], value)]]]]]}
+            if 'value' in column_type or column_type.get('max', 1) != 1:
+                return
+            if value == '[]' and column_type.get('min', 1) == 0:
+                parsed = ['set', []]
+            else:
+                parsed = self._parse_atom(column_type['key'], value)
+        except (KeyError, ValueError):
+            return
+        return {'op': 'update', 'table': table, 'where': where,
+                'row': {column: parsed}}
+
+    def get_clear_operation(self, table, name, column):
+        """Return the operation clearing a set or map column.
+
+        None is returned for the columns which can't be empty.
+        """
+        try:
+            column_type = self._get_column_type(table, column)
+        except KeyError:
+            return
+        if 'value' in column_type:
+            empty = ['map', []]
+        elif column_type.get('min', 1) == 0:
+            empty = ['set', []]
+        else:
+            return
+        return {'op': 'update', 'table': table,
+                'where': [['name', '==', name]], 'row': {column: empty}}
+
+    def transact(self, operations):
+        """Run operations as a transaction, or queue them in a batch."""
+        pending_operations = getattr(self._transaction, 'operations', None)
+        if pending_operations is not None:
+            pending_operations.extend(operations)
+            return
+        if not operations:
+            return
+        results = self._call('transact', [DATABASE] + operations)
+        errors = [result for result in results
+                  if result and result.get('error')]
+        if errors:
+            raise OvsdbError(method='transact', error=errors)
+        for operation, result in zip(operations, results):
+            if operation['op'] in ('update', 'mutate') and not result.get(
+                    'count'):
+                LOG.error(_('No %(table)s record matches %(where)s'),
+                          {'table': operation['table'],
+                           'where': operation['where']})
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Batch the operations run in the block into a transaction.
+
+        The batch is local to the calling greenthread, the operations run by
+        the others aren't added to it.
+        """
+        if getattr(self._transaction, 'operations', None) is not None:
+            # nested in another batch
+            yield
+            return
+        self._transaction.operations = []
+        try:
+            yield
+            operations = self._transaction.operations
+        finally:
+            self._transaction.operations = None
+        self.transact(operations)
+
+
+def get_idl(connection, timeout):
+    """Return the replica of the OVSDB reached through connection."""
+    if connection not in _idls:
+        _idls[connection] = OvsdbIdl(connection, timeout)
+    return _idls[connection]
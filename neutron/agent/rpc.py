@@ -100,7 +100,9 @@ class PluginApi(n_rpc.RpcProxy):
                                           devices=devices,
                                           agent_id=agent_id),
                             topic=self.topic, version='1.2')
-        except messaging.UnsupportedVersion:
+        except (messaging.UnsupportedVersion, n_rpc.RemoteError) as e:
+            if not n_rpc.is_unsupported_version(e):
+                raise
             res = [
                 self.call(context,
                           self.make_msg('get_device_details', device=device,
@@ -122,6 +124,31 @@ class PluginApi(n_rpc.RpcProxy):
                                        agent_id=agent_id, host=host),
                          topic=self.topic)
 
+    def update_devices_down(self, context, devices, agent_id, host=None):
+        try:
+            return self.call(context,
+                             self.make_msg('update_devices_down',
+                                           devices=devices,
+                                           agent_id=agent_id, host=host),
+                             topic=self.topic, version='1.4')
+        except (messaging.UnsupportedVersion, n_rpc.RemoteError) as e:
+            if not n_rpc.is_unsupported_version(e):
+                raise
+            return [self.update_device_down(context, device, agent_id, host)
+                    for device in devices]
+
+    def update_devices_up(self, context, devices, agent_id, host=None):
+        try:
+            self.call(context,
+                      self.make_msg('update_devices_up', devices=devices,
+                                    agent_id=agent_id, host=host),
+                      topic=self.topic, version='1.4')
+        except (messaging.UnsupportedVersion, n_rpc.RemoteError) as e:
+            if not n_rpc.is_unsupported_version(e):
+                raise
+            for device in devices:
+                self.update_device_up(context, device, agent_id, host)
+
     def tunnel_sync(self, context, tunnel_ip, tunnel_type=None):
         return self.call(context,
                          self.make_msg('tunnel_sync', tunnel_ip=tunnel_ip,
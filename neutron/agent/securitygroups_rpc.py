@@ -14,14 +14,20 @@
 #    under the License.
 #
 
+import netaddr
 from oslo.config import cfg
+from oslo import messaging
 
+from neutron.common import rpc as n_rpc
 from neutron.common import topics
 from neutron.openstack.common import importutils
 from neutron.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
 SG_RPC_VERSION = "1.1"
+SG_INFO_RPC_VERSION = "1.3"
+DIRECTION_IP_PREFIX = {'ingress': 'source_ip_prefix',
+                       'egress': 'dest_ip_prefix'}
 
 security_group_opts = [
     cfg.StrOpt(
@@ -33,7 +39,13 @@ security_group_opts = [
         help=_(
             'Controls whether the neutron security group API is enabled '
             'in the server. It should be false when using no security '
-            'groups or using the nova security group API.'))
+            'groups or using the nova security group API.')),
+    cfg.BoolOpt(
+        'enable_ipset',
+        default=True,
+        help=_('Use ipset to match the members of the remote security '
+               'groups in the iptables firewall drivers, instead of a rule '
+               'per member ip.'))
 ]
 cfg.CONF.register_opts(security_group_opts, 'SECURITYGROUP')
 
@@ -83,6 +95,15 @@ class SecurityGroupServerRpcApiMixin(object):
                          version=SG_RPC_VERSION,
                          topic=self.topic)
 
+    def security_group_info_for_devices(self, context, devices):
+        LOG.debug(_("Get security group information "
+                    "for devices via rpc %r"), devices)
+        return self.call(context,
+                         self.make_msg('security_group_info_for_devices',
+                                       devices=devices),
+                         version=SG_INFO_RPC_VERSION,
+                         topic=self.topic)
+
 
 class SecurityGroupAgentRpcCallbackMixin(object):
     """A mix-in that enable SecurityGroup agent
@@ -148,19 +169,93 @@ class SecurityGroupAgentRpcMixin(object):
         # Stores devices for which firewall should be refreshed when
         # deferred refresh is enabled.
         self.devices_to_refilter = set()
+        # Stores the security groups whose members should be updated when
+        # deferred refresh is enabled.
+        self.sg_members_to_update = set()
         # Flag raised when a global refresh is needed
         self.global_refresh_firewall = False
+        # Cleared when the server does not support the security group
+        # information RPC, the expanded rules are requested instead
+        self.use_enhanced_rpc = True
 
     def prepare_devices_filter(self, device_ids):
         if not device_ids:
             return
         LOG.info(_("Preparing filters for devices %s"), device_ids)
-        devices = self.plugin_rpc.security_group_rules_for_devices(
-            self.context, list(device_ids))
+        devices = self._get_devices_with_rules(list(device_ids))
         with self.firewall.defer_apply():
             for device in devices.values():
                 self.firewall.prepare_port_filter(device)
 
+    def _get_security_group_info(self, device_ids):
+        """Return the security group information of the devices.
+
+        None is returned if the server does not support the RPC.
+        """
+        if not self.use_enhanced_rpc:
+            return
+        try:
+            return self.plugin_rpc.security_group_info_for_devices(
+                self.context, device_ids)
+        except (messaging.UnsupportedVersion, n_rpc.RemoteError) as e:
+            if not n_rpc.is_unsupported_version(e):
+                raise
+            LOG.warning(_("Security group information RPC is not "
+                          "supported by the server, falling back to "
+                          "security_group_rules_for_devices"))
+            self.use_enhanced_rpc = False
+
+    def _get_devices_with_rules(self, device_ids):
+        """Return the devices with their security group rules."""
+        sg_info = self._get_security_group_info(device_ids)
+        if sg_info is not None:
+            return self._expand_security_group_rules(sg_info)
+        return self.plugin_rpc.security_group_rules_for_devices(
+            self.context, device_ids)
+
+    def _update_security_group_members(self, sg_info, sg_ids=None):
+        for sg_id, member_ips in sg_info['sg_member_ips'].items():
+            if sg_ids is None or sg_id in sg_ids:
+                self.firewall.update_security_group_members(sg_id,
+                                                            member_ips)
+
+    def _expand_security_group_rules(self, sg_info):
+        """Build the rules of the devices from their security groups.
+
+        Unless the firewall driver matches the remote groups itself, the
+        remote_group_id rules are converted to a rule per member ip of the
+        remote group, as security_group_rules_for_devices does on the
+        server side.
+        """
+        matches_remote_groups = self.firewall.matches_remote_groups
+        if matches_remote_groups:
+            self._update_security_group_members(sg_info)
+        devices = sg_info['devices']
+        for device in devices.values():
+            rules = []
+            fixed_ips = device.get('fixed_ips', [])
+            for sg_id in device.get('security_groups', []):
+                for rule in sg_info['security_groups'].get(sg_id, []):
+                    remote_group_id = rule.get('remote_group_id')
+                    if not remote_group_id or matches_remote_groups:
+                        rules.append(rule.copy())
+                        continue
+                    direction_ip_prefix = DIRECTION_IP_PREFIX[
+                        rule['direction']]
+                    member_ips = sg_info['sg_member_ips'].get(
+                        remote_group_id, {}).get(rule['ethertype'], [])
+                    for ip in member_ips:
+                        if ip in fixed_ips:
+                            continue
+                        ip_rule = rule.copy()
+                        ip_rule[direction_ip_prefix] = str(
+                            netaddr.IPNetwork(ip).cidr)
+                        rules.append(ip_rule)
+            # The provider rules sent with the device come last
+            device['security_group_rules'] = (
+                rules + device.get('security_group_rules', []))
+        return devices
+
     def security_groups_rule_updated(self, security_groups):
         LOG.info(_("Security group "
                    "rule updated %r"), security_groups)
@@ -171,16 +266,45 @@ class SecurityGroupAgentRpcMixin(object):
     def security_groups_member_updated(self, security_groups):
         LOG.info(_("Security group "
                    "member updated %r"), security_groups)
+        if self.use_enhanced_rpc and self.firewall.matches_remote_groups:
+            if self.defer_refresh_firewall:
+                LOG.debug(_("Adding %s security groups to the list of "
+                            "security groups whose members need to be "
+                            "updated"), security_groups)
+                self.sg_members_to_update |= set(security_groups)
+            else:
+                self._security_group_members_updated(security_groups)
+            return
         self._security_group_updated(
             security_groups,
             'security_group_source_groups')
 
-    def _security_group_updated(self, security_groups, attribute):
+    def _select_devices_for_security_groups(self, security_groups,
+                                            attribute):
         devices = []
         sec_grp_set = set(security_groups)
         for device in self.firewall.ports.values():
             if sec_grp_set & set(device.get(attribute, [])):
                 devices.append(device['device'])
+        return devices
+
+    def _security_group_members_updated(self, security_groups):
+        # Only the members matched by the firewall driver are updated, the
+        # rules of the devices are unchanged
+        devices = self._select_devices_for_security_groups(
+            security_groups, 'security_group_source_groups')
+        if not devices:
+            return
+        sg_info = self._get_security_group_info(devices)
+        if sg_info is None:
+            self._security_group_updated(security_groups,
+                                         'security_group_source_groups')
+            return
+        self._update_security_group_members(sg_info, set(security_groups))
+
+    def _security_group_updated(self, security_groups, attribute):
+        devices = self._select_devices_for_security_groups(security_groups,
+                                                           attribute)
         if devices:
             if self.defer_refresh_firewall:
                 LOG.debug(_("Adding %s devices to the list of devices "
@@ -218,15 +342,15 @@ class SecurityGroupAgentRpcMixin(object):
             if not device_ids:
                 LOG.info(_("No ports here to refresh firewall"))
                 return
-        devices = self.plugin_rpc.security_group_rules_for_devices(
-            self.context, device_ids)
+        devices = self._get_devices_with_rules(list(device_ids))
         with self.firewall.defer_apply():
             for device in devices.values():
                 LOG.debug(_("Update port filter for %s"), device['device'])
                 self.firewall.update_port_filter(device)
 
     def firewall_refresh_needed(self):
-        return self.global_refresh_firewall or self.devices_to_refilter
+        return (self.global_refresh_firewall or self.devices_to_refilter or
+                self.sg_members_to_update)
 
     def setup_port_filters(self, new_devices, updated_devices):
         """Configure port filters for devices.
@@ -247,8 +371,10 @@ class SecurityGroupAgentRpcMixin(object):
         # losing updates occurring during firewall refresh
         devices_to_refilter = self.devices_to_refilter
         global_refresh_firewall = self.global_refresh_firewall
+        sg_members_to_update = self.sg_members_to_update
         self.devices_to_refilter = set()
         self.global_refresh_firewall = False
+        self.sg_members_to_update = set()
         # TODO(salv-orlando): Avoid if possible ever performing the global
         # refresh providing a precise list of devices for which firewall
         # should be refreshed
@@ -264,6 +390,12 @@ class SecurityGroupAgentRpcMixin(object):
                 LOG.debug(_("Refreshing firewall for %d devices"),
                           len(updated_devices))
                 self.refresh_firewall(updated_devices)
+            # The members of all the security groups are updated by a
+            # global refresh
+            if sg_members_to_update:
+                LOG.debug(_("Updating the members of %d security groups"),
+                          len(sg_members_to_update))
+                self._security_group_members_updated(sg_members_to_update)
 
 
 class SecurityGroupAgentRpcApiMixin(object):
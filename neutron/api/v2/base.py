@@ -26,6 +26,8 @@ from neutron.api.v2 import resource as wsgi_resource
 from neutron.common import constants as const
 from neutron.common import exceptions
 from neutron.common import rpc as n_rpc
+from neutron import context as neutron_context
+from neutron.openstack.common import excutils
 from neutron.openstack.common import log as logging
 from neutron import policy
 from neutron import quota
@@ -133,19 +135,23 @@ class Controller(object):
         to see them.
         """
         attributes_to_exclude = []
+        visible_attributes = []
         for attr_name in data.keys():
             attr_data = self._attr_info.get(attr_name)
             if attr_data and attr_data['is_visible']:
-                if policy.check(
-                    context,
-                    '%s:%s' % (self._plugin_handlers[self.SHOW], attr_name),
-                    data,
-                    might_not_exist=True):
-                    # this attribute is visible, check next one
-                    continue
-            # if the code reaches this point then either the policy check
-            # failed or the attribute was not visible in the first place
-            attributes_to_exclude.append(attr_name)
+                visible_attributes.append(attr_name)
+            else:
+                attributes_to_exclude.append(attr_name)
+        # Check the policies of all the visible attributes at once
+        results = policy.check_many(
+            context,
+            ['%s:%s' % (self._plugin_handlers[self.SHOW], attr_name)
+             for attr_name in visible_attributes],
+            data,
+            might_not_exist=True)
+        attributes_to_exclude.extend(
+            attr_name for attr_name, visible in
+            zip(visible_attributes, results) if not visible)
         return attributes_to_exclude
 
     def _view(self, context, data, fields_to_strip=None):
@@ -381,37 +387,28 @@ class Controller(object):
         if self._collection in body:
             # Have to account for bulk create
             items = body[self._collection]
-            deltas = {}
-            bulk = True
         else:
             items = [body]
-            bulk = False
         # Ensure policy engine is initialized
         policy.init()
+        deltas = {}
         for item in items:
             self._validate_network_tenant_ownership(request,
                                                     item[self._resource])
             policy.enforce(request.context,
                            action,
                            item[self._resource])
-            try:
-                tenant_id = item[self._resource]['tenant_id']
-                count = quota.QUOTAS.count(request.context, self._resource,
-                                           self._plugin, self._collection,
-                                           tenant_id)
-                if bulk:
-                    delta = deltas.get(tenant_id, 0) + 1
-                    deltas[tenant_id] = delta
-                else:
-                    delta = 1
-                kwargs = {self._resource: count + delta}
-            except exceptions.QuotaResourceUnknown as e:
-                # We don't want to quota this resource
-                LOG.debug(e)
-            else:
-                quota.QUOTAS.limit_check(request.context,
-                                         item[self._resource]['tenant_id'],
-                                         **kwargs)
+            tenant_id = item[self._resource]['tenant_id']
+            tenant_deltas = deltas.setdefault(tenant_id, {self._resource: 0})
+            tenant_deltas[self._resource] += 1
+        try:
+            # The quotas are checked once for all the items
+            reservations = quota.QUOTAS.make_reservations(
+                request.context, deltas, self._plugin)
+        except exceptions.QuotaResourceUnknown as e:
+            # We don't want to quota this resource
+            LOG.debug(e)
+            reservations = []
 
         def notify(create_result):
             notifier_method = self._resource + '.create.end'
@@ -424,31 +421,40 @@ class Controller(object):
             return create_result
 
         kwargs = {self._parent_id_name: parent_id} if parent_id else {}
-        if self._collection in body and self._native_bulk:
-            # plugin does atomic bulk create operations
-            obj_creator = getattr(self._plugin, "%s_bulk" % action)
-            objs = obj_creator(request.context, body, **kwargs)
-            # Use first element of list to discriminate attributes which
-            # should be removed because of authZ policies
-            fields_to_strip = self._exclude_attributes_by_policy(
-                request.context, objs[0])
-            return notify({self._collection: [self._filter_attributes(
-                request.context, obj, fields_to_strip=fields_to_strip)
-                for obj in objs]})
-        else:
-            obj_creator = getattr(self._plugin, action)
-            if self._collection in body:
-                # Emulate atomic bulk behavior
-                objs = self._emulate_bulk_create(obj_creator, request,
-                                                 body, parent_id)
-                return notify({self._collection: objs})
+        try:
+            if self._collection in body and self._native_bulk:
+                # plugin does atomic bulk create operations
+                obj_creator = getattr(self._plugin, "%s_bulk" % action)
+                objs = obj_creator(request.context, body, **kwargs)
+                # Use first element of list to discriminate attributes which
+                # should be removed because of authZ policies
+                fields_to_strip = self._exclude_attributes_by_policy(
+                    request.context, objs[0])
+                result = {self._collection: [self._filter_attributes(
+                    request.context, obj, fields_to_strip=fields_to_strip)
+                    for obj in objs]}
             else:
-                kwargs.update({self._resource: body})
-                obj = obj_creator(request.context, **kwargs)
-                self._send_nova_notification(action, {},
-                                             {self._resource: obj})
-                return notify({self._resource: self._view(request.context,
-                                                          obj)})
+                obj_creator = getattr(self._plugin, action)
+                if self._collection in body:
+                    # Emulate atomic bulk behavior
+                    objs = self._emulate_bulk_create(obj_creator, request,
+                                                     body, parent_id)
+                    result = {self._collection: objs}
+                else:
+                    kwargs.update({self._resource: body})
+                    obj = obj_creator(request.context, **kwargs)
+                    self._send_nova_notification(action, {},
+                                                 {self._resource: obj})
+                    result = {self._resource: self._view(request.context,
+                                                         obj)}
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for reservation in reservations:
+                    quota.QUOTAS.cancel_reservation(request.context,
+                                                    reservation)
+        for reservation in reservations:
+            quota.QUOTAS.commit_reservation(request.context, reservation)
+        return notify(result)
 
     def delete(self, request, id, **kwargs):
         """Deletes the specified entity."""
@@ -473,6 +479,8 @@ class Controller(object):
 
         obj_deleter = getattr(self._plugin, action)
         obj_deleter(request.context, id, **kwargs)
+        if self._resource in quota.QUOTAS.resources and obj.get('tenant_id'):
+            quota.QUOTAS.mark_usages_dirty(request.context, obj['tenant_id'])
         notifier_method = self._resource + '.delete.end'
         self._notifier.info(request.context,
                             notifier_method,
@@ -648,14 +656,26 @@ class Controller(object):
         if (request.context.is_admin or
                 self._resource not in ('port', 'subnet')):
             return
-        network = self._plugin.get_network(
-            request.context,
-            resource_item['network_id'])
+        # NOTE: the network is cached in the context, so that it is
+        # retrieved only once for all the items of a bulk request. It is
+        # retrieved with the fields and privileges of the policy owner
+        # checks, which then use the same cached network.
+        fields = policy.PARENT_FIELDS['network']
+        network = request.context.get_cached_resource(
+            'network', resource_item['network_id'],
+            lambda network_id: self._plugin.get_network(
+                neutron_context.get_admin_context(), network_id,
+                fields=fields),
+            fields=fields, admin=True)
         # do not perform the check on shared networks
         if network.get('shared'):
             return
 
         network_owner = network['tenant_id']
+        if network_owner != request.context.tenant_id:
+            # The network is not visible to the user
+            raise exceptions.NetworkNotFound(
+                net_id=resource_item['network_id'])
 
         if network_owner != resource_item['tenant_id']:
             msg = _("Tenant %(tenant_id)s not allowed to "
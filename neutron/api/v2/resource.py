@@ -136,6 +136,12 @@ def Resource(controller, faults=None, deserializers=None, serializers=None):
             raise webob.exc.HTTPInternalServerError(**kwargs)
 
         status = action_status.get(action, 200)
+        if action == 'index' and hasattr(serializer, 'serialize_chunks'):
+            # NOTE: collections can be large, write them in chunks rather
+            # than building the whole response body in memory
+            return webob.Response(request=request, status=status,
+                                  content_type=content_type,
+                                  app_iter=serializer.serialize_chunks(result))
         body = serializer.serialize(result)
         # NOTE(jkoelker) Comply with RFC2616 section 9.7
         if status == 204:
@@ -72,10 +72,11 @@ def build_resource_info(plural_mappings, resource_map, which_service,
     for collection_name in resource_map:
         resource_name = plural_mappings[collection_name]
         params = resource_map.get(collection_name, {})
+        if register_quota:
+            quota.QUOTAS.register_resource_by_name(
+                resource_name, plural_name=collection_name)
         if translate_name:
             collection_name = collection_name.replace('_', '-')
-        if register_quota:
-            quota.QUOTAS.register_resource_by_name(resource_name)
         member_actions = action_map.get(resource_name, {})
         controller = base.create_resource(
             collection_name, resource_name, plugin, params,
@@ -53,6 +53,11 @@ core_opts = [
                help=_("The base MAC address Neutron will use for VIFs")),
     cfg.IntOpt('mac_generation_retries', default=16,
                help=_("How many times Neutron will retry MAC generation")),
+    cfg.IntOpt('ip_allocation_retries', default=16,
+               help=_("How many times Neutron will try, each time in a new "
+                      "transaction, a port operation whose IP address "
+                      "allocation conflicts with concurrent ones on the "
+                      "same subnet")),
     cfg.BoolOpt('allow_bulk', default=True,
                 help=_("Allow the usage of the bulk API")),
     cfg.BoolOpt('allow_pagination', default=False,
@@ -220,6 +220,11 @@ class IpAddressGenerationFailure(Conflict):
     message = _("No more IP addresses available on network %(net_id)s.")
 
 
+class IpAddressAllocationContention(ServiceUnavailable):
+    message = _("Unable to allocate an IP address on subnet %(subnet_id)s "
+                "because of concurrent allocations, please retry.")
+
+
 class BridgeDoesNotExist(NeutronException):
     message = _("Bridge %(bridge)s does not exist.")
 
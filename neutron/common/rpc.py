@@ -272,6 +272,18 @@ def create_connection(new=True):
     return Connection()
 
 
+def is_unsupported_version(exc):
+    """Return whether exc reports an RPC version the server can't handle.
+
+    The UnsupportedVersion raised by the dispatcher of the server is
+    received by the client as a RemoteError.
+    """
+    if isinstance(exc, messaging.UnsupportedVersion):
+        return True
+    return (isinstance(exc, messaging.RemoteError) and
+            exc.exc_type == 'UnsupportedVersion')
+
+
 # exceptions
 RPCException = messaging.MessagingException
 RemoteError = messaging.RemoteError
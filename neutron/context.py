@@ -63,6 +63,9 @@ class ContextBase(common_context.RequestContext):
             timestamp = datetime.datetime.utcnow()
         self.timestamp = timestamp
         self._session = None
+        # Resources looked up while processing the request, see
+        # get_cached_resource()
+        self._resource_cache = {}
         self.roles = roles or []
         if self.is_admin is None:
             self.is_admin = policy.check_is_admin(self)
@@ -132,6 +135,25 @@ class ContextBase(common_context.RequestContext):
                 'user_name': self.user_name,
                 }
 
+    def get_cached_resource(self, resource, resource_id, getter,
+                            fields=None, admin=False):
+        """Return a resource, looking it up only once per context.
+
+        getter is called with the resource id only if the resource was not
+        looked up before through this context or one of its copies, e.g.
+        while checking policies for the previous items of a bulk request,
+        with the same fields and privileges. admin must be set if getter
+        looks the resource up with an admin context; lookups through an
+        elevated copy of this context are cached as admin ones too, so that
+        they are never returned to lookups with the user privileges.
+        """
+        key = (resource, resource_id,
+               tuple(sorted(fields)) if fields else None,
+               bool(admin or self.is_admin))
+        if key not in self._resource_cache:
+            self._resource_cache[key] = getter(resource_id)
+        return self._resource_cache[key]
+
     @classmethod
     def from_dict(cls, values):
         return cls(**values)
@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+
 from eventlet import greenthread
 
 from oslo.config import cfg
@@ -21,6 +23,7 @@ import sqlalchemy as sa
 from sqlalchemy.orm import exc
 
 from neutron.common import rpc as n_rpc
+from neutron import context as n_context
 from neutron.db import model_base
 from neutron.db import models_v2
 from neutron.extensions import agent as ext_agent
@@ -28,14 +31,30 @@ from neutron import manager
 from neutron.openstack.common import excutils
 from neutron.openstack.common import jsonutils
 from neutron.openstack.common import log as logging
+from neutron.openstack.common import loopingcall
 from neutron.openstack.common import timeutils
 
 LOG = logging.getLogger(__name__)
-cfg.CONF.register_opt(
+cfg.CONF.register_opts([
     cfg.IntOpt('agent_down_time', default=75,
                help=_("Seconds to regard the agent is down; should be at "
                       "least twice report_interval, to be sure the "
-                      "agent is down for good.")))
+                      "agent is down for good.")),
+    cfg.IntOpt('agent_heartbeat_flush_interval', default=0,
+               help=_("Seconds between the batched writes of the agent "
+                      "heartbeats received by a server worker. The "
+                      "heartbeats are written as they are received if 0. "
+                      "The agents are seen alive up to this many seconds "
+                      "late, so agent_down_time should be at least "
+                      "report_interval plus this interval.")),
+])
+
+# Maximum number of agents whose heartbeats are written per statement
+HEARTBEAT_FLUSH_BATCH_SIZE = 500
+
+
+def _get_configurations_hash(configurations):
+    return hashlib.md5(configurations.encode('utf-8')).hexdigest()
 
 
 class Agent(model_base.BASEV2, models_v2.HasId):
@@ -151,7 +170,10 @@ class AgentDbMixin(ext_agent.AgentPluginBase):
             res = dict((k, agent[k]) for k in res_keys)
 
             configurations_dict = agent.get('configurations', {})
-            res['configurations'] = jsonutils.dumps(configurations_dict)
+            # The keys are sorted so that the content of the configurations
+            # can be compared by hash
+            res['configurations'] = jsonutils.dumps(configurations_dict,
+                                                    sort_keys=True)
             current_time = timeutils.utcnow()
             try:
                 agent_db = self._get_agent_by_type_and_host(
@@ -171,6 +193,7 @@ class AgentDbMixin(ext_agent.AgentPluginBase):
                 greenthread.sleep(0)
                 context.session.add(agent_db)
             greenthread.sleep(0)
+        return agent_db
 
     def create_or_update_agent(self, context, agent):
         """Create or update agent according to report."""
@@ -196,6 +219,109 @@ class AgentDbMixin(ext_agent.AgentPluginBase):
                     return self._create_or_update_agent(context, agent)
 
 
+class AgentHeartbeatAggregator(object):
+    """Coalesces the database writes of the agent heartbeats.
+
+    The first report of an agent, the reports of a starting agent, and the
+    reports whose configurations changed are written as they are received.
+    The other reports are buffered, and only their heartbeat timestamps
+    are written, once per interval, in batched UPDATE statements.
+
+    The aggregator is local to a server worker: before writing the
+    heartbeats, the configurations in the database are checked against the
+    ones last written by the worker, and the agents whose configurations
+    were changed or which were deleted in the meantime are written in full.
+    """
+
+    def __init__(self, plugin, interval):
+        self.plugin = plugin
+        self.interval = interval
+        # Hashes of the configurations last written, by agent type and host
+        self._configurations_hashes = {}
+        # Buffered reports by agent id, as (agent state, time received)
+        self._reports = {}
+        self._flush_loop = None
+
+    def report(self, context, agent_state):
+        """Write a report, or buffer its heartbeat if nothing else changed."""
+        key = (agent_state['agent_type'], agent_state['host'])
+        configurations = jsonutils.dumps(
+            agent_state.get('configurations', {}), sort_keys=True)
+        configurations_hash = _get_configurations_hash(configurations)
+        known = self._configurations_hashes.get(key)
+        if (agent_state.get('start_flag') or not known or
+                known[1] != configurations_hash):
+            self._write_report(context, agent_state)
+            return
+
+        self._reports[known[0]] = (agent_state, timeutils.utcnow())
+        if not self._flush_loop:
+            self._flush_loop = loopingcall.FixedIntervalLoopingCall(
+                self._flush)
+            self._flush_loop.start(interval=self.interval)
+
+    def _write_report(self, context, agent_state):
+        key = (agent_state['agent_type'], agent_state['host'])
+        known = self._configurations_hashes.pop(key, None)
+        if known:
+            self._reports.pop(known[0], None)
+        agent_db = self.plugin.create_or_update_agent(context, agent_state)
+        if agent_db:
+            self._configurations_hashes[key] = (
+                agent_db.id,
+                _get_configurations_hash(agent_db.configurations))
+
+    def _flush(self):
+        # A failure must not stop the looping call
+        try:
+            self.flush()
+        except Exception:
+            LOG.exception(_("Failed to write the agent heartbeats"))
+
+    def flush(self, context=None):
+        """Write the buffered heartbeats."""
+        reports, self._reports = self._reports, {}
+        if not reports:
+            return
+        context = context or n_context.get_admin_context()
+        agent_ids = list(reports)
+        outdated = []
+        for index in range(0, len(agent_ids), HEARTBEAT_FLUSH_BATCH_SIZE):
+            batch = agent_ids[index:index + HEARTBEAT_FLUSH_BATCH_SIZE]
+            outdated += self._flush_batch(context, batch, reports)
+        for agent_state in outdated:
+            self._write_report(context, agent_state)
+
+    def _flush_batch(self, context, agent_ids, reports):
+        """Write the heartbeats of a batch of agents.
+
+        Returns the reports of the agents which must be written in full.
+        """
+        heartbeats = []
+        outdated = []
+        with context.session.begin(subtransactions=True):
+            query = context.session.query(Agent.id, Agent.configurations)
+            current = dict(query.filter(Agent.id.in_(agent_ids)))
+            for agent_id in agent_ids:
+                agent_state, heartbeat_timestamp = reports[agent_id]
+                key = (agent_state['agent_type'], agent_state['host'])
+                known = self._configurations_hashes.get(key)
+                configurations = current.get(agent_id)
+                if (configurations is not None and known and
+                        known[1] == _get_configurations_hash(configurations)):
+                    heartbeats.append({'agent_id': agent_id,
+                                       'timestamp': heartbeat_timestamp})
+                else:
+                    outdated.append(agent_state)
+            if heartbeats:
+                context.session.execute(
+                    Agent.__table__.update().
+                    where(Agent.id == sa.bindparam('agent_id')).
+                    values(heartbeat_timestamp=sa.bindparam('timestamp')),
+                    heartbeats)
+        return outdated
+
+
 class AgentExtRpcCallback(n_rpc.RpcCallback):
     """Processes the rpc report in plugin implementations."""
 
@@ -205,6 +331,7 @@ class AgentExtRpcCallback(n_rpc.RpcCallback):
     def __init__(self, plugin=None):
         super(AgentExtRpcCallback, self).__init__()
         self.plugin = plugin
+        self.heartbeat_aggregator = None
 
     def report_state(self, context, **kwargs):
         """Report state from agent to server."""
@@ -216,4 +343,11 @@ class AgentExtRpcCallback(n_rpc.RpcCallback):
         agent_state = kwargs['agent_state']['agent_state']
         if not self.plugin:
             self.plugin = manager.NeutronManager.get_plugin()
-        self.plugin.create_or_update_agent(context, agent_state)
+        flush_interval = cfg.CONF.agent_heartbeat_flush_interval
+        if flush_interval <= 0:
+            self.plugin.create_or_update_agent(context, agent_state)
+            return
+        if not self.heartbeat_aggregator:
+            self.heartbeat_aggregator = AgentHeartbeatAggregator(
+                self.plugin, flush_interval)
+        self.heartbeat_aggregator.report(context, agent_state)
@@ -115,7 +115,7 @@ class DhcpAgentSchedulerDbMixin(dhcpagentscheduler
                 NetworkDhcpAgentBinding.network_id == network_ids[0])
         elif network_ids:
             query = query.filter(
-                NetworkDhcpAgentBinding.network_id in network_ids)
+                NetworkDhcpAgentBinding.network_id.in_(network_ids))
         if active is not None:
             query = (query.filter(agents_db.Agent.admin_state_up == active))
 
@@ -221,6 +221,25 @@ class DhcpAgentSchedulerDbMixin(dhcpagentscheduler
             return self.network_scheduler.schedule(
                 self, context, created_network)
 
+    def schedule_networks(self, context, networks):
+        """Schedule a batch of networks.
+
+        A dict of the lists of scheduled agents by network id is returned.
+        """
+        if self.network_scheduler:
+            return self.network_scheduler.schedule_networks(
+                self, context, networks)
+
+    def rebalance_networks(self, context):
+        """Rebalance the networks hosted by the DHCP agents.
+
+        A list of the moves, as (network id, old agent id, new agent id),
+        is returned, or None if the scheduler doesn't rebalance networks.
+        """
+        rebalance = getattr(self.network_scheduler, 'rebalance', None)
+        if rebalance:
+            return rebalance(self, context)
+
     def auto_schedule_networks(self, context, host):
         if self.network_scheduler:
             self.network_scheduler.auto_schedule_networks(self, context, host)
@@ -13,10 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import functools
+
 from oslo.config import cfg
 from oslo.db.sqlalchemy import session
 import sqlalchemy as sql
 
+from neutron.common import exceptions as n_exc
 from neutron.db import model_base
 from neutron.openstack.common import log as logging
 
@@ -82,3 +85,34 @@ def unregister_models(base=BASE):
         base.metadata.drop_all(engine)
     except Exception:
         LOG.exception(_("Database exception"))
+
+
+def retry_ip_allocation(f):
+    """Retry a plugin method in a new transaction on IP allocation conflicts.
+
+    The availability ranges read by a transaction may not show the changes
+    committed by concurrent allocations, so an allocation which conflicts
+    with one can only be retried by a new transaction. The method is
+    retried only if its context isn't in a transaction already, otherwise
+    the conflict is raised to the caller which started the transaction.
+    """
+    @functools.wraps(f)
+    def wrapper(self, context, *args, **kwargs):
+        if context.session.is_active:
+            return f(self, context, *args, **kwargs)
+        max_retries = cfg.CONF.ip_allocation_retries
+        for attempt in range(1, max_retries + 1):
+            try:
+                return f(self, context, *args, **kwargs)
+            except n_exc.IpAddressAllocationContention:
+                if attempt == max_retries:
+                    LOG.error(_("%(method)s failed after %(attempts)d "
+                                "attempts because of concurrent IP "
+                                "allocations"),
+                              {'method': f.__name__, 'attempts': attempt})
+                    raise
+                LOG.debug(_("Retrying %(method)s after a concurrent IP "
+                            "allocation, remaining attempts %(remaining)d"),
+                          {'method': f.__name__,
+                           'remaining': max_retries - attempt})
+    return wrapper
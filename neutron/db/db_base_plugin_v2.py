@@ -13,7 +13,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import bisect
+import collections
+import contextlib
+import itertools
 import random
+import threading
 import weakref
 
 import netaddr
@@ -51,6 +56,18 @@ LOG = logging.getLogger(__name__)
 # IP allocations being cleaned up by cascade.
 AUTO_DELETE_PORT_OWNERS = [constants.DEVICE_OWNER_DHCP]
 
+# Large allocation pools are stored as up to IP_RANGE_STRIPES availability
+# ranges of at least IP_RANGE_STRIPE_SIZE addresses. The allocations pick a
+# random range, concurrent ones update different rows instead of retrying
+# on the same one.
+IP_RANGE_STRIPES = 64
+IP_RANGE_STRIPE_SIZE = 256
+
+# The addresses allocated at once for the ports of the bulk request being
+# created by the current thread, by id of the port attributes. They are
+# handed over to create_port() by _bulk_port_allocations().
+_bulk_ports = threading.local()
+
 
 class CommonDbMixin(object):
     """Common methods used in core and service plugins."""
@@ -66,6 +83,12 @@ class CommonDbMixin(object):
     # TODO(salvatore-orlando): Avoid using class-level variables
     _dict_extend_functions = {}
 
+    # Loader options (e.g. joinedload or subqueryload) applied when fetching
+    # collections of a model class. Plugins and mixins register them with
+    # register_model_load_options in order to load in a fixed number of
+    # queries the relationships used for building the resource dicts.
+    _model_load_options = {}
+
     @classmethod
     def register_model_query_hook(cls, model, name, query_hook, filter_hook,
                                   result_filters=None):
@@ -91,6 +114,24 @@ class CommonDbMixin(object):
         model_hooks[name] = {'query': query_hook, 'filter': filter_hook,
                              'result_filters': result_filters}
 
+    @classmethod
+    def register_model_load_options(cls, model, name, options):
+        """Register the load profile of a mixin for a model class.
+
+        Add the loader options to the _model_load_options dict. Models are
+        the keys of this dict, whereas the value is another dict mapping
+        profile names to lists of SQLAlchemy loader options.
+        The options of all the profiles registered for a model are applied
+        by _get_collection, so that the relationships accessed while building
+        the dict of each row do not issue a query per row.
+        """
+        model_options = cls._model_load_options.get(model)
+        if not model_options:
+            # add key to dict
+            model_options = {}
+            cls._model_load_options[model] = model_options
+        model_options[name] = options
+
     @property
     def safe_reference(self):
         """Return a weakref to the instance.
@@ -134,6 +175,12 @@ class CommonDbMixin(object):
             query = query.filter(query_filter)
         return query
 
+    def _apply_load_options(self, query, model):
+        for _name, options in self._model_load_options.get(model,
+                                                           {}).iteritems():
+            query = query.options(*options)
+        return query
+
     def _fields(self, resource, fields):
         if fields:
             return dict(((key, item) for key, item in resource.items()
@@ -184,27 +231,88 @@ class CommonDbMixin(object):
             if func:
                 func(*args)
 
+    def _paginate_query(self, query, model, sorts=None, limit=None,
+                        marker_obj=None, page_reverse=False):
+        """Add sorting and keyset pagination criteria to a query.
+
+        The rows of the page are selected by comparing the sort keys with
+        their values in marker_obj rather than with an offset, so that the
+        cost of fetching a page does not depend on its position.
+        """
+        if limit and page_reverse and sorts:
+            sorts = [(s[0], not s[1]) for s in sorts]
+        return sqlalchemyutils.paginate_query(query, model, limit, sorts,
+                                              marker_obj=marker_obj)
+
+    def _get_projection_fields(self, model, fields, resource, dict_func):
+        """Return the fields to select as columns of model, if possible.
+
+        The fields can be selected directly from the database only if all
+        of them are column attributes of the model, and if neither a plugin
+        override of dict_func nor a dict extend function registered for
+        resource can change their values; None is returned otherwise, and
+        the full objects have to be loaded.
+        """
+        if not fields or self._dict_extend_functions.get(resource):
+            return None
+        base_dict_func = getattr(NeutronDbPluginV2, dict_func.__name__, None)
+        if (base_dict_func is None or getattr(dict_func, 'im_func', None)
+                is not base_dict_func.im_func):
+            return None
+        column_attrs = orm.class_mapper(model).column_attrs.keys()
+        projection = []
+        for field in fields:
+            if field not in column_attrs:
+                return None
+            if field not in projection:
+                projection.append(field)
+        return projection
+
     def _get_collection_query(self, context, model, filters=None,
                               sorts=None, limit=None, marker_obj=None,
-                              page_reverse=False):
+                              page_reverse=False, projection=None):
+        """Build the query for a collection of model objects.
+
+        If projection, a list of column attribute names, is given only
+        these columns are selected and the query returns tuples instead of
+        model objects, without loading any relationship.
+        """
         collection = self._model_query(context, model)
         collection = self._apply_filters_to_query(collection, model, filters)
-        if limit and page_reverse and sorts:
-            sorts = [(s[0], not s[1]) for s in sorts]
-        collection = sqlalchemyutils.paginate_query(collection, model, limit,
-                                                    sorts,
-                                                    marker_obj=marker_obj)
+        collection = self._paginate_query(collection, model, sorts=sorts,
+                                          limit=limit, marker_obj=marker_obj,
+                                          page_reverse=page_reverse)
+        if projection:
+            collection = collection.with_entities(
+                *[getattr(model, field) for field in projection])
         return collection
 
     def _get_collection(self, context, model, dict_func, filters=None,
                         fields=None, sorts=None, limit=None, marker_obj=None,
-                        page_reverse=False):
+                        page_reverse=False, project_resource=None):
+        """Return the dicts of a collection of model objects.
+
+        With project_resource, the name of the resource collection, requests
+        asking only for column attributes of the model are served by
+        selecting these columns; dict_func and the dict extend functions are
+        not invoked in this case, so callers must only enable it when they
+        copy column attributes to the dicts unchanged.
+        """
+        projection = (project_resource and
+                      self._get_projection_fields(model, fields,
+                                                  project_resource,
+                                                  dict_func))
         query = self._get_collection_query(context, model, filters=filters,
                                            sorts=sorts,
                                            limit=limit,
                                            marker_obj=marker_obj,
-                                           page_reverse=page_reverse)
-        items = [dict_func(c, fields) for c in query]
+                                           page_reverse=page_reverse,
+                                           projection=projection)
+        if projection:
+            items = [dict(zip(projection, row)) for row in query]
+        else:
+            query = self._apply_load_options(query, model)
+            items = [dict_func(c, fields) for c in query]
         if limit and page_reverse:
             items.reverse()
         return items
@@ -302,32 +410,60 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return context.session.query(models_v2.Subnet).all()
 
     @staticmethod
-    def _generate_mac(context, network_id):
+    def _get_random_mac():
         base_mac = cfg.CONF.base_mac.split(':')
+        mac = [int(base_mac[0], 16), int(base_mac[1], 16),
+               int(base_mac[2], 16), random.randint(0x00, 0xff),
+               random.randint(0x00, 0xff), random.randint(0x00, 0xff)]
+        if base_mac[3] != '00':
+            mac[3] = int(base_mac[3], 16)
+        return ':'.join(map(lambda x: "%02x" % x, mac))
+
+    @staticmethod
+    def _generate_mac(context, network_id):
+        return NeutronDbPluginV2._generate_macs(context, network_id, 1)[0]
+
+    @staticmethod
+    def _generate_macs(context, network_id, count):
+        """Generate count MAC addresses which are unique on the network.
+
+        The candidates of each attempt are checked with a single query and
+        only the ones already in use are generated again.
+        """
         max_retries = cfg.CONF.mac_generation_retries
+        macs = set()
         for i in range(max_retries):
-            mac = [int(base_mac[0], 16), int(base_mac[1], 16),
-                   int(base_mac[2], 16), random.randint(0x00, 0xff),
-                   random.randint(0x00, 0xff), random.randint(0x00, 0xff)]
-            if base_mac[3] != '00':
-                mac[3] = int(base_mac[3], 16)
-            mac_address = ':'.join(map(lambda x: "%02x" % x, mac))
-            if NeutronDbPluginV2._check_unique_mac(context, network_id,
-                                                   mac_address):
-                LOG.debug(_("Generated mac for network %(network_id)s "
-                            "is %(mac_address)s"),
+            candidates = set()
+            while len(macs) + len(candidates) < count:
+                mac_address = NeutronDbPluginV2._get_random_mac()
+                if mac_address not in macs:
+                    candidates.add(mac_address)
+            in_use = NeutronDbPluginV2._get_macs_in_use(context, network_id,
+                                                        candidates)
+            macs.update(candidates - in_use)
+            if not in_use:
+                LOG.debug(_("Generated macs for network %(network_id)s "
+                            "are %(mac_addresses)s"),
                           {'network_id': network_id,
-                           'mac_address': mac_address})
-                return mac_address
+                           'mac_addresses': sorted(macs)})
+                return list(macs)
             else:
-                LOG.debug(_("Generated mac %(mac_address)s exists. Remaining "
-                            "attempts %(max_retries)s."),
-                          {'mac_address': mac_address,
+                LOG.debug(_("Generated macs %(mac_addresses)s exist. "
+                            "Remaining attempts %(max_retries)s."),
+                          {'mac_addresses': sorted(in_use),
                            'max_retries': max_retries - (i + 1)})
         LOG.error(_("Unable to generate mac address after %s attempts"),
                   max_retries)
         raise n_exc.MacAddressGenerationFailure(net_id=network_id)
 
+    @staticmethod
+    def _get_macs_in_use(context, network_id, mac_addresses):
+        mac_qry = context.session.query(models_v2.Port.mac_address)
+        mac_qry = mac_qry.filter(
+            models_v2.Port.network_id == network_id,
+            models_v2.Port.mac_address.in_(mac_addresses))
+        return set(mac_address for mac_address, in mac_qry)
+
     @staticmethod
     def _check_unique_mac(context, network_id, mac_address):
         mac_qry = context.session.query(models_v2.Port)
@@ -339,7 +475,8 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return False
 
     @staticmethod
-    def _delete_ip_allocation(context, network_id, subnet_id, ip_address):
+    def _delete_ip_allocation(context, network_id, subnet_id, ip_address,
+                              recycle=True):
 
         # Delete the IP address from the IPAllocate table
         LOG.debug(_("Delete allocated IP %(ip_address)s "
@@ -347,10 +484,84 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                   {'ip_address': ip_address,
                    'network_id': network_id,
                    'subnet_id': subnet_id})
-        context.session.query(models_v2.IPAllocation).filter_by(
+        count = context.session.query(models_v2.IPAllocation).filter_by(
             network_id=network_id,
             ip_address=ip_address,
             subnet_id=subnet_id).delete()
+        if count and recycle:
+            NeutronDbPluginV2._recycle_ip(context, subnet_id, ip_address)
+
+    @staticmethod
+    def _recycle_ip(context, subnet_id, ip_address):
+        """Return a released IP address to the availability ranges.
+
+        The address is merged into the ranges ending right before or
+        starting right after it, so that the number of ranges follows the
+        fragmentation of the pool rather than the number of releases.
+        Addresses computed by EUI-64, which are never taken from the ranges,
+        and addresses already in a range are left alone.
+        Raises IpAddressAllocationContention if a concurrent transaction
+        modified these ranges first.
+        """
+        ip = netaddr.IPAddress(ip_address)
+        subnet = context.session.query(models_v2.Subnet).options(
+            orm.noload('*')).filter_by(id=subnet_id).first()
+        if (not subnet or
+                NeutronDbPluginV2._check_if_subnet_uses_eui64(subnet)):
+            # The EUI-64 addresses are not taken from the ranges
+            return
+        pool_qry = context.session.query(
+            models_v2.IPAllocationPool).options(
+                orm.noload('available_ranges')).filter_by(
+                    subnet_id=subnet_id)
+        for pool in pool_qry:
+            if (netaddr.IPAddress(pool['first_ip']) <= ip <=
+                    netaddr.IPAddress(pool['last_ip'])):
+                break
+        else:
+            # Addresses outside of the allocation pools are not recycled
+            return
+        IPAvailabilityRange = models_v2.IPAvailabilityRange
+        range_qry = context.session.query(
+            IPAvailabilityRange.allocation_pool_id,
+            IPAvailabilityRange.first_ip,
+            IPAvailabilityRange.last_ip).filter(
+                IPAvailabilityRange.allocation_pool_id == pool['id'])
+        lower = upper = None
+        for ip_range in range_qry:
+            first_ip = netaddr.IPAddress(ip_range.first_ip)
+            last_ip = netaddr.IPAddress(ip_range.last_ip)
+            if first_ip <= ip <= last_ip:
+                # The address is available already
+                return
+            if last_ip == ip - 1:
+                lower = ip_range
+            elif first_ip == ip + 1:
+                upper = ip_range
+        if lower and upper:
+            if (NeutronDbPluginV2._update_availability_range(
+                    context, lower, netaddr.IPAddress(lower.first_ip),
+                    netaddr.IPAddress(upper.last_ip)) and
+                    NeutronDbPluginV2._delete_availability_range(context,
+                                                                 upper)):
+                return
+        elif lower:
+            if NeutronDbPluginV2._update_availability_range(
+                    context, lower, netaddr.IPAddress(lower.first_ip), ip):
+                return
+        elif upper:
+            if NeutronDbPluginV2._update_availability_range(
+                    context, upper, ip, netaddr.IPAddress(upper.last_ip)):
+                return
+        else:
+            context.session.add(IPAvailabilityRange(
+                allocation_pool_id=pool['id'],
+                first_ip=str(ip),
+                last_ip=str(ip)))
+            return
+        LOG.debug(_("Availability ranges next to %(ip_address)s were "
+                    "modified concurrently"), {'ip_address': ip_address})
+        raise n_exc.IpAddressAllocationContention(subnet_id=subnet_id)
 
     @staticmethod
     def _check_if_subnet_uses_eui64(subnet):
@@ -367,6 +578,69 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
 
         return NeutronDbPluginV2._try_generate_ip(context, subnets)
 
+    @staticmethod
+    def _get_availability_ranges_query(context, subnet_id):
+        # NOTE: only the columns are fetched, the boundaries are used as the
+        # expected values of the compare-and-swap updates below
+        return context.session.query(
+            models_v2.IPAvailabilityRange.allocation_pool_id,
+            models_v2.IPAvailabilityRange.first_ip,
+            models_v2.IPAvailabilityRange.last_ip).join(
+                models_v2.IPAllocationPool).filter(
+                    models_v2.IPAllocationPool.subnet_id == subnet_id)
+
+    @staticmethod
+    def _update_availability_range(context, ip_range, first_ip, last_ip):
+        """Compare-and-swap the boundaries of an availability range.
+
+        The row is modified only if it still holds the boundaries it was
+        read with, which removes the need for locking it. The row is deleted
+        when first_ip is greater than last_ip.
+        Returns False if a concurrent allocation modified the row first.
+        """
+        if first_ip > last_ip:
+            return NeutronDbPluginV2._delete_availability_range(context,
+                                                                ip_range)
+        query = NeutronDbPluginV2._get_availability_range_query(context,
+                                                                ip_range)
+        count = query.update({'first_ip': str(first_ip),
+                              'last_ip': str(last_ip)},
+                             synchronize_session='evaluate')
+        return count == 1
+
+    @staticmethod
+    def _delete_availability_range(context, ip_range):
+        """Delete an availability range unless it was modified meanwhile."""
+        query = NeutronDbPluginV2._get_availability_range_query(context,
+                                                                ip_range)
+        return query.delete(synchronize_session='evaluate') == 1
+
+    @staticmethod
+    def _get_availability_range_query(context, ip_range):
+        return context.session.query(
+            models_v2.IPAvailabilityRange).filter_by(
+                allocation_pool_id=ip_range.allocation_pool_id,
+                first_ip=ip_range.first_ip,
+                last_ip=ip_range.last_ip)
+
+    @staticmethod
+    def _split_availability_range(first, last):
+        """Split the integer range first - last into stripes."""
+        size = last - first + 1
+        stripes = min(IP_RANGE_STRIPES, size // IP_RANGE_STRIPE_SIZE) or 1
+        stripe_size = -(-size // stripes)
+        return [(start, min(start + stripe_size - 1, last))
+                for start in range(first, last + 1, stripe_size)]
+
+    @staticmethod
+    def _add_availability_ranges(context, pool_id, version, first, last):
+        for first_ip, last_ip in NeutronDbPluginV2._split_availability_range(
+                first, last):
+            context.session.add(models_v2.IPAvailabilityRange(
+                allocation_pool_id=pool_id,
+                first_ip=str(netaddr.IPAddress(first_ip, version)),
+                last_ip=str(netaddr.IPAddress(last_ip, version))))
+
     @staticmethod
     def _try_generate_ip(context, subnets):
         """Generate an IP address.
@@ -374,37 +648,100 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
         The IP address will be generated from one of the subnets defined on
         the network.
         """
-        range_qry = context.session.query(
-            models_v2.IPAvailabilityRange).join(
-                models_v2.IPAllocationPool).with_lockmode('update')
+        ips = NeutronDbPluginV2._try_generate_ips(context, subnets, 1)
+        if not ips:
+            raise n_exc.IpAddressGenerationFailure(
+                net_id=subnets[0]['network_id'])
+        return ips[0]
+
+    @staticmethod
+    def _generate_ips(context, subnets, count):
+        """Generate count IP addresses from the subnets in a single pass."""
+        ips = NeutronDbPluginV2._try_generate_ips(context, subnets, count)
+        if len(ips) < count:
+            # The addresses generated so far are not stored yet, the
+            # rebuild must not make them available again
+            NeutronDbPluginV2._rebuild_availability_ranges(
+                context, subnets, allocated_ips=ips)
+            ips.extend(NeutronDbPluginV2._try_generate_ips(
+                context, subnets, count - len(ips)))
+        if len(ips) < count:
+            raise n_exc.IpAddressGenerationFailure(
+                net_id=subnets[0]['network_id'])
+        return ips
+
+    @staticmethod
+    def _try_generate_ips(context, subnets, count):
+        """Generate up to count IP addresses.
+
+        The addresses are taken from the availability ranges of the subnets
+        in the given order, picking a random range among the stripes of each
+        subnet so that concurrent transactions seldom update the same one.
+        All the addresses taken from a range are claimed with a single
+        compare-and-swap update. Fewer addresses are returned if the subnets
+        run out of available ranges.
+        Raises IpAddressAllocationContention if a concurrent transaction
+        modified a range first: the ranges read by this transaction may not
+        show the concurrent changes, the whole transaction must be retried.
+        """
+        ips = []
         for subnet in subnets:
-            range = range_qry.filter_by(subnet_id=subnet['id']).first()
-            if not range:
-                LOG.debug(_("All IPs from subnet %(subnet_id)s (%(cidr)s) "
-                            "allocated"),
-                          {'subnet_id': subnet['id'], 'cidr': subnet['cidr']})
-                continue
-            ip_address = range['first_ip']
-            LOG.debug(_("Allocated IP - %(ip_address)s from %(first_ip)s "
-                        "to %(last_ip)s"),
-                      {'ip_address': ip_address,
-                       'first_ip': range['first_ip'],
-                       'last_ip': range['last_ip']})
-            if range['first_ip'] == range['last_ip']:
-                # No more free indices on subnet => delete
-                LOG.debug(_("No more free IP's in slice. Deleting allocation "
-                            "pool."))
-                context.session.delete(range)
-            else:
-                # increment the first free
-                range['first_ip'] = str(netaddr.IPAddress(ip_address) + 1)
-            return {'ip_address': ip_address, 'subnet_id': subnet['id']}
-        raise n_exc.IpAddressGenerationFailure(net_id=subnets[0]['network_id'])
+            range_qry = NeutronDbPluginV2._get_availability_ranges_query(
+                context, subnet['id'])
+            while len(ips) < count:
+                ip_ranges = range_qry.limit(IP_RANGE_STRIPES).all()
+                if not ip_ranges:
+                    LOG.debug(_("All IPs from subnet %(subnet_id)s "
+                                "(%(cidr)s) allocated"),
+                              {'subnet_id': subnet['id'],
+                               'cidr': subnet['cidr']})
+                    break
+                # The small ranges are used in order once the stripes are
+                # exhausted, small subnets keep handing out addresses in
+                # the order of their ranges
+                stripes = [r for r in ip_ranges
+                           if (int(netaddr.IPAddress(r.last_ip)) -
+                               int(netaddr.IPAddress(r.first_ip)) + 1 >=
+                               IP_RANGE_STRIPE_SIZE)]
+                ip_range = random.choice(stripes) if stripes else ip_ranges[0]
+                first_ip = netaddr.IPAddress(ip_range.first_ip)
+                last_ip = netaddr.IPAddress(ip_range.last_ip)
+                size = min(count - len(ips), int(last_ip) - int(first_ip) + 1)
+                # Move the first free address past the claimed ones; the
+                # range is deleted once its last address is claimed
+                if not NeutronDbPluginV2._update_availability_range(
+                        context, ip_range, first_ip + size, last_ip):
+                    LOG.debug(_("Availability range %(first_ip)s - "
+                                "%(last_ip)s was modified concurrently"),
+                              {'first_ip': ip_range.first_ip,
+                               'last_ip': ip_range.last_ip})
+                    raise n_exc.IpAddressAllocationContention(
+                        subnet_id=subnet['id'])
+                LOG.debug(_("Allocated %(count)d IPs starting at "
+                            "%(ip_address)s from %(first_ip)s to "
+                            "%(last_ip)s"),
+                          {'count': size,
+                           'ip_address': ip_range.first_ip,
+                           'first_ip': ip_range.first_ip,
+                           'last_ip': ip_range.last_ip})
+                ips.extend({'ip_address': str(first_ip + i),
+                            'subnet_id': subnet['id']}
+                           for i in range(size))
+            if len(ips) == count:
+                return ips
+        return ips
 
     @staticmethod
-    def _rebuild_availability_ranges(context, subnets):
+    def _rebuild_availability_ranges(context, subnets, allocated_ips=None):
+        """Rebuild the availability ranges of the subnets from scratch.
+
+        The free ranges of each pool are the gaps between the sorted
+        allocated addresses, computed on integers so that memory use does
+        not depend on the size of the pools. allocated_ips lists addresses
+        which are allocated but not stored yet.
+        """
         ip_qry = context.session.query(
-            models_v2.IPAllocation).with_lockmode('update')
+            models_v2.IPAllocation.ip_address).with_lockmode('update')
         # PostgreSQL does not support select...for update with an outer join.
         # No join is needed here.
         pool_qry = context.session.query(
@@ -414,70 +751,73 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
             LOG.debug(_("Rebuilding availability ranges for subnet %s")
                       % subnet)
 
-            # Create a set of all currently allocated addresses
+            # Sorted integer values of all currently allocated addresses
             ip_qry_results = ip_qry.filter_by(subnet_id=subnet['id'])
-            allocations = netaddr.IPSet([netaddr.IPAddress(i['ip_address'])
-                                        for i in ip_qry_results])
+            allocations = [int(netaddr.IPAddress(i.ip_address))
+                           for i in ip_qry_results]
+            allocations.extend(int(netaddr.IPAddress(ip['ip_address']))
+                               for ip in allocated_ips or []
+                               if ip['subnet_id'] == subnet['id'])
+            allocations.sort()
 
             for pool in pool_qry.filter_by(subnet_id=subnet['id']):
-                # Create a set of all addresses in the pool
-                poolset = netaddr.IPSet(netaddr.iter_iprange(pool['first_ip'],
-                                                             pool['last_ip']))
-
-                # Use set difference to find free addresses in the pool
-                available = poolset - allocations
-
-                # Generator compacts an ip set into contiguous ranges
-                def ipset_to_ranges(ipset):
-                    first, last = None, None
-                    for cidr in ipset.iter_cidrs():
-                        if last and last + 1 != cidr.first:
-                            yield netaddr.IPRange(first, last)
-                            first = None
-                        first, last = first if first else cidr.first, cidr.last
-                    if first:
-                        yield netaddr.IPRange(first, last)
+                version = netaddr.IPAddress(pool['first_ip']).version
+                first = int(netaddr.IPAddress(pool['first_ip']))
+                last = int(netaddr.IPAddress(pool['last_ip']))
+
+                # Walk the allocations inside the pool, every gap between
+                # two of them is an available range
+                ranges = []
+                start = bisect.bisect_left(allocations, first)
+                for ip in itertools.islice(allocations, start, None):
+                    if ip > last:
+                        break
+                    if ip > first:
+                        ranges.append((first, ip - 1))
+                    first = ip + 1
+                if first <= last:
+                    ranges.append((first, last))
 
                 # Write the ranges to the db
-                for range in ipset_to_ranges(available):
-                    available_range = models_v2.IPAvailabilityRange(
-                        allocation_pool_id=pool['id'],
-                        first_ip=str(netaddr.IPAddress(range.first)),
-                        last_ip=str(netaddr.IPAddress(range.last)))
-                    context.session.add(available_range)
+                for first_ip, last_ip in ranges:
+                    NeutronDbPluginV2._add_availability_ranges(
+                        context, pool['id'], version, first_ip, last_ip)
 
     @staticmethod
     def _allocate_specific_ip(context, subnet_id, ip_address):
-        """Allocate a specific IP address on the subnet."""
-        ip = int(netaddr.IPAddress(ip_address))
-        range_qry = context.session.query(
-            models_v2.IPAvailabilityRange).join(
-                models_v2.IPAllocationPool).with_lockmode('update')
-        results = range_qry.filter_by(subnet_id=subnet_id)
-        for range in results:
-            first = int(netaddr.IPAddress(range['first_ip']))
-            last = int(netaddr.IPAddress(range['last_ip']))
+        """Allocate a specific IP address on the subnet.
+
+        Raises IpAddressAllocationContention if a concurrent transaction
+        modified the range of the address first.
+        """
+        ip = netaddr.IPAddress(ip_address)
+        range_qry = NeutronDbPluginV2._get_availability_ranges_query(
+            context, subnet_id)
+        for ip_range in range_qry:
+            first = netaddr.IPAddress(ip_range.first_ip)
+            last = netaddr.IPAddress(ip_range.last_ip)
             if first <= ip <= last:
-                if first == last:
-                    context.session.delete(range)
-                    return
-                elif first == ip:
-                    range['first_ip'] = str(netaddr.IPAddress(ip_address) + 1)
-                    return
-                elif last == ip:
-                    range['last_ip'] = str(netaddr.IPAddress(ip_address) - 1)
-                    return
-                else:
-                    # Split into two ranges
-                    new_first = str(netaddr.IPAddress(ip_address) + 1)
-                    new_last = range['last_ip']
-                    range['last_ip'] = str(netaddr.IPAddress(ip_address) - 1)
-                    ip_range = models_v2.IPAvailabilityRange(
-                        allocation_pool_id=range['allocation_pool_id'],
-                        first_ip=new_first,
-                        last_ip=new_last)
-                    context.session.add(ip_range)
-                    return
+                break
+        else:
+            # The address is not available for allocation
+            return
+        if ip == first:
+            new_first, new_last = ip + 1, last
+        else:
+            new_first, new_last = first, ip - 1
+        if not NeutronDbPluginV2._update_availability_range(
+                context, ip_range, new_first, new_last):
+            LOG.debug(_("Availability range %(first_ip)s - %(last_ip)s "
+                        "was modified concurrently"),
+                      {'first_ip': ip_range.first_ip,
+                       'last_ip': ip_range.last_ip})
+            raise n_exc.IpAddressAllocationContention(subnet_id=subnet_id)
+        if first < ip < last:
+            # Split into two ranges
+            context.session.add(models_v2.IPAvailabilityRange(
+                allocation_pool_id=ip_range.allocation_pool_id,
+                first_ip=str(ip + 1),
+                last_ip=str(last)))
 
     @staticmethod
     def _check_unique_ip(context, network_id, subnet_id, ip_address):
@@ -637,17 +977,37 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
 
         # Check if the IP's to add are OK
         to_add = self._test_fixed_ips_for_port(context, network_id, new_ips)
-        for ip in original_ips:
+        to_release = list(original_ips)
+        if to_add:
+            LOG.debug(_("Port update. Adding %s"), to_add)
+            network = self._get_network(context, network_id)
+            for fixed in to_add:
+                try:
+                    ips.extend(self._allocate_fixed_ips(context, network,
+                                                        [fixed]))
+                except n_exc.IpAddressGenerationFailure:
+                    if not to_release:
+                        raise
+                    # The subnet is full, the removed IPs are released
+                    # first so that the new IP can be taken from them
+                    LOG.debug(_("Port update. No IP available, releasing "
+                                "%s first"), to_release)
+                    for ip in to_release:
+                        NeutronDbPluginV2._delete_ip_allocation(
+                            context, network_id, ip['subnet_id'],
+                            ip['ip_address'])
+                    to_release = []
+                    ips.extend(self._allocate_fixed_ips(context, network,
+                                                        [fixed]))
+
+        # Release the removed IPs only once the new ones are allocated, so
+        # that they are not handed back to the same port
+        for ip in to_release:
             LOG.debug(_("Port update. Hold %s"), ip)
             NeutronDbPluginV2._delete_ip_allocation(context,
                                                     network_id,
                                                     ip['subnet_id'],
                                                     ip['ip_address'])
-
-        if to_add:
-            LOG.debug(_("Port update. Adding %s"), to_add)
-            network = self._get_network(context, network_id)
-            ips = self._allocate_fixed_ips(context, network, to_add)
         return ips, prev_ips
 
     def _allocate_ips_for_port(self, context, network, port):
@@ -661,7 +1021,11 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
         ips = []
 
         fixed_configured = p['fixed_ips'] is not attributes.ATTR_NOT_SPECIFIED
-        if fixed_configured:
+        bulk_ips = self._get_bulk_port_allocation(p).get('ips')
+        if not fixed_configured and bulk_ips is not None:
+            # Allocated at once with the other ports of a bulk request
+            ips = bulk_ips
+        elif fixed_configured:
             configured_ips = self._test_fixed_ips_for_port(context,
                                                            p["network_id"],
                                                            p['fixed_ips'])
@@ -1040,7 +1404,7 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
 
             # clean up network owned ports
             for port in ports:
-                self._delete_port(context, port['id'])
+                self._delete_port(context, port['id'], recycle_ips=False)
 
             # clean up subnets
             subnets_qry = context.session.query(models_v2.Subnet)
@@ -1061,7 +1425,8 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                                     sorts=sorts,
                                     limit=limit,
                                     marker_obj=marker_obj,
-                                    page_reverse=page_reverse)
+                                    page_reverse=page_reverse,
+                                    project_resource=attributes.NETWORKS)
 
     def get_networks_count(self, context, filters=None):
         return self._get_collection_count(context, models_v2.Network,
@@ -1222,15 +1587,15 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                     context.session.add(route)
 
             for pool in s['allocation_pools']:
-                ip_pool = models_v2.IPAllocationPool(subnet=subnet,
-                                                     first_ip=pool['start'],
-                                                     last_ip=pool['end'])
+                # The id of the pool is needed by its availability ranges
+                ip_pool = models_v2.IPAllocationPool(
+                    id=uuidutils.generate_uuid(), subnet=subnet,
+                    first_ip=pool['start'], last_ip=pool['end'])
                 context.session.add(ip_pool)
-                ip_range = models_v2.IPAvailabilityRange(
-                    ipallocationpool=ip_pool,
-                    first_ip=pool['start'],
-                    last_ip=pool['end'])
-                context.session.add(ip_range)
+                first_ip = netaddr.IPAddress(pool['start'])
+                NeutronDbPluginV2._add_availability_ranges(
+                    context, ip_pool.id, first_ip.version, int(first_ip),
+                    int(netaddr.IPAddress(pool['end'])))
 
         return self._make_subnet_dict(subnet)
 
@@ -1366,7 +1731,8 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
             for a in allocated:
                 if a.ports.device_owner in AUTO_DELETE_PORT_OWNERS:
                     NeutronDbPluginV2._delete_ip_allocation(
-                        context, subnet.network_id, id, a.ip_address)
+                        context, subnet.network_id, id, a.ip_address,
+                        recycle=False)
                 else:
                     raise n_exc.SubnetInUse(subnet_id=id)
 
@@ -1386,15 +1752,117 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                                     sorts=sorts,
                                     limit=limit,
                                     marker_obj=marker_obj,
-                                    page_reverse=page_reverse)
+                                    page_reverse=page_reverse,
+                                    project_resource=attributes.SUBNETS)
 
     def get_subnets_count(self, context, filters=None):
         return self._get_collection_count(context, models_v2.Subnet,
                                           filters=filters)
 
+    @contextlib.contextmanager
+    def _bulk_port_allocations(self, context, items):
+        """Allocate the addresses of the ports of a bulk request at once.
+
+        The missing MAC addresses of all the ports of a network are
+        generated and checked at once, and so are the IP addresses of the
+        ports without fixed IPs. The allocations are looked up by
+        create_port() with _get_bulk_port_allocation() while the block runs.
+        """
+        allocations = collections.defaultdict(dict)
+        macs_by_network = collections.defaultdict(list)
+        ips_by_network = collections.defaultdict(list)
+        for item in items:
+            p = item['port']
+            if p.get('mac_address') is attributes.ATTR_NOT_SPECIFIED:
+                macs_by_network[p['network_id']].append(p)
+            if p.get('fixed_ips') is attributes.ATTR_NOT_SPECIFIED:
+                ips_by_network[p['network_id']].append(p)
+        for network_id, network_ports in macs_by_network.iteritems():
+            mac_addresses = NeutronDbPluginV2._generate_macs(
+                context, network_id, len(network_ports))
+            for p, mac_address in zip(network_ports, mac_addresses):
+                p['mac_address'] = mac_address
+                allocations[id(p)]['mac_address'] = mac_address
+        for network_id, network_ports in ips_by_network.iteritems():
+            ips = self._allocate_ips_for_ports(context, network_id,
+                                               network_ports)
+            for p, port_ips in zip(network_ports, ips):
+                allocations[id(p)]['ips'] = port_ips
+        _bulk_ports.allocations = allocations
+        try:
+            yield
+        finally:
+            _bulk_ports.allocations = {}
+
+    @staticmethod
+    def _get_bulk_port_allocation(p):
+        """Return the addresses allocated for a port of a bulk request."""
+        return getattr(_bulk_ports, 'allocations', {}).get(id(p), {})
+
+    @db.retry_ip_allocation
     def create_port_bulk(self, context, ports):
-        return self._create_bulk('port', context, ports)
+        # The addresses allocated at once must be rolled back with the ports
+        with context.session.begin(subtransactions=True):
+            with self._bulk_port_allocations(context, ports['ports']):
+                return self._create_bulk('port', context, ports)
+
+    def _allocate_ips_for_ports(self, context, network_id, ports):
+        """Allocate IP addresses for ports without configured fixed IPs.
+
+        Returns the list of allocated IPs of every port. All the addresses
+        of a subnet are generated in a single pass.
+        """
+        filter = {'network_id': [network_id]}
+        subnets = self.get_subnets(context, filters=filter)
+        ips = [[] for p in ports]
+        v4 = [subnet for subnet in subnets if subnet['ip_version'] == 4]
+        v6 = []
+        for subnet in subnets:
+            if subnet['ip_version'] == 4:
+                continue
+            if not self._check_if_subnet_uses_eui64(subnet):
+                v6.append(subnet)
+                continue
+            for p, port_ips in zip(ports, ips):
+                ip_address = ipv6_utils.get_ipv6_addr_by_EUI64(
+                    subnet['cidr'], p['mac_address'])
+                port_ips.append({'ip_address': ip_address.format(),
+                                 'subnet_id': subnet['id']})
+        for version_subnets in [v4, v6]:
+            if version_subnets:
+                generated = NeutronDbPluginV2._generate_ips(
+                    context, version_subnets, len(ports))
+                for port_ips, ip in zip(ips, generated):
+                    port_ips.append(ip)
+        return ips
 
+    @staticmethod
+    def _make_port_db(p, port_id, tenant_id, ips):
+        for ip in ips:
+            LOG.debug(_("Allocated IP %(ip_address)s "
+                        "(%(network_id)s/%(subnet_id)s/%(port_id)s)"),
+                      {'ip_address': ip['ip_address'],
+                       'network_id': p['network_id'],
+                       'subnet_id': ip['subnet_id'],
+                       'port_id': port_id})
+        fixed_ips = [models_v2.IPAllocation(network_id=p['network_id'],
+                                            port_id=port_id,
+                                            ip_address=ip['ip_address'],
+                                            subnet_id=ip['subnet_id'])
+                     for ip in ips]
+        return models_v2.Port(tenant_id=tenant_id,
+                              name=p['name'],
+                              id=port_id,
+                              network_id=p['network_id'],
+                              mac_address=p['mac_address'],
+                              admin_state_up=p['admin_state_up'],
+                              status=p.get('status',
+                                           constants.PORT_STATUS_ACTIVE),
+                              device_id=p['device_id'],
+                              device_owner=p['device_owner'],
+                              fixed_ips=fixed_ips)
+
+    @db.retry_ip_allocation
     def create_port(self, context, port):
         p = port['port']
         port_id = p.get('id') or uuidutils.generate_uuid()
@@ -1417,8 +1885,10 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                 #calculating an EUI-64 address for a v6 subnet
                 p['mac_address'] = NeutronDbPluginV2._generate_mac(context,
                                                                    network_id)
-            else:
-                # Ensure that the mac on the network is unique
+            elif (p['mac_address'] !=
+                  self._get_bulk_port_allocation(p).get('mac_address')):
+                # Ensure that the mac on the network is unique, the ones
+                # generated for a bulk request were checked already
                 if not NeutronDbPluginV2._check_unique_mac(context,
                                                            network_id,
                                                            p['mac_address']):
@@ -1428,43 +1898,12 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
             # Returns the IP's for the port
             ips = self._allocate_ips_for_port(context, network, port)
 
-            if 'status' not in p:
-                status = constants.PORT_STATUS_ACTIVE
-            else:
-                status = p['status']
-
-            port = models_v2.Port(tenant_id=tenant_id,
-                                  name=p['name'],
-                                  id=port_id,
-                                  network_id=network_id,
-                                  mac_address=p['mac_address'],
-                                  admin_state_up=p['admin_state_up'],
-                                  status=status,
-                                  device_id=p['device_id'],
-                                  device_owner=p['device_owner'])
+            port = self._make_port_db(p, port_id, tenant_id, ips)
             context.session.add(port)
 
-            # Update the allocated IP's
-            if ips:
-                for ip in ips:
-                    ip_address = ip['ip_address']
-                    subnet_id = ip['subnet_id']
-                    LOG.debug(_("Allocated IP %(ip_address)s "
-                                "(%(network_id)s/%(subnet_id)s/%(port_id)s)"),
-                              {'ip_address': ip_address,
-                               'network_id': network_id,
-                               'subnet_id': subnet_id,
-                               'port_id': port_id})
-                    allocated = models_v2.IPAllocation(
-                        network_id=network_id,
-                        port_id=port_id,
-                        ip_address=ip_address,
-                        subnet_id=subnet_id,
-                    )
-                    context.session.add(allocated)
-
         return self._make_port_dict(port, process_extensions=False)
 
+    @db.retry_ip_allocation
     def update_port(self, context, id, port):
         p = port['port']
 
@@ -1512,6 +1951,7 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
             result['fixed_ips'] = prev_ips + added_ips
         return result
 
+    @db.retry_ip_allocation
     def delete_port(self, context, id):
         with context.session.begin(subtransactions=True):
             self._delete_port(context, id)
@@ -1532,11 +1972,22 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                             "The port has already been deleted."),
                           port_id)
 
-    def _delete_port(self, context, id):
+    def _delete_port(self, context, id, recycle_ips=True):
         query = (context.session.query(models_v2.Port).
                  enable_eagerloads(False).filter_by(id=id))
         if not context.is_admin:
             query = query.filter_by(tenant_id=context.tenant_id)
+        if recycle_ips:
+            # The allocations deleted by the cascade would not be returned
+            # to the availability ranges
+            allocations = (context.session.query(models_v2.IPAllocation).
+                           join(models_v2.Port).
+                           filter(models_v2.Port.id.in_(
+                               query.with_entities(models_v2.Port.id))))
+            for allocation in allocations.all():
+                NeutronDbPluginV2._delete_ip_allocation(
+                    context, allocation['network_id'],
+                    allocation['subnet_id'], allocation['ip_address'])
         query.delete()
 
     def get_port(self, context, id, fields=None):
@@ -1544,7 +1995,8 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return self._make_port_dict(port, fields)
 
     def _get_ports_query(self, context, filters=None, sorts=None, limit=None,
-                         marker_obj=None, page_reverse=False):
+                         marker_obj=None, page_reverse=False,
+                         projection=None):
         Port = models_v2.Port
         IPAllocation = models_v2.IPAllocation
 
@@ -1564,21 +2016,34 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                 query = query.filter(IPAllocation.subnet_id.in_(subnet_ids))
 
         query = self._apply_filters_to_query(query, Port, filters)
-        if limit and page_reverse and sorts:
-            sorts = [(s[0], not s[1]) for s in sorts]
-        query = sqlalchemyutils.paginate_query(query, Port, limit,
-                                               sorts, marker_obj)
+        query = self._paginate_query(query, Port, sorts=sorts, limit=limit,
+                                     marker_obj=marker_obj,
+                                     page_reverse=page_reverse)
+        if projection:
+            query = query.with_entities(
+                *[getattr(Port, field) for field in projection])
         return query
 
     def get_ports(self, context, filters=None, fields=None,
                   sorts=None, limit=None, marker=None,
                   page_reverse=False):
         marker_obj = self._get_marker_obj(context, 'port', limit, marker)
+        # NOTE: filtering on fixed IPs joins the IP allocations, which can
+        # return a port more than once; only full objects are deduplicated
+        projection = None
+        if not (filters and 'fixed_ips' in filters):
+            projection = self._get_projection_fields(
+                models_v2.Port, fields, attributes.PORTS, self._make_port_dict)
         query = self._get_ports_query(context, filters=filters,
                                       sorts=sorts, limit=limit,
                                       marker_obj=marker_obj,
-                                      page_reverse=page_reverse)
-        items = [self._make_port_dict(c, fields) for c in query]
+                                      page_reverse=page_reverse,
+                                      projection=projection)
+        if projection:
+            items = [dict(zip(projection, row)) for row in query]
+        else:
+            query = self._apply_load_options(query, models_v2.Port)
+            items = [self._make_port_dict(c, fields) for c in query]
         if limit and page_reverse:
             items.reverse()
         return items
@@ -1623,3 +2088,17 @@ class NeutronDbPluginV2(neutron_plugin_base_v2.NeutronPluginBaseV2,
                             device_id=device_id)
                 if tenant_id != router['tenant_id']:
                     raise n_exc.DeviceIDNotOwnedByTenant(device_id=device_id)
+
+
+# Subnets are listed with their DNS name servers and host routes; networks
+# only need the ids of their subnets, so the allocation pools of the subnets
+# and the availability ranges of the pools, which are otherwise loaded
+# eagerly, are left out of the collection queries.
+NeutronDbPluginV2.register_model_load_options(
+    models_v2.Network, 'core',
+    [orm.lazyload('subnets.allocation_pools')])
+NeutronDbPluginV2.register_model_load_options(
+    models_v2.Subnet, 'core',
+    [orm.lazyload('allocation_pools.available_ranges'),
+     orm.subqueryload('dns_nameservers'),
+     orm.subqueryload('routes')])
@@ -276,8 +276,8 @@ class L3AgentSchedulerDbMixin(l3agentscheduler.L3AgentSchedulerPluginBase,
 
     def schedule_routers(self, context, routers):
         """Schedule the routers to l3 agents."""
-        for router in routers:
-            self.schedule_router(context, router)
+        if self.router_scheduler:
+            self.router_scheduler.schedule_routers(self, context, routers)
 
     def get_l3_agent_with_min_routers(self, context, agent_ids):
         """Return l3 agent with the least number of routers."""
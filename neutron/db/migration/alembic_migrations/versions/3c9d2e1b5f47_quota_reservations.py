@@ -0,0 +1,72 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""quota_reservations
+
+Revision ID: 3c9d2e1b5f47
+Revises: 5b7fdd8a5ad9
+Create Date: 2014-06-09 15:02:17.593022
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c9d2e1b5f47'
+down_revision = '5b7fdd8a5ad9'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = ['*']
+
+from alembic import op
+import sqlalchemy as sa
+
+from neutron.db import migration
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table(
+        'quotausages',
+        sa.Column('tenant_id', sa.String(length=255), nullable=False),
+        sa.Column('resource', sa.String(length=255), nullable=False),
+        sa.Column('in_use', sa.Integer(), nullable=False),
+        sa.Column('dirty', sa.Boolean(), nullable=False),
+        sa.Column('counted_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('tenant_id', 'resource'))
+    op.create_table(
+        'reservations',
+        sa.Column('id', sa.String(length=36), nullable=False),
+        sa.Column('tenant_id', sa.String(length=255), nullable=True),
+        sa.Column('expiration', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_table(
+        'resourcedeltas',
+        sa.Column('resource', sa.String(length=255), nullable=False),
+        sa.Column('reservation_id', sa.String(length=36), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['reservation_id'], ['reservations.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('resource', 'reservation_id'))
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.drop_table('resourcedeltas')
+    op.drop_table('reservations')
+    op.drop_table('quotausages')
@@ -0,0 +1,59 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""sg_cache_invalidations
+
+Revision ID: 52a3b9f1d7e8
+Revises: 3c9d2e1b5f47
+Create Date: 2014-06-16 10:24:51.361826
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '52a3b9f1d7e8'
+down_revision = '3c9d2e1b5f47'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = ['*']
+
+from alembic import op
+import sqlalchemy as sa
+
+from neutron.db import migration
+
+
+def upgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.create_table(
+        'securitygroupcacheinvalidations',
+        sa.Column('id', sa.Integer(), nullable=False, autoincrement=True),
+        sa.Column('security_group_id', sa.String(length=36),
+                  nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'))
+    op.create_index('ix_securitygroupcacheinvalidations_created_at',
+                    'securitygroupcacheinvalidations', ['created_at'])
+
+
+def downgrade(active_plugins=None, options=None):
+    if not migration.should_run(active_plugins, migration_for_plugins):
+        return
+
+    op.drop_index('ix_securitygroupcacheinvalidations_created_at',
+                  'securitygroupcacheinvalidations')
+    op.drop_table('securitygroupcacheinvalidations')
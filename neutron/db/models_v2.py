@@ -119,6 +119,13 @@ class SubnetRoute(model_base.BASEV2, Route):
 class Port(model_base.BASEV2, HasId, HasTenant):
     """Represents a port on a Neutron v2 network."""
 
+    # Tenants list their ports sorted by id, the primary key used as
+    # pagination marker by default
+    __table_args__ = (
+        sa.Index('ix_ports_tenant_id_id', 'tenant_id', 'id'),
+        model_base.BASEV2.__table_args__
+    )
+
     name = sa.Column(sa.String(255))
     network_id = sa.Column(sa.String(36), sa.ForeignKey("networks.id"),
                            nullable=False)
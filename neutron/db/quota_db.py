@@ -13,11 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+
+from oslo.config import cfg
+from oslo.db import exception as db_exc
 import sqlalchemy as sa
+from sqlalchemy import orm
 
 from neutron.common import exceptions
 from neutron.db import model_base
 from neutron.db import models_v2
+from neutron.openstack.common import timeutils
 
 
 class Quota(model_base.BASEV2, models_v2.HasId):
@@ -31,6 +37,38 @@ class Quota(model_base.BASEV2, models_v2.HasId):
     limit = sa.Column(sa.Integer)
 
 
+class QuotaUsage(model_base.BASEV2):
+    """Represent the number of resources of a tenant currently in use.
+
+    The count is not reliable when the usage is dirty, in which case it has
+    to be computed again. counted_at is the time of the last count.
+    """
+    tenant_id = sa.Column(sa.String(255), primary_key=True)
+    resource = sa.Column(sa.String(255), primary_key=True)
+    in_use = sa.Column(sa.Integer, nullable=False, default=0)
+    dirty = sa.Column(sa.Boolean, nullable=False, default=False)
+    counted_at = sa.Column(sa.DateTime)
+
+
+class ResourceDelta(model_base.BASEV2):
+    """Represent the amount of a resource held by a reservation."""
+    resource = sa.Column(sa.String(255), primary_key=True)
+    reservation_id = sa.Column(sa.String(36),
+                               sa.ForeignKey('reservations.id',
+                                             ondelete='CASCADE'),
+                               primary_key=True)
+    amount = sa.Column(sa.Integer, nullable=False)
+
+
+class Reservation(model_base.BASEV2, models_v2.HasId, models_v2.HasTenant):
+    """Represent resources reserved for a tenant by a pending request."""
+    expiration = sa.Column(sa.DateTime, nullable=False)
+    deltas = orm.relationship(ResourceDelta,
+                              backref='reservation',
+                              lazy='joined',
+                              cascade='all, delete-orphan')
+
+
 class DbQuotaDriver(object):
     """Driver to perform necessary checks to enforce quotas and obtain quota
     information.
@@ -59,6 +97,31 @@ class DbQuotaDriver(object):
 
         return tenant_quota
 
+    @staticmethod
+    def get_tenants_quotas(context, resources, tenant_ids):
+        """Given a list of resources, retrieve the quotas for several tenants
+        with a single query.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the registered resource keys.
+        :param tenant_ids: The IDs of the tenants to return quotas for.
+        :return dict: from tenant ID to dict from resource name to limit
+        """
+
+        # init with defaults
+        default_quota = dict((key, resource.default)
+                             for key, resource in resources.items())
+        tenant_quotas = dict((tenant_id, default_quota.copy())
+                             for tenant_id in tenant_ids)
+
+        # update with tenant specific limits
+        q_qry = context.session.query(Quota).filter(
+            Quota.tenant_id.in_(tenant_quotas))
+        for q in q_qry:
+            tenant_quotas[q['tenant_id']][q['resource']] = q['limit']
+
+        return tenant_quotas
+
     @staticmethod
     def delete_tenant_quota(context, tenant_id):
         """Delete the quota entries for a given tenant_id.
@@ -125,6 +188,29 @@ class DbQuotaDriver(object):
         :param keys: A list of the desired quotas to retrieve.
 
         """
+        sub_resources = self._get_sub_resources(resources, keys)
+
+        # Grab and return the quotas (without usages)
+        quotas = DbQuotaDriver.get_tenant_quotas(
+            context, sub_resources, tenant_id)
+
+        return dict((k, v) for k, v in quotas.items())
+
+    def _get_tenants_quotas(self, context, tenant_ids, resources, keys):
+        """Retrieves the quotas of several tenants for specific resources.
+
+        :param context: The request context, for access checks.
+        :param tenant_ids: the tenant_ids to check quota.
+        :param resources: A dictionary of the registered resources.
+        :param keys: A list of the desired quotas to retrieve.
+        :return dict: from tenant_id to dict from resource name to limit
+        """
+        sub_resources = self._get_sub_resources(resources, keys)
+        return DbQuotaDriver.get_tenants_quotas(
+            context, sub_resources, tenant_ids)
+
+    @staticmethod
+    def _get_sub_resources(resources, keys):
         desired = set(keys)
         sub_resources = dict((k, v) for k, v in resources.items()
                              if k in desired)
@@ -133,12 +219,7 @@ class DbQuotaDriver(object):
         if len(keys) != len(sub_resources):
             unknown = desired - set(sub_resources.keys())
             raise exceptions.QuotaResourceUnknown(unknown=sorted(unknown))
-
-        # Grab and return the quotas (without usages)
-        quotas = DbQuotaDriver.get_tenant_quotas(
-            context, sub_resources, tenant_id)
-
-        return dict((k, v) for k, v in quotas.items())
+        return sub_resources
 
     def limit_check(self, context, tenant_id, resources, values):
         """Check simple quota limits.
@@ -162,18 +243,239 @@ class DbQuotaDriver(object):
         :param values: A dictionary of the values to check against the
                        quota.
         """
+        self.bulk_limit_check(context, resources, {tenant_id: values})
+
+    def bulk_limit_check(self, context, resources, values):
+        """Check simple quota limits of several tenants at once.
+
+        The quotas of all the tenants are retrieved with a single query,
+        and a single OverQuota exception is raised with the sorted list of
+        the resources which are too high for any of the tenants.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the registered resources.
+        :param values: A dictionary from tenant_id to dictionary of the
+                       values to check against the quota of the tenant.
+        """
 
         # Ensure no value is less than zero
-        unders = [key for key, val in values.items() if val < 0]
+        unders = set(key for tenant_values in values.values()
+                     for key, val in tenant_values.items() if val < 0)
         if unders:
             raise exceptions.InvalidQuotaValue(unders=sorted(unders))
 
         # Get the applicable quotas
-        quotas = self._get_quotas(context, tenant_id, resources, values.keys())
+        keys = set(key for tenant_values in values.values()
+                   for key in tenant_values)
+        quotas = self._get_tenants_quotas(context, values.keys(), resources,
+                                          keys)
 
         # Check the quotas and construct a list of the resources that
         # would be put over limit by the desired values
-        overs = [key for key, val in values.items()
-                 if quotas[key] >= 0 and quotas[key] < val]
+        overs = set(key for tenant_id, tenant_values in values.items()
+                    for key, val in tenant_values.items()
+                    if quotas[tenant_id][key] >= 0 and
+                    quotas[tenant_id][key] < val)
         if overs:
             raise exceptions.OverQuota(overs=sorted(overs))
+
+
+class DbReservationQuotaDriver(DbQuotaDriver):
+    """Quota driver caching the usage of the resources in the database.
+
+    Instead of counting the resources of a tenant for every check, this
+    driver keeps their count in the quotausages table. The count of the
+    resources registered with register_tracked_resource() is incremented
+    when the reservations are committed, and marked dirty when resources of
+    the tenant are deleted, in which case it is computed again on the next
+    reservation. It is also computed again once older than usage_max_age
+    seconds, to account for the resources created or deleted without going
+    through the API, e.g. the DHCP ports. The other resources are counted
+    for every reservation.
+
+    The resources being created by a request are reserved before they are
+    created, so that concurrent requests cannot exceed the quota. The
+    reservations are removed when committed or cancelled, or ignored once
+    expired, e.g. if the server died while processing the request.
+    """
+
+    _tracked_resources = set()
+
+    @classmethod
+    def register_tracked_resource(cls, resource):
+        """Keep the usage count of a resource between the reservations.
+
+        :param resource: The name of the resource, i.e., "port".
+        """
+        cls._tracked_resources.add(resource)
+
+    @classmethod
+    def _is_usage_current(cls, usage, now):
+        if usage.dirty or usage.resource not in cls._tracked_resources:
+            return False
+        max_age = cfg.CONF.QUOTAS.usage_max_age
+        return max_age <= 0 or (
+            usage.counted_at is not None and
+            now - usage.counted_at < datetime.timedelta(seconds=max_age))
+
+    def make_reservations(self, context, resources, deltas, count):
+        """Check the quotas of one or more tenants and reserve resources.
+
+        The quotas, usages and reservations of all the tenants are looked
+        up at once, and a single OverQuota exception is raised with the
+        resources which would be put over quota for any of the tenants.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the registered resources.
+        :param deltas: A dictionary from tenant_id to dictionary of the
+                       amounts of resources to reserve for the tenant.
+        :param count: A callable returning the number of resources of a
+                      tenant given the tenant_id and the resource name.
+        :return: the list of the ids of the reservations, one per tenant
+                 having a limit on any of the resources.
+        """
+        try:
+            return self._make_reservations(context, resources, deltas, count)
+        except db_exc.DBDuplicateEntry:
+            # The usages have been created by a concurrent request
+            return self._make_reservations(context, resources, deltas, count)
+
+    def _make_reservations(self, context, resources, deltas, count):
+        unders = set(key for tenant_deltas in deltas.values()
+                     for key, val in tenant_deltas.items() if val < 0)
+        if unders:
+            raise exceptions.InvalidQuotaValue(unders=sorted(unders))
+
+        keys = set(key for tenant_deltas in deltas.values()
+                   for key in tenant_deltas)
+        quotas = self._get_tenants_quotas(context, deltas.keys(), resources,
+                                          keys)
+        # Unlimited resources are neither counted nor reserved
+        deltas = dict((tenant_id, dict((key, val)
+                                       for key, val in tenant_deltas.items()
+                                       if quotas[tenant_id][key] >= 0))
+                      for tenant_id, tenant_deltas in deltas.items())
+        deltas = dict((tenant_id, tenant_deltas)
+                      for tenant_id, tenant_deltas in deltas.items()
+                      if tenant_deltas)
+        if not deltas:
+            return []
+
+        now = timeutils.utcnow()
+        with context.session.begin(subtransactions=True):
+            usages = dict(
+                ((usage.tenant_id, usage.resource), usage) for usage in
+                context.session.query(QuotaUsage).filter(
+                    QuotaUsage.tenant_id.in_(deltas),
+                    QuotaUsage.resource.in_(keys)).with_lockmode('update'))
+            counted = set()
+            for tenant_id, tenant_deltas in deltas.items():
+                for key in tenant_deltas:
+                    usage = usages.get((tenant_id, key))
+                    if usage is None:
+                        usage = QuotaUsage(tenant_id=tenant_id, resource=key)
+                        context.session.add(usage)
+                        usages[(tenant_id, key)] = usage
+                    elif self._is_usage_current(usage, now):
+                        continue
+                    usage.in_use = count(tenant_id, key)
+                    usage.dirty = False
+                    usage.counted_at = now
+                    counted.add((tenant_id, key))
+
+            reserved = self._get_reserved(context, deltas.keys(), now)
+
+            def get_overs():
+                return set((tenant_id, key)
+                           for tenant_id, tenant_deltas in deltas.items()
+                           for key, val in tenant_deltas.items()
+                           if quotas[tenant_id][key] < (
+                               usages[(tenant_id, key)].in_use +
+                               reserved.get((tenant_id, key), 0) + val))
+
+            overs = get_overs()
+            if overs - counted:
+                # The cached usages err by excess when resources are deleted
+                # without going through the API, check them again
+                for tenant_id, key in overs - counted:
+                    usages[(tenant_id, key)].in_use = count(tenant_id, key)
+                    usages[(tenant_id, key)].counted_at = now
+                overs = get_overs()
+            if overs:
+                raise exceptions.OverQuota(
+                    overs=sorted(set(key for tenant_id, key in overs)))
+
+            expiration = now + datetime.timedelta(
+                seconds=cfg.CONF.QUOTAS.reservation_expiration)
+            reservations = [
+                Reservation(tenant_id=tenant_id,
+                            expiration=expiration,
+                            deltas=[ResourceDelta(resource=key, amount=val)
+                                    for key, val in tenant_deltas.items()])
+                for tenant_id, tenant_deltas in deltas.items()]
+            context.session.add_all(reservations)
+        return [reservation.id for reservation in reservations]
+
+    @staticmethod
+    def _get_reserved(context, tenant_ids, now):
+        """Return the amounts of resources held by pending reservations.
+
+        The expired reservations of the tenants are removed.
+
+        :return dict: from (tenant_id, resource) to amount
+        """
+        reserved = {}
+        query = context.session.query(Reservation).filter(
+            Reservation.tenant_id.in_(tenant_ids))
+        for reservation in query:
+            if reservation.expiration <= now:
+                context.session.delete(reservation)
+                continue
+            for delta in reservation.deltas:
+                key = (reservation.tenant_id, delta.resource)
+                reserved[key] = reserved.get(key, 0) + delta.amount
+        return reserved
+
+    def _delete_reservation(self, context, reservation_id, commit):
+        with context.session.begin(subtransactions=True):
+            reservation = context.session.query(Reservation).filter_by(
+                id=reservation_id).first()
+            # The reservation is gone if it expired in the meantime, the
+            # resources will be counted once the usages are too old
+            if not reservation:
+                return
+            if commit:
+                for delta in reservation.deltas:
+                    if delta.resource not in self._tracked_resources:
+                        continue
+                    context.session.query(QuotaUsage).filter_by(
+                        tenant_id=reservation.tenant_id,
+                        resource=delta.resource).update(
+                            {'in_use': QuotaUsage.in_use + delta.amount},
+                            synchronize_session=False)
+            context.session.delete(reservation)
+
+    def commit_reservation(self, context, reservation_id):
+        """Add the reserved resources to the usages once created."""
+        self._delete_reservation(context, reservation_id, True)
+
+    def cancel_reservation(self, context, reservation_id):
+        """Release the resources held by a reservation."""
+        self._delete_reservation(context, reservation_id, False)
+
+    @staticmethod
+    def mark_usages_dirty(context, tenant_id):
+        """Count the usages of a tenant again on its next reservation.
+
+        Deleting a resource may delete others, e.g. the ports of a network,
+        hence all the usages of the tenant are marked dirty.
+        """
+        with context.session.begin(subtransactions=True):
+            context.session.query(QuotaUsage).filter_by(
+                tenant_id=tenant_id, dirty=False).update(
+                    {'dirty': True}, synchronize_session=False)
+
+
+DbReservationQuotaDriver.register_tracked_resource('network')
+DbReservationQuotaDriver.register_tracked_resource('subnet')
+DbReservationQuotaDriver.register_tracked_resource('port')
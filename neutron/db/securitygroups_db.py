@@ -158,6 +158,10 @@ class SecurityGroupDbMixin(ext_sg.SecurityGroupPluginBase):
                                     limit=limit, marker_obj=marker_obj,
                                     page_reverse=page_reverse)
 
+    # Load the rules of all the listed security groups with a single query
+    db_base_plugin_v2.NeutronDbPluginV2.register_model_load_options(
+        SecurityGroup, 'securitygroups', [orm.subqueryload('rules')])
+
     def get_security_groups_count(self, context, filters=None):
         return self._get_collection_count(context, SecurityGroup,
                                           filters=filters)
@@ -13,16 +13,23 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+
 import netaddr
+from oslo.config import cfg
+from oslo.db import exception as db_exc
+import sqlalchemy as sa
 from sqlalchemy.orm import exc
 
 from neutron.common import constants as q_const
 from neutron.common import ipv6_utils as ipv6
 from neutron.common import utils
+from neutron.db import model_base
 from neutron.db import models_v2
 from neutron.db import securitygroups_db as sg_db
 from neutron.extensions import securitygroup as ext_sg
 from neutron.openstack.common import log as logging
+from neutron.openstack.common import timeutils
 
 LOG = logging.getLogger(__name__)
 
@@ -34,33 +41,203 @@ IP_MASK = {q_const.IPv4: 32,
 DIRECTION_IP_PREFIX = {'ingress': 'source_ip_prefix',
                        'egress': 'dest_ip_prefix'}
 
+security_group_server_opts = [
+    cfg.BoolOpt(
+        'enable_rules_cache',
+        default=False,
+        help=_('Cache the rules and members of the security groups sent to '
+               'the agents. The changes are recorded in the database, and '
+               'the cache of each server process is invalidated by the '
+               'changes recorded by all of them, hence the option must be '
+               'set alike on all the servers.')),
+    cfg.IntOpt(
+        'rules_cache_sync_margin',
+        default=60,
+        help=_('Number of seconds the changes recorded for the rules cache '
+               'are looked back for. It must exceed the duration of the '
+               'transactions changing security groups and the clock skew '
+               'between the servers.')),
+]
+cfg.CONF.register_opts(security_group_server_opts, 'SECURITYGROUP')
+
+
+class SecurityGroupCacheInvalidation(model_base.BASEV2):
+    """Represent a change of the rules or members of a security group.
+
+    The changes are recorded in the transactions making them, and read by
+    the servers caching the security groups before they use their cache.
+    """
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    security_group_id = sa.Column(sa.String(36), nullable=False)
+    created_at = sa.Column(sa.DateTime, nullable=False, index=True)
+
+
+class SecurityGroupRulesCache(object):
+    """Rules and member addresses of security groups, as sent to agents.
+
+    The entries are built once for all the ports of a security group, and
+    invalidated when the rules or the members of the group change. The
+    changes made by any server are recorded with record_changes() and
+    applied to the cache by sync().
+    """
+
+    def __init__(self):
+        self._rules = {}
+        self._members = {}
+        # Incremented on every invalidation, so that entries built from the
+        # database before an invalidation are not stored
+        self._generation = 0
+        self._synced_at = None
+        self._pruned_at = None
+        # The ids and times of the changes already applied
+        self._applied = {}
+
+    @staticmethod
+    def record_changes(context, sg_ids):
+        """Record that the rules or members of security groups change."""
+        now = timeutils.utcnow()
+        with context.session.begin(subtransactions=True):
+            for sg_id in set(sg_ids):
+                context.session.add(SecurityGroupCacheInvalidation(
+                    security_group_id=sg_id, created_at=now))
+
+    def sync(self, context):
+        """Invalidate the entries changed since the previous sync.
+
+        The changes are looked back for rules_cache_sync_margin seconds
+        before the previous sync, since a transaction may commit a change
+        after a later one.
+        """
+        now = timeutils.utcnow()
+        margin = datetime.timedelta(
+            seconds=cfg.CONF.SECURITYGROUP.rules_cache_sync_margin)
+        since = (self._synced_at or now) - margin
+        changed = set()
+        query = context.session.query(SecurityGroupCacheInvalidation).filter(
+            SecurityGroupCacheInvalidation.created_at >= since)
+        for change in query:
+            if change.id not in self._applied:
+                self._applied[change.id] = change.created_at
+                changed.add(change.security_group_id)
+        if changed:
+            self.invalidate_rules(changed)
+            self.invalidate_members(changed)
+        self._applied = dict((change_id, created_at) for change_id, created_at
+                             in self._applied.items() if created_at >= since)
+        self._synced_at = now
+        if self._pruned_at is None or now - self._pruned_at > margin:
+            self._prune(context, now - 2 * margin)
+            self._pruned_at = now
+
+    @staticmethod
+    def _prune(context, before):
+        try:
+            with context.session.begin(subtransactions=True):
+                context.session.query(SecurityGroupCacheInvalidation).filter(
+                    SecurityGroupCacheInvalidation.created_at < before
+                ).delete(synchronize_session=False)
+        except db_exc.DBError as e:
+            # Another server is pruning them
+            LOG.debug(_("Unable to prune the security group changes: %s"), e)
+
+    def get_rules(self, sg_ids, build_rules):
+        return self._get(self._rules, sg_ids, build_rules)
+
+    def get_members(self, sg_ids, build_members):
+        return self._get(self._members, sg_ids, build_members)
+
+    def invalidate_rules(self, sg_ids):
+        self._invalidate(self._rules, sg_ids)
+
+    def invalidate_members(self, sg_ids):
+        self._invalidate(self._members, sg_ids)
+
+    def _get(self, entries, sg_ids, build):
+        generation = self._generation
+        result = dict((sg_id, entries[sg_id])
+                      for sg_id in sg_ids if sg_id in entries)
+        missing = set(sg_ids) - set(result)
+        if missing:
+            built = build(missing)
+            if generation == self._generation:
+                entries.update(built)
+            result.update(built)
+        return result
+
+    def _invalidate(self, entries, sg_ids):
+        self._generation += 1
+        for sg_id in sg_ids or []:
+            entries.pop(sg_id, None)
+
+
+RULES_CACHE = SecurityGroupRulesCache()
+
 
 class SecurityGroupServerRpcMixin(sg_db.SecurityGroupDbMixin):
 
     def create_security_group_rule(self, context, security_group_rule):
         bulk_rule = {'security_group_rules': [security_group_rule]}
-        rule = self.create_security_group_rule_bulk_native(context,
-                                                           bulk_rule)[0]
+        with context.session.begin(subtransactions=True):
+            rule = self.create_security_group_rule_bulk_native(context,
+                                                               bulk_rule)[0]
+            self._record_rules_cache_changes(context,
+                                             [rule['security_group_id']])
         sgids = [rule['security_group_id']]
         self.notifier.security_groups_rule_updated(context, sgids)
         return rule
 
     def create_security_group_rule_bulk(self, context,
                                         security_group_rule):
-        rules = super(SecurityGroupServerRpcMixin,
-                      self).create_security_group_rule_bulk_native(
-                          context, security_group_rule)
-        sgids = set([r['security_group_id'] for r in rules])
+        with context.session.begin(subtransactions=True):
+            rules = super(SecurityGroupServerRpcMixin,
+                          self).create_security_group_rule_bulk_native(
+                              context, security_group_rule)
+            sgids = set([r['security_group_id'] for r in rules])
+            self._record_rules_cache_changes(context, sgids)
         self.notifier.security_groups_rule_updated(context, list(sgids))
         return rules
 
     def delete_security_group_rule(self, context, sgrid):
-        rule = self.get_security_group_rule(context, sgrid)
-        super(SecurityGroupServerRpcMixin,
-              self).delete_security_group_rule(context, sgrid)
+        with context.session.begin(subtransactions=True):
+            rule = self.get_security_group_rule(context, sgrid)
+            super(SecurityGroupServerRpcMixin,
+                  self).delete_security_group_rule(context, sgrid)
+            self._record_rules_cache_changes(context,
+                                             [rule['security_group_id']])
         self.notifier.security_groups_rule_updated(context,
                                                    [rule['security_group_id']])
 
+    def delete_security_group(self, context, id):
+        with context.session.begin(subtransactions=True):
+            # The rules of the groups using this one as remote group are
+            # deleted by cascade
+            query = context.session.query(
+                sg_db.SecurityGroupRule.security_group_id).filter_by(
+                    remote_group_id=id)
+            sgids = set(rule.security_group_id for rule in query)
+            sgids.add(id)
+            super(SecurityGroupServerRpcMixin,
+                  self).delete_security_group(context, id)
+            self._record_rules_cache_changes(context, sgids)
+
+    def _delete_port_security_group_bindings(self, context, port_id):
+        with context.session.begin(subtransactions=True):
+            if cfg.CONF.SECURITYGROUP.enable_rules_cache:
+                # The port leaves the members of its groups
+                query = context.session.query(
+                    sg_db.SecurityGroupPortBinding).filter_by(
+                        port_id=port_id)
+                self._record_rules_cache_changes(
+                    context,
+                    set(binding.security_group_id for binding in query))
+            super(SecurityGroupServerRpcMixin,
+                  self)._delete_port_security_group_bindings(context,
+                                                             port_id)
+
+    def _record_rules_cache_changes(self, context, sgids):
+        if cfg.CONF.SECURITYGROUP.enable_rules_cache and sgids:
+            RULES_CACHE.record_changes(context, sgids)
+
     def update_security_group_on_port(self, context, id, port,
                                       original_port, updated_port):
         """Update security groups on port.
@@ -103,6 +280,13 @@ class SecurityGroupServerRpcMixin(sg_db.SecurityGroupDbMixin):
                 original_port.get(ext_sg.SECURITYGROUPS),
                 updated_port.get(ext_sg.SECURITYGROUPS))):
             need_notify = True
+        if (need_notify or
+                original_port.get('allowed_address_pairs') !=
+                updated_port.get('allowed_address_pairs')):
+            self._record_rules_cache_changes(
+                context,
+                set(original_port.get(ext_sg.SECURITYGROUPS) or []) |
+                set(updated_port.get(ext_sg.SECURITYGROUPS) or []))
         return need_notify
 
     def notify_security_groups_member_updated(self, context, port):
@@ -116,6 +300,8 @@ class SecurityGroupServerRpcMixin(sg_db.SecurityGroupDbMixin):
         occurs and the plugin agent fetches the update provider
         rule in the other RPC call (security_group_rules_for_devices).
         """
+        self._record_rules_cache_changes(context,
+                                         port.get(ext_sg.SECURITYGROUPS))
         if port['device_owner'] == q_const.DEVICE_OWNER_DHCP:
             self.notifier.security_groups_provider_updated(context)
         # For IPv6, provider rule need to be updated in case router
@@ -143,8 +329,27 @@ class SecurityGroupServerRpcCallbackMixin(object):
         :params devices: list of devices
         :returns: port correspond to the devices with security group rules
         """
-        devices = kwargs.get('devices')
+        ports = self._get_ports_for_devices(kwargs.get('devices'))
+        return self._security_group_rules_for_ports(context, ports)
+
+    def security_group_info_for_devices(self, context, **kwargs):
+        """Return security group rules and members for the devices.
+
+        Unlike security_group_rules_for_devices, remote_group_id rules are
+        not converted: the rules of each security group and the member ips
+        of each remote group are returned once, and the agent builds the
+        rules of each port from them.
+
+        :params devices: list of devices
+        :returns: dict with the ports corresponding to the devices
+                  ('devices'), the rules of their security groups
+                  ('security_groups') and the member ips of the remote
+                  groups by ethertype ('sg_member_ips')
+        """
+        ports = self._get_ports_for_devices(kwargs.get('devices'))
+        return self._security_group_info_for_ports(context, ports)
 
+    def _get_ports_for_devices(self, devices):
         ports = {}
         for device in devices:
             port = self.get_port_from_device(device)
@@ -153,22 +358,54 @@ class SecurityGroupServerRpcCallbackMixin(object):
             if port['device_owner'].startswith('network:'):
                 continue
             ports[port['id']] = port
-        return self._security_group_rules_for_ports(context, ports)
+        return ports
 
-    def _select_rules_for_ports(self, context, ports):
+    def _get_rules_cache(self, context):
+        if cfg.CONF.SECURITYGROUP.enable_rules_cache:
+            RULES_CACHE.sync(context)
+            return RULES_CACHE
+        # The entries are still built once per security group for the
+        # ports of a request
+        return SecurityGroupRulesCache()
+
+    def _select_sg_ids_for_ports(self, context, ports):
+        sg_ids = dict((port_id, []) for port_id in ports)
         if not ports:
-            return []
+            return sg_ids
         sg_binding_port = sg_db.SecurityGroupPortBinding.port_id
         sg_binding_sgid = sg_db.SecurityGroupPortBinding.security_group_id
 
+        query = context.session.query(sg_binding_port, sg_binding_sgid)
+        query = query.filter(sg_binding_port.in_(ports.keys()))
+        for port_id, sg_id in query:
+            sg_ids[port_id].append(sg_id)
+        return sg_ids
+
+    def _select_rules_for_security_groups(self, context, sg_ids):
+        rules = dict((sg_id, []) for sg_id in sg_ids)
+        if not sg_ids:
+            return rules
         sgr_sgid = sg_db.SecurityGroupRule.security_group_id
 
-        query = context.session.query(sg_db.SecurityGroupPortBinding,
-                                      sg_db.SecurityGroupRule)
-        query = query.join(sg_db.SecurityGroupRule,
-                           sgr_sgid == sg_binding_sgid)
-        query = query.filter(sg_binding_port.in_(ports.keys()))
-        return query.all()
+        query = context.session.query(sg_db.SecurityGroupRule)
+        query = query.filter(sgr_sgid.in_(sg_ids))
+        for rule_in_db in query:
+            direction = rule_in_db['direction']
+            rule_dict = {
+                'security_group_id': rule_in_db['security_group_id'],
+                'direction': direction,
+                'ethertype': rule_in_db['ethertype'],
+            }
+            for key in ('protocol', 'port_range_min', 'port_range_max',
+                        'remote_ip_prefix', 'remote_group_id'):
+                if rule_in_db.get(key):
+                    if key == 'remote_ip_prefix':
+                        direction_ip_prefix = DIRECTION_IP_PREFIX[direction]
+                        rule_dict[direction_ip_prefix] = rule_in_db[key]
+                        continue
+                    rule_dict[key] = rule_in_db[key]
+            rules[rule_in_db['security_group_id']].append(rule_dict)
+        return rules
 
     def _select_ips_for_remote_group(self, context, remote_group_ids):
         ips_by_group = {}
@@ -289,7 +526,9 @@ class SecurityGroupServerRpcCallbackMixin(object):
 
     def _convert_remote_group_id_to_ip_prefix(self, context, ports):
         remote_group_ids = self._select_remote_group_ids(ports)
-        ips = self._select_ips_for_remote_group(context, remote_group_ids)
+        ips = self._get_rules_cache(context).get_members(
+            remote_group_ids,
+            lambda sg_ids: self._select_ips_for_remote_group(context, sg_ids))
         for port in ports.values():
             updated_rule = []
             for rule in port.get('security_group_rules'):
@@ -355,24 +594,50 @@ class SecurityGroupServerRpcCallbackMixin(object):
             self._add_ingress_dhcp_rule(port, ips_dhcp)
 
     def _security_group_rules_for_ports(self, context, ports):
-        rules_in_db = self._select_rules_for_ports(context, ports)
-        for (binding, rule_in_db) in rules_in_db:
-            port_id = binding['port_id']
-            port = ports[port_id]
-            direction = rule_in_db['direction']
-            rule_dict = {
-                'security_group_id': rule_in_db['security_group_id'],
-                'direction': direction,
-                'ethertype': rule_in_db['ethertype'],
-            }
-            for key in ('protocol', 'port_range_min', 'port_range_max',
-                        'remote_ip_prefix', 'remote_group_id'):
-                if rule_in_db.get(key):
-                    if key == 'remote_ip_prefix':
-                        direction_ip_prefix = DIRECTION_IP_PREFIX[direction]
-                        rule_dict[direction_ip_prefix] = rule_in_db[key]
-                        continue
-                    rule_dict[key] = rule_in_db[key]
-            port['security_group_rules'].append(rule_dict)
+        sg_ids_by_port = self._select_sg_ids_for_ports(context, ports)
+        rules = self._get_rules_cache(context).get_rules(
+            set(sg_id for sg_ids in sg_ids_by_port.values()
+                for sg_id in sg_ids),
+            lambda sg_ids: self._select_rules_for_security_groups(context,
+                                                                  sg_ids))
+        for port_id, sg_ids in sg_ids_by_port.items():
+            # The rules are shared by the ports and the cache, they must not
+            # be modified
+            for sg_id in sg_ids:
+                ports[port_id]['security_group_rules'].extend(rules[sg_id])
         self._apply_provider_rule(context, ports)
         return self._convert_remote_group_id_to_ip_prefix(context, ports)
+
+    def _security_group_info_for_ports(self, context, ports):
+        cache = self._get_rules_cache(context)
+        sg_ids_by_port = self._select_sg_ids_for_ports(context, ports)
+        rules = cache.get_rules(
+            set(sg_id for sg_ids in sg_ids_by_port.values()
+                for sg_id in sg_ids),
+            lambda sg_ids: self._select_rules_for_security_groups(context,
+                                                                  sg_ids))
+        remote_group_ids = set()
+        for port_id, sg_ids in sg_ids_by_port.items():
+            port = ports[port_id]
+            port['security_groups'] = sg_ids
+            source_groups = set(rule['remote_group_id']
+                                for sg_id in sg_ids for rule in rules[sg_id]
+                                if rule.get('remote_group_id'))
+            port['security_group_source_groups'].extend(source_groups)
+            remote_group_ids |= source_groups
+        members = cache.get_members(
+            remote_group_ids,
+            lambda sg_ids: self._select_ips_for_remote_group(context, sg_ids))
+        sg_member_ips = {}
+        for sg_id, ips in members.items():
+            member_ips = {q_const.IPv4: [], q_const.IPv6: []}
+            for ip in ips:
+                version = netaddr.IPNetwork(ip).version
+                member_ips['IPv%s' % version].append(ip)
+            sg_member_ips[sg_id] = member_ips
+        # The provider rules are specific to each port, they are kept in the
+        # security group rules of the ports
+        self._apply_provider_rule(context, ports)
+        return {'devices': ports,
+                'security_groups': rules,
+                'sg_member_ips': sg_member_ips}
@@ -37,6 +37,11 @@ def paginate_query(query, model, limit, sorts, marker_obj=None):
     (k1 > X1) or (k1 == X1 && k2 > X2) or (k1 == X1 && k2 == X2 && k3 > X3)
     The reason of didn't use OFFSET clause was it don't scale, please refer
     discussion at https://lists.launchpad.net/openstack/msg02547.html
+    Databases can't use an index to evaluate a disjunction like this one, so
+    the redundant criterion (k1 >= X1) is added as well: it lets them seek
+    into an index starting with k1, e.g. the primary key or a composite
+    index on the sort keys, and scan only the rows of the requested page
+    instead of all the rows before the marker.
 
     We also have to cope with different sort directions.
 
@@ -99,6 +104,14 @@ def paginate_query(query, model, limit, sorts, marker_obj=None):
             criteria_list.append(criteria)
 
         f = sqlalchemy.sql.or_(*criteria_list)
+        if len(sorts) > 1:
+            # Bound the leading sort key so that the rows before the
+            # marker can be skipped with an index seek
+            model_attr = getattr(model, sorts[0][0])
+            if sorts[0][1]:
+                f = sqlalchemy.sql.and_(model_attr >= marker_values[0], f)
+            else:
+                f = sqlalchemy.sql.and_(model_attr <= marker_values[0], f)
         query = query.filter(f)
 
     if limit:
@@ -122,7 +122,7 @@ class Quotasv2(extensions.ExtensionDescriptor):
     @classmethod
     def get_description(cls):
         description = 'Expose functions for quotas management'
-        if cfg.CONF.QUOTAS.quota_driver == DB_QUOTA_DRIVER:
+        if cfg.CONF.QUOTAS.quota_driver in quota.QUOTA_DB_DRIVERS:
             description += ' per tenant'
         return description
 
@@ -83,11 +83,12 @@ class BridgeRpcCallbacks(n_rpc.RpcCallback,
                          sg_db_rpc.SecurityGroupServerRpcCallbackMixin):
     """Agent callback."""
 
-    RPC_API_VERSION = '1.2'
+    RPC_API_VERSION = '1.3'
     # Device names start with "tap"
     # history
     #   1.1 Support Security Group RPC
     #   1.2 Support get_devices_details_list
+    #   1.3 Support security_group_info_for_devices
     TAP_PREFIX_LEN = 3
 
     @classmethod
@@ -871,6 +871,8 @@ class LinuxBridgeNeutronAgentRPC(sg_rpc.SecurityGroupAgentRpcMixin):
             # resync is needed
             return True
 
+        devices_up = []
+        devices_down = []
         for device_details in devices_details_list:
             device = device_details['device']
             LOG.debug("Port %s added", device)
@@ -895,43 +897,48 @@ class LinuxBridgeNeutronAgentRPC(sg_rpc.SecurityGroupAgentRpcMixin):
                         segmentation_id,
                         device_details['port_id']):
 
-                        # update plugin about port status
-                        self.plugin_rpc.update_device_up(self.context,
-                                                         device,
-                                                         self.agent_id,
-                                                         cfg.CONF.host)
+                        devices_up.append(device)
                     else:
-                        self.plugin_rpc.update_device_down(self.context,
-                                                           device,
-                                                           self.agent_id,
-                                                           cfg.CONF.host)
+                        devices_down.append(device)
                 else:
                     self.remove_port_binding(device_details['network_id'],
                                              device_details['port_id'])
             else:
                 LOG.info(_("Device %s not defined on plugin"), device)
+        # update plugin about port status
+        if devices_up:
+            self.plugin_rpc.update_devices_up(self.context,
+                                              devices_up,
+                                              self.agent_id,
+                                              cfg.CONF.host)
+        if devices_down:
+            self.plugin_rpc.update_devices_down(self.context,
+                                                devices_down,
+                                                self.agent_id,
+                                                cfg.CONF.host)
         return False
 
     def treat_devices_removed(self, devices):
         resync = False
         self.remove_devices_filter(devices)
+        devices = list(devices)
         for device in devices:
             LOG.info(_("Attachment %s removed"), device)
-            details = None
-            try:
-                details = self.plugin_rpc.update_device_down(self.context,
-                                                             device,
-                                                             self.agent_id,
-                                                             cfg.CONF.host)
-            except Exception as e:
-                LOG.debug(_("port_removed failed for %(device)s: %(e)s"),
-                          {'device': device, 'e': e})
-                resync = True
-            if details and details['exists']:
-                LOG.info(_("Port %s updated."), device)
+        devices_details_list = []
+        try:
+            devices_details_list = self.plugin_rpc.update_devices_down(
+                self.context, devices, self.agent_id, cfg.CONF.host)
+        except Exception as e:
+            LOG.debug(_("port_removed failed for %(devices)s: %(e)s"),
+                      {'devices': devices, 'e': e})
+            resync = True
+        for details in devices_details_list:
+            if details['exists']:
+                LOG.info(_("Port %s updated."), details['device'])
             else:
-                LOG.debug(_("Device %s not defined on plugin"), device)
-            self.br_mgr.remove_empty_bridges()
+                LOG.debug(_("Device %s not defined on plugin"),
+                          details['device'])
+        self.br_mgr.remove_empty_bridges()
         return resync
 
     def scan_devices(self, previous, sync):
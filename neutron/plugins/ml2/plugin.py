@@ -29,6 +29,7 @@ from neutron.common import topics
 from neutron.db import agents_db
 from neutron.db import agentschedulers_db
 from neutron.db import allowedaddresspairs_db as addr_pair_db
+from neutron.db import api as db_api
 from neutron.db import db_base_plugin_v2
 from neutron.db import external_net_db
 from neutron.db import extradhcpopt_db
@@ -632,6 +633,7 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
             # the fact that an error occurred.
             LOG.error(_("mechanism_manager.delete_subnet_postcommit failed"))
 
+    @db_api.retry_ip_allocation
     def create_port(self, context, port):
         attrs = port['port']
         attrs['status'] = const.PORT_STATUS_DOWN
@@ -665,6 +667,7 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
         self.notify_security_groups_member_updated(context, result)
         return result
 
+    @db_api.retry_ip_allocation
     def update_port(self, context, id, port):
         attrs = port['port']
         need_port_update_notify = False
@@ -714,6 +717,7 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
 
         return updated_port
 
+    @db_api.retry_ip_allocation
     def delete_port(self, context, id, l3_port_check=True):
         LOG.debug(_("Deleting port %s"), id)
         l3plugin = manager.NeutronManager.get_service_plugins().get(
@@ -763,33 +767,49 @@ class Ml2Plugin(db_base_plugin_v2.NeutronDbPluginV2,
         self.notify_security_groups_member_updated(context, port)
 
     def update_port_status(self, context, port_id, status):
-        updated = False
+        return self.update_port_statuses(context, [port_id], status)[port_id]
+
+    def update_port_statuses(self, context, port_ids, status, host=None):
+        """Update the status of ports in a single transaction.
+
+        The ports which aren't bound to host, when given, are left
+        unchanged. Return a dict telling whether each port exists.
+        """
+        exists = {}
+        mech_contexts = []
         session = context.session
         # REVISIT: Serialize this operation with a semaphore to prevent
         # undesired eventlet yields leading to 'lock wait timeout' errors
         with contextlib.nested(lockutils.lock('db-access'),
                                session.begin(subtransactions=True)):
-            port = db.get_port(session, port_id)
-            if not port:
-                LOG.warning(_("Port %(port)s updated up by agent not found"),
-                            {'port': port_id})
-                return False
-            if port.status != status:
-                original_port = self._make_port_dict(port)
-                port.status = status
-                updated_port = self._make_port_dict(port)
-                network = self.get_network(context,
-                                           original_port['network_id'])
-                mech_context = driver_context.PortContext(
-                    self, context, updated_port, network,
-                    original_port=original_port)
-                self.mechanism_manager.update_port_precommit(mech_context)
-                updated = True
-
-        if updated:
+            for port_id in port_ids:
+                port = db.get_port(session, port_id)
+                exists[port_id] = bool(port)
+                if not port:
+                    LOG.warning(_("Port %(port)s updated up by agent not "
+                                  "found"), {'port': port_id})
+                    continue
+                if host and (not port.port_binding or
+                             port.port_binding.host != host):
+                    LOG.debug(_("Port %(port)s not bound to the agent host "
+                                "%(host)s"), {'port': port_id, 'host': host})
+                    continue
+                if port.status != status:
+                    original_port = self._make_port_dict(port)
+                    port.status = status
+                    updated_port = self._make_port_dict(port)
+                    network = self.get_network(context,
+                                               original_port['network_id'])
+                    mech_context = driver_context.PortContext(
+                        self, context, updated_port, network,
+                        original_port=original_port)
+                    self.mechanism_manager.update_port_precommit(mech_context)
+                    mech_contexts.append(mech_context)
+
+        for mech_context in mech_contexts:
             self.mechanism_manager.update_port_postcommit(mech_context)
 
-        return True
+        return exists
 
     def port_bound_to_host(self, port_id, host):
         port_host = db.get_port_binding_host(port_id)
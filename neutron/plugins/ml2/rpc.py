@@ -40,11 +40,13 @@ class RpcCallbacks(n_rpc.RpcCallback,
                    sg_db_rpc.SecurityGroupServerRpcCallbackMixin,
                    type_tunnel.TunnelRpcCallbackMixin):
 
-    RPC_API_VERSION = '1.2'
+    RPC_API_VERSION = '1.4'
     # history
     #   1.0 Initial version (from openvswitch/linuxbridge)
     #   1.1 Support Security Group RPC
     #   1.2 Support get_devices_details_list
+    #   1.3 Support security_group_info_for_devices
+    #   1.4 Support update_devices_up and update_devices_down
 
     def __init__(self, notifier, type_manager):
         self.setup_tunnel_callback_mixin(notifier, type_manager)
@@ -200,6 +202,38 @@ class RpcCallbacks(n_rpc.RpcCallback,
         plugin.update_port_status(rpc_context, port_id,
                                   q_const.PORT_STATUS_ACTIVE)
 
+    def _update_devices_status(self, rpc_context, status, **kwargs):
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices', [])
+        host = kwargs.get('host')
+        LOG.debug(_("Devices %(devices)s %(status)s at agent %(agent_id)s"),
+                  {'devices': devices, 'status': status,
+                   'agent_id': agent_id})
+        plugin = manager.NeutronManager.get_plugin()
+        port_ids = dict((device, self._device_to_port_id(device))
+                        for device in devices)
+        exists = plugin.update_port_statuses(rpc_context,
+                                             set(port_ids.values()),
+                                             status, host)
+        return [{'device': device, 'exists': exists[port_ids[device]]}
+                for device in devices]
+
+    def update_devices_down(self, rpc_context, **kwargs):
+        """Devices no longer exist on agent.
+
+        The status of all the devices is updated in a single transaction.
+        """
+        return self._update_devices_status(rpc_context,
+                                           q_const.PORT_STATUS_DOWN, **kwargs)
+
+    def update_devices_up(self, rpc_context, **kwargs):
+        """Devices are up on agent.
+
+        The status of all the devices is updated in a single transaction.
+        """
+        self._update_devices_status(rpc_context, q_const.PORT_STATUS_ACTIVE,
+                                    **kwargs)
+
 
 class AgentNotifierApi(n_rpc.RpcProxy,
                        sg_rpc.SecurityGroupAgentRpcApiMixin,
@@ -277,6 +277,15 @@ class L3AgentSchedulerDbMixin(l3_agentschedulers_db.L3AgentSchedulerDbMixin):
             return super(L3AgentSchedulerDbMixin, self).schedule_router(
                 context, router)
 
+    def schedule_routers(self, context, routers):
+        if not routers:
+            return
+        router_ids = rdb.get_routers_by_provider(
+            context.session, nconst.ROUTER_PROVIDER_L3AGENT, routers)
+        if router_ids:
+            return super(L3AgentSchedulerDbMixin, self).schedule_routers(
+                context, router_ids)
+
     def add_router_to_l3_agent(self, context, id, router_id):
         provider = self._get_provider_by_router_id(context, router_id)
         if provider != nconst.ROUTER_PROVIDER_L3AGENT:
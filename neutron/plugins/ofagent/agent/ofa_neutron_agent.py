@@ -1089,7 +1089,10 @@ class OFANeutronAgent(n_rpc.RpcCallback,
 
     def treat_devices_added_or_updated(self, devices):
         resync = False
-        all_ports = dict((p.port_name, p) for p in self._get_ports())
+        all_ports = dict((p.port_name, p)
+                         for p in self._get_ports(self.int_br))
+        devices_up = []
+        devices_down = []
         for device in devices:
             LOG.debug(_("Processing port %s"), device)
             if device not in all_ports:
@@ -1123,21 +1126,26 @@ class OFANeutronAgent(n_rpc.RpcCallback,
                 # update plugin about port status
                 if details.get('admin_state_up'):
                     LOG.debug(_("Setting status for %s to UP"), device)
-                    self.plugin_rpc.update_device_up(
-                        self.context, device, self.agent_id, cfg.CONF.host)
+                    devices_up.append(device)
                 else:
                     LOG.debug(_("Setting status for %s to DOWN"), device)
-                    self.plugin_rpc.update_device_down(
-                        self.context, device, self.agent_id, cfg.CONF.host)
+                    devices_down.append(device)
                 LOG.info(_("Configuration for device %s completed."), device)
             else:
                 LOG.warn(_("Device %s not defined on plugin"), device)
                 if (port and port.ofport != -1):
                     self.port_dead(port)
+        if devices_up:
+            self.plugin_rpc.update_devices_up(
+                self.context, devices_up, self.agent_id, cfg.CONF.host)
+        if devices_down:
+            self.plugin_rpc.update_devices_down(
+                self.context, devices_down, self.agent_id, cfg.CONF.host)
         return resync
 
     def treat_ancillary_devices_added(self, devices):
         resync = False
+        devices_up = []
         for device in devices:
             LOG.info(_("Ancillary Port %s added"), device)
             try:
@@ -1149,52 +1157,53 @@ class OFANeutronAgent(n_rpc.RpcCallback,
                           {'device': device, 'e': e})
                 resync = True
                 continue
-
-            # update plugin about port status
-            self.plugin_rpc.update_device_up(self.context,
-                                             device,
-                                             self.agent_id,
-                                             cfg.CONF.host)
+            devices_up.append(device)
+
+        # update plugin about port status
+        if devices_up:
+            self.plugin_rpc.update_devices_up(self.context,
+                                              devices_up,
+                                              self.agent_id,
+                                              cfg.CONF.host)
         return resync
 
     def treat_devices_removed(self, devices):
-        resync = False
         self.sg_agent.remove_devices_filter(devices)
+        devices = list(devices)
         for device in devices:
             LOG.info(_("Attachment %s removed"), device)
-            try:
-                self.plugin_rpc.update_device_down(self.context,
-                                                   device,
-                                                   self.agent_id,
-                                                   cfg.CONF.host)
-            except Exception as e:
-                LOG.debug(_("port_removed failed for %(device)s: %(e)s"),
-                          {'device': device, 'e': e})
-                resync = True
-                continue
+        try:
+            self.plugin_rpc.update_devices_down(self.context,
+                                                devices,
+                                                self.agent_id,
+                                                cfg.CONF.host)
+        except Exception as e:
+            LOG.debug(_("port_removed failed for %(devices)s: %(e)s"),
+                      {'devices': devices, 'e': e})
+            return True
+        for device in devices:
             self.port_unbound(device)
-        return resync
+        return False
 
     def treat_ancillary_devices_removed(self, devices):
-        resync = False
+        devices = list(devices)
         for device in devices:
             LOG.info(_("Attachment %s removed"), device)
-            try:
-                details = self.plugin_rpc.update_device_down(self.context,
-                                                             device,
-                                                             self.agent_id,
-                                                             cfg.CONF.host)
-            except Exception as e:
-                LOG.debug(_("port_removed failed for %(device)s: %(e)s"),
-                          {'device': device, 'e': e})
-                resync = True
-                continue
+        try:
+            devices_details_list = self.plugin_rpc.update_devices_down(
+                self.context, devices, self.agent_id, cfg.CONF.host)
+        except Exception as e:
+            LOG.debug(_("port_removed failed for %(devices)s: %(e)s"),
+                      {'devices': devices, 'e': e})
+            return True
+        for details in devices_details_list:
             if details['exists']:
-                LOG.info(_("Port %s updated."), device)
+                LOG.info(_("Port %s updated."), details['device'])
                 # Nothing to do regarding local networking
             else:
-                LOG.debug(_("Device %s not defined on plugin"), device)
-        return resync
+                LOG.debug(_("Device %s not defined on plugin"),
+                          details['device'])
+        return False
 
     def process_network_ports(self, port_info):
         resync_add = False
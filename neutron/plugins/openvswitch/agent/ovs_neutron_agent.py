@@ -14,7 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import hashlib
+import random
 import signal
 import sys
 import time
@@ -51,6 +53,10 @@ LOG = logging.getLogger(__name__)
 # A placeholder for dead vlans.
 DEAD_VLAN_TAG = str(q_const.MAX_VLAN_TAG + 1)
 
+# The OpenFlow versions of the bridges when the flow changes are applied in
+# OpenFlow 1.4 bundles
+ATOMIC_FLOW_UPDATES_PROTOCOLS = '[OpenFlow10,OpenFlow14]'
+
 
 # A class to represent a VIF (i.e., a port that has 'iface-id' and 'vif-mac'
 # attributes set).
@@ -181,7 +187,15 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         # Keep track of int_br's device count for use by _report_state()
         self.int_br_device_count = 0
 
+        # The cookie of the flows of this run of the agent, the flows of
+        # the previous runs are deleted once the new ones are in place
+        self.agent_cookie = random.getrandbits(64)
+        if tunnel_types:
+            self.enable_tunneling = True
+        else:
+            self.enable_tunneling = False
         self.int_br = ovs_lib.OVSBridge(integ_br, self.root_helper)
+        self.int_br.default_cookie = self.agent_cookie
         self.setup_integration_br()
         # Stores port update notifications for processing in main rpc loop
         self.updated_ports = set()
@@ -196,17 +210,15 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         self.minimize_polling = minimize_polling
         self.ovsdb_monitor_respawn_interval = ovsdb_monitor_respawn_interval
 
-        if tunnel_types:
-            self.enable_tunneling = True
-        else:
-            self.enable_tunneling = False
         self.local_ip = local_ip
         self.tunnel_count = 0
         self.vxlan_udp_port = cfg.CONF.AGENT.vxlan_udp_port
         self.dont_fragment = cfg.CONF.AGENT.dont_fragment
+        self.atomic_flow_updates = cfg.CONF.AGENT.atomic_flow_updates
         self.tun_br = None
         if self.enable_tunneling:
             self.setup_tunnel_br(tun_br)
+        self.setup_bridge_protocols()
         # Collect additional bridges to monitor
         self.ancillary_brs = self.setup_ancillary_bridges(integ_br, tun_br)
 
@@ -326,23 +338,23 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
             agent_ports = values.get('ports')
             agent_ports.pop(self.local_ip, None)
             if len(agent_ports):
-                self.tun_br.defer_apply_on()
-                for agent_ip, ports in agent_ports.items():
-                    # Ensure we have a tunnel port with this remote agent
-                    ofport = self.tun_br_ofports[
-                        lvm.network_type].get(agent_ip)
-                    if not ofport:
-                        remote_ip_hex = self.get_ip_in_hex(agent_ip)
-                        if not remote_ip_hex:
-                            continue
-                        port_name = '%s-%s' % (lvm.network_type, remote_ip_hex)
-                        ofport = self.setup_tunnel_port(port_name, agent_ip,
-                                                        lvm.network_type)
-                        if ofport == 0:
-                            continue
-                    for port in ports:
-                        self._add_fdb_flow(port, lvm, ofport)
-                self.tun_br.defer_apply_off()
+                with self.tun_br.flow_transaction():
+                    for agent_ip, ports in agent_ports.items():
+                        # Ensure we have a tunnel port with this remote agent
+                        ofport = self.tun_br_ofports[
+                            lvm.network_type].get(agent_ip)
+                        if not ofport:
+                            remote_ip_hex = self.get_ip_in_hex(agent_ip)
+                            if not remote_ip_hex:
+                                continue
+                            port_name = '%s-%s' % (lvm.network_type,
+                                                   remote_ip_hex)
+                            ofport = self.setup_tunnel_port(
+                                port_name, agent_ip, lvm.network_type)
+                            if ofport == 0:
+                                continue
+                        for port in ports:
+                            self._add_fdb_flow(port, lvm, ofport)
 
     def fdb_remove(self, context, fdb_entries):
         LOG.debug(_("fdb_remove received"))
@@ -354,15 +366,14 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
             agent_ports = values.get('ports')
             agent_ports.pop(self.local_ip, None)
             if len(agent_ports):
-                self.tun_br.defer_apply_on()
-                for agent_ip, ports in agent_ports.items():
-                    ofport = self.tun_br_ofports[
-                        lvm.network_type].get(agent_ip)
-                    if not ofport:
-                        continue
-                    for port in ports:
-                        self._del_fdb_flow(port, lvm, ofport)
-                self.tun_br.defer_apply_off()
+                with self.tun_br.flow_transaction():
+                    for agent_ip, ports in agent_ports.items():
+                        ofport = self.tun_br_ofports[
+                            lvm.network_type].get(agent_ip)
+                        if not ofport:
+                            continue
+                        for port in ports:
+                            self._del_fdb_flow(port, lvm, ofport)
 
     def _add_fdb_flow(self, port_info, lvm, ofport):
         if port_info == q_const.FLOODING_ENTRY:
@@ -722,7 +733,9 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
     def setup_integration_br(self):
         '''Setup the integration bridge.
 
-        Create patch ports and remove all existing flows.
+        Remove the patch port to the tunnel bridge if tunneling is disabled,
+        and add the default flows. The existing flows are kept until
+        delete_stale_flows is called.
 
         :param bridge_name: the name of the integration bridge.
         :returns: the integration bridge
@@ -734,8 +747,10 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         self.int_br.create()
         self.int_br.set_secure_mode()
 
-        self.int_br.delete_port(cfg.CONF.OVS.int_peer_patch_port)
-        self.int_br.remove_all_flows()
+        if not self.enable_tunneling:
+            # The patch port to the tunnel bridge is kept forwarding the
+            # tunnelled traffic when tunneling is enabled
+            self.int_br.delete_port(cfg.CONF.OVS.int_peer_patch_port)
         # switch all traffic using L2 learning
         self.int_br.add_flow(priority=1, actions="normal")
         # Add a canary flow to int_br to track OVS restarts
@@ -778,8 +793,9 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         '''
         if not self.tun_br:
             self.tun_br = ovs_lib.OVSBridge(tun_br, self.root_helper)
+            self.tun_br.default_cookie = self.agent_cookie
 
-        self.tun_br.reset_bridge()
+        self.tun_br.create()
         self.patch_tun_ofport = self.int_br.add_patch_port(
             cfg.CONF.OVS.int_peer_patch_port, cfg.CONF.OVS.tun_peer_patch_port)
         self.patch_int_ofport = self.tun_br.add_patch_port(
@@ -790,7 +806,6 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                         "of OVS does not support tunnels or patch ports. "
                         "Agent terminated!"))
             exit(1)
-        self.tun_br.remove_all_flows()
 
         # Table 0 (default) will sort incoming traffic depending on in_port
         self.tun_br.add_flow(priority=1,
@@ -890,7 +905,8 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         '''Setup the physical network bridges.
 
         Creates physical network bridges and links them to the
-        integration bridge using veths.
+        integration bridge using veths. The links set up by a previous run
+        are kept.
 
         :param bridge_mappings: map physical network names to bridge names.
         '''
@@ -913,7 +929,7 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                            'bridge': bridge})
                 sys.exit(1)
             br = ovs_lib.OVSBridge(bridge, self.root_helper)
-            br.remove_all_flows()
+            br.default_cookie = self.agent_cookie
             br.add_flow(priority=1, actions="normal")
             self.phys_brs[physical_network] = br
 
@@ -922,27 +938,39 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                                              bridge)
             phys_if_name = self.get_peer_name(constants.PEER_PHYSICAL_PREFIX,
                                               bridge)
-            self.int_br.delete_port(int_if_name)
-            br.delete_port(phys_if_name)
-            if self.use_veth_interconnection:
-                if ip_lib.device_exists(int_if_name, self.root_helper):
-                    ip_lib.IPDevice(int_if_name,
-                                    self.root_helper).link.delete()
-                    # Give udev a chance to process its rules here, to avoid
-                    # race conditions between commands launched by udev rules
-                    # and the subsequent call to ip_wrapper.add_veth
-                    utils.execute(['/sbin/udevadm', 'settle', '--timeout=10'])
-                int_veth, phys_veth = ip_wrapper.add_veth(int_if_name,
-                                                          phys_if_name)
-                int_ofport = self.int_br.add_port(int_veth)
-                phys_ofport = br.add_port(phys_veth)
+            if self._is_interconnected(br, int_if_name, phys_if_name):
+                # Keep the interconnection of a previous run forwarding the
+                # traffic until the flows of this run replace its flows
+                int_ofport = self.int_br.get_port_ofport(int_if_name)
+                phys_ofport = br.get_port_ofport(phys_if_name)
+                if self.use_veth_interconnection:
+                    int_veth = ip_lib.IPDevice(int_if_name, self.root_helper)
+                    phys_veth = ip_lib.IPDevice(phys_if_name,
+                                                self.root_helper)
             else:
-                # Create patch ports without associating them in order to block
-                # untranslated traffic before association
-                int_ofport = self.int_br.add_patch_port(
-                    int_if_name, constants.NONEXISTENT_PEER)
-                phys_ofport = br.add_patch_port(
-                    phys_if_name, constants.NONEXISTENT_PEER)
+                self.int_br.delete_port(int_if_name)
+                br.delete_port(phys_if_name)
+                if self.use_veth_interconnection:
+                    if ip_lib.device_exists(int_if_name, self.root_helper):
+                        ip_lib.IPDevice(int_if_name,
+                                        self.root_helper).link.delete()
+                        # Give udev a chance to process its rules here, to
+                        # avoid race conditions between commands launched by
+                        # udev rules and the subsequent call to
+                        # ip_wrapper.add_veth
+                        utils.execute(['/sbin/udevadm', 'settle',
+                                       '--timeout=10'])
+                    int_veth, phys_veth = ip_wrapper.add_veth(int_if_name,
+                                                              phys_if_name)
+                    int_ofport = self.int_br.add_port(int_veth)
+                    phys_ofport = br.add_port(phys_veth)
+                else:
+                    # Create patch ports without associating them in order
+                    # to block untranslated traffic before association
+                    int_ofport = self.int_br.add_patch_port(
+                        int_if_name, constants.NONEXISTENT_PEER)
+                    phys_ofport = br.add_patch_port(
+                        phys_if_name, constants.NONEXISTENT_PEER)
 
             self.int_ofports[physical_network] = int_ofport
             self.phys_ofports[physical_network] = phys_ofport
@@ -967,6 +995,28 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                 br.set_db_attribute('Interface', phys_if_name,
                                     'options:peer', int_if_name)
 
+    def _is_interconnected(self, br, int_if_name, phys_if_name):
+        '''Check if a physical bridge is linked to the integration bridge.
+
+        :param br: the physical bridge.
+        :param int_if_name: the name of the port on the integration bridge.
+        :param phys_if_name: the name of the port on the physical bridge.
+        :returns: whether both ports exist and are linked the configured way,
+                  by veths or by patch ports peered to each other.
+        '''
+        if (self.int_br.get_port_ofport(int_if_name) ==
+                constants.INVALID_OFPORT or
+                br.get_port_ofport(phys_if_name) == constants.INVALID_OFPORT):
+            return False
+        int_peer = self.int_br.db_get_map('Interface', int_if_name,
+                                          'options').get('peer')
+        phys_peer = br.db_get_map('Interface', phys_if_name,
+                                  'options').get('peer')
+        if self.use_veth_interconnection:
+            return (int_peer is None and phys_peer is None and
+                    ip_lib.device_exists(int_if_name, self.root_helper))
+        return int_peer == phys_if_name and phys_peer == int_if_name
+
     def scan_ports(self, registered_ports, updated_ports=None):
         cur_ports = self.int_br.get_vif_port_set()
         self.int_br_device_count = len(cur_ports)
@@ -1051,6 +1101,7 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         else:
             LOG.debug(_("No VIF port for port %s defined on agent."), port_id)
 
+    @q_utils.synchronized('ovs-tunnel-ports')
     def setup_tunnel_port(self, port_name, remote_ip, tunnel_type):
         ofport = self.tun_br.add_tunnel_port(port_name,
                                              remote_ip,
@@ -1116,42 +1167,61 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                       {'devices': devices, 'e': e})
             # resync is needed
             return True
-        for details in devices_details_list:
-            device = details['device']
-            LOG.debug("Processing port: %s", device)
-            port = self.int_br.get_vif_port_by_id(device)
-            if not port:
-                # The port has disappeared and should not be processed
-                # There is no need to put the port DOWN in the plugin as
-                # it never went up in the first place
-                LOG.info(_("Port %s was not found on the integration bridge "
-                           "and will therefore not be processed"), device)
-                continue
+        try:
+            vif_ports = self.int_br.get_vif_ports_by_ids(
+                details['device'] for details in devices_details_list)
+        except Exception as e:
+            LOG.debug("Unable to get the ports of %(devices)s: %(e)s",
+                      {'devices': devices, 'e': e})
+            # resync is needed
+            return True
+        devices_up = []
+        devices_down = []
+        # The ports are wired before their status is reported
+        with self._flow_transaction():
+            for details in devices_details_list:
+                device = details['device']
+                LOG.debug("Processing port: %s", device)
+                port = vif_ports.get(device)
+                if not port:
+                    # The port has disappeared and should not be processed
+                    # There is no need to put the port DOWN in the plugin as
+                    # it never went up in the first place
+                    LOG.info(_("Port %s was not found on the integration "
+                               "bridge and will therefore not be processed"),
+                             device)
+                    continue
 
-            if 'port_id' in details:
-                LOG.info(_("Port %(device)s updated. Details: %(details)s"),
-                         {'device': device, 'details': details})
-                self.treat_vif_port(port, details['port_id'],
-                                    details['network_id'],
-                                    details['network_type'],
-                                    details['physical_network'],
-                                    details['segmentation_id'],
-                                    details['admin_state_up'],
-                                    ovs_restarted)
-                # update plugin about port status
-                if details.get('admin_state_up'):
-                    LOG.debug(_("Setting status for %s to UP"), device)
-                    self.plugin_rpc.update_device_up(
-                        self.context, device, self.agent_id, cfg.CONF.host)
+                if 'port_id' in details:
+                    LOG.info(_("Port %(device)s updated. "
+                               "Details: %(details)s"),
+                             {'device': device, 'details': details})
+                    self.treat_vif_port(port, details['port_id'],
+                                        details['network_id'],
+                                        details['network_type'],
+                                        details['physical_network'],
+                                        details['segmentation_id'],
+                                        details['admin_state_up'],
+                                        ovs_restarted)
+                    # update plugin about port status
+                    if details.get('admin_state_up'):
+                        LOG.debug(_("Setting status for %s to UP"), device)
+                        devices_up.append(device)
+                    else:
+                        LOG.debug(_("Setting status for %s to DOWN"), device)
+                        devices_down.append(device)
+                    LOG.info(_("Configuration for device %s completed."),
+                             device)
                 else:
-                    LOG.debug(_("Setting status for %s to DOWN"), device)
-                    self.plugin_rpc.update_device_down(
-                        self.context, device, self.agent_id, cfg.CONF.host)
-                LOG.info(_("Configuration for device %s completed."), device)
-            else:
-                LOG.warn(_("Device %s not defined on plugin"), device)
-                if (port and port.ofport != -1):
-                    self.port_dead(port)
+                    LOG.warn(_("Device %s not defined on plugin"), device)
+                    if (port and port.ofport != -1):
+                        self.port_dead(port)
+        if devices_up:
+            self.plugin_rpc.update_devices_up(
+                self.context, devices_up, self.agent_id, cfg.CONF.host)
+        if devices_down:
+            self.plugin_rpc.update_devices_down(
+                self.context, devices_down, self.agent_id, cfg.CONF.host)
         return False
 
     def treat_ancillary_devices_added(self, devices):
@@ -1166,55 +1236,58 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
             # resync is needed
             return True
 
+        devices_up = []
         for details in devices_details_list:
             device = details['device']
             LOG.info(_("Ancillary Port %s added"), device)
-
-            # update plugin about port status
-            self.plugin_rpc.update_device_up(self.context,
-                                             device,
-                                             self.agent_id,
-                                             cfg.CONF.host)
+            devices_up.append(device)
+
+        # update plugin about port status
+        if devices_up:
+            self.plugin_rpc.update_devices_up(self.context,
+                                              devices_up,
+                                              self.agent_id,
+                                              cfg.CONF.host)
         return False
 
     def treat_devices_removed(self, devices):
-        resync = False
         self.sg_agent.remove_devices_filter(devices)
+        devices = list(devices)
         for device in devices:
             LOG.info(_("Attachment %s removed"), device)
-            try:
-                self.plugin_rpc.update_device_down(self.context,
-                                                   device,
-                                                   self.agent_id,
-                                                   cfg.CONF.host)
-            except Exception as e:
-                LOG.debug(_("port_removed failed for %(device)s: %(e)s"),
-                          {'device': device, 'e': e})
-                resync = True
-                continue
-            self.port_unbound(device)
-        return resync
+        try:
+            self.plugin_rpc.update_devices_down(self.context,
+                                                devices,
+                                                self.agent_id,
+                                                cfg.CONF.host)
+        except Exception as e:
+            LOG.debug(_("port_removed failed for %(devices)s: %(e)s"),
+                      {'devices': devices, 'e': e})
+            return True
+        with self._flow_transaction():
+            for device in devices:
+                self.port_unbound(device)
+        return False
 
     def treat_ancillary_devices_removed(self, devices):
-        resync = False
+        devices = list(devices)
         for device in devices:
             LOG.info(_("Attachment %s removed"), device)
-            try:
-                details = self.plugin_rpc.update_device_down(self.context,
-                                                             device,
-                                                             self.agent_id,
-                                                             cfg.CONF.host)
-            except Exception as e:
-                LOG.debug(_("port_removed failed for %(device)s: %(e)s"),
-                          {'device': device, 'e': e})
-                resync = True
-                continue
+        try:
+            devices_details_list = self.plugin_rpc.update_devices_down(
+                self.context, devices, self.agent_id, cfg.CONF.host)
+        except Exception as e:
+            LOG.debug(_("port_removed failed for %(devices)s: %(e)s"),
+                      {'devices': devices, 'e': e})
+            return True
+        for details in devices_details_list:
             if details['exists']:
-                LOG.info(_("Port %s updated."), device)
+                LOG.info(_("Port %s updated."), details['device'])
                 # Nothing to do regarding local networking
             else:
-                LOG.debug(_("Device %s not defined on plugin"), device)
-        return resync
+                LOG.debug(_("Device %s not defined on plugin"),
+                          details['device'])
+        return False
 
     def process_network_ports(self, port_info, ovs_restarted):
         resync_a = False
@@ -1332,6 +1405,70 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         canary_flow = self.int_br.dump_flows_for_table(constants.CANARY_TABLE)
         return not canary_flow
 
+    def _get_flow_bridges(self):
+        """Return the bridges whose flows are programmed by the agent."""
+        bridges = [self.int_br] + self.phys_brs.values()
+        if self.enable_tunneling:
+            bridges.append(self.tun_br)
+        return bridges
+
+    def setup_bridge_protocols(self):
+        '''Enable the OpenFlow versions needed by the agent on its bridges.
+
+        The flow changes are applied in OpenFlow 1.4 bundles when
+        atomic_flow_updates is set, the other ovs-ofctl commands use
+        OpenFlow 1.0.
+        '''
+        if self.atomic_flow_updates:
+            for bridge in self._get_flow_bridges():
+                bridge.set_protocols(ATOMIC_FLOW_UPDATES_PROTOCOLS)
+
+    def _flow_transaction(self):
+        """Collect the flow changes made to the bridges of the agent.
+
+        The changes are applied when the block exits, with one ovs-ofctl
+        call per bridge and kind of consecutive changes, or as one bundle
+        per bridge if atomic_flow_updates is set.
+        """
+        return contextlib.nested(
+            *[bridge.flow_transaction(atomic=self.atomic_flow_updates)
+              for bridge in self._get_flow_bridges()])
+
+    def delete_stale_flows(self):
+        """Delete the flows left over by the previous runs of the agent.
+
+        The flows of the previous runs keep forwarding until the flows of
+        this run are in place, and are told apart by their cookie.
+        """
+        LOG.info(_("Deleting the flows of the previous runs of the agent"))
+        with self._flow_transaction():
+            for bridge in self._get_flow_bridges():
+                bridge.delete_stale_flows()
+        if self.enable_tunneling:
+            self.delete_stale_tunnel_ports()
+
+    @q_utils.synchronized('ovs-tunnel-ports')
+    def delete_stale_tunnel_ports(self):
+        """Delete the tunnel ports left over by the previous runs.
+
+        The tunnel ports which were not set up by this run have no flows
+        left once the flows of the previous runs are deleted.
+        """
+        tunnel_ports = set()
+        for tunnel_type, ofports in self.tun_br_ofports.iteritems():
+            tunnel_ports.update('%s-%s' % (tunnel_type,
+                                           self.get_ip_in_hex(remote_ip))
+                                for remote_ip in ofports)
+        flow_ofports = self.tun_br.get_flow_ofports()
+        for port_name in self.tun_br.get_port_name_list():
+            tunnel_type = port_name.split('-', 1)[0]
+            if (tunnel_type not in self.tun_br_ofports or
+                    port_name in tunnel_ports or
+                    self.tun_br.get_port_ofport(port_name) in flow_ofports):
+                continue
+            LOG.info(_("Deleting stale tunnel port %s"), port_name)
+            self.tun_br.delete_port(port_name)
+
     def rpc_loop(self, polling_manager=None):
         if not polling_manager:
             polling_manager = polling.AlwaysPoll()
@@ -1342,6 +1479,7 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
         ancillary_ports = set()
         tunnel_sync = True
         ovs_restarted = False
+        stale_flows = True
         while self.run_daemon_loop:
             start = time.time()
             port_stats = {'regular': {'added': 0,
@@ -1364,11 +1502,13 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                 if self.enable_tunneling:
                     self.setup_tunnel_br()
                     tunnel_sync = True
+                self.setup_bridge_protocols()
             # Notify the plugin of tunnel IP
             if self.enable_tunneling and tunnel_sync:
                 LOG.info(_("Agent tunnel out of sync with plugin!"))
                 try:
-                    tunnel_sync = self.tunnel_sync()
+                    with self._flow_transaction():
+                        tunnel_sync = self.tunnel_sync()
                 except Exception:
                     LOG.exception(_("Error while synchronizing tunnels"))
                     tunnel_sync = True
@@ -1444,6 +1584,13 @@ class OVSNeutronAgent(n_rpc.RpcCallback,
                     self.updated_ports |= updated_ports_copy
                     sync = True
 
+            # Once the ports and tunnels are synchronized, the flows of the
+            # previous runs of the agent are not needed anymore
+            if (stale_flows and not sync and
+                    not (self.enable_tunneling and tunnel_sync)):
+                self.delete_stale_flows()
+                stale_flows = False
+
             # sleep till end of polling interval
             elapsed = (time.time() - start)
             LOG.debug(_("Agent rpc_loop - iteration:%(iter_num)d "
@@ -86,6 +86,10 @@ agent_opts = [
     cfg.BoolOpt('dont_fragment', default=True,
                 help=_("Set or un-set the don't fragment (DF) bit on "
                        "outgoing IP packet carrying GRE/VXLAN tunnel")),
+    cfg.BoolOpt('atomic_flow_updates', default=False,
+                help=_("Apply the flow changes made together by the agent "
+                       "atomically, as an OpenFlow 1.4 bundle. Requires OVS "
+                       "2.4, OpenFlow14 is enabled on the bridges")),
 ]
 
 
@@ -66,8 +66,9 @@ class OVSRpcCallbacks(n_rpc.RpcCallback,
     #   1.0 Initial version
     #   1.1 Support Security Group RPC
     #   1.2 Support get_devices_details_list
+    #   1.3 Support security_group_info_for_devices
 
-    RPC_API_VERSION = '1.2'
+    RPC_API_VERSION = '1.3'
 
     def __init__(self, notifier, tunnel_type):
         super(OVSRpcCallbacks, self).__init__()
@@ -33,6 +33,12 @@ from neutron.openstack.common import policy
 LOG = logging.getLogger(__name__)
 _POLICY_PATH = None
 _POLICY_CACHE = {}
+# Match rules built by _build_match_rule, keyed by action and by the
+# policy enforced attributes (and sub-attributes) set in the target
+_MATCH_RULE_CACHE = {}
+# The keys include sub-attributes from the request body, bound the size
+# of the cache
+_MATCH_RULE_CACHE_SIZE = 1024
 ADMIN_CTX_POLICY = 'context_is_admin'
 # Maps deprecated 'extension' policies to new-style policies
 DEPRECATED_POLICY_MAP = {
@@ -50,6 +56,10 @@ DEPRECATED_ACTION_MAP = {
     'view': ['get'],
     'set': ['create', 'update']
 }
+# Fields of the parent resources looked up by the owner checks. The
+# network ownership check of the API controller looks the networks up with
+# the same fields and privileges, so both share the cached network.
+PARENT_FIELDS = {'network': ['tenant_id', 'shared']}
 
 cfg.CONF.import_opt('policy_file', 'neutron.common.config')
 
@@ -59,6 +69,7 @@ def reset():
     global _POLICY_CACHE
     _POLICY_PATH = None
     _POLICY_CACHE = {}
+    _MATCH_RULE_CACHE.clear()
     policy.reset()
 
 
@@ -113,6 +124,7 @@ def _set_rules(data):
                 LOG.error(_("Backward compatibility unavailable for "
                             "deprecated policy %s. The policy will "
                             "not be enforced"), pol)
+    _MATCH_RULE_CACHE.clear()
     policy.set_rules(policies)
 
 
@@ -149,6 +161,36 @@ def _build_subattr_match_rule(attr_name, attr, action, target):
     return policy.AndCheck(sub_attr_rules)
 
 
+def _get_enforced_attributes(resource, target):
+    """Return the attributes of target subject to attribute-based checks.
+
+    Each item is a tuple holding the attribute name and, for attributes
+    whose sub-attributes are checked as well, the sorted names of the keys
+    set in the target value.
+    """
+    # assigning to variable with short name for improving readability
+    res_map = attributes.RESOURCE_ATTRIBUTE_MAP
+    enforced_attributes = []
+    if resource in res_map:
+        for attribute_name in res_map[resource]:
+            if _is_attribute_explicitly_set(attribute_name,
+                                            res_map[resource],
+                                            target):
+                attribute = res_map[resource][attribute_name]
+                if 'enforce_policy' in attribute:
+                    sub_attributes = None
+                    validate = attribute.get('validate')
+                    if (validate and any([k.startswith('type:dict') and v
+                                          for (k, v) in
+                                          validate.iteritems()])):
+                        value = target[attribute_name]
+                        sub_attributes = tuple(sorted(
+                            value if isinstance(value, dict) else []))
+                    enforced_attributes.append(
+                        (attribute_name, sub_attributes))
+    return tuple(enforced_attributes)
+
+
 def _build_match_rule(action, target):
     """Create the rule to match for a given action.
 
@@ -160,32 +202,33 @@ def _build_match_rule(action, target):
     4) add an entry for sub-attributes of a resource for which the
        action is being executed
        (e.g.: create_router:external_gateway_info:network_id)
+
+    The rule only depends on the action and on the attributes set in the
+    target, so it is built once and then served from _MATCH_RULE_CACHE.
     """
-    match_rule = policy.RuleCheck('rule', action)
     resource, is_write = get_resource_and_action(action)
     # Attribute-based checks shall not be enforced on GETs
-    if is_write:
-        # assigning to variable with short name for improving readability
-        res_map = attributes.RESOURCE_ATTRIBUTE_MAP
-        if resource in res_map:
-            for attribute_name in res_map[resource]:
-                if _is_attribute_explicitly_set(attribute_name,
-                                                res_map[resource],
-                                                target):
-                    attribute = res_map[resource][attribute_name]
-                    if 'enforce_policy' in attribute:
-                        attr_rule = policy.RuleCheck('rule', '%s:%s' %
-                                                     (action, attribute_name))
-                        # Build match entries for sub-attributes, if present
-                        validate = attribute.get('validate')
-                        if (validate and any([k.startswith('type:dict') and v
-                                              for (k, v) in
-                                              validate.iteritems()])):
-                            attr_rule = policy.AndCheck(
-                                [attr_rule, _build_subattr_match_rule(
-                                    attribute_name, attribute,
-                                    action, target)])
-                        match_rule = policy.AndCheck([match_rule, attr_rule])
+    enforced_attributes = (is_write and
+                           _get_enforced_attributes(resource, target) or ())
+    key = (action, enforced_attributes)
+    match_rule = _MATCH_RULE_CACHE.get(key)
+    if match_rule is not None:
+        return match_rule
+    match_rule = policy.RuleCheck('rule', action)
+    for attribute_name, sub_attributes in enforced_attributes:
+        attr_rule = policy.RuleCheck('rule', '%s:%s' %
+                                     (action, attribute_name))
+        # Build match entries for sub-attributes, if present
+        if sub_attributes is not None:
+            attribute = attributes.RESOURCE_ATTRIBUTE_MAP[resource][
+                attribute_name]
+            attr_rule = policy.AndCheck(
+                [attr_rule, _build_subattr_match_rule(
+                    attribute_name, attribute, action, target)])
+        match_rule = policy.AndCheck([match_rule, attr_rule])
+    if len(_MATCH_RULE_CACHE) >= _MATCH_RULE_CACHE_SIZE:
+        _MATCH_RULE_CACHE.clear()
+    _MATCH_RULE_CACHE[key] = match_rule
     return match_rule
 
 
@@ -268,10 +311,24 @@ class OwnerCheck(policy.Check):
             # f *must* exist, if not found it is better to let neutron
             # explode. Check will be performed with admin context
             context = importutils.import_module('neutron.context')
+            fields = PARENT_FIELDS.get(parent_res, [])
+            if parent_field not in fields:
+                fields = [parent_field]
+
+            def get_parent(parent_id):
+                return f(context.get_admin_context(), parent_id,
+                         fields=fields)
+
             try:
-                data = f(context.get_admin_context(),
-                         target[parent_foreign_key],
-                         fields=[parent_field])
+                # The parent is looked up once per request, even if it is
+                # referenced by several rules or items of a bulk request
+                request_context = getattr(creds, 'context', None)
+                if request_context:
+                    data = request_context.get_cached_resource(
+                        parent_res, target[parent_foreign_key], get_parent,
+                        fields=fields, admin=True)
+                else:
+                    data = get_parent(target[parent_foreign_key])
                 target[self.target_field] = data[parent_field]
             except Exception:
                 with excutils.save_and_reraise_exception():
@@ -320,10 +377,26 @@ def _prepare_check(context, action, target):
     if target is None:
         target = {}
     match_rule = _build_match_rule(action, target)
-    credentials = context.to_dict()
+    credentials = Credentials(context)
     return match_rule, target, credentials
 
 
+class Credentials(dict):
+    """The credentials of a context, along with the context itself.
+
+    The context is not one of the items of the dict, so that checks
+    serializing the credentials, like HttpCheck, are not affected.
+    """
+
+    def __init__(self, context):
+        super(Credentials, self).__init__(context.to_dict())
+        neutron_context = importutils.import_module('neutron.context')
+        if isinstance(context, neutron_context.ContextBase):
+            self.context = context
+        else:
+            self.context = None
+
+
 def check(context, action, target, plugin=None, might_not_exist=False):
     """Verifies that the action is valid on the target in this context.
 
@@ -346,6 +419,34 @@ def check(context, action, target, plugin=None, might_not_exist=False):
     return policy.check(*(_prepare_check(context, action, target)))
 
 
+def check_many(context, actions, target, might_not_exist=False):
+    """Verifies a list of actions on the same target in this context.
+
+    This is equivalent to calling check() for each action, but the
+    credentials are extracted from the context only once.
+
+    :param context: neutron context
+    :param actions: list of strings representing the actions to be checked
+    :param target: dictionary representing the object of the actions
+    :param might_not_exist: If True the policy check is skipped for the
+        actions whose policy does not exist.
+
+    :return: Returns a list with the result of the check of each action.
+    """
+    if target is None:
+        target = {}
+    credentials = Credentials(context)
+    results = []
+    for action in actions:
+        if might_not_exist and not (policy._rules and
+                                    action in policy._rules):
+            results.append(True)
+        else:
+            results.append(policy.check(_build_match_rule(action, target),
+                                        target, credentials))
+    return results
+
+
 def enforce(context, action, target, plugin=None):
     """Verifies that the action is valid on the target in this context.
 
@@ -26,6 +26,8 @@ from neutron.openstack.common import log as logging
 LOG = logging.getLogger(__name__)
 QUOTA_DB_MODULE = 'neutron.db.quota_db'
 QUOTA_DB_DRIVER = 'neutron.db.quota_db.DbQuotaDriver'
+QUOTA_DB_RESERVATION_DRIVER = 'neutron.db.quota_db.DbReservationQuotaDriver'
+QUOTA_DB_DRIVERS = (QUOTA_DB_DRIVER, QUOTA_DB_RESERVATION_DRIVER)
 QUOTA_CONF_DRIVER = 'neutron.quota.ConfDriver'
 
 quota_opts = [
@@ -52,6 +54,16 @@ quota_opts = [
     cfg.StrOpt('quota_driver',
                default=QUOTA_DB_DRIVER,
                help=_('Default driver to use for quota checks')),
+    cfg.IntOpt('reservation_expiration',
+               default=120,
+               help=_('Number of seconds after which the quota reservations '
+                      'which were neither committed nor cancelled expire. '
+                      'Only used by quota drivers supporting reservations.')),
+    cfg.IntOpt('usage_max_age',
+               default=60,
+               help=_('Number of seconds after which the usages cached by '
+                      'the quota drivers supporting reservations are counted '
+                      'again. Zero or a negative value disables it.')),
 ]
 # Register the configuration options
 cfg.CONF.register_opts(quota_opts, 'QUOTAS')
@@ -86,10 +98,8 @@ class ConfDriver(object):
         if len(keys) != len(sub_resources):
             unknown = desired - set(sub_resources.keys())
             raise exceptions.QuotaResourceUnknown(unknown=sorted(unknown))
-        quotas = {}
-        for resource in sub_resources.values():
-            quotas[resource.name] = resource.default
-        return quotas
+        return dict((resource.name, resource.default)
+                    for resource in sub_resources.values())
 
     def limit_check(self, context, tenant_id,
                     resources, values):
@@ -114,19 +124,37 @@ class ConfDriver(object):
         :param values: A dictionary of the values to check against the
                        quota.
         """
+        self.bulk_limit_check(context, resources, {tenant_id: values})
+
+    def bulk_limit_check(self, context, resources, values):
+        """Check simple quota limits of several tenants at once.
+
+        The quotas are retrieved once for all the tenants, and a single
+        OverQuota exception is raised with the sorted list of the resources
+        which are too high for any of the tenants.
+
+        :param context: The request context, for access checks.
+        :param resources: A dictionary of the registered resources.
+        :param values: A dictionary from tenant_id to dictionary of the
+                       values to check against the quota of the tenant.
+        """
 
         # Ensure no value is less than zero
-        unders = [key for key, val in values.items() if val < 0]
+        unders = set(key for tenant_values in values.values()
+                     for key, val in tenant_values.items() if val < 0)
         if unders:
             raise exceptions.InvalidQuotaValue(unders=sorted(unders))
 
-        # Get the applicable quotas
-        quotas = self._get_quotas(context, resources, values.keys())
+        # Get the applicable quotas, which are the same for all tenants
+        keys = set(key for tenant_values in values.values()
+                   for key in tenant_values)
+        quotas = self._get_quotas(context, resources, keys)
 
         # Check the quotas and construct a list of the resources that
         # would be put over limit by the desired values
-        overs = [key for key, val in values.items()
-                 if quotas[key] >= 0 and quotas[key] < val]
+        overs = set(key for tenant_values in values.values()
+                    for key, val in tenant_values.items()
+                    if quotas[key] >= 0 and quotas[key] < val)
         if overs:
             raise exceptions.OverQuota(overs=sorted(overs), quotas=quotas,
                                        usages={})
@@ -157,15 +185,18 @@ class ConfDriver(object):
 class BaseResource(object):
     """Describe a single resource for quota checking."""
 
-    def __init__(self, name, flag):
+    def __init__(self, name, flag, plural_name=None):
         """Initializes a resource.
 
         :param name: The name of the resource, i.e., "instances".
         :param flag: The name of the flag or configuration option
+        :param plural_name: The name of the collection of the resource,
+                            i.e., "instances". Defaults to name + "s".
         """
 
         self.name = name
         self.flag = flag
+        self.plural_name = plural_name or name + 's'
 
     @property
     def default(self):
@@ -178,7 +209,7 @@ class BaseResource(object):
 class CountableResource(BaseResource):
     """Describe a resource where the counts are determined by a function."""
 
-    def __init__(self, name, count, flag=None):
+    def __init__(self, name, count, flag=None, plural_name=None):
         """Initializes a CountableResource.
 
         Countable resources are those resources which directly
@@ -199,9 +230,11 @@ class CountableResource(BaseResource):
         :param flag: The name of the flag or configuration option
                      which specifies the default value of the quota
                      for this resource.
+        :param plural_name: The name of the collection of the resource.
         """
 
-        super(CountableResource, self).__init__(name, flag=flag)
+        super(CountableResource, self).__init__(name, flag=flag,
+                                                plural_name=plural_name)
         self.count = count
 
 
@@ -219,7 +252,7 @@ class QuotaEngine(object):
         if self._driver is None:
             _driver_class = (self._driver_class or
                              cfg.CONF.QUOTAS.quota_driver)
-            if (_driver_class == QUOTA_DB_DRIVER and
+            if (_driver_class in QUOTA_DB_DRIVERS and
                     QUOTA_DB_MODULE not in sys.modules):
                 # If quotas table is not loaded, force config quota driver.
                 _driver_class = QUOTA_CONF_DRIVER
@@ -241,10 +274,11 @@ class QuotaEngine(object):
             return
         self._resources[resource.name] = resource
 
-    def register_resource_by_name(self, resourcename):
+    def register_resource_by_name(self, resourcename, plural_name=None):
         """Register a resource by name."""
         resource = CountableResource(resourcename, _count_resource,
-                                     'quota_' + resourcename)
+                                     'quota_' + resourcename,
+                                     plural_name=plural_name)
         self.register_resource(resource)
 
     def register_resources(self, resources):
@@ -297,6 +331,83 @@ class QuotaEngine(object):
         return self.get_driver().limit_check(context, tenant_id,
                                              self._resources, values)
 
+    def make_reservations(self, context, deltas, plugin):
+        """Reserve resources for one or more tenants.
+
+        Check that the tenants can create the given amounts of resources,
+        taking into account the resources currently in use and the ones
+        reserved by other requests, and reserve them until the reservations
+        are committed, cancelled or expired. All the resources created by a
+        request, e.g. a bulk request, are checked at once.
+
+        The usage of each resource is counted once per tenant by calling
+        its count() function with the plugin, the collection name of the
+        resource and the tenant id, unless the driver knows it already.
+
+        If the driver does not support reservations, only the limits are
+        checked, and no reservation is returned.
+
+        This method will raise a QuotaResourceUnknown exception if a
+        given resource is unknown, and an OverQuota exception with all the
+        resources which would be put over quota by the deltas.
+
+        :param context: The request context, for access checks.
+        :param deltas: A dictionary from tenant id to dictionary of the
+                       amounts of resources to reserve for the tenant.
+        :param plugin: The plugin owning the resources.
+        :return: the list of the ids of the reservations.
+        """
+        unknown = set(key for tenant_deltas in deltas.values()
+                      for key in tenant_deltas if key not in self._resources)
+        if unknown:
+            raise exceptions.QuotaResourceUnknown(unknown=sorted(unknown))
+
+        def count(tenant_id, resource):
+            res = self._resources[resource]
+            return res.count(context, plugin, res.plural_name, tenant_id)
+
+        driver = self.get_driver()
+        if hasattr(driver, 'make_reservations'):
+            return driver.make_reservations(context, self._resources,
+                                            deltas, count)
+        values = dict(
+            (tenant_id, dict((key, count(tenant_id, key) + delta)
+                             for key, delta in tenant_deltas.items()))
+            for tenant_id, tenant_deltas in deltas.items())
+        if hasattr(driver, 'bulk_limit_check'):
+            driver.bulk_limit_check(context, self._resources, values)
+        else:
+            for tenant_id, tenant_values in values.items():
+                driver.limit_check(context, tenant_id, self._resources,
+                                   tenant_values)
+        return []
+
+    def commit_reservation(self, context, reservation_id):
+        """Commit a reservation once the resources have been created.
+
+        :param context: The request context, for access checks.
+        :param reservation_id: An id returned by make_reservations().
+        """
+        self.get_driver().commit_reservation(context, reservation_id)
+
+    def cancel_reservation(self, context, reservation_id):
+        """Release the resources of a reservation which failed.
+
+        :param context: The request context, for access checks.
+        :param reservation_id: An id returned by make_reservations().
+        """
+        self.get_driver().cancel_reservation(context, reservation_id)
+
+    def mark_usages_dirty(self, context, tenant_id):
+        """Have the usages of a tenant counted again once it deleted some.
+
+        :param context: The request context, for access checks.
+        :param tenant_id: The tenant which deleted resources.
+        """
+        driver = self.get_driver()
+        if hasattr(driver, 'mark_usages_dirty'):
+            driver.mark_usages_dirty(context, tenant_id)
+
     @property
     def resources(self):
         return self._resources
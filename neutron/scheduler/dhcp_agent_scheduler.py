@@ -13,15 +13,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import heapq
 import random
 
 from oslo.config import cfg
 from oslo.db import exception as db_exc
+import sqlalchemy as sa
 from sqlalchemy import sql
 
 from neutron.common import constants
 from neutron.db import agents_db
 from neutron.db import agentschedulers_db
+from neutron.extensions import dhcpagentscheduler
 from neutron.openstack.common import log as logging
 
 
@@ -92,6 +96,18 @@ class ChanceScheduler(object):
         self._schedule_bind_network(context, chosen_agents, network['id'])
         return chosen_agents
 
+    def schedule_networks(self, plugin, context, networks):
+        """Schedule networks to active DHCP agent(s).
+
+        A dict of the lists of scheduled agents by network id is returned.
+        """
+        scheduled = {}
+        for network in networks:
+            agents = self.schedule(plugin, context, network)
+            if agents:
+                scheduled[network['id']] = agents
+        return scheduled
+
     def auto_schedule_networks(self, plugin, context, host):
         """Schedule non-hosted networks to the DHCP agent on
         the specified host.
@@ -131,3 +147,231 @@ class ChanceScheduler(object):
         for agent, net_id in bindings_to_add:
             self._schedule_bind_network(context, [agent], net_id)
         return True
+
+
+class LeastNetworksScheduler(ChanceScheduler):
+    """Allocate the DHCP agents hosting the fewest networks to networks.
+
+    A batch of networks is scheduled in a single transaction, keeping count
+    of the networks hosted by each agent as the networks are scheduled.
+    """
+
+    def _get_active_dhcp_agents(self, context, host=None):
+        query = context.session.query(agents_db.Agent)
+        query = query.filter(agents_db.Agent.agent_type ==
+                             constants.AGENT_TYPE_DHCP,
+                             agents_db.Agent.admin_state_up == sql.true())
+        if host is not None:
+            query = query.filter(agents_db.Agent.host == host)
+        return [agent for agent in query
+                if not agents_db.AgentDbMixin.is_agent_down(
+                    agent.heartbeat_timestamp)]
+
+    def _get_agents_loads(self, context, agent_ids):
+        """Return the number of networks hosted by agent id."""
+        binding = agentschedulers_db.NetworkDhcpAgentBinding
+        query = context.session.query(binding.dhcp_agent_id,
+                                      sa.func.count(binding.network_id))
+        query = query.filter(binding.dhcp_agent_id.in_(agent_ids))
+        loads = dict.fromkeys(agent_ids, 0)
+        loads.update(query.group_by(binding.dhcp_agent_id))
+        return loads
+
+    def _get_hosting_agents(self, context, network_ids):
+        """Return the ids of the agents hosting the networks by network id."""
+        binding = agentschedulers_db.NetworkDhcpAgentBinding
+        query = context.session.query(binding.network_id,
+                                      binding.dhcp_agent_id)
+        query = query.filter(binding.network_id.in_(network_ids))
+        hosting_agents = collections.defaultdict(set)
+        for network_id, agent_id in query:
+            hosting_agents[network_id].add(agent_id)
+        return hosting_agents
+
+    def schedule(self, plugin, context, network):
+        """Schedule the network to the least loaded active DHCP agent(s).
+
+        A list of scheduled agents is returned.
+        """
+        return self.schedule_networks(
+            plugin, context, [network]).get(network['id'])
+
+    def schedule_networks(self, plugin, context, networks):
+        """Schedule networks to the least loaded active DHCP agents.
+
+        A dict of the lists of scheduled agents by network id is returned.
+        """
+        agents_per_network = cfg.CONF.dhcp_agents_per_network
+        network_ids = [network['id'] for network in networks]
+        scheduled = {}
+        try:
+            with context.session.begin(subtransactions=True):
+                agents = dict((agent.id, agent) for agent in
+                              self._get_active_dhcp_agents(context))
+                if not agents:
+                    LOG.warn(_('No more DHCP agents'))
+                    return scheduled
+                loads = self._get_agents_loads(context, list(agents))
+                hosting_agents = self._get_hosting_agents(context,
+                                                          network_ids)
+                binding = agentschedulers_db.NetworkDhcpAgentBinding
+
+                for network_id in network_ids:
+                    n_agents = (agents_per_network -
+                                len(hosting_agents[network_id]))
+                    if n_agents <= 0:
+                        LOG.debug(_('Network %s is hosted already'),
+                                  network_id)
+                        continue
+                    chosen_agent_ids = [
+                        agent_id for load, agent_id in heapq.nsmallest(
+                            n_agents,
+                            ((loads[agent_id], agent_id) for agent_id in agents
+                             if agent_id not in hosting_agents[network_id]))]
+                    if not chosen_agent_ids:
+                        LOG.warn(_('No more DHCP agents'))
+                        continue
+                    for agent_id in chosen_agent_ids:
+                        loads[agent_id] += 1
+                        hosting_agents[network_id].add(agent_id)
+                        context.session.add(binding(
+                            network_id=network_id, dhcp_agent_id=agent_id))
+                    scheduled[network_id] = [agents[agent_id] for agent_id
+                                             in chosen_agent_ids]
+                # write the bindings so that a concurrent scheduling of
+                # the networks is caught here
+                context.session.flush()
+        except db_exc.DBDuplicateEntry:
+            if len(networks) == 1:
+                # it's totally ok, someone just did our job!
+                LOG.info(_('Network %s was scheduled concurrently'),
+                         network_ids[0])
+                return {}
+            LOG.info(_('Networks were scheduled concurrently, scheduling '
+                       'them one by one'))
+            scheduled = {}
+            for network in networks:
+                scheduled.update(
+                    self.schedule_networks(plugin, context, [network]))
+            return scheduled
+
+        for network_id, agents in scheduled.iteritems():
+            LOG.debug(_('Network %(network_id)s is scheduled to be hosted '
+                        'by DHCP agent(s) %(agent_ids)s'),
+                      {'network_id': network_id,
+                       'agent_ids': [agent.id for agent in agents]})
+        return scheduled
+
+    def auto_schedule_networks(self, plugin, context, host):
+        """Schedule non-hosted networks to the DHCP agent on
+        the specified host.
+
+        The networks are bound in a single transaction, or one by one if
+        they are scheduled concurrently.
+        """
+        agents_per_network = cfg.CONF.dhcp_agents_per_network
+        fields = ['network_id', 'enable_dhcp']
+        subnets = plugin.get_subnets(context, fields=fields)
+        net_ids = sorted(set(s['network_id'] for s in subnets
+                             if s['enable_dhcp']))
+        if not net_ids:
+            LOG.debug(_('No non-hosted networks'))
+            return False
+        binding = agentschedulers_db.NetworkDhcpAgentBinding
+        # a list of (agent, net_id) tuples
+        bindings_to_add = []
+        try:
+            with context.session.begin(subtransactions=True):
+                dhcp_agents = self._get_active_dhcp_agents(context, host)
+                if not dhcp_agents:
+                    LOG.warn(_('No active DHCP agent on host %s'), host)
+                    return True
+                hosting_agents = self._get_hosting_agents(context, net_ids)
+                for dhcp_agent in dhcp_agents:
+                    for net_id in net_ids:
+                        agent_ids = hosting_agents[net_id]
+                        if (len(agent_ids) >= agents_per_network or
+                                dhcp_agent.id in agent_ids):
+                            continue
+                        agent_ids.add(dhcp_agent.id)
+                        bindings_to_add.append((dhcp_agent, net_id))
+                        context.session.add(binding(
+                            network_id=net_id, dhcp_agent_id=dhcp_agent.id))
+                # write the bindings so that a concurrent scheduling of
+                # the networks is caught here
+                context.session.flush()
+        except db_exc.DBDuplicateEntry:
+            LOG.info(_('Networks were scheduled concurrently, scheduling '
+                       'them one by one'))
+            for agent, net_id in bindings_to_add:
+                self._schedule_bind_network(context, [agent], net_id)
+            return True
+
+        for agent, net_id in bindings_to_add:
+            LOG.debug(_('Network %(network_id)s is scheduled to be '
+                        'hosted by DHCP agent %(agent_id)s'),
+                      {'network_id': net_id,
+                       'agent_id': agent.id})
+        return True
+
+    def rebalance(self, plugin, context):
+        """Move networks from the most to the least loaded active agents.
+
+        Networks are moved until the numbers of networks hosted by the
+        active DHCP agents differ by one at most. A list of the moves, as
+        (network id, old agent id, new agent id), is returned.
+        """
+        binding = agentschedulers_db.NetworkDhcpAgentBinding
+        with context.session.begin(subtransactions=True):
+            agent_ids = [agent.id for agent in
+                         self._get_active_dhcp_agents(context)]
+            if not agent_ids:
+                return []
+            query = context.session.query(binding.network_id,
+                                          binding.dhcp_agent_id)
+            query = query.filter(binding.dhcp_agent_id.in_(agent_ids))
+            networks = dict((agent_id, set()) for agent_id in agent_ids)
+            for network_id, agent_id in query:
+                networks[agent_id].add(network_id)
+
+        moves = []
+        while True:
+            busiest = max(agent_ids, key=lambda a: len(networks[a]))
+            idlest = min(agent_ids, key=lambda a: len(networks[a]))
+            if len(networks[busiest]) - len(networks[idlest]) <= 1:
+                break
+            movable = networks[busiest] - networks[idlest]
+            if not movable:
+                break
+            network_id = min(movable)
+            networks[busiest].remove(network_id)
+            networks[idlest].add(network_id)
+            moves.append((network_id, busiest, idlest))
+
+        for network_id, old_agent_id, new_agent_id in moves:
+            # bind the network to the new agent first, so that the network
+            # is never left without an agent if the move fails halfway
+            try:
+                plugin.add_network_to_dhcp_agent(
+                    context, new_agent_id, network_id)
+            except dhcpagentscheduler.NetworkHostedByDHCPAgent as e:
+                # the network was moved concurrently
+                LOG.info(_('Failed to move network %(network_id)s: '
+                           '%(error)s'),
+                         {'network_id': network_id, 'error': e})
+                continue
+            try:
+                plugin.remove_network_from_dhcp_agent(
+                    context, old_agent_id, network_id)
+            except dhcpagentscheduler.NetworkNotHostedByDhcpAgent as e:
+                # the old binding was removed concurrently, the network is
+                # hosted by the new agent anyway
+                LOG.info(_('Failed to remove network %(network_id)s from '
+                           'its old DHCP agent: %(error)s'),
+                         {'network_id': network_id, 'error': e})
+            LOG.debug(_('Network %(network_id)s is moved from DHCP agent '
+                        '%(old_agent_id)s to %(new_agent_id)s'),
+                      {'network_id': network_id,
+                       'old_agent_id': old_agent_id,
+                       'new_agent_id': new_agent_id})
+        return moves
@@ -14,9 +14,12 @@
 #    under the License.
 
 import abc
+import collections
+import heapq
 import random
 
 import six
+from sqlalchemy import func
 from sqlalchemy.orm import exc
 from sqlalchemy import sql
 
@@ -24,6 +27,7 @@ from neutron.common import constants
 from neutron.db import agents_db
 from neutron.db import l3_agentschedulers_db
 from neutron.db import l3_db
+from neutron.db import models_v2
 from neutron.openstack.common import log as logging
 
 
@@ -68,15 +72,13 @@ class L3Scheduler(object):
                 LOG.warn(_('L3 agent %s is not active'), l3_agent.id)
             # check if each of the specified routers is hosted
             if router_ids:
+                hosted_router_ids = self._get_router_ids_hosted(
+                    context, router_ids)
                 unscheduled_router_ids = []
                 for router_id in router_ids:
-                    l3_agents = plugin.get_l3_agents_hosting_routers(
-                        context, [router_id], admin_state_up=True)
-                    if l3_agents:
-                        LOG.debug(_('Router %(router_id)s has already been'
-                                    ' hosted by L3 agent %(agent_id)s'),
-                                  {'router_id': router_id,
-                                   'agent_id': l3_agents[0]['id']})
+                    if router_id in hosted_router_ids:
+                        LOG.debug(_('Router %s has already been hosted'
+                                    ' by an L3 agent'), router_id)
                     else:
                         unscheduled_router_ids.append(router_id)
                 if not unscheduled_router_ids:
@@ -114,6 +116,27 @@ class L3Scheduler(object):
                 self.bind_router(context, router_id, l3_agent)
         return True
 
+    def _get_router_ids_hosted(self, context, router_ids):
+        """Return the ids of the routers hosted by enabled L3 agents."""
+        binding = l3_agentschedulers_db.RouterL3AgentBinding
+        query = context.session.query(binding.router_id)
+        query = query.join(binding.l3_agent)
+        query = query.filter(binding.router_id.in_(router_ids),
+                             agents_db.Agent.admin_state_up == sql.true())
+        return set(item[0] for item in query)
+
+    def schedule_routers(self, plugin, context, router_ids):
+        """Schedule routers to active L3 agents.
+
+        A dict of the scheduled agents by router id is returned.
+        """
+        scheduled = {}
+        for router_id in router_ids:
+            agent = self.schedule(plugin, context, router_id)
+            if agent:
+                scheduled[router_id] = agent
+        return scheduled
+
     def get_candidates(self, plugin, context, sync_router):
         """Return L3 agents where a router could be scheduled."""
         with context.session.begin(subtransactions=True):
@@ -190,3 +213,187 @@ class LeastRoutersScheduler(L3Scheduler):
             self.bind_router(context, router_id, chosen_agent)
 
             return chosen_agent
+
+
+class L3AgentLoadIndex(object):
+    """Index of the load of L3 agents.
+
+    The load of an agent is the number of routers, router interfaces and
+    floating IPs it hosts. The index is refreshed from the router bindings
+    in the database, and updated as routers are scheduled.
+    """
+
+    def __init__(self):
+        self.routers = collections.Counter()
+        self.interfaces = collections.Counter()
+        self.floatingips = collections.Counter()
+
+    def refresh(self, context, agent_ids):
+        """Count the routers, interfaces and floating IPs of the agents."""
+        binding = l3_agentschedulers_db.RouterL3AgentBinding
+
+        def count(query):
+            query = query.filter(binding.l3_agent_id.in_(agent_ids))
+            return collections.Counter(
+                dict(query.group_by(binding.l3_agent_id)))
+
+        self.routers = count(context.session.query(
+            binding.l3_agent_id, func.count(binding.router_id)))
+        self.interfaces = count(context.session.query(
+            binding.l3_agent_id, func.count(models_v2.Port.id)).join(
+                models_v2.Port,
+                models_v2.Port.device_id == binding.router_id).filter(
+                    models_v2.Port.device_owner ==
+                    l3_db.DEVICE_OWNER_ROUTER_INTF))
+        self.floatingips = count(context.session.query(
+            binding.l3_agent_id, func.count(l3_db.FloatingIP.id)).join(
+                l3_db.FloatingIP,
+                l3_db.FloatingIP.router_id == binding.router_id))
+
+    def get_load(self, agent_id):
+        return (self.routers[agent_id] + self.interfaces[agent_id] +
+                self.floatingips[agent_id])
+
+    def add_router(self, agent_id, interfaces=0, floatingips=0):
+        self.routers[agent_id] += 1
+        self.interfaces[agent_id] += interfaces
+        self.floatingips[agent_id] += floatingips
+
+
+class LeastLoadedScheduler(L3Scheduler):
+    """Allocate routers to the L3 agents with the least load.
+
+    The load of the agents is counted in routers, router interfaces and
+    floating IPs. A batch of routers is scheduled in a single pass: the
+    load of the agents is counted once, and the candidate agents are
+    computed once per external network.
+    """
+
+    def __init__(self):
+        self.load_index = L3AgentLoadIndex()
+
+    def _get_candidates_heap(self, candidates):
+        heap = [(self.load_index.get_load(agent.id), agent.id, agent)
+                for agent in candidates]
+        heapq.heapify(heap)
+        return heap
+
+    def _pop_least_loaded_agent(self, heap):
+        """Return the least loaded agent of a heap of candidates.
+
+        The loads in the heap may be outdated, as they are only updated
+        when they reach the top of the heap. The agent is left at the top
+        of the heap, and must be pushed back with its new load.
+        """
+        while True:
+            load, agent_id, agent = heap[0]
+            current_load = self.load_index.get_load(agent_id)
+            if load == current_load:
+                return agent
+            heapq.heapreplace(heap, (current_load, agent_id, agent))
+
+    def _push_agent(self, heap, agent):
+        heapq.heapreplace(heap, (self.load_index.get_load(agent.id),
+                                 agent.id, agent))
+
+    def _get_routers_loads(self, context, router_ids):
+        """Count the interfaces and floating IPs of the routers."""
+        query = context.session.query(models_v2.Port.device_id,
+                                      func.count(models_v2.Port.id))
+        query = query.filter(
+            models_v2.Port.device_id.in_(router_ids),
+            models_v2.Port.device_owner == l3_db.DEVICE_OWNER_ROUTER_INTF)
+        interfaces = collections.Counter(
+            dict(query.group_by(models_v2.Port.device_id)))
+        query = context.session.query(l3_db.FloatingIP.router_id,
+                                      func.count(l3_db.FloatingIP.id))
+        query = query.filter(l3_db.FloatingIP.router_id.in_(router_ids))
+        floatingips = collections.Counter(
+            dict(query.group_by(l3_db.FloatingIP.router_id)))
+        return interfaces, floatingips
+
+    def schedule(self, plugin, context, router_id, candidates=None):
+        if not candidates:
+            return self.schedule_routers(
+                plugin, context, [router_id]).get(router_id)
+
+        with context.session.begin(subtransactions=True):
+            self.load_index.refresh(context,
+                                    [candidate.id for candidate in candidates])
+            chosen_agent = self._pop_least_loaded_agent(
+                self._get_candidates_heap(candidates))
+            self.bind_router(context, router_id, chosen_agent)
+            return chosen_agent
+
+    def schedule_routers(self, plugin, context, router_ids):
+        """Schedule routers to the least loaded active L3 agents.
+
+        A dict of the scheduled agents by router id is returned.
+        """
+        scheduled = {}
+        with context.session.begin(subtransactions=True):
+            # allow one router is hosted by just
+            # one enabled l3 agent hosting since active is just a
+            # timing problem. Non-active l3 agent can return to
+            # active any time
+            hosted_router_ids = self._get_router_ids_hosted(
+                context, router_ids)
+            router_ids = [router_id for router_id in router_ids
+                          if router_id not in hosted_router_ids]
+            if hosted_router_ids:
+                LOG.debug(_('Routers %s have already been hosted'),
+                          list(hosted_router_ids))
+            if not router_ids:
+                return scheduled
+
+            active_l3_agents = plugin.get_l3_agents(context, active=True)
+            if not active_l3_agents:
+                LOG.warn(_('No active L3 agents'))
+                return scheduled
+            # the candidates only depend on the router id when an agent
+            # handles a single router
+            per_router_candidates = any(
+                not plugin.get_configuration_dict(agent).get(
+                    'use_namespaces', True)
+                for agent in active_l3_agents)
+            self.load_index.refresh(
+                context, [agent.id for agent in active_l3_agents])
+            interfaces, floatingips = self._get_routers_loads(context,
+                                                              router_ids)
+
+            # heaps of the candidates by load
+            candidates_cache = {}
+            sync_routers = plugin.get_routers(context,
+                                              filters={'id': router_ids})
+            for sync_router in sync_routers:
+                router_id = sync_router['id']
+                ex_net_id = (sync_router['external_gateway_info'] or {}).get(
+                    'network_id')
+                key = (ex_net_id, per_router_candidates and router_id)
+                if key not in candidates_cache:
+                    candidates_cache[key] = self._get_candidates_heap(
+                        plugin.get_l3_agent_candidates(sync_router,
+                                                       active_l3_agents))
+                candidates = candidates_cache[key]
+                if not candidates:
+                    LOG.warn(_('No L3 agents can host the router %s'),
+                             router_id)
+                    continue
+
+                chosen_agent = self._pop_least_loaded_agent(candidates)
+                self.load_index.add_router(chosen_agent.id,
+                                           interfaces[router_id],
+                                           floatingips[router_id])
+                self._push_agent(candidates, chosen_agent)
+                # the bindings are written together when the transaction
+                # is committed
+                binding = l3_agentschedulers_db.RouterL3AgentBinding()
+                binding.l3_agent = chosen_agent
+                binding.router_id = router_id
+                context.session.add(binding)
+                scheduled[router_id] = chosen_agent
+        for router_id, agent in scheduled.iteritems():
+            LOG.debug(_('Router %(router_id)s is scheduled to '
+                        'L3 agent %(agent_id)s'),
+                      {'router_id': router_id, 'agent_id': agent.id})
+        return scheduled
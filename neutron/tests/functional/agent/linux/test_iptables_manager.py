@@ -0,0 +1,108 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from oslo.config import cfg
+
+from neutron.agent.linux import iptables_manager
+from neutron.openstack.common import log as logging
+from neutron.tests import base
+
+LOG = logging.getLogger(__name__)
+
+CHAINS = 5000
+RULES_PER_CHAIN = 20
+
+
+class FakeIptables(object):
+    """Fake iptables binaries which keep the last fully restored tables."""
+
+    def __init__(self):
+        self.tables = {}
+        self.restores = []
+
+    def execute(self, cmd, root_helper=None, process_input=None):
+        if cmd[0].endswith('-save'):
+            return self.tables.get(cmd[0], '')
+        self.restores.append(process_input)
+        if '-n' not in cmd:
+            self.tables[cmd[0].replace('-restore', '-save')] = process_input
+        return ''
+
+
+class IptablesTableBenchmarkTestCase(base.BaseTestCase):
+    """Measure the rule bookkeeping of a large IptablesManager.
+
+    The iptables binaries are faked, so this measures the time spent in
+    IptablesTable and in generating the iptables-restore input for
+    CHAINS chains of RULES_PER_CHAIN rules each.
+    """
+
+    def setUp(self):
+        super(IptablesTableBenchmarkTestCase, self).setUp()
+        cfg.CONF.set_override('lock_path', self.temp_dir)
+        self.fake_iptables = FakeIptables()
+        self.iptables = iptables_manager.IptablesManager(
+            _execute=self.fake_iptables.execute, use_ipv6=False)
+        self.table = self.iptables.ipv4['filter']
+        self.default_rules = len(self.table.rules)
+
+    def _timed(self, description, func, *args):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        LOG.info(_("%(description)s in %(elapsed).3f seconds"),
+                 {'description': description, 'elapsed': elapsed})
+
+    def _add_rules(self):
+        for chain_index in range(CHAINS):
+            chain = 'c%d' % chain_index
+            self.table.add_chain(chain)
+            self.table.add_rule('FORWARD', '-j $%s' % chain, tag=chain)
+            for rule_index in range(RULES_PER_CHAIN - 1):
+                self.table.add_rule(
+                    chain, '-s 10.%d.%d.0/24 -j RETURN' %
+                    (chain_index % 256, rule_index), tag=chain)
+
+    def _remove_rules(self):
+        for chain_index in range(0, CHAINS, 2):
+            chain = 'c%d' % chain_index
+            self.table.remove_rule(chain, '-s 10.%d.0.0/24 -j RETURN' %
+                                   (chain_index % 256))
+
+    def _clear_rules_by_tag(self):
+        for chain_index in range(1, CHAINS, 2):
+            self.table.clear_rules_by_tag('c%d' % chain_index)
+
+    def _remove_chains(self):
+        for chain_index in range(0, CHAINS, 2):
+            self.table.remove_chain('c%d' % chain_index)
+
+    def test_apply_many_rules(self):
+        self._timed(_("Added %d rules") % (CHAINS * RULES_PER_CHAIN),
+                    self._add_rules)
+        self._timed(_("Applied the rules"), self.iptables.apply)
+        self._timed(_("Applied the unchanged rules"), self.iptables.apply)
+        self._timed(_("Removed a rule from %d chains") % (CHAINS / 2),
+                    self._remove_rules)
+        self._timed(_("Cleared the rules of %d tags") % (CHAINS / 2),
+                    self._clear_rules_by_tag)
+        self._timed(_("Removed %d chains") % (CHAINS / 2),
+                    self._remove_chains)
+        self._timed(_("Applied the changes"), self.iptables.apply)
+
+        self.assertEqual(self.default_rules, len(self.table.rules))
+        self.assertIn('-X %s-c0\n' % self.iptables.wrap_name,
+                      self.fake_iptables.restores[-1])
@@ -0,0 +1,120 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import contextlib
+import time
+
+import mock
+
+from neutron.agent.linux import ovs_lib
+from neutron.openstack.common import log as logging
+from neutron.plugins.openvswitch.common import constants
+from neutron.tests import base
+
+LOG = logging.getLogger(__name__)
+
+NETWORKS = 100
+PORTS_PER_NETWORK = 10
+TUNNEL_OFPORTS = '1,2,3'
+
+
+class FakeOfctl(object):
+    """Fake ovs-ofctl binary which counts its forks and flow changes."""
+
+    def __init__(self):
+        self.forks = 0
+        self.flows = 0
+
+    def execute(self, cmd, root_helper=None, process_input=None):
+        self.forks += 1
+        if process_input:
+            self.flows += process_input.count('\n')
+        else:
+            self.flows += len(cmd) - 3
+        return ''
+
+
+class OVSFlowsBenchmarkTestCase(base.BaseTestCase):
+    """Measure the ovs-ofctl forks of an agent loop iteration.
+
+    The iteration provisions NETWORKS tunnel networks and binds
+    PORTS_PER_NETWORK ports on each of them, making the flow changes the
+    OVS agent makes on the integration and tunnel bridges.
+    """
+
+    def setUp(self):
+        super(OVSFlowsBenchmarkTestCase, self).setUp()
+        self.fake_ofctl = FakeOfctl()
+        mock.patch.object(ovs_lib.utils, 'execute',
+                          new=self.fake_ofctl.execute).start()
+        self.int_br = ovs_lib.OVSBridge('br-int', 'sudo')
+        self.tun_br = ovs_lib.OVSBridge('br-tun', 'sudo')
+
+    def _program_iteration(self):
+        for network_index in range(NETWORKS):
+            lvid = network_index + 1
+            segmentation_id = network_index + 1000
+            self.tun_br.mod_flow(table=constants.FLOOD_TO_TUN,
+                                 dl_vlan=lvid,
+                                 actions="strip_vlan,set_tunnel:%s,"
+                                 "output:%s" % (segmentation_id,
+                                                TUNNEL_OFPORTS))
+            self.tun_br.add_flow(table=constants.GRE_TUN_TO_LV,
+                                 priority=1,
+                                 tun_id=segmentation_id,
+                                 actions="mod_vlan_vid:%s,resubmit(,%s)" %
+                                 (lvid, constants.LEARN_FROM_TUN))
+            for port_index in range(PORTS_PER_NETWORK):
+                ofport = network_index * PORTS_PER_NETWORK + port_index + 10
+                self.int_br.delete_flows(in_port=ofport)
+                self.int_br.add_flow(priority=2, in_port=ofport,
+                                     actions="drop")
+                self.int_br.delete_flows(in_port=ofport)
+
+    def _run_iteration(self, description, transaction=None):
+        self.fake_ofctl.forks = self.fake_ofctl.flows = 0
+        start = time.time()
+        if transaction:
+            with transaction():
+                self._program_iteration()
+        else:
+            self._program_iteration()
+        elapsed = time.time() - start
+        LOG.info(_("%(description)s: %(flows)d flow changes in %(forks)d "
+                   "ovs-ofctl forks, %(elapsed).3f seconds"),
+                 {'description': description,
+                  'flows': self.fake_ofctl.flows,
+                  'forks': self.fake_ofctl.forks,
+                  'elapsed': elapsed})
+        return self.fake_ofctl.forks
+
+    def _flow_transaction(self, atomic=False):
+        return contextlib.nested(
+            self.int_br.flow_transaction(atomic=atomic),
+            self.tun_br.flow_transaction(atomic=atomic))
+
+    def test_flow_transaction_forks(self):
+        flow_changes = NETWORKS * (2 + 3 * PORTS_PER_NETWORK)
+        forks = self._run_iteration(_("Flows applied one by one"))
+        self.assertEqual(flow_changes, forks)
+        forks = self._run_iteration(_("Flows applied in a transaction"),
+                                    self._flow_transaction)
+        self.assertEqual(flow_changes, self.fake_ofctl.flows)
+        # one fork per run of consecutive changes of the same kind
+        self.assertEqual(NETWORKS * (2 + 2 * PORTS_PER_NETWORK) + 1, forks)
+        forks = self._run_iteration(
+            _("Flows applied in an atomic transaction"),
+            lambda: self._flow_transaction(atomic=True))
+        self.assertEqual(flow_changes, self.fake_ofctl.flows)
+        self.assertEqual(2, forks)
@@ -0,0 +1,90 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import time
+
+from neutron.common import constants
+from neutron.common import topics
+from neutron.db import agents_db
+from neutron.db import db_base_plugin_v2
+from neutron.db import l3_agentschedulers_db
+from neutron.db import l3_db
+from neutron.openstack.common import log as logging
+from neutron.openstack.common import timeutils
+from neutron.openstack.common import uuidutils
+from neutron.scheduler import l3_agent_scheduler
+from neutron.tests.functional.db import base
+
+LOG = logging.getLogger(__name__)
+
+L3_AGENTS = 50
+ROUTERS = 10000
+
+
+class L3SchedulerPlugin(db_base_plugin_v2.NeutronDbPluginV2,
+                        l3_db.L3_NAT_db_mixin,
+                        l3_agentschedulers_db.L3AgentSchedulerDbMixin):
+    pass
+
+
+class LeastLoadedSchedulerBenchmarkTestCase(base.DbBenchmarkTestCase):
+    """Schedule ROUTERS routers onto L3_AGENTS L3 agents in one batch."""
+
+    def setUp(self):
+        super(LeastLoadedSchedulerBenchmarkTestCase, self).setUp()
+        self.plugin = L3SchedulerPlugin()
+        self.scheduler = l3_agent_scheduler.LeastLoadedScheduler()
+
+    def _create_agents(self):
+        now = timeutils.utcnow()
+        with self.context.session.begin(subtransactions=True):
+            for index in range(L3_AGENTS):
+                self.context.session.add(agents_db.Agent(
+                    agent_type=constants.AGENT_TYPE_L3,
+                    binary='neutron-l3-agent',
+                    topic=topics.L3_AGENT,
+                    host='host-%d' % index,
+                    admin_state_up=True,
+                    created_at=now,
+                    started_at=now,
+                    heartbeat_timestamp=now,
+                    configurations='{}'))
+
+    def _create_routers(self):
+        router_ids = [uuidutils.generate_uuid() for index in range(ROUTERS)]
+        with self.context.session.begin(subtransactions=True):
+            for router_id in router_ids:
+                self.context.session.add(l3_db.Router(
+                    id=router_id, tenant_id=self.tenant_id,
+                    name='benchmark', admin_state_up=True))
+        return router_ids
+
+    def test_schedule_routers(self):
+        self._create_agents()
+        router_ids = self._create_routers()
+
+        start = time.time()
+        scheduled = self.scheduler.schedule_routers(
+            self.plugin, self.context, router_ids)
+        elapsed = time.time() - start
+        LOG.info(_("Scheduled %(count)d routers onto %(agents)d L3 agents "
+                   "in %(elapsed).2f seconds (%(rate).1f routers/s)"),
+                 {'count': len(scheduled), 'agents': L3_AGENTS,
+                  'elapsed': elapsed, 'rate': len(scheduled) / elapsed})
+
+        self.assertEqual(ROUTERS, len(scheduled))
+        loads = collections.Counter(agent.id
+                                    for agent in scheduled.itervalues())
+        self.assertEqual(set([ROUTERS / L3_AGENTS]), set(loads.values()))
@@ -0,0 +1,103 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from neutron import context
+from neutron.db import models_v2
+from neutron.openstack.common import log as logging
+from neutron.openstack.common import uuidutils
+from neutron.tests.functional.db import base
+
+LOG = logging.getLogger(__name__)
+
+PORTS = 200000
+PAGE_SIZE = 1000
+INSERT_CHUNK_SIZE = 10000
+# Number of pages whose latency is compared at both ends of the collection
+SAMPLE_PAGES = 10
+# The last pages may be slower than the first ones by this factor at most;
+# it is generous so that only an offset scan, whose cost grows with the
+# page number, exceeds it on a loaded machine
+MAX_LATENCY_RATIO = 5
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class PortPaginationTestCase(base.DbBenchmarkTestCase):
+    """Page through a large port collection with native pagination.
+
+    As pages are selected by seeking past the marker rather than with an
+    offset, the last pages should be fetched as fast as the first ones.
+    The latencies depend on the machine running the test, so only the
+    ratio of the median latencies at both ends is checked.
+    """
+
+    def _insert_ports(self, network_id, count):
+        ports = models_v2.Port.__table__
+        with self.context.session.begin():
+            for start in range(0, count, INSERT_CHUNK_SIZE):
+                self.context.session.execute(ports.insert(), [
+                    {'id': uuidutils.generate_uuid(),
+                     'tenant_id': self.tenant_id,
+                     'name': 'port-%d' % index,
+                     'network_id': network_id,
+                     'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                         index >> 16, (index >> 8) & 0xff, index & 0xff),
+                     'admin_state_up': True,
+                     'status': 'ACTIVE',
+                     'device_id': '',
+                     'device_owner': ''}
+                    for index in range(start,
+                                       min(start + INSERT_CHUNK_SIZE, count))])
+
+    def test_page_through_ports(self):
+        network = self._create_network()
+        self._insert_ports(network['id'], PORTS)
+        tenant_context = context.Context('', self.tenant_id)
+
+        latencies = []
+        ids = []
+        marker = None
+        while True:
+            start = time.time()
+            page = self.plugin.get_ports(tenant_context,
+                                         fields=['id'],
+                                         sorts=[('id', True)],
+                                         limit=PAGE_SIZE, marker=marker)
+            latencies.append(time.time() - start)
+            if not page:
+                break
+            ids.extend(port['id'] for port in page)
+            marker = page[-1]['id']
+        # The last request returns an empty page
+        latencies.pop()
+
+        first = _median(latencies[:SAMPLE_PAGES])
+        last = _median(latencies[-SAMPLE_PAGES:])
+        LOG.info(_("Fetched %(count)d ports in %(pages)d pages, "
+                   "a median of %(first).4f seconds per page at the "
+                   "beginning and %(last).4f at the end"),
+                 {'count': len(ids), 'pages': len(latencies),
+                  'first': first, 'last': last})
+
+        self.assertEqual(PORTS, len(ids))
+        self.assertEqual(sorted(ids), ids)
+        self.assertLess(last, first * MAX_LATENCY_RATIO)
@@ -0,0 +1,89 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron.agent.linux import ipset_manager
+from neutron.tests import base
+
+IPSET_NAME = 'IPv4fake_sgid'
+
+
+class TestIpsetManager(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestIpsetManager, self).setUp()
+        self.execute = mock.Mock()
+        self.ipset = ipset_manager.IpsetManager(execute=self.execute,
+                                                root_helper='sudo')
+
+    def _expect_restore(self, *commands):
+        self.execute.assert_called_once_with(
+            ['ipset', 'restore', '-exist'], root_helper='sudo',
+            process_input=''.join('%s\n' % command for command in commands))
+        self.execute.reset_mock()
+
+    def test_get_ipset_name(self):
+        sg_id = 'c5d1b8f0-4b84-4c9b-9d56-3f4e1f5e0a12'
+        name = ipset_manager.get_ipset_name(sg_id, 'IPv6')
+        self.assertEqual('IPv6xdG48EuETJudVj9OH14KEg', name)
+
+    def test_get_ipset_name_no_collision(self):
+        # the UUIDs only differ by their last characters
+        names = set(ipset_manager.get_ipset_name(
+            'c5d1b8f0-4b84-4c9b-9d56-3f4e1f5e0a%02d' % i, 'IPv4')
+            for i in range(100))
+        self.assertEqual(100, len(names))
+
+    def test_get_ipset_name_not_uuid(self):
+        name = ipset_manager.get_ipset_name('x' * 64, 'IPv4')
+        self.assertEqual(ipset_manager.IPSET_NAME_MAX, len(name))
+        self.assertNotEqual(name,
+                            ipset_manager.get_ipset_name('x' * 63, 'IPv4'))
+
+    def test_refresh_ipset_creates_ipset(self):
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4', ['10.0.0.2/32'])
+        self._expect_restore('create %s hash:net family inet' % IPSET_NAME,
+                             'flush %s' % IPSET_NAME,
+                             'add %s 10.0.0.2/32' % IPSET_NAME)
+        self.assertTrue(self.ipset.ipset_exists(IPSET_NAME))
+
+    def test_refresh_ipset_changes_members(self):
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4',
+                                 ['10.0.0.2/32', '10.0.0.3/32'])
+        self.execute.reset_mock()
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4',
+                                 ['10.0.0.3/32', '10.0.0.4/32'])
+        self._expect_restore('add %s 10.0.0.4/32' % IPSET_NAME,
+                             'del %s 10.0.0.2/32' % IPSET_NAME)
+
+    def test_refresh_ipset_unchanged(self):
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4', ['10.0.0.2/32'])
+        self.execute.reset_mock()
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4', ['10.0.0.2/32'])
+        self.assertFalse(self.execute.called)
+
+    def test_destroy_ipset(self):
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4', [])
+        self.execute.reset_mock()
+        self.ipset.destroy_ipset(IPSET_NAME)
+        self.execute.assert_called_once_with(['ipset', 'destroy', IPSET_NAME],
+                                             root_helper='sudo')
+        self.assertFalse(self.ipset.ipset_exists(IPSET_NAME))
+
+    def test_destroy_ipset_in_use(self):
+        self.ipset.refresh_ipset(IPSET_NAME, 'IPv4', [])
+        self.execute.side_effect = RuntimeError()
+        self.assertFalse(self.ipset.destroy_ipset(IPSET_NAME))
+        self.assertTrue(self.ipset.ipset_exists(IPSET_NAME))
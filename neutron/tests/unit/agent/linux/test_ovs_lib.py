@@ -13,11 +13,15 @@
 #    under the License.
 
 import collections
+import contextlib
+import threading
+
 import mock
 from oslo.config import cfg
 import testtools
 
 from neutron.agent.linux import ovs_lib
+from neutron.agent.linux import ovsdb_native
 from neutron.agent.linux import utils
 from neutron.common import exceptions
 from neutron.openstack.common import jsonutils
@@ -26,6 +30,7 @@ from neutron.plugins.common import constants as p_const
 from neutron.plugins.openvswitch.common import constants as const
 from neutron.tests import base
 from neutron.tests import tools
+from neutron.tests.unit.agent.linux import test_ovsdb_native
 
 try:
     OrderedDict = collections.OrderedDict
@@ -446,8 +451,10 @@ class OVS_Lib_Test(base.BaseTestCase):
         ])
 
         run_ofctl.assert_has_calls([
-            mock.call('add-flows', ['-'], 'added_flow_1\nadded_flow_2\n'),
-            mock.call('del-flows', ['-'], 'deleted_flow_1\n')
+            mock.call('add-flows', ['-'], 'added_flow_1\nadded_flow_2\n',
+                      check_error=True),
+            mock.call('del-flows', ['-'], 'deleted_flow_1\n',
+                      check_error=True)
         ])
 
     def test_defer_apply_flows_concurrently(self):
@@ -458,7 +465,8 @@ class OVS_Lib_Test(base.BaseTestCase):
 
         run_ofctl = mock.patch.object(self.br, 'run_ofctl').start()
 
-        def run_ofctl_fake(cmd, args, process_input=None):
+        def run_ofctl_fake(cmd, args, process_input=None,
+                           check_error=False):
             self.br.defer_apply_on()
             if cmd == 'add-flows':
                 self.br.add_flow(flow='added_flow_2')
@@ -486,14 +494,173 @@ class OVS_Lib_Test(base.BaseTestCase):
             mock.call({'flow': 'modified_flow_2'}, 'mod')
         ])
         run_ofctl.assert_has_calls([
-            mock.call('add-flows', ['-'], 'added_flow_1\n'),
-            mock.call('del-flows', ['-'], 'deleted_flow_1\n'),
-            mock.call('mod-flows', ['-'], 'modified_flow_1\n'),
-            mock.call('add-flows', ['-'], 'added_flow_2\n'),
-            mock.call('del-flows', ['-'], 'deleted_flow_2\n'),
-            mock.call('mod-flows', ['-'], 'modified_flow_2\n')
+            mock.call('add-flows', ['-'], 'added_flow_1\n',
+                      check_error=True),
+            mock.call('del-flows', ['-'], 'deleted_flow_1\n',
+                      check_error=True),
+            mock.call('mod-flows', ['-'], 'modified_flow_1\n',
+                      check_error=True),
+            mock.call('add-flows', ['-'], 'added_flow_2\n',
+                      check_error=True),
+            mock.call('del-flows', ['-'], 'deleted_flow_2\n',
+                      check_error=True),
+            mock.call('mod-flows', ['-'], 'modified_flow_2\n',
+                      check_error=True)
+        ])
+
+    def test_defer_apply_flows_in_order(self):
+        run_ofctl = mock.patch.object(self.br, 'run_ofctl').start()
+        self.br.defer_apply_on()
+        self.br.delete_flows(in_port=1)
+        self.br.add_flow(in_port=1, actions='drop')
+        self.br.add_flow(in_port=2, actions='drop')
+        self.br.delete_flows(in_port=2)
+        self.br.defer_apply_off()
+        run_ofctl.assert_has_calls([
+            mock.call('del-flows', ['-'], 'in_port=1\n',
+                      check_error=True),
+            mock.call('add-flows', ['-'],
+                      'hard_timeout=0,idle_timeout=0,priority=1,in_port=1,'
+                      'actions=drop\n'
+                      'hard_timeout=0,idle_timeout=0,priority=1,in_port=2,'
+                      'actions=drop\n',
+                      check_error=True),
+            mock.call('del-flows', ['-'], 'in_port=2\n',
+                      check_error=True)
+        ])
+        self.assertEqual(3, run_ofctl.call_count)
+
+    def test_defer_apply_flows_atomic(self):
+        run_ofctl = mock.patch.object(self.br, 'run_ofctl').start()
+        self.br.defer_apply_on()
+        self.br.delete_flows(in_port=1)
+        self.br.add_flow(in_port=1, actions='drop')
+        self.br.mod_flow(in_port=2, actions='drop')
+        self.br.defer_apply_off(atomic=True)
+        run_ofctl.assert_called_once_with(
+            'add-flows', ['--bundle', '-'],
+            'delete in_port=1\n'
+            'add hard_timeout=0,idle_timeout=0,priority=1,in_port=1,'
+            'actions=drop\n'
+            'modify in_port=2,actions=drop\n', check_error=True)
+
+    def test_flow_transaction(self):
+        run_ofctl = mock.patch.object(self.br, 'run_ofctl').start()
+        with self.br.flow_transaction():
+            self.br.delete_flows(in_port=1)
+            with self.br.flow_transaction():
+                self.br.delete_flows(in_port=2)
+            self.assertFalse(run_ofctl.called)
+        run_ofctl.assert_called_once_with('del-flows', ['-'],
+                                          'in_port=1\nin_port=2\n',
+                                          check_error=True)
+        self.assertFalse(self.br.defer_apply_flows)
+
+    def test_flow_transaction_exception(self):
+        run_ofctl = mock.patch.object(self.br, 'run_ofctl').start()
+
+        def run_transaction():
+            with self.br.flow_transaction(atomic=True):
+                self.br.delete_flows(in_port=1)
+                raise ValueError()
+
+        self.assertRaises(ValueError, run_transaction)
+        # the changes made before the exception are applied
+        run_ofctl.assert_called_once_with('add-flows', ['--bundle', '-'],
+                                          'delete in_port=1\n',
+                                          check_error=True)
+        self.assertFalse(self.br.defer_apply_flows)
+
+    def test_flow_transaction_apply_failure(self):
+        self.execute.side_effect = RuntimeError()
+
+        def run_transaction():
+            with self.br.flow_transaction():
+                self.br.delete_flows(in_port=1)
+
+        self.assertRaises(RuntimeError, run_transaction)
+        # the failure of a single change isn't raised
+        self.br.delete_flows(in_port=1)
+
+    def test_flow_transaction_other_thread(self):
+        run_ofctl = mock.patch.object(self.br, 'run_ofctl').start()
+
+        def run_transaction():
+            with self.br.flow_transaction():
+                self.br.delete_flows(in_port=2)
+
+        with self.br.flow_transaction():
+            self.br.delete_flows(in_port=1)
+            thread = threading.Thread(target=run_transaction)
+            thread.start()
+            thread.join()
+            # the transaction of the other thread is applied on its own
+            run_ofctl.assert_called_once_with('del-flows', ['-'],
+                                              'in_port=2\n',
+                                              check_error=True)
+        run_ofctl.assert_called_with('del-flows', ['-'], 'in_port=1\n',
+                                     check_error=True)
+        self.assertEqual(2, run_ofctl.call_count)
+
+    def test_add_flow_default_cookie(self):
+        self.br.default_cookie = 0x2a
+        self.br.add_flow(priority=2, actions='drop')
+        self.br.add_flow(priority=2, cookie='0x1', actions='drop')
+        self.br.mod_flow(in_port=1, actions='drop')
+        self.br.delete_flows(in_port=1)
+        self.execute.assert_has_calls([
+            mock.call(['ovs-ofctl', 'add-flow', self.BR_NAME,
+                       'hard_timeout=0,idle_timeout=0,priority=2,'
+                       'cookie=0x2a,actions=drop'],
+                      process_input=None, root_helper=self.root_helper),
+            mock.call(['ovs-ofctl', 'add-flow', self.BR_NAME,
+                       'hard_timeout=0,idle_timeout=0,priority=2,'
+                       'cookie=0x1,actions=drop'],
+                      process_input=None, root_helper=self.root_helper),
+            mock.call(['ovs-ofctl', 'mod-flows', self.BR_NAME,
+                       'cookie=0x2a,in_port=1,actions=drop'],
+                      process_input=None, root_helper=self.root_helper),
+            mock.call(['ovs-ofctl', 'del-flows', self.BR_NAME, 'in_port=1'],
+                      process_input=None, root_helper=self.root_helper),
         ])
 
+    def test_get_flow_cookies(self):
+        self.execute.return_value = (
+            'NXST_FLOW reply (xid=0x4):\n'
+            ' cookie=0x2a, duration=1.1s, table=0, n_packets=0, '
+            'priority=1 actions=NORMAL\n'
+            ' cookie=0x0, duration=1.1s, table=10, n_packets=0, '
+            'priority=1 actions=learn(table=20,cookie=0x5,'
+            'NXM_OF_VLAN_TCI[0..11])\n'
+            ' cookie=0x2a, duration=1.1s, table=22, n_packets=0, '
+            'priority=0 actions=drop\n')
+        self.assertEqual(set([0x2a, 0]), self.br.get_flow_cookies())
+
+    def test_get_flow_ofports(self):
+        self.execute.return_value = (
+            'NXST_FLOW reply (xid=0x4):\n'
+            ' cookie=0x2a, duration=1.1s, table=0, n_packets=0, '
+            'priority=1,in_port=3 actions=resubmit(,2)\n'
+            ' cookie=0x2a, duration=1.1s, table=22, n_packets=0, '
+            'priority=1,dl_vlan=1 actions=strip_vlan,set_tunnel:0x1,'
+            'output:4,output:5\n'
+            ' cookie=0x2a, duration=1.1s, table=22, n_packets=0, '
+            'priority=0 actions=drop\n')
+        self.assertEqual(set(['3', '4', '5']), self.br.get_flow_ofports())
+
+    def test_delete_stale_flows(self):
+        self.br.default_cookie = 0x2a
+        with contextlib.nested(
+            mock.patch.object(self.br, 'get_flow_cookies',
+                              return_value=set([0x2a, 0x0, 0x1])),
+            mock.patch.object(self.br, 'delete_flows')
+        ) as (get_cookies_fn, delete_flows_fn):
+            self.br.delete_stale_flows()
+        self.assertEqual(2, delete_flows_fn.call_count)
+        delete_flows_fn.assert_has_calls([mock.call(cookie='0x0/-1'),
+                                          mock.call(cookie='0x1/-1')],
+                                         any_order=True)
+
     def test_add_tunnel_port(self):
         pname = "tap99"
         local_ip = "1.1.1.1"
@@ -564,7 +731,8 @@ class OVS_Lib_Test(base.BaseTestCase):
         ofport = "6"
 
         # Each element is a tuple of (expected mock call, return_value)
-        command = ["ovs-vsctl", self.TO, "add-port", self.BR_NAME, pname]
+        command = ["ovs-vsctl", self.TO, "--", "--may-exist", "add-port",
+                   self.BR_NAME, pname]
         command.extend(["--", "set", "Interface", pname])
         command.extend(["type=patch", "options:peer=" + peer])
         expected_calls_and_values = [
@@ -737,6 +905,45 @@ class OVS_Lib_Test(base.BaseTestCase):
         self.assertRaises(RuntimeError, self.br.get_vif_port_set)
         tools.verify_mock_calls(self.execute, expected_calls_and_values)
 
+    def test_get_vif_ports_by_ids(self):
+        headings = ['name', 'external_ids', 'ofport']
+        data = [
+            # A vif port on this bridge:
+            ['tap99', {'iface-id': 'tap99id', 'attached-mac': 'tap99mac'}, 1],
+            # A vif port on this bridge not yet configured
+            ['tap98', {'iface-id': 'tap98id', 'attached-mac': 'tap98mac'},
+             ['set', []]],
+            # A vif port on this bridge which failed
+            ['tap97', {'iface-id': 'tap97id', 'attached-mac': 'tap97mac'},
+             -1],
+            # A vif port on another bridge:
+            ['tap88', {'iface-id': 'tap88id', 'attached-mac': 'tap88id'}, 1],
+            # A vif port on this bridge which isn't requested
+            ['tap87', {'iface-id': 'tap87id', 'attached-mac': 'tap87mac'}, 2],
+            # Non-vif port on this bridge:
+            ['tun22', {}, 3],
+        ]
+        expected_calls_and_values = [
+            (mock.call(["ovs-vsctl", self.TO, "list-ports", self.BR_NAME],
+                       root_helper=self.root_helper),
+             'tap87\ntap97\ntap98\ntap99\ntun22'),
+            (mock.call(["ovs-vsctl", self.TO, "--format=json",
+                        "--", "--columns=name,external_ids,ofport",
+                        "list", "Interface"],
+                       root_helper=self.root_helper),
+             self._encode_ovs_json(headings, data)),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        vif_ports = self.br.get_vif_ports_by_ids(
+            ['tap99id', 'tap98id', 'tap97id', 'tap88id', 'tap66id'])
+        self.assertEqual(['tap99id'], vif_ports.keys())
+        vif_port = vif_ports['tap99id']
+        self.assertEqual(('tap99', 1, 'tap99id', 'tap99mac', self.br),
+                         (vif_port.port_name, vif_port.ofport,
+                          vif_port.vif_id, vif_port.vif_mac, vif_port.switch))
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+
     def test_get_port_tag_dict(self):
         headings = ['name', 'tag']
         data = [
@@ -964,3 +1171,109 @@ class OVS_Lib_Test(base.BaseTestCase):
                            'br-test-test'], root_helper=self.root_helper)
             ])
             self.assertFalse(supported)
+
+
+class OVS_Lib_Native_Test(test_ovsdb_native.FakeOvsdbTestCase):
+
+    def setUp(self):
+        super(OVS_Lib_Native_Test, self).setUp()
+        cfg.CONF.set_override('ovsdb_interface', 'native')
+        self.execute = mock.patch.object(utils, "execute").start()
+        self.server.add_bridge('br-int')
+        self.server.add_port('br-int', 'tap1', tag=1, ofport=1,
+                             external_ids={'iface-id': 'id1',
+                                           'attached-mac': 'mac1'})
+        self.server.add_port('br-int', 'tap2', ofport=-1,
+                             external_ids={'iface-id': 'id2',
+                                           'attached-mac': 'mac2'})
+        self.server.add_port('br-int', 'patch-tun', ofport=2)
+        self.server.add_bridge('br-tun')
+        self.server.add_port('br-tun', 'tap3', ofport=1,
+                             external_ids={'iface-id': 'id3',
+                                           'attached-mac': 'mac3'})
+        self.br = ovs_lib.OVSBridge('br-int', 'sudo')
+
+    def test_get_port_name_list(self):
+        self.assertEqual(['patch-tun', 'tap1', 'tap2'],
+                         self.br.get_port_name_list())
+        self.assertFalse(self.execute.called)
+
+    def test_get_vif_ports(self):
+        ports = self.br.get_vif_ports()
+        self.assertEqual([('tap1', 1, 'id1', 'mac1'),
+                          ('tap2', -1, 'id2', 'mac2')],
+                         sorted((port.port_name, port.ofport, port.vif_id,
+                                 port.vif_mac) for port in ports))
+        self.assertFalse(self.execute.called)
+
+    def test_get_vif_port_set(self):
+        self.assertEqual(set(['id1']), self.br.get_vif_port_set())
+        self.assertFalse(self.execute.called)
+
+    def test_get_port_tag_dict(self):
+        self.assertEqual({'tap1': 1, 'tap2': [], 'patch-tun': []},
+                         self.br.get_port_tag_dict())
+        self.assertFalse(self.execute.called)
+
+    def test_get_vif_port_by_id(self):
+        port = self.br.get_vif_port_by_id('id1')
+        self.assertEqual(('tap1', 1, 'mac1', self.br),
+                         (port.port_name, port.ofport, port.vif_mac,
+                          port.switch))
+        self.assertIsNone(self.br.get_vif_port_by_id('id2'))
+        self.assertIsNone(self.br.get_vif_port_by_id('id3'))
+        self.assertIsNone(self.br.get_vif_port_by_id('id4'))
+        self.assertFalse(self.execute.called)
+
+    def test_get_vif_ports_by_ids(self):
+        vif_ports = self.br.get_vif_ports_by_ids(['id1', 'id2', 'id3', 'id4'])
+        self.assertEqual(['id1'], vif_ports.keys())
+        self.assertEqual(('tap1', 1, 'mac1'),
+                         (vif_ports['id1'].port_name, vif_ports['id1'].ofport,
+                          vif_ports['id1'].vif_mac))
+        self.assertFalse(self.execute.called)
+
+    def test_db_get_val(self):
+        self.assertEqual('1', self.br.db_get_val('Port', 'tap1', 'tag'))
+        self.assertEqual('[]', self.br.db_get_val('Port', 'tap2', 'tag'))
+        self.assertEqual('1', self.br.get_port_ofport('tap1'))
+        self.assertFalse(self.execute.called)
+
+    def test_db_get_val_not_replicated(self):
+        self.execute.return_value = '"0000aabbccddeeff"\n'
+        self.assertEqual('0000aabbccddeeff', self.br.get_datapath_id())
+        self.execute.assert_called_once_with(
+            ['ovs-vsctl', '--timeout=10', 'get', 'Bridge', 'br-int',
+             'datapath_id'], root_helper='sudo')
+
+    def test_set_db_attribute(self):
+        with self.br.db_transaction():
+            self.br.set_db_attribute('Port', 'tap1', 'tag', 2)
+            self.br.set_db_attribute('Interface', 'patch-tun',
+                                     'options:peer', 'patch-int')
+        self.assertEqual(1, len(self.server.get_transactions()))
+        self.assertEqual('2', self.br.db_get_val('Port', 'tap1', 'tag'))
+        interface = self.server.tables['Interface'][
+            self.server._find('Interface', 'patch-tun')]
+        self.assertEqual({'peer': 'patch-int'}, interface['options'])
+        self.assertFalse(self.execute.called)
+
+    def test_set_db_attribute_not_supported(self):
+        self.br.set_db_attribute('controller', 'br-int', 'connection_mode',
+                                 'out-of-band')
+        self.execute.assert_called_once_with(
+            ['ovs-vsctl', '--timeout=10', 'set', 'controller', 'br-int',
+             'connection_mode=out-of-band'], root_helper='sudo')
+
+    def test_clear_db_attribute(self):
+        self.br.clear_db_attribute('Port', 'tap1', 'tag')
+        self.assertEqual('[]', self.br.db_get_val('Port', 'tap1', 'tag'))
+        self.assertFalse(self.execute.called)
+
+    def test_ovsdb_error(self):
+        self.server.closed = True
+        self.assertRaises(ovsdb_native.OvsdbError,
+                          self.br.get_vif_port_set)
+        # the calls which don't check errors fall back to ovs-vsctl
+        self.execute.return_value = '1\n'
+        self.assertEqual('1', self.br.db_get_val('Port', 'tap1', 'tag'))
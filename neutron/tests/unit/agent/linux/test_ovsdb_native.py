@@ -0,0 +1,530 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import socket
+import threading
+
+import mock
+
+from neutron.agent.linux import ovsdb_native
+from neutron.tests import base
+
+UUID_SET = {'key': {'type': 'uuid'}, 'min': 0, 'max': 'unlimited'}
+STRING_MAP = {'key': 'string', 'value': 'string',
+              'min': 0, 'max': 'unlimited'}
+SCHEMA = {
+    'name': 'Open_vSwitch',
+    'tables': {
+        'Bridge': {'columns': {
+            'name': {'type': 'string'},
+            'ports': {'type': UUID_SET},
+            'datapath_id': {'type': {'key': 'string', 'min': 0}}}},
+        'Port': {'columns': {
+            'name': {'type': 'string'},
+            'interfaces': {'type': dict(UUID_SET, min=1)},
+            'tag': {'type': {'key': {'type': 'integer',
+                                     'minInteger': 0, 'maxInteger': 4095},
+                             'min': 0}}}},
+        'Interface': {'columns': {
+            'name': {'type': 'string'},
+            'ofport': {'type': {'key': 'integer', 'min': 0}},
+            'external_ids': {'type': STRING_MAP},
+            'options': {'type': STRING_MAP},
+            'statistics': {'type': {'key': 'string', 'value': 'integer',
+                                    'min': 0, 'max': 'unlimited'}}}},
+    }
+}
+
+
+class FakeOvsdbServer(object):
+    """A stand-in for ovsdb-server, behind a fake socket.
+
+    The rows are held as Python values: lists for sets, dicts for maps and
+    None for empty optional atoms. The replies are split into small chunks
+    to exercise the parsing of partial messages.
+    """
+
+    chunk_size = 7
+
+    def __init__(self):
+        self.tables = dict((table, {}) for table in SCHEMA['tables'])
+        self.requests = []
+        self.monitored = None
+        self._next_uuid = 0
+        self._output = ''
+        self.closed = False
+        self.socket = mock.Mock()
+        self.socket.sendall.side_effect = self._receive
+        self.socket.recv.side_effect = self._send
+
+    def _new_uuid(self):
+        self._next_uuid += 1
+        return 'uuid-%d' % self._next_uuid
+
+    def add_bridge(self, name):
+        uuid = self._new_uuid()
+        self.tables['Bridge'][uuid] = {'name': name, 'ports': [],
+                                       'datapath_id': None}
+        self.add_port(name, name)
+        return uuid
+
+    def add_port(self, br_name, name, tag=None, ofport=None,
+                 external_ids=None):
+        interface_uuid = self._new_uuid()
+        self.tables['Interface'][interface_uuid] = {
+            'name': name, 'ofport': ofport,
+            'external_ids': external_ids or {}, 'options': {},
+            'statistics': {}}
+        port_uuid = self._new_uuid()
+        self.tables['Port'][port_uuid] = {
+            'name': name, 'interfaces': [interface_uuid], 'tag': tag}
+        bridge_uuid = self._find('Bridge', br_name)
+        if bridge_uuid:
+            self.tables['Bridge'][bridge_uuid]['ports'].append(port_uuid)
+            self.notify_changes({'Bridge': [bridge_uuid],
+                                 'Port': [port_uuid],
+                                 'Interface': [interface_uuid]})
+        return port_uuid
+
+    def _find(self, table, name):
+        for uuid, row in self.tables[table].iteritems():
+            if row['name'] == name:
+                return uuid
+
+    def _to_json(self, table, column, value):
+        column_type = SCHEMA['tables'][table]['columns'][column]['type']
+        if not isinstance(column_type, dict):
+            return value
+        if 'value' in column_type:
+            return ['map', sorted(value.items())]
+        key_type = column_type['key']
+        if isinstance(key_type, dict):
+            key_type = key_type['type']
+        if column_type.get('max', 1) != 1:
+            if key_type == 'uuid':
+                value = [['uuid', item] for item in value]
+            return ['set', value]
+        if value is None:
+            return ['set', []]
+        return value
+
+    def _row_to_json(self, table, row, columns=None):
+        return dict((column, self._to_json(table, column, value))
+                    for column, value in row.iteritems()
+                    if columns is None or column in columns)
+
+    def _get_updates(self, changes):
+        updates = {}
+        for table, uuids in changes.iteritems():
+            columns = self.monitored.get(table, {}).get('columns')
+            if columns is None:
+                continue
+            rows = updates.setdefault(table, {})
+            for uuid in uuids:
+                row = self.tables[table].get(uuid)
+                if row is None:
+                    rows[uuid] = {'old': {}}
+                else:
+                    rows[uuid] = {'new': self._row_to_json(table, row,
+                                                           columns)}
+        return updates
+
+    def notify_changes(self, changes):
+        if self.monitored is not None:
+            self.push({'method': 'update', 'id': None,
+                       'params': [None, self._get_updates(changes)]})
+
+    def push(self, message):
+        self._output += json.dumps(message)
+
+    def _send(self, size):
+        if self.closed:
+            return ''
+        data = self._output[:min(size, self.chunk_size)]
+        self._output = self._output[len(data):]
+        return data
+
+    def _receive(self, data):
+        message = json.loads(data)
+        if 'method' not in message:
+            # a reply to an echo request of the server
+            self.requests.append(message)
+            return
+        self.requests.append(message)
+        method = message['method']
+        params = message['params']
+        error = None
+        result = None
+        if method == 'get_schema':
+            result = SCHEMA
+        elif method == 'monitor':
+            self.monitored = params[2]
+            result = self._get_updates(
+                dict((table, self.tables[table].keys())
+                     for table in self.monitored))
+        elif method == 'echo':
+            result = params
+        elif method == 'transact':
+            result = self._transact(params[1:])
+        else:
+            error = 'unknown method'
+        self.push({'id': message['id'], 'result': result, 'error': error})
+
+    def _parse_value(self, table, column, value):
+        if isinstance(value, list):
+            kind, data = value
+            if kind == 'map':
+                return dict(data)
+            if kind == 'set':
+                if SCHEMA['tables'][table]['columns'][column]['type'].get(
+                        'max', 1) == 1:
+                    return data[0] if data else None
+                return data
+        return value
+
+    def _transact(self, operations):
+        results = []
+        changes = {}
+        for operation in operations:
+            table = operation['table']
+            [[column, function, name]] = operation['where']
+            uuid = self._find(table, name)
+            if uuid is None:
+                results.append({'count': 0})
+                continue
+            if table not in SCHEMA['tables'] or operation.get('fail'):
+                return [{'error': 'constraint violation'}]
+            row = self.tables[table][uuid]
+            if operation['op'] == 'update':
+                for column, value in operation['row'].iteritems():
+                    row[column] = self._parse_value(table, column, value)
+            elif operation['op'] == 'mutate':
+                for column, mutator, value in operation['mutations']:
+                    value = self._parse_value(table, column, value)
+                    if mutator == 'delete':
+                        for key in value:
+                            row[column].pop(key, None)
+                    else:
+                        row[column].update(value)
+            changes.setdefault(table, []).append(uuid)
+            results.append({'count': 1})
+        self.notify_changes(changes)
+        return results
+
+    def get_transactions(self):
+        return [request['params'][1:] for request in self.requests
+                if request.get('method') == 'transact']
+
+
+class FakeOvsdbTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(FakeOvsdbTestCase, self).setUp()
+        self.server = FakeOvsdbServer()
+        mock.patch.dict(ovsdb_native._idls, clear=True).start()
+        mock.patch.object(ovsdb_native.Connection, 'connect',
+                          autospec=True,
+                          side_effect=lambda connection:
+                          connection.connect_socket(
+                              self.server.socket)).start()
+
+
+class TestFromJson(base.BaseTestCase):
+
+    def test_from_json(self):
+        self.assertEqual([], ovsdb_native.from_json(['set', []]))
+        self.assertEqual(['a', 'b'], ovsdb_native.from_json(
+            ['set', [['uuid', 'a'], ['uuid', 'b']]]))
+        self.assertEqual({'iface-id': 'id'}, ovsdb_native.from_json(
+            ['map', [['iface-id', 'id']]]))
+        self.assertEqual('a', ovsdb_native.from_json(['uuid', 'a']))
+        self.assertEqual(1, ovsdb_native.from_json(1))
+        self.assertEqual('br-int', ovsdb_native.from_json('br-int'))
+
+
+class TestConnection(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestConnection, self).setUp()
+        self.server = FakeOvsdbServer()
+        self.notify = mock.Mock()
+        self.connection = ovsdb_native.Connection('tcp:127.0.0.1:6640', 10,
+                                                  self.notify)
+
+    def test_connect_tcp(self):
+        with mock.patch.object(ovsdb_native.socket,
+                               'create_connection') as create:
+            self.connection.connect()
+        create.assert_called_once_with(('127.0.0.1', 6640), 10)
+        self.assertTrue(self.connection.connected)
+
+    def test_connect_unix(self):
+        self.connection.connection = 'unix:/var/run/openvswitch/db.sock'
+        with mock.patch.object(ovsdb_native.socket, 'socket') as sock:
+            self.connection.connect()
+        sock.return_value.connect.assert_called_once_with(
+            '/var/run/openvswitch/db.sock')
+
+    def test_connect_invalid(self):
+        self.connection.connection = 'ssl:127.0.0.1:6640'
+        self.assertRaises(ovsdb_native.OvsdbError, self.connection.connect)
+
+    def test_call(self):
+        self.connection.connect_socket(self.server.socket)
+        self.assertEqual(['ping'], self.connection.call('echo', ['ping']))
+        self.assertEqual(SCHEMA, self.connection.call('get_schema',
+                                                      ['Open_vSwitch']))
+
+    def test_call_handles_requests(self):
+        self.connection.connect_socket(self.server.socket)
+        self.server.push({'method': 'echo', 'params': [], 'id': 'echo'})
+        self.server.push({'method': 'update', 'params': [None, {}],
+                          'id': None})
+        self.connection.call('echo', [])
+        self.assertIn({'result': [], 'error': None, 'id': 'echo'},
+                      self.server.requests)
+        self.notify.assert_called_once_with(None, {})
+
+    def test_call_error(self):
+        self.connection.connect_socket(self.server.socket)
+        self.assertRaises(ovsdb_native.OvsdbError,
+                          self.connection.call, 'unknown', [])
+        self.assertTrue(self.connection.connected)
+
+    def test_call_connection_closed(self):
+        self.connection.connect_socket(self.server.socket)
+        self.server.closed = True
+        self.assertRaises(ovsdb_native.OvsdbError,
+                          self.connection.call, 'echo', [])
+        self.assertFalse(self.connection.connected)
+
+    def test_call_socket_error(self):
+        self.connection.connect_socket(self.server.socket)
+        self.server.socket.sendall.side_effect = socket.error
+        self.assertRaises(ovsdb_native.OvsdbError,
+                          self.connection.call, 'echo', [])
+        self.assertFalse(self.connection.connected)
+
+
+class TestOvsdbIdl(FakeOvsdbTestCase):
+
+    def setUp(self):
+        super(TestOvsdbIdl, self).setUp()
+        self.server.add_bridge('br-int')
+        self.server.add_port('br-int', 'tap1', tag=1, ofport=1,
+                             external_ids={'iface-id': 'id1',
+                                           'attached-mac': 'mac1'})
+        self.server.add_port('br-int', 'patch-tun', ofport=2)
+        self.server.add_bridge('br-tun')
+        self.server.add_port('br-tun', 'patch-int', ofport=1)
+        self.idl = ovsdb_native.get_idl('tcp:127.0.0.1:6640', 10)
+
+    def test_get_idl(self):
+        self.assertIs(self.idl, ovsdb_native.get_idl('tcp:127.0.0.1:6640',
+                                                     10))
+
+    def test_get_bridge_ports(self):
+        ports = self.idl.get_bridge_ports('br-int')
+        self.assertEqual(set(['tap1', 'patch-tun']),
+                         set(port['name'] for port in ports))
+        self.assertEqual([], self.idl.get_bridge_ports('br-ex'))
+
+    def test_get_bridge_interfaces(self):
+        interfaces = self.idl.get_bridge_interfaces('br-tun')
+        self.assertEqual([{'name': 'patch-int', 'ofport': 1,
+                           'external_ids': {}}], interfaces)
+
+    def test_get_bridge_name_for_interface(self):
+        self.assertEqual('br-tun',
+                         self.idl.get_bridge_name_for_interface('patch-int'))
+        self.assertIsNone(self.idl.get_bridge_name_for_interface('tap2'))
+
+    def test_find_interface(self):
+        row = self.idl.find_interface('external_ids', 'iface-id', 'id1')
+        self.assertEqual('tap1', row['name'])
+        self.assertIsNone(self.idl.find_interface('external_ids',
+                                                  'iface-id', 'id2'))
+
+    def test_get_value(self):
+        self.assertEqual(1, self.idl.get_value('Port', 'tap1', 'tag'))
+        self.assertEqual([], self.idl.get_value('Port', 'patch-tun', 'tag'))
+        self.assertRaises(KeyError, self.idl.get_value,
+                          'Port', 'tap2', 'tag')
+        self.assertRaises(KeyError, self.idl.get_value,
+                          'Interface', 'tap1', 'statistics')
+
+    def test_monitor_updates(self):
+        self.idl.refresh()
+        self.server.add_port('br-int', 'tap2', ofport=3,
+                             external_ids={'iface-id': 'id2',
+                                           'attached-mac': 'mac2'})
+        row = self.idl.find_interface('external_ids', 'iface-id', 'id2')
+        self.assertEqual('tap2', row['name'])
+        self.assertEqual('br-int',
+                         self.idl.get_bridge_name_for_interface('tap2'))
+        # a single get_schema and monitor are needed
+        methods = [request.get('method') for request in self.server.requests]
+        self.assertEqual(['get_schema', 'monitor', 'echo', 'echo', 'echo'],
+                         methods)
+
+    def test_reconnect(self):
+        self.idl.refresh()
+        self.server.closed = True
+        self.assertRaises(ovsdb_native.OvsdbError, self.idl.refresh)
+        self.server.closed = False
+        self.assertEqual(1, self.idl.get_value('Port', 'tap1', 'tag'))
+
+    def test_reconnect_monitors_again(self):
+        self.idl.refresh()
+        self.server.closed = True
+        self.assertRaises(ovsdb_native.OvsdbError, self.idl.transact,
+                          [self.idl.get_set_operation('Port', 'tap1', 'tag',
+                                                      '2')])
+        # the monitor doesn't outlive the connection
+        self.server.closed = False
+        self.server.monitored = None
+        self.server.add_port('br-int', 'tap2', ofport=3,
+                             external_ids={'iface-id': 'id2'})
+        self.idl.transact([self.idl.get_set_operation('Port', 'tap2', 'tag',
+                                                      '2')])
+        self.assertEqual(2, self.idl.get_value('Port', 'tap2', 'tag'))
+        methods = [request.get('method') for request in self.server.requests]
+        self.assertEqual(2, methods.count('monitor'))
+
+    def test_connect_error(self):
+        with mock.patch.object(ovsdb_native.Connection, 'connect',
+                               side_effect=socket.error):
+            self.assertRaises(ovsdb_native.OvsdbError, self.idl.refresh)
+        self.assertEqual(1, self.idl.get_value('Port', 'tap1', 'tag'))
+
+    def test_start_error(self):
+        self.server.socket.recv.side_effect = [
+            json.dumps({'id': 0, 'result': None, 'error': 'failure'})]
+        self.assertRaises(ovsdb_native.OvsdbError, self.idl.refresh)
+        self.assertFalse(self.idl.connection.connected)
+
+    def test_calls_serialized(self):
+        locked = []
+
+        def send(size):
+            locked.append(self.idl._lock.locked())
+            return send_reply(size)
+
+        send_reply = self.server.socket.recv.side_effect
+        self.server.socket.recv.side_effect = send
+        self.idl.refresh()
+        self.assertTrue(locked)
+        self.assertTrue(all(locked))
+        self.assertFalse(self.idl._lock.locked())
+
+    def test_get_set_operation(self):
+        where = [['name', '==', 'tap1']]
+        self.assertEqual(
+            {'op': 'update', 'table': 'Port', 'where': where,
+             'row': {'tag': 2}},
+            self.idl.get_set_operation('Port', 'tap1', 'tag', '2'))
+        self.assertEqual(
+            {'op': 'update', 'table': 'Port', 'where': where,
+             'row': {'tag': ['set', []]}},
+            self.idl.get_set_operation('Port', 'tap1', 'tag', '[]'))
+        self.assertEqual(
+            {'op': 'mutate', 'table': 'Interface', 'where': where,
+             'mutations': [['options', 'delete', ['set', ['peer']]],
+                           ['options', 'insert',
+                            ['map', [['peer', 'patch-int']]]]]},
+            self.idl.get_set_operation('Interface', 'tap1',
+                                       'options:peer', '"patch-int"'))
+
+    def test_get_set_operation_unsupported(self):
+        for table, column, value in (('Port', 'interfaces', '[]'),
+                                     ('Interface', 'external_ids', '{}'),
+                                     ('Port', 'tag:key', '1'),
+                                     ('Port', 'tag', 'invalid'),
+                                     ('Port', 'unknown', '1'),
+                                     ('controller', 'target', '1')):
+            self.assertIsNone(self.idl.get_set_operation(table, 'tap1',
+                                                         column, value))
+
+    def test_get_clear_operation(self):
+        self.assertEqual(
+            {'op': 'update', 'table': 'Interface',
+             'where': [['name', '==', 'tap1']],
+             'row': {'options': ['map', []]}},
+            self.idl.get_clear_operation('Interface', 'tap1', 'options'))
+        self.assertEqual(
+            {'op': 'update', 'table': 'Port',
+             'where': [['name', '==', 'tap1']],
+             'row': {'tag': ['set', []]}},
+            self.idl.get_clear_operation('Port', 'tap1', 'tag'))
+        self.assertIsNone(self.idl.get_clear_operation('Port', 'tap1',
+                                                       'name'))
+
+    def test_transact(self):
+        operation = self.idl.get_set_operation('Port', 'tap1', 'tag', '2')
+        self.idl.transact([operation])
+        self.assertEqual(2, self.idl.get_value('Port', 'tap1', 'tag'))
+
+    def test_transact_error(self):
+        operation = self.idl.get_set_operation('Port', 'tap1', 'tag', '2')
+        operation['fail'] = True
+        self.assertRaises(ovsdb_native.OvsdbError,
+                          self.idl.transact, [operation])
+
+    def test_transact_no_match(self):
+        operation = self.idl.get_set_operation('Port', 'tap2', 'tag', '2')
+        with mock.patch.object(ovsdb_native.LOG, 'error') as log:
+            self.idl.transact([operation])
+        self.assertTrue(log.called)
+
+    def test_transaction(self):
+        with self.idl.transaction():
+            self.idl.transact([self.idl.get_set_operation(
+                'Port', 'tap1', 'tag', '2')])
+            with self.idl.transaction():
+                self.idl.transact([self.idl.get_set_operation(
+                    'Port', 'patch-tun', 'tag', '3')])
+            self.assertEqual([], self.server.get_transactions())
+        self.assertEqual(1, len(self.server.get_transactions()))
+        self.assertEqual(2, self.idl.get_value('Port', 'tap1', 'tag'))
+        self.assertEqual(3, self.idl.get_value('Port', 'patch-tun', 'tag'))
+
+    def test_transaction_exception(self):
+        def run_transaction():
+            with self.idl.transaction():
+                self.idl.transact([self.idl.get_set_operation(
+                    'Port', 'tap1', 'tag', '2')])
+                raise ValueError()
+
+        self.assertRaises(ValueError, run_transaction)
+        self.assertEqual([], self.server.get_transactions())
+        self.assertIsNone(self.idl._transaction.operations)
+
+    def test_transaction_other_thread(self):
+        def run_transaction():
+            with self.idl.transaction():
+                self.idl.transact([self.idl.get_set_operation(
+                    'Port', 'patch-tun', 'tag', '3')])
+
+        with self.idl.transaction():
+            self.idl.transact([self.idl.get_set_operation(
+                'Port', 'tap1', 'tag', '2')])
+            thread = threading.Thread(target=run_transaction)
+            thread.start()
+            thread.join()
+            # the transaction of the other thread is run on its own
+            self.assertEqual(1, len(self.server.get_transactions()))
+        self.assertEqual(2, len(self.server.get_transactions()))
+        self.assertEqual(2, self.idl.get_value('Port', 'tap1', 'tag'))
+        self.assertEqual(3, self.idl.get_value('Port', 'patch-tun', 'tag'))
@@ -13,13 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+
 import mock
+from oslo.config import cfg
 from oslo.db import exception as exc
 
 from neutron import context
 from neutron.db import agents_db
 from neutron.db import api as db
 from neutron.db import db_base_plugin_v2 as base_plugin
+from neutron.openstack.common import jsonutils
+from neutron.openstack.common import timeutils
 from neutron.tests import base
 
 
@@ -82,3 +87,93 @@ class TestAgentsDbMixin(base.BaseTestCase):
 
             self.assertEqual(add_mock.call_count, 2,
                              "Agent entry creation hasn't been retried")
+
+
+class TestAgentHeartbeatAggregator(base.BaseTestCase):
+    def setUp(self):
+        super(TestAgentHeartbeatAggregator, self).setUp()
+
+        self.context = context.get_admin_context()
+        self.plugin = FakePlugin()
+        self.addCleanup(db.clear_db)
+        self.looping_call = mock.patch(
+            'neutron.openstack.common.loopingcall.'
+            'FixedIntervalLoopingCall').start()
+        self.aggregator = agents_db.AgentHeartbeatAggregator(self.plugin, 10)
+
+        self.agent_status = {
+            'agent_type': 'Open vSwitch agent',
+            'binary': 'neutron-openvswitch-agent',
+            'host': 'overcloud-notcompute',
+            'topic': 'N/A',
+            'configurations': {'devices': 1}
+        }
+        self.start_time = datetime.datetime(2014, 1, 1)
+        timeutils.set_time_override(self.start_time)
+        self.addCleanup(timeutils.clear_time_override)
+
+    def _get_agent(self):
+        return self.plugin.get_agents(self.context)[0]
+
+    def test_report_new_agent_is_written(self):
+        self.aggregator.report(self.context, self.agent_status)
+        agent = self._get_agent()
+        self.assertEqual({'devices': 1}, agent['configurations'])
+        self.assertFalse(self.looping_call.called)
+
+    def test_report_heartbeat_is_buffered(self):
+        self.aggregator.report(self.context, self.agent_status)
+        timeutils.advance_time_seconds(30)
+        self.aggregator.report(self.context, self.agent_status)
+        self.assertEqual(self.start_time,
+                         self._get_agent()['heartbeat_timestamp'])
+        self.looping_call.return_value.start.assert_called_once_with(
+            interval=10)
+
+        with mock.patch.object(self.plugin,
+                               'create_or_update_agent') as write_mock:
+            self.aggregator.flush(self.context)
+        self.assertFalse(write_mock.called)
+        self.assertEqual(self.start_time + datetime.timedelta(seconds=30),
+                         self._get_agent()['heartbeat_timestamp'])
+
+    def test_report_changed_configurations_is_written(self):
+        self.aggregator.report(self.context, self.agent_status)
+        self.agent_status['configurations'] = {'devices': 2}
+        self.aggregator.report(self.context, self.agent_status)
+        self.assertEqual({'devices': 2}, self._get_agent()['configurations'])
+        self.assertFalse(self.looping_call.called)
+
+    def test_report_start_flag_is_written(self):
+        self.aggregator.report(self.context, self.agent_status)
+        timeutils.advance_time_seconds(30)
+        self.agent_status['start_flag'] = True
+        self.aggregator.report(self.context, self.agent_status)
+        self.assertEqual(self.start_time + datetime.timedelta(seconds=30),
+                         self._get_agent()['started_at'])
+
+    def test_flush_rewrites_configurations_changed_elsewhere(self):
+        self.aggregator.report(self.context, self.agent_status)
+        with self.context.session.begin():
+            agent_db = self.context.session.query(agents_db.Agent).one()
+            agent_db.configurations = jsonutils.dumps({'devices': 3})
+        self.aggregator.report(self.context, self.agent_status)
+        self.aggregator.flush(self.context)
+        self.assertEqual({'devices': 1}, self._get_agent()['configurations'])
+
+    def test_flush_recreates_deleted_agent(self):
+        self.aggregator.report(self.context, self.agent_status)
+        self.plugin.delete_agent(self.context, self._get_agent()['id'])
+        self.aggregator.report(self.context, self.agent_status)
+        self.aggregator.flush(self.context)
+        self.assertEqual(1, len(self.plugin.get_agents(self.context)))
+
+    def test_report_state_uses_aggregator(self):
+        cfg.CONF.set_override('agent_heartbeat_flush_interval', 10)
+        callback = agents_db.AgentExtRpcCallback(self.plugin)
+        with mock.patch.object(agents_db.AgentHeartbeatAggregator,
+                               'report') as report_mock:
+            callback.report_state(
+                self.context, agent_state={'agent_state': self.agent_status},
+                time=timeutils.strtime(callback.START_TIME))
+        report_mock.assert_called_once_with(self.context, self.agent_status)
@@ -15,11 +15,15 @@
 #
 # @author: Sergio Cazzolato, Intel
 
+import mock
+from oslo.config import cfg
+
 from neutron.common import exceptions
 from neutron import context
 from neutron.db import api as db
 from neutron.db import db_base_plugin_v2 as base_plugin
 from neutron.db import quota_db
+from neutron.openstack.common import timeutils
 from neutron.tests import base
 
 
@@ -130,6 +134,41 @@ class TestDbQuotaDriver(base.BaseTestCase):
                           self.plugin.limit_check, context.get_admin_context(),
                           PROJECT, resources, values)
 
+    def test_get_tenants_quotas(self):
+        project_2 = 'prj_test_2'
+        resources = {RESOURCE: TestResource(RESOURCE, 4)}
+
+        self.plugin.update_quota_limit(self.context, PROJECT, RESOURCE, 2)
+        quotas = self.plugin.get_tenants_quotas(self.context, resources,
+                                                [PROJECT, project_2])
+        self.assertEqual({PROJECT: {RESOURCE: 2}, project_2: {RESOURCE: 4}},
+                         quotas)
+
+    def test_bulk_limit_check(self):
+        resources = {RESOURCE: TestResource(RESOURCE, 2)}
+        values = {PROJECT: {RESOURCE: 2}, 'prj_test_2': {RESOURCE: 2}}
+
+        self.plugin.bulk_limit_check(self.context, resources, values)
+
+    def test_bulk_limit_check_over_quota(self):
+        resource_1 = 'res_test_1'
+        resource_2 = 'res_test_2'
+        resources = {resource_1: TestResource(resource_1, 2),
+                     resource_2: TestResource(resource_2, 2)}
+        values = {PROJECT: {resource_1: 3, resource_2: 1},
+                  'prj_test_2': {resource_1: 1, resource_2: 3}}
+
+        with mock.patch.object(quota_db.DbQuotaDriver,
+                               'get_tenants_quotas',
+                               wraps=self.plugin.get_tenants_quotas) as get:
+            try:
+                self.plugin.bulk_limit_check(self.context, resources, values)
+            except exceptions.OverQuota as e:
+                self.assertIn(str([resource_1, resource_2]), str(e))
+            else:
+                self.fail('OverQuota not raised')
+            self.assertEqual(1, get.call_count)
+
     def test_limit_check_wrong_values_size(self):
         resource_1 = 'res_test_1'
         resource_2 = 'res_test_2'
@@ -141,3 +180,158 @@ class TestDbQuotaDriver(base.BaseTestCase):
         self.assertRaises(exceptions.QuotaResourceUnknown,
                           self.plugin.limit_check, context.get_admin_context(),
                           PROJECT, resources, values)
+
+
+class TestDbReservationQuotaDriver(base.BaseTestCase):
+    def setUp(self):
+        super(TestDbReservationQuotaDriver, self).setUp()
+        self.plugin = base_plugin.NeutronDbPluginV2()
+        self.driver = quota_db.DbReservationQuotaDriver()
+        self.context = context.get_admin_context()
+        self.addCleanup(db.clear_db)
+        self.resources = {'network': TestResource('network', 10),
+                          RESOURCE: TestResource(RESOURCE, 2)}
+        self.count = mock.Mock(return_value=0)
+        self.addCleanup(timeutils.clear_time_override)
+
+    def _make_reservation(self, deltas):
+        reservations = self.driver.make_reservations(
+            self.context, self.resources, {PROJECT: deltas},
+            lambda tenant_id, resource: self.count(resource))
+        return reservations[0] if reservations else None
+
+    def _create_network(self):
+        return self.plugin.create_network(
+            self.context, {'network': {'name': 'net',
+                                       'admin_state_up': True,
+                                       'shared': False,
+                                       'tenant_id': PROJECT}})
+
+    def _get_usage(self, resource):
+        return self.context.session.query(quota_db.QuotaUsage).filter_by(
+            tenant_id=PROJECT, resource=resource).one()
+
+    def test_make_reservation(self):
+        reservation_id = self._make_reservation({'network': 10})
+        self.assertIsNotNone(reservation_id)
+        self.count.assert_called_once_with('network')
+
+    def test_make_reservation_over_quota(self):
+        self.count.return_value = 9
+        self.assertRaises(exceptions.OverQuota,
+                          self._make_reservation, {'network': 2})
+
+    def test_make_reservation_unlimited(self):
+        self.driver.update_quota_limit(self.context, PROJECT, 'network', -1)
+        self.assertIsNone(self._make_reservation({'network': 100}))
+        self.assertFalse(self.count.called)
+
+    def test_make_reservation_counts_reserved(self):
+        self._make_reservation({'network': 5})
+        self._make_reservation({'network': 5})
+        self.assertRaises(exceptions.OverQuota,
+                          self._make_reservation, {'network': 1})
+
+    def test_commit_reservation_releases_reserved(self):
+        reservation_id = self._make_reservation({'network': 2})
+        self._create_network()
+        self._create_network()
+        self.driver.commit_reservation(self.context, reservation_id)
+        self.assertEqual(2, self._get_usage('network').in_use)
+        self._make_reservation({'network': 8})
+        self.count.return_value = 2
+        self.assertRaises(exceptions.OverQuota,
+                          self._make_reservation, {'network': 1})
+
+    def test_cancel_reservation_releases_reserved(self):
+        reservation_id = self._make_reservation({'network': 10})
+        self.driver.cancel_reservation(self.context, reservation_id)
+        self._make_reservation({'network': 10})
+
+    def test_expired_reservation_ignored(self):
+        cfg.CONF.set_override('reservation_expiration', 10, group='QUOTAS')
+        timeutils.set_time_override()
+        self._make_reservation({'network': 10})
+        timeutils.advance_time_seconds(11)
+        self._make_reservation({'network': 10})
+        self.assertEqual(
+            1, self.context.session.query(quota_db.Reservation).count())
+
+    def test_tracked_usage_not_counted_again(self):
+        reservation_id = self._make_reservation({'network': 1})
+        self.driver.commit_reservation(self.context, reservation_id)
+        self._make_reservation({'network': 1})
+        self.count.assert_called_once_with('network')
+        self.assertEqual(1, self._get_usage('network').in_use)
+
+    def test_cancel_reservation_keeps_usage(self):
+        reservation_id = self._make_reservation({'network': 1})
+        self.driver.cancel_reservation(self.context, reservation_id)
+        self.assertEqual(0, self._get_usage('network').in_use)
+
+    def test_tracked_usage_not_updated_by_models(self):
+        self._make_reservation({'network': 1})
+        network = self._create_network()
+        self.assertEqual(0, self._get_usage('network').in_use)
+        self.plugin.delete_network(self.context, network['id'])
+        self.assertFalse(self._get_usage('network').dirty)
+
+    def test_mark_usages_dirty(self):
+        self._make_reservation({'network': 1})
+        self.driver.mark_usages_dirty(self.context, PROJECT)
+        self.assertTrue(self._get_usage('network').dirty)
+        self._make_reservation({'network': 1})
+        self.assertEqual(2, self.count.call_count)
+        self.assertFalse(self._get_usage('network').dirty)
+
+    def test_tracked_usage_counted_again_when_old(self):
+        cfg.CONF.set_override('usage_max_age', 10, group='QUOTAS')
+        timeutils.set_time_override()
+        self._make_reservation({'network': 1})
+        timeutils.advance_time_seconds(5)
+        self._make_reservation({'network': 1})
+        self.assertEqual(1, self.count.call_count)
+        timeutils.advance_time_seconds(6)
+        self._make_reservation({'network': 1})
+        self.assertEqual(2, self.count.call_count)
+
+    def test_tracked_usage_max_age_disabled(self):
+        cfg.CONF.set_override('usage_max_age', 0, group='QUOTAS')
+        timeutils.set_time_override()
+        self._make_reservation({'network': 1})
+        timeutils.advance_time_seconds(3600)
+        self._make_reservation({'network': 1})
+        self.assertEqual(1, self.count.call_count)
+
+    def test_untracked_usage_counted_for_each_reservation(self):
+        self._make_reservation({RESOURCE: 1})
+        self._make_reservation({RESOURCE: 1})
+        self.assertEqual(2, self.count.call_count)
+
+    def test_make_reservations_several_tenants(self):
+        project_2 = 'prj_test_2'
+        self.driver.update_quota_limit(self.context, project_2, 'network', 1)
+        reservations = self.driver.make_reservations(
+            self.context, self.resources,
+            {PROJECT: {'network': 2}, project_2: {'network': 1}},
+            lambda tenant_id, resource: self.count(resource))
+        self.assertEqual(2, len(reservations))
+        self.assertEqual(2, self.count.call_count)
+        self.assertRaises(exceptions.OverQuota,
+                          self.driver.make_reservations,
+                          self.context, self.resources,
+                          {PROJECT: {'network': 1}, project_2: {'network': 1}},
+                          lambda tenant_id, resource: self.count(resource))
+        # Nothing is reserved when any of the tenants is over quota
+        self.assertEqual(
+            2, self.context.session.query(quota_db.Reservation).count())
+
+    def test_stale_usage_counted_again_when_over_quota(self):
+        self._make_reservation({'network': 1})
+        # Networks deleted without going through the API leave a stale
+        # usage
+        with self.context.session.begin():
+            self._get_usage('network').in_use = 9
+        self._make_reservation({'network': 1})
+        self.assertEqual(2, self.count.call_count)
+        self.assertEqual(0, self._get_usage('network').in_use)
@@ -0,0 +1,45 @@
+# Copyright 2014 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy import orm
+
+from neutron.db import models_v2
+from neutron.db import sqlalchemyutils
+from neutron.tests import base
+
+
+class TestPaginateQuery(base.BaseTestCase):
+
+    def _get_criteria(self, sorts, marker_obj):
+        query = orm.Query(models_v2.Port)
+        query = sqlalchemyutils.paginate_query(query, models_v2.Port, 10,
+                                               sorts, marker_obj=marker_obj)
+        return str(query.whereclause)
+
+    def test_single_sort_key(self):
+        marker_obj = models_v2.Port(id='id1', name='name1')
+        criteria = self._get_criteria([('id', True)], marker_obj)
+        self.assertEqual('ports.id > :id_1', criteria)
+
+    def test_leading_sort_key_bounded_asc(self):
+        marker_obj = models_v2.Port(id='id1', name='name1')
+        criteria = self._get_criteria([('name', True), ('id', True)],
+                                      marker_obj)
+        self.assertTrue(criteria.startswith('ports.name >= :name_1 AND '))
+
+    def test_leading_sort_key_bounded_desc(self):
+        marker_obj = models_v2.Port(id='id1', name='name1')
+        criteria = self._get_criteria([('name', False), ('id', True)],
+                                      marker_obj)
+        self.assertTrue(criteria.startswith('ports.name <= :name_1 AND '))
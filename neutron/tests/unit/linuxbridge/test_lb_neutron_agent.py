@@ -117,11 +117,11 @@ class TestLinuxBridgeAgent(base.BaseTestCase):
                                                                      None)
         devices = [DEVICE_1]
         with contextlib.nested(
-            mock.patch.object(agent.plugin_rpc, "update_device_down"),
+            mock.patch.object(agent.plugin_rpc, "update_devices_down"),
             mock.patch.object(agent, "remove_devices_filter")
         ) as (fn_udd, fn_rdf):
-            fn_udd.return_value = {'device': DEVICE_1,
-                                   'exists': True}
+            fn_udd.return_value = [{'device': DEVICE_1,
+                                    'exists': True}]
             with mock.patch.object(linuxbridge_neutron_agent.LOG,
                                    'info') as log:
                 resync = agent.treat_devices_removed(devices)
@@ -136,11 +136,11 @@ class TestLinuxBridgeAgent(base.BaseTestCase):
                                                                      None)
         devices = [DEVICE_1]
         with contextlib.nested(
-            mock.patch.object(agent.plugin_rpc, "update_device_down"),
+            mock.patch.object(agent.plugin_rpc, "update_devices_down"),
             mock.patch.object(agent, "remove_devices_filter")
         ) as (fn_udd, fn_rdf):
-            fn_udd.return_value = {'device': DEVICE_1,
-                                   'exists': False}
+            fn_udd.return_value = [{'device': DEVICE_1,
+                                    'exists': False}]
             with mock.patch.object(linuxbridge_neutron_agent.LOG,
                                    'debug') as log:
                 resync = agent.treat_devices_removed(devices)
@@ -155,14 +155,14 @@ class TestLinuxBridgeAgent(base.BaseTestCase):
                                                                      None)
         devices = [DEVICE_1]
         with contextlib.nested(
-            mock.patch.object(agent.plugin_rpc, "update_device_down"),
+            mock.patch.object(agent.plugin_rpc, "update_devices_down"),
             mock.patch.object(agent, "remove_devices_filter")
         ) as (fn_udd, fn_rdf):
             fn_udd.side_effect = Exception()
             with mock.patch.object(linuxbridge_neutron_agent.LOG,
                                    'debug') as log:
                 resync = agent.treat_devices_removed(devices)
-                self.assertEqual(2, log.call_count)
+                self.assertEqual(1, log.call_count)
                 self.assertTrue(resync)
                 self.assertTrue(fn_udd.called)
                 self.assertTrue(fn_rdf.called)
@@ -322,7 +322,8 @@ class TestLinuxBridgeAgent(base.BaseTestCase):
         agent.br_mgr.add_interface.assert_called_with('net123', 'vlan',
                                                       'physnet1', 100,
                                                       'port123')
-        self.assertTrue(agent.plugin_rpc.update_device_up.called)
+        agent.plugin_rpc.update_devices_up.assert_called_once_with(
+            agent.context, ['dev123'], agent.agent_id, mock.ANY)
 
     def test_treat_devices_added_updated_admin_state_up_false(self):
         agent = self.agent
@@ -340,7 +341,7 @@ class TestLinuxBridgeAgent(base.BaseTestCase):
 
         self.assertFalse(resync_needed)
         agent.remove_port_binding.assert_called_with('net123', 'port123')
-        self.assertFalse(agent.plugin_rpc.update_device_up.called)
+        self.assertFalse(agent.plugin_rpc.update_devices_up.called)
 
 
 class TestLinuxBridgeManager(base.BaseTestCase):
@@ -21,6 +21,7 @@ import webob
 
 from neutron.common import exceptions as exc
 from neutron import context
+from neutron.db import db_base_plugin_v2
 from neutron.extensions import multiprovidernet as mpnet
 from neutron.extensions import portbindings
 from neutron.extensions import providernet as pnet
@@ -30,6 +31,7 @@ from neutron.plugins.ml2.common import exceptions as ml2_exc
 from neutron.plugins.ml2 import config
 from neutron.plugins.ml2 import driver_api
 from neutron.plugins.ml2 import plugin as ml2_plugin
+from neutron.plugins.ml2 import rpc as plugin_rpc
 from neutron.tests.unit import _test_extension_portbindings as test_bindings
 from neutron.tests.unit.ml2.drivers import mechanism_logger as mech_logger
 from neutron.tests.unit.ml2.drivers import mechanism_test as mech_test
@@ -113,11 +115,86 @@ class TestMl2SubnetsV2(test_plugin.TestSubnetsV2,
 
 class TestMl2PortsV2(test_plugin.TestPortsV2, Ml2PluginV2TestCase):
 
+    def test_create_port_retries_ip_allocation_contention(self):
+        update_range = (db_base_plugin_v2.NeutronDbPluginV2.
+                        _update_availability_range)
+        # the first claim of an address conflicts with a concurrent one
+        results = [False]
+
+        def _update_availability_range(context, ip_range, first_ip,
+                                       last_ip):
+            if results:
+                return results.pop()
+            return update_range(context, ip_range, first_ip, last_ip)
+
+        with self.subnet() as subnet:
+            with mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                                   '_update_availability_range',
+                                   side_effect=_update_availability_range
+                                   ) as update_range_fn:
+                with self.port(subnet=subnet) as port:
+                    ips = port['port']['fixed_ips']
+                    self.assertEqual('10.0.0.2', ips[0]['ip_address'])
+                    self.assertEqual(2, update_range_fn.call_count)
+
     def test_update_port_status_build(self):
         with self.port() as port:
             self.assertEqual('DOWN', port['port']['status'])
             self.assertEqual('DOWN', self.port_create_status)
 
+    def test_update_port_statuses(self):
+        ctx = context.get_admin_context()
+        plugin = manager.NeutronManager.get_plugin()
+        host_arg = {portbindings.HOST_ID: 'host1'}
+        with self.subnet() as subnet:
+            with contextlib.nested(
+                self.port(subnet=subnet, arg_list=(portbindings.HOST_ID,),
+                          **host_arg),
+                self.port(subnet=subnet, arg_list=(portbindings.HOST_ID,),
+                          **host_arg),
+                self.port(subnet=subnet)
+            ) as ports:
+                port_ids = [port['port']['id'] for port in ports]
+                with mock.patch.object(plugin.mechanism_manager,
+                                       'update_port_postcommit') as postcommit:
+                    exists = plugin.update_port_statuses(
+                        ctx, port_ids + ['invalid-uuid'], 'ACTIVE', 'host1')
+                self.assertEqual(
+                    dict([(port_id, True) for port_id in port_ids],
+                         **{'invalid-uuid': False}), exists)
+                self.assertEqual(2, postcommit.call_count)
+                statuses = [plugin.get_port(ctx, port_id)['status']
+                            for port_id in port_ids]
+                # the third port isn't bound to host1
+                self.assertEqual(['ACTIVE', 'ACTIVE', 'DOWN'], statuses)
+
+    def test_update_devices_up_and_down(self):
+        ctx = context.get_admin_context()
+        plugin = manager.NeutronManager.get_plugin()
+        callbacks = plugin_rpc.RpcCallbacks(mock.Mock(), mock.Mock())
+        with self.subnet() as subnet:
+            with contextlib.nested(self.port(subnet=subnet),
+                                   self.port(subnet=subnet)) as ports:
+                devices = ['tap' + port['port']['id'] for port in ports]
+                with mock.patch.object(plugin, 'update_port_statuses',
+                                       wraps=plugin.update_port_statuses
+                                       ) as update:
+                    callbacks.update_devices_up(ctx, devices=devices,
+                                                agent_id='agent')
+                self.assertEqual(1, update.call_count)
+                for port in ports:
+                    self.assertEqual('ACTIVE', plugin.get_port(
+                        ctx, port['port']['id'])['status'])
+                details = callbacks.update_devices_down(
+                    ctx, devices=devices + ['tapinvalid'], agent_id='agent')
+                self.assertEqual(
+                    [{'device': devices[0], 'exists': True},
+                     {'device': devices[1], 'exists': True},
+                     {'device': 'tapinvalid', 'exists': False}], details)
+                for port in ports:
+                    self.assertEqual('DOWN', plugin.get_port(
+                        ctx, port['port']['id'])['status'])
+
     def test_update_non_existent_port(self):
         ctx = context.get_admin_context()
         plugin = manager.NeutronManager.get_plugin()
@@ -134,7 +134,7 @@ class TestOvsNeutronAgent(base.BaseTestCase):
                        'OVSNeutronAgent._check_arp_responder_support',
                        return_value=True)):
             self.agent = ovs_neutron_agent.OVSNeutronAgent(**kwargs)
-            self.agent.tun_br = mock.Mock()
+            self.agent.tun_br = mock.MagicMock()
         self.agent.sg_agent = mock.Mock()
 
     def _mock_port_bound(self, ofport=None, new_local_vlan=None,
@@ -288,16 +288,26 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             mock.patch.object(self.agent.plugin_rpc,
                               'get_devices_details_list',
                               side_effect=Exception()),
-            mock.patch.object(self.agent.int_br, 'get_vif_port_by_id',
-                              return_value=mock.Mock())):
+            mock.patch.object(self.agent.int_br, 'get_vif_ports_by_ids',
+                              return_value={})):
             self.assertTrue(self.agent.treat_devices_added_or_updated([{}],
                                                                       False))
 
+    def test_treat_devices_added_returns_true_for_vif_ports_error(self):
+        with contextlib.nested(
+            mock.patch.object(self.agent.plugin_rpc,
+                              'get_devices_details_list',
+                              return_value=[{'device': 'xxx'}]),
+            mock.patch.object(self.agent.int_br, 'get_vif_ports_by_ids',
+                              side_effect=RuntimeError())):
+            self.assertTrue(self.agent.treat_devices_added_or_updated(
+                ['xxx'], False))
+
     def _mock_treat_devices_added_updated(self, details, port, func_name):
         """Mock treat devices added or updated.
 
         :param details: the details to return for the device
-        :param port: the port that get_vif_port_by_id should return
+        :param port: the port that get_vif_ports_by_ids should return
         :param func_name: the function that should be called
         :returns: whether the named function was called
         """
@@ -305,10 +315,10 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             mock.patch.object(self.agent.plugin_rpc,
                               'get_devices_details_list',
                               return_value=[details]),
-            mock.patch.object(self.agent.int_br, 'get_vif_port_by_id',
-                              return_value=port),
-            mock.patch.object(self.agent.plugin_rpc, 'update_device_up'),
-            mock.patch.object(self.agent.plugin_rpc, 'update_device_down'),
+            mock.patch.object(self.agent.int_br, 'get_vif_ports_by_ids',
+                              return_value={details['device']: port}),
+            mock.patch.object(self.agent.plugin_rpc, 'update_devices_up'),
+            mock.patch.object(self.agent.plugin_rpc, 'update_devices_down'),
             mock.patch.object(self.agent, func_name)
         ) as (get_dev_fn, get_vif_func, upd_dev_up, upd_dev_down, func):
             self.assertFalse(self.agent.treat_devices_added_or_updated([{}],
@@ -329,11 +339,19 @@ class TestOvsNeutronAgent(base.BaseTestCase):
 
     def test_treat_devices_added_does_not_process_missing_port(self):
         with contextlib.nested(
-            mock.patch.object(self.agent.plugin_rpc, 'get_device_details'),
-            mock.patch.object(self.agent.int_br, 'get_vif_port_by_id',
-                              return_value=None)
-        ) as (get_dev_fn, get_vif_func):
-            self.assertFalse(get_dev_fn.called)
+            mock.patch.object(self.agent.plugin_rpc,
+                              'get_devices_details_list',
+                              return_value=[{'device': 'xxx',
+                                             'port_id': 'xxx'}]),
+            mock.patch.object(self.agent.int_br, 'get_vif_ports_by_ids',
+                              return_value={}),
+            mock.patch.object(self.agent, 'treat_vif_port')
+        ) as (get_dev_fn, get_vif_func, treat_vif_port):
+            self.assertFalse(self.agent.treat_devices_added_or_updated(
+                ['xxx'], False))
+        get_vif_func.assert_called_once_with(mock.ANY)
+        self.assertEqual(['xxx'], list(get_vif_func.call_args[0][0]))
+        self.assertFalse(treat_vif_port.called)
 
     def test_treat_devices_added__updated_updates_known_port(self):
         details = mock.MagicMock()
@@ -353,10 +371,10 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             mock.patch.object(self.agent.plugin_rpc,
                               'get_devices_details_list',
                               return_value=[fake_details_dict]),
-            mock.patch.object(self.agent.int_br, 'get_vif_port_by_id',
-                              return_value=mock.MagicMock()),
-            mock.patch.object(self.agent.plugin_rpc, 'update_device_up'),
-            mock.patch.object(self.agent.plugin_rpc, 'update_device_down'),
+            mock.patch.object(self.agent.int_br, 'get_vif_ports_by_ids',
+                              return_value={'xxx': mock.MagicMock()}),
+            mock.patch.object(self.agent.plugin_rpc, 'update_devices_up'),
+            mock.patch.object(self.agent.plugin_rpc, 'update_devices_down'),
             mock.patch.object(self.agent, 'treat_vif_port')
         ) as (get_dev_fn, get_vif_func, upd_dev_up,
               upd_dev_down, treat_vif_port):
@@ -366,14 +384,14 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             self.assertTrue(upd_dev_down.called)
 
     def test_treat_devices_removed_returns_true_for_missing_device(self):
-        with mock.patch.object(self.agent.plugin_rpc, 'update_device_down',
+        with mock.patch.object(self.agent.plugin_rpc, 'update_devices_down',
                                side_effect=Exception()):
             self.assertTrue(self.agent.treat_devices_removed([{}]))
 
     def _mock_treat_devices_removed(self, port_exists):
         details = dict(exists=port_exists)
-        with mock.patch.object(self.agent.plugin_rpc, 'update_device_down',
-                               return_value=details):
+        with mock.patch.object(self.agent.plugin_rpc, 'update_devices_down',
+                               return_value=[details]):
             with mock.patch.object(self.agent, 'port_unbound') as port_unbound:
                 self.assertFalse(self.agent.treat_devices_removed([{}]))
         self.assertTrue(port_unbound.called)
@@ -465,10 +483,12 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             mock.patch.object(self.agent.int_br, "add_patch_port"),
             mock.patch.object(self.agent.int_br, "delete_port"),
             mock.patch.object(self.agent.int_br, "set_db_attribute"),
+            mock.patch.object(self.agent, "_is_interconnected",
+                              return_value=False),
         ) as (devex_fn, sysexit_fn, utilsexec_fn, remflows_fn, ovs_add_flow_fn,
               ovs_addpatch_port_fn, ovs_delport_fn, ovs_set_attr_fn,
               br_add_flow_fn, br_addpatch_port_fn, br_delport_fn,
-              br_set_attr_fn):
+              br_set_attr_fn, interconnected_fn):
             devex_fn.return_value = True
             parent = mock.MagicMock()
             parent.attach_mock(ovs_addpatch_port_fn, 'phy_add_patch_port')
@@ -498,6 +518,9 @@ class TestOvsNeutronAgent(base.BaseTestCase):
 
             ]
             parent.assert_has_calls(expected_calls)
+            self.assertFalse(remflows_fn.called)
+            self.assertEqual(self.agent.agent_cookie,
+                             self.agent.phys_brs["physnet1"].default_cookie)
             self.assertEqual(self.agent.int_ofports["physnet1"],
                              "int_ofport")
             self.assertEqual(self.agent.phys_ofports["physnet1"],
@@ -519,10 +542,13 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             mock.patch.object(ip_lib.IpLinkCommand, "delete"),
             mock.patch.object(ip_lib.IpLinkCommand, "set_up"),
             mock.patch.object(ip_lib.IpLinkCommand, "set_mtu"),
-            mock.patch.object(ovs_lib, "get_bridges")
+            mock.patch.object(ovs_lib, "get_bridges"),
+            mock.patch.object(self.agent, "_is_interconnected",
+                              return_value=False)
         ) as (devex_fn, sysexit_fn, utilsexec_fn, remflows_fn, ovs_addfl_fn,
               ovs_addport_fn, ovs_delport_fn, br_addport_fn, br_delport_fn,
-              addveth_fn, linkdel_fn, linkset_fn, linkmtu_fn, get_br_fn):
+              addveth_fn, linkdel_fn, linkset_fn, linkmtu_fn, get_br_fn,
+              interconnected_fn):
             devex_fn.return_value = True
             parent = mock.MagicMock()
             parent.attach_mock(utilsexec_fn, 'utils_execute')
@@ -546,6 +572,88 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             self.assertEqual(self.agent.phys_ofports["physnet1"],
                              "int_ofport")
 
+    def test_setup_physical_bridges_keeps_interconnection(self):
+        with contextlib.nested(
+            mock.patch.object(ovs_lib, "get_bridges",
+                              return_value=["br-eth"]),
+            mock.patch.object(ovs_lib.OVSBridge, "add_flow"),
+            mock.patch.object(ovs_lib.OVSBridge, "get_port_ofport",
+                              return_value="phy_ofport"),
+            mock.patch.object(ovs_lib.OVSBridge, "add_patch_port"),
+            mock.patch.object(ovs_lib.OVSBridge, "delete_port"),
+            mock.patch.object(ovs_lib.OVSBridge, "set_db_attribute"),
+            mock.patch.object(self.agent.int_br, "add_flow"),
+            mock.patch.object(self.agent.int_br, "get_port_ofport",
+                              return_value="int_ofport"),
+            mock.patch.object(self.agent.int_br, "add_patch_port"),
+            mock.patch.object(self.agent.int_br, "delete_port"),
+            mock.patch.object(self.agent.int_br, "set_db_attribute"),
+            mock.patch.object(self.agent, "_is_interconnected",
+                              return_value=True),
+        ) as (get_br_fn, ovs_add_flow_fn, ovs_get_ofport_fn,
+              ovs_addpatch_port_fn, ovs_delport_fn, ovs_set_attr_fn,
+              br_add_flow_fn, br_get_ofport_fn, br_addpatch_port_fn,
+              br_delport_fn, br_set_attr_fn, interconnected_fn):
+            self.agent.setup_physical_bridges({"physnet1": "br-eth"})
+        for fn in (ovs_addpatch_port_fn, ovs_delport_fn, br_addpatch_port_fn,
+                   br_delport_fn):
+            self.assertFalse(fn.called)
+        self.assertEqual("int_ofport", self.agent.int_ofports["physnet1"])
+        self.assertEqual("phy_ofport", self.agent.phys_ofports["physnet1"])
+        br_add_flow_fn.assert_called_once_with(priority=2,
+                                               in_port="int_ofport",
+                                               actions="drop")
+
+    def _test_is_interconnected(self, int_options, phys_options,
+                                ofport="1", use_veth=False):
+        self.agent.use_veth_interconnection = use_veth
+        br = mock.Mock()
+        br.get_port_ofport.return_value = ofport
+        br.db_get_map.return_value = phys_options
+        with contextlib.nested(
+            mock.patch.object(self.agent.int_br, "get_port_ofport",
+                              return_value="2"),
+            mock.patch.object(self.agent.int_br, "db_get_map",
+                              return_value=int_options),
+            mock.patch.object(ip_lib, "device_exists", return_value=True)
+        ):
+            return self.agent._is_interconnected(br, "int-br-eth",
+                                                 "phy-br-eth")
+
+    def test_is_interconnected_by_patch_ports(self):
+        self.assertTrue(self._test_is_interconnected(
+            {'peer': 'phy-br-eth'}, {'peer': 'int-br-eth'}))
+
+    def test_is_interconnected_unassociated_patch_ports(self):
+        self.assertFalse(self._test_is_interconnected(
+            {'peer': constants.NONEXISTENT_PEER},
+            {'peer': constants.NONEXISTENT_PEER}))
+
+    def test_is_interconnected_missing_port(self):
+        self.assertFalse(self._test_is_interconnected(
+            {'peer': 'phy-br-eth'}, {'peer': 'int-br-eth'},
+            ofport=constants.INVALID_OFPORT))
+
+    def test_is_interconnected_by_veths(self):
+        self.assertTrue(self._test_is_interconnected({}, {}, use_veth=True))
+        self.assertFalse(self._test_is_interconnected(
+            {'peer': 'phy-br-eth'}, {'peer': 'int-br-eth'}, use_veth=True))
+
+    def test_setup_integration_br_keeps_tunnel_patch_port(self):
+        with contextlib.nested(
+            mock.patch.object(self.agent.int_br, "create"),
+            mock.patch.object(self.agent.int_br, "set_secure_mode"),
+            mock.patch.object(self.agent.int_br, "add_flow"),
+            mock.patch.object(self.agent.int_br, "delete_port")
+        ) as (create_fn, secure_fn, add_flow_fn, delete_port_fn):
+            self.agent.enable_tunneling = True
+            self.agent.setup_integration_br()
+            self.assertFalse(delete_port_fn.called)
+            self.agent.enable_tunneling = False
+            self.agent.setup_integration_br()
+            delete_port_fn.assert_called_once_with(
+                cfg.CONF.OVS.int_peer_patch_port)
+
     def test_get_peer_name(self):
             bridge1 = "A_REALLY_LONG_BRIDGE_NAME1"
             bridge2 = "A_REALLY_LONG_BRIDGE_NAME2"
@@ -608,6 +716,111 @@ class TestOvsNeutronAgent(base.BaseTestCase):
             self.assertFalse(del_flow_fn.called)
             self.assertFalse(clean_tun_fn.called)
 
+    def test_flow_transaction(self):
+        self.agent.atomic_flow_updates = True
+        self.agent.enable_tunneling = True
+        self.agent.phys_brs = {'physnet1': mock.MagicMock()}
+        with contextlib.nested(
+            mock.patch.object(self.agent.int_br, 'run_ofctl'),
+            mock.patch.object(self.agent.int_br, '_apply_deferred_flows')
+        ) as (run_ofctl, apply_flows_fn):
+            with self.agent._flow_transaction():
+                self.agent.int_br.add_flow(priority=0, actions='normal')
+                self.assertFalse(run_ofctl.called)
+            apply_flows_fn.assert_called_once_with([('add', mock.ANY)], True)
+        for bridge in (self.agent.phys_brs['physnet1'], self.agent.tun_br):
+            bridge.flow_transaction.assert_called_once_with(atomic=True)
+
+    def test_setup_bridge_protocols(self):
+        self.agent.enable_tunneling = True
+        self.agent.phys_brs = {'physnet1': mock.MagicMock()}
+        with mock.patch.object(self.agent.int_br,
+                               'set_protocols') as set_protocols_fn:
+            self.agent.setup_bridge_protocols()
+            self.assertFalse(set_protocols_fn.called)
+            self.agent.atomic_flow_updates = True
+            self.agent.setup_bridge_protocols()
+        protocols = ovs_neutron_agent.ATOMIC_FLOW_UPDATES_PROTOCOLS
+        set_protocols_fn.assert_called_once_with(protocols)
+        for bridge in (self.agent.phys_brs['physnet1'], self.agent.tun_br):
+            bridge.set_protocols.assert_called_once_with(protocols)
+
+    def test_treat_devices_added_applies_flows_before_status(self):
+        details = {'device': 'tap1', 'port_id': 'port1',
+                   'network_id': 'net1', 'network_type': 'vlan',
+                   'physical_network': 'physnet1', 'segmentation_id': 1,
+                   'admin_state_up': True}
+        parent = mock.MagicMock()
+        with contextlib.nested(
+            mock.patch.object(self.agent.plugin_rpc,
+                              'get_devices_details_list',
+                              return_value=[details]),
+            mock.patch.object(self.agent.int_br, 'get_vif_ports_by_ids',
+                              return_value={'tap1': mock.Mock()}),
+            mock.patch.object(self.agent, 'treat_vif_port'),
+            mock.patch.object(self.agent, '_flow_transaction',
+                              return_value=parent.transaction),
+            mock.patch.object(self.agent.plugin_rpc, 'update_devices_up',
+                              new=parent.update_devices_up)
+        ):
+            self.assertFalse(self.agent.treat_devices_added_or_updated(
+                ['tap1'], False))
+        self.assertEqual(['transaction.__enter__', 'transaction.__exit__',
+                          'update_devices_up'],
+                         [call[0] for call in parent.mock_calls])
+
+    def test_delete_stale_flows(self):
+        self.agent.enable_tunneling = True
+        self.agent.phys_brs = {'physnet1': mock.MagicMock()}
+        with mock.patch.object(self.agent.int_br,
+                               'delete_stale_flows') as int_delete_fn:
+            with mock.patch.object(self.agent, 'delete_stale_tunnel_ports'
+                                   ) as delete_ports_fn:
+                self.agent.delete_stale_flows()
+        int_delete_fn.assert_called_once_with()
+        for bridge in (self.agent.phys_brs['physnet1'], self.agent.tun_br):
+            bridge.delete_stale_flows.assert_called_once_with()
+        delete_ports_fn.assert_called_once_with()
+
+    def test_delete_stale_tunnel_ports(self):
+        self.agent.tun_br_ofports = {p_const.TYPE_GRE: {'10.0.0.2': '3'},
+                                     p_const.TYPE_VXLAN: {}}
+        ofports = {'gre-0a000002': '3', 'gre-0a000003': '4',
+                   'gre-0a000004': '5', 'vxlan-0a000005': '6'}
+        self.agent.tun_br.get_port_name_list.return_value = (
+            ['patch-int'] + sorted(ofports))
+        self.agent.tun_br.get_port_ofport.side_effect = ofports.get
+        # a port still flooded to by a flow is kept
+        self.agent.tun_br.get_flow_ofports.return_value = set(['1', '5'])
+        self.agent.delete_stale_tunnel_ports()
+        self.assertEqual(
+            [mock.call('gre-0a000003'), mock.call('vxlan-0a000005')],
+            self.agent.tun_br.delete_port.call_args_list)
+
+    def test_rpc_loop_deletes_stale_flows_once_synchronized(self):
+        def process_network_ports(port_info, ovs_restarted):
+            if process_network_ports_fn.call_count == 3:
+                self.agent.run_daemon_loop = False
+            # the first iteration fails
+            return process_network_ports_fn.call_count == 1
+
+        with contextlib.nested(
+            mock.patch.object(self.agent, 'check_ovs_restart',
+                              return_value=False),
+            mock.patch.object(self.agent, 'scan_ports',
+                              return_value={'current': set(),
+                                            'added': set(['tap1'])}),
+            mock.patch.object(self.agent, 'process_network_ports'),
+            mock.patch.object(self.agent, 'delete_stale_flows'),
+            mock.patch.object(self.agent, '_flow_transaction'),
+            mock.patch('time.sleep')
+        ) as (restart_fn, scan_ports_fn, process_network_ports_fn,
+              delete_stale_flows_fn, flow_transaction_fn, sleep_fn):
+            process_network_ports_fn.side_effect = process_network_ports
+            self.agent.rpc_loop()
+        self.assertEqual(3, process_network_ports_fn.call_count)
+        delete_stale_flows_fn.assert_called_once_with()
+
     def test_fdb_ignore_self(self):
         self._prepare_l2_pop_ofports()
         self.agent.local_ip = 'agent_ip'
@@ -619,7 +832,7 @@ class TestOvsNeutronAgent(base.BaseTestCase):
                        [[FAKE_MAC, FAKE_IP1],
                         n_const.FLOODING_ENTRY]}}}
         with mock.patch.object(self.agent.tun_br,
-                               "defer_apply_on") as defer_fn:
+                               "flow_transaction") as defer_fn:
             self.agent.fdb_add(None, fdb_entry)
             self.assertFalse(defer_fn.called)
 
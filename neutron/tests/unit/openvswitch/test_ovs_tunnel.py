@@ -138,6 +138,10 @@ class TunnelTest(base.BaseTestCase):
 
         self.execute = mock.patch('neutron.agent.linux.utils.execute').start()
 
+        mock.patch('neutron.plugins.openvswitch.agent.ovs_neutron_agent.'
+                   'OVSNeutronAgent._is_interconnected',
+                   return_value=False).start()
+
         self._define_expected_calls()
 
     def _define_expected_calls(self):
@@ -151,15 +155,12 @@ class TunnelTest(base.BaseTestCase):
         self.mock_int_bridge_expected = [
             mock.call.create(),
             mock.call.set_secure_mode(),
-            mock.call.delete_port('patch-tun'),
-            mock.call.remove_all_flows(),
             mock.call.add_flow(priority=1, actions='normal'),
             mock.call.add_flow(priority=0, table=constants.CANARY_TABLE,
                                actions='drop'),
         ]
 
         self.mock_map_tun_bridge_expected = [
-            mock.call.remove_all_flows(),
             mock.call.add_flow(priority=1, actions='normal'),
             mock.call.delete_port('phy-%s' % self.MAP_TUN_BRIDGE),
             mock.call.add_patch_port('phy-%s' % self.MAP_TUN_BRIDGE,
@@ -189,7 +190,7 @@ class TunnelTest(base.BaseTestCase):
         ]
 
         self.mock_tun_bridge_expected = [
-            mock.call.reset_bridge(),
+            mock.call.create(),
             mock.call.add_patch_port('patch-int', 'patch-tun'),
         ]
         self.mock_int_bridge_expected += [
@@ -197,7 +198,6 @@ class TunnelTest(base.BaseTestCase):
         ]
 
         self.mock_tun_bridge_expected += [
-            mock.call.remove_all_flows(),
             mock.call.add_flow(priority=1,
                                in_port=self.INT_OFPORT,
                                actions="resubmit(,%s)" %
@@ -296,7 +296,7 @@ class TunnelTest(base.BaseTestCase):
     def test_construct_with_arp_responder(self):
         self._build_agent(l2_population=True, arp_responder=True)
         self.mock_tun_bridge_expected.insert(
-            5, mock.call.add_flow(table=constants.PATCH_LV_TO_TUN,
+            4, mock.call.add_flow(table=constants.PATCH_LV_TO_TUN,
                                   priority=1,
                                   proto="arp",
                                   dl_dst="ff:ff:ff:ff:ff:ff",
@@ -304,7 +304,7 @@ class TunnelTest(base.BaseTestCase):
                                   constants.ARP_RESPONDER)
         )
         self.mock_tun_bridge_expected.insert(
-            12, mock.call.add_flow(table=constants.ARP_RESPONDER,
+            11, mock.call.add_flow(table=constants.ARP_RESPONDER,
                                    priority=0,
                                    actions="resubmit(,%s)" %
                                    constants.FLOOD_TO_TUN)
@@ -520,8 +520,11 @@ class TunnelTest(base.BaseTestCase):
             mock.patch.object(ovs_neutron_agent.OVSNeutronAgent,
                               'scan_ports'),
             mock.patch.object(ovs_neutron_agent.OVSNeutronAgent,
-                              'process_network_ports')
-        ) as (log_exception, scan_ports, process_network_ports):
+                              'process_network_ports'),
+            mock.patch.object(ovs_neutron_agent.OVSNeutronAgent,
+                              '_flow_transaction')
+        ) as (log_exception, scan_ports, process_network_ports,
+              flow_transaction):
             log_exception.side_effect = Exception(
                 'Fake exception to get out of the loop')
             scan_ports.side_effect = [reply2, reply3]
@@ -553,6 +556,7 @@ class TunnelTest(base.BaseTestCase):
                        'removed': set(['tap0']),
                        'added': set([])}, False)
         ])
+        self.assertEqual(2, flow_transaction.call_count)
         self._verify_mock_calls()
 
 
@@ -569,15 +573,12 @@ class TunnelTestUseVethInterco(TunnelTest):
         self.mock_int_bridge_expected = [
             mock.call.create(),
             mock.call.set_secure_mode(),
-            mock.call.delete_port('patch-tun'),
-            mock.call.remove_all_flows(),
             mock.call.add_flow(priority=1, actions='normal'),
             mock.call.add_flow(table=constants.CANARY_TABLE, priority=0,
                                actions="drop")
         ]
 
         self.mock_map_tun_bridge_expected = [
-            mock.call.remove_all_flows(),
             mock.call.add_flow(priority=1, actions='normal'),
             mock.call.delete_port('phy-%s' % self.MAP_TUN_BRIDGE),
             mock.call.add_port(self.intb),
@@ -599,7 +600,7 @@ class TunnelTestUseVethInterco(TunnelTest):
         ]
 
         self.mock_tun_bridge_expected = [
-            mock.call.reset_bridge(),
+            mock.call.create(),
             mock.call.add_patch_port('patch-int', 'patch-tun'),
         ]
         self.mock_int_bridge_expected += [
@@ -607,7 +608,6 @@ class TunnelTestUseVethInterco(TunnelTest):
         ]
 
         self.mock_tun_bridge_expected += [
-            mock.call.remove_all_flows(),
             mock.call.add_flow(priority=1,
                                in_port=self.INT_OFPORT,
                                actions="resubmit(,%s)" %
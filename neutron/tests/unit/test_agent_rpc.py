@@ -56,6 +56,42 @@ class AgentRPCPluginApi(base.BaseTestCase):
     def test_update_device_down(self):
         self._test_rpc_call('update_device_down')
 
+    def test_update_devices_down(self):
+        self._test_rpc_call('update_devices_down')
+
+    def test_update_devices_down_unsupported(self):
+        agent = rpc.PluginApi('fake_topic')
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+        expect_val = [{'device': 'fake_device', 'exists': True}]
+        with mock.patch('neutron.common.rpc.RpcProxy.call') as rpc_call:
+            rpc_call.side_effect = [
+                messaging.RemoteError('UnsupportedVersion'), expect_val[0]]
+            actual_val = agent.update_devices_down(ctxt, ['fake_device'],
+                                                   'fake_agent_id')
+        self.assertEqual(actual_val, expect_val)
+
+    def test_update_devices_up_unsupported(self):
+        agent = rpc.PluginApi('fake_topic')
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+        with mock.patch('neutron.common.rpc.RpcProxy.call') as rpc_call:
+            rpc_call.side_effect = [
+                messaging.RemoteError('UnsupportedVersion'), None, None]
+            agent.update_devices_up(ctxt, ['fake_device1', 'fake_device2'],
+                                    'fake_agent_id')
+        self.assertEqual(3, rpc_call.call_count)
+        self.assertEqual('update_device_up',
+                         rpc_call.call_args[0][1]['method'])
+
+    def test_update_devices_up_remote_error(self):
+        agent = rpc.PluginApi('fake_topic')
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+        with mock.patch('neutron.common.rpc.RpcProxy.call') as rpc_call:
+            rpc_call.side_effect = messaging.RemoteError('PortNotFound')
+            self.assertRaises(messaging.RemoteError,
+                              agent.update_devices_up, ctxt,
+                              ['fake_device'], 'fake_agent_id')
+        self.assertEqual(1, rpc_call.call_count)
+
     def test_tunnel_sync(self):
         self._test_rpc_call('tunnel_sync')
 
@@ -884,6 +884,42 @@ class JSONV2TestCase(APIv2TestBase, testlib_api.WebTestCase):
                             content_type='application/' + self.fmt)
         self.assertEqual(res.status_int, exc.HTTPCreated.code)
 
+    def test_create_bulk_ports_get_network_once(self):
+        tenant_id = _uuid()
+        net_id = _uuid()
+        ports = [{'network_id': net_id,
+                  'admin_state_up': True,
+                  'tenant_id': tenant_id,
+                  'mac_address': 'ca:fe:de:ad:%02x:%02x' % divmod(i, 256)}
+                 for i in range(1000)]
+        env = {'neutron.context': context.Context('', tenant_id)}
+        cfg.CONF.set_override('quota_port', -1, group='QUOTAS')
+
+        def side_effect(context, port):
+            return {'id': _uuid(),
+                    'network_id': port['port']['network_id'],
+                    'tenant_id': port['port']['tenant_id'],
+                    'mac_address': port['port']['mac_address'],
+                    'status': 'ACTIVE'}
+
+        instance = self.plugin.return_value
+        instance.get_network.return_value = {'tenant_id': tenant_id,
+                                             'shared': False}
+        instance.get_ports_count.return_value = 0
+        instance.create_port.side_effect = side_effect
+        res = self.api.post(_get_path('ports', fmt=self.fmt),
+                            self.serialize({'ports': ports}),
+                            content_type='application/' + self.fmt,
+                            extra_environ=env)
+        self.assertEqual(res.status_int, exc.HTTPCreated.code)
+        # The network is retrieved once, for checking the ownership of the
+        # network and the create_port:mac_address policy of all the ports
+        self.assertEqual(1, instance.get_network.call_count)
+        (ctx, network_id), kwargs = instance.get_network.call_args
+        self.assertTrue(ctx.is_admin)
+        self.assertEqual(net_id, network_id)
+        self.assertEqual(['tenant_id', 'shared'], kwargs['fields'])
+
     def test_create_bulk_no_networks(self):
         data = {'networks': []}
         res = self.api.post(_get_path('networks', fmt=self.fmt),
@@ -1381,6 +1417,71 @@ class QuotaTest(APIv2TestBase):
             _get_path('networks'), initial_input)
         self.assertEqual(res.status_int, exc.HTTPCreated.code)
 
+    def test_create_networks_bulk_quota_counted_once(self):
+        cfg.CONF.set_override('quota_network', 4, group='QUOTAS')
+        tenant_1 = _uuid()
+        tenant_2 = _uuid()
+        initial_input = {'networks': [{'name': 'net%d' % i,
+                                       'tenant_id': tenant}
+                                      for i, tenant in enumerate(
+                                          [tenant_1] * 3 + [tenant_2] * 2)]}
+        instance = self.plugin.return_value
+        instance.get_networks_count.return_value = 2
+        res = self.api.post_json(
+            _get_path('networks'), initial_input, expect_errors=True)
+        self.assertEqual(2, instance.get_networks_count.call_count)
+        self.assertIn("Quota exceeded for resources: ['network']",
+                      res.json['NeutronError']['message'])
+        self.assertFalse(instance.create_network.called)
+
+    def _test_create_network_reservation(self, create_side_effect=None):
+        tenant_id = _uuid()
+        initial_input = {'network': {'name': 'net1', 'tenant_id': tenant_id}}
+        instance = self.plugin.return_value
+        instance.create_network.return_value = {'id': _uuid(),
+                                                'tenant_id': tenant_id}
+        instance.create_network.side_effect = create_side_effect
+        make_reservations = mock.patch.object(
+            quota.QUOTAS, 'make_reservations',
+            return_value=['fake_reservation']).start()
+        commit_reservation = mock.patch.object(
+            quota.QUOTAS, 'commit_reservation').start()
+        cancel_reservation = mock.patch.object(
+            quota.QUOTAS, 'cancel_reservation').start()
+        res = self.api.post_json(
+            _get_path('networks'), initial_input, expect_errors=True)
+        make_reservations.assert_called_once_with(
+            mock.ANY, {tenant_id: {'network': 1}}, mock.ANY)
+        return res, commit_reservation, cancel_reservation
+
+    def test_create_network_commits_reservation(self):
+        res, commit_reservation, cancel_reservation = (
+            self._test_create_network_reservation())
+        self.assertEqual(res.status_int, exc.HTTPCreated.code)
+        commit_reservation.assert_called_once_with(mock.ANY,
+                                                   'fake_reservation')
+        self.assertFalse(cancel_reservation.called)
+
+    def test_create_network_failure_cancels_reservation(self):
+        res, commit_reservation, cancel_reservation = (
+            self._test_create_network_reservation(
+                n_exc.NetworkInUse(net_id='fake')))
+        self.assertEqual(res.status_int, exc.HTTPConflict.code)
+        cancel_reservation.assert_called_once_with(mock.ANY,
+                                                   'fake_reservation')
+        self.assertFalse(commit_reservation.called)
+
+    def test_delete_network_marks_usages_dirty(self):
+        tenant_id = _uuid()
+        instance = self.plugin.return_value
+        instance.get_network.return_value = {'tenant_id': tenant_id,
+                                             'shared': False}
+        with mock.patch.object(quota.QUOTAS,
+                               'mark_usages_dirty') as mark_usages_dirty:
+            res = self.api.delete(_get_path('networks', id=_uuid()))
+        self.assertEqual(res.status_int, exc.HTTPNoContent.code)
+        mark_usages_dirty.assert_called_once_with(mock.ANY, tenant_id)
+
 
 class ExtensionTestCase(base.BaseTestCase):
     def setUp(self):
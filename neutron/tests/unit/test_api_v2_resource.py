@@ -312,6 +312,21 @@ class ResourceTestCase(base.BaseTestCase):
         res = resource.get('', extra_environ=environ)
         self.assertEqual(res.status_int, 200)
 
+    def test_index_streamed(self):
+        controller = mock.MagicMock()
+        controller.index = lambda request: {'foos': [{'id': 1}, {'id': 2}]}
+
+        resource = wsgi_resource.Resource(controller)
+
+        req = wsgi_resource.Request.blank('/')
+        req.environ['wsgiorg.routing_args'] = (None, {'action': 'index'})
+        res = req.get_response(resource)
+        self.assertEqual(res.status_int, 200)
+        self.assertIsNone(res.content_length)
+        self.assertEqual({'foos': [{'id': 1}, {'id': 2}]},
+                         wsgi.JSONDeserializer().deserialize(
+                             res.body)['body'])
+
     def test_status_204(self):
         controller = mock.MagicMock()
         controller.test = lambda request: {'foo': 'bar'}
@@ -17,6 +17,7 @@ import contextlib
 import copy
 
 import mock
+import netaddr
 from oslo.config import cfg
 from testtools import matchers
 import webob.exc
@@ -853,6 +854,99 @@ class TestPortsV2(NeutronDbPluginV2TestCase):
             for p in self.deserialize(self.fmt, res)['ports']:
                 self._delete('ports', p['id'])
 
+    def test_create_ports_bulk_native_generates_macs_at_once(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        plugin = manager.NeutronManager.get_plugin()
+        with contextlib.nested(
+            self.network(),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_generate_macs',
+                              wraps=plugin._generate_macs),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_check_unique_mac')
+        ) as (net, generate_macs, check_unique_mac):
+            res = self._create_port_bulk(self.fmt, 2, net['network']['id'],
+                                         'test', True)
+            self._validate_behavior_on_bulk_success(res, 'ports')
+            ports = self.deserialize(self.fmt, res)['ports']
+            self.assertEqual(2, len(set(p['mac_address'] for p in ports)))
+            generate_macs.assert_called_once_with(mock.ANY,
+                                                  net['network']['id'], 2)
+            self.assertFalse(check_unique_mac.called)
+            for p in ports:
+                self._delete('ports', p['id'])
+
+    def test_create_ports_bulk_checks_requested_macs(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        with contextlib.nested(
+            self.network(),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_check_unique_mac', return_value=True)
+        ) as (net, check_unique_mac):
+            overrides = {0: {'mac_address': '00:11:22:33:44:55'}}
+            res = self._create_port_bulk(self.fmt, 2, net['network']['id'],
+                                         'test', True, override=overrides)
+            self._validate_behavior_on_bulk_success(res, 'ports')
+            check_unique_mac.assert_called_once_with(
+                mock.ANY, net['network']['id'], '00:11:22:33:44:55')
+            for p in self.deserialize(self.fmt, res)['ports']:
+                self._delete('ports', p['id'])
+
+    def test_create_ports_bulk_native_allocates_ips(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        plugin = manager.NeutronManager.get_plugin()
+        with contextlib.nested(
+            self.subnet(),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_generate_ips', wraps=plugin._generate_ips),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_generate_ip')
+        ) as (subnet, generate_ips, generate_ip):
+            res = self._create_port_bulk(self.fmt, 2,
+                                         subnet['subnet']['network_id'],
+                                         'test', True)
+            self._validate_behavior_on_bulk_success(res, 'ports')
+            # the addresses of both ports are allocated at once
+            generate_ips.assert_called_once_with(mock.ANY, mock.ANY, 2)
+            self.assertFalse(generate_ip.called)
+            ports = self.deserialize(self.fmt, res)['ports']
+            ips = [p['fixed_ips'] for p in ports]
+            self.assertEqual(
+                [[{'subnet_id': subnet['subnet']['id'],
+                   'ip_address': '10.0.0.2'}],
+                 [{'subnet_id': subnet['subnet']['id'],
+                   'ip_address': '10.0.0.3'}]], ips)
+            for p in ports:
+                self._delete('ports', p['id'])
+
+    def test_create_ports_bulk_native_duplicate_mac(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        with self.network() as net:
+            overrides = {0: {'mac_address': '00:11:22:33:44:55'},
+                         1: {'mac_address': '00:11:22:33:44:55'}}
+            res = self._create_port_bulk(self.fmt, 2, net['network']['id'],
+                                         'test', True, override=overrides)
+            self._validate_behavior_on_bulk_failure(
+                res, 'ports', webob.exc.HTTPConflict.code)
+
+    def test_create_ports_bulk_native_duplicate_fixed_ip(self):
+        if self._skip_native_bulk:
+            self.skipTest("Plugin does not support native bulk port create")
+        with self.subnet() as subnet:
+            fixed_ips = [{'subnet_id': subnet['subnet']['id'],
+                          'ip_address': '10.0.0.5'}]
+            overrides = {0: {'fixed_ips': fixed_ips},
+                         1: {'fixed_ips': fixed_ips}}
+            res = self._create_port_bulk(self.fmt, 2,
+                                         subnet['subnet']['network_id'],
+                                         'test', True, override=overrides)
+            self._validate_behavior_on_bulk_failure(
+                res, 'ports', webob.exc.HTTPConflict.code)
+
     def test_create_ports_bulk_emulated(self):
         real_has_attr = hasattr
 
@@ -942,6 +1036,16 @@ class TestPortsV2(NeutronDbPluginV2TestCase):
                                self.port()) as ports:
             self._test_list_resources('port', ports)
 
+    def test_list_ports_with_fields(self):
+        with self.port(name='port1') as port:
+            req = self.new_list_request('ports',
+                                        params='fields=name&fields=status')
+            res = self.deserialize(self.fmt, req.get_response(self.api))
+            self.assertEqual(1, len(res['ports']))
+            self.assertEqual({'name': port['port']['name'],
+                              'status': port['port']['status']},
+                             res['ports'][0])
+
     def test_list_ports_filtered_by_fixed_ip(self):
         # for this test we need to enable overlapping ips
         cfg.CONF.set_default('allow_overlapping_ips', True)
@@ -1238,6 +1342,89 @@ fixed_ips=ip_address%%3D%s&fixed_ips=ip_address%%3D%s&fixed_ips=subnet_id%%3D%s
                 self.assertEqual(ips[1]['ip_address'], '10.0.0.4')
                 self.assertEqual(ips[1]['subnet_id'], subnet['subnet']['id'])
 
+    def _get_availability_ranges(self, subnet_id):
+        ranges = context.get_admin_context().session.query(
+            models_v2.IPAvailabilityRange).join(
+                models_v2.IPAllocationPool).filter_by(subnet_id=subnet_id)
+        return sorted((r['first_ip'], r['last_ip']) for r in ranges)
+
+    def test_create_subnet_stripes_availability_ranges(self):
+        with self.subnet(cidr='10.0.0.0/22') as subnet:
+            subnet_id = subnet['subnet']['id']
+            self.assertEqual([('10.0.0.2', '10.0.1.86'),
+                              ('10.0.1.87', '10.0.2.171'),
+                              ('10.0.2.172', '10.0.3.254')],
+                             self._get_availability_ranges(subnet_id))
+            with self.port(subnet=subnet) as port:
+                ip = port['port']['fixed_ips'][0]['ip_address']
+                self.assertIn(ip, ['10.0.0.2', '10.0.1.87', '10.0.2.172'])
+                self.assertEqual(3, len(
+                    self._get_availability_ranges(subnet_id)))
+
+    def test_update_port_recycles_removed_ips(self):
+        with self.subnet() as subnet:
+            subnet_id = subnet['subnet']['id']
+            with contextlib.nested(self.port(subnet=subnet),
+                                   self.port(subnet=subnet),
+                                   self.port(subnet=subnet)) as ports:
+                self.assertEqual([('10.0.0.5', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+                data = {'port': {'fixed_ips': []}}
+                self._update('ports', ports[1]['port']['id'], data)
+                self.assertEqual([('10.0.0.3', '10.0.0.3'),
+                                  ('10.0.0.5', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+                self._update('ports', ports[2]['port']['id'], data)
+                self.assertEqual([('10.0.0.3', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+                self._update('ports', ports[0]['port']['id'], data)
+                self.assertEqual([('10.0.0.2', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+
+    def test_update_port_replace_ip_in_full_subnet(self):
+        with self.subnet(cidr='10.0.0.0/29') as subnet:
+            subnet_id = subnet['subnet']['id']
+            fixed_ips = [{'subnet_id': subnet_id}] * 4
+            with contextlib.nested(
+                    self.port(subnet=subnet),
+                    self.port(subnet=subnet, fixed_ips=fixed_ips)) as ports:
+                self.assertEqual([], self._get_availability_ranges(subnet_id))
+                # no other address is available, the removed address is
+                # released first and allocated again
+                data = {'port': {'fixed_ips': [{'subnet_id': subnet_id}]}}
+                res = self._update('ports', ports[0]['port']['id'], data)
+                ips = res['port']['fixed_ips']
+                self.assertEqual(1, len(ips))
+                self.assertEqual('10.0.0.2', ips[0]['ip_address'])
+                self.assertEqual([], self._get_availability_ranges(subnet_id))
+
+    def test_delete_port_eui64_ips_not_recycled(self):
+        with self.network() as network:
+            with self.subnet(network=network, gateway_ip='fe80::1',
+                             cidr='fe80::/64', ip_version=6,
+                             ipv6_address_mode=constants.IPV6_SLAAC) as subnet:
+                subnet_id = subnet['subnet']['id']
+                ranges = self._get_availability_ranges(subnet_id)
+                for i in range(2):
+                    port = self._make_port(self.fmt,
+                                           network['network']['id'])
+                    self._delete('ports', port['port']['id'])
+                self.assertEqual(ranges,
+                                 self._get_availability_ranges(subnet_id))
+
+    def test_delete_port_recycles_ips(self):
+        with self.subnet() as subnet:
+            subnet_id = subnet['subnet']['id']
+            with self.port(subnet=subnet):
+                res = self._create_port(self.fmt,
+                                        subnet['subnet']['network_id'])
+                port = self.deserialize(self.fmt, res)
+                self.assertEqual([('10.0.0.4', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+                self._delete('ports', port['port']['id'])
+                self.assertEqual([('10.0.0.3', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+
     def test_requested_duplicate_mac(self):
         with self.port() as port:
             mac = port['port']['mac_address']
@@ -3825,6 +4012,158 @@ class TestSubnetsV2(NeutronDbPluginV2TestCase):
             n_exc.HostRoutesExhausted)
 
 
+class TestCollectionQueryCount(NeutronDbPluginV2TestCase):
+    """Check that listing resources does not issue a query per row."""
+
+    # Main query plus one query for each relationship loaded with
+    # subqueryload in the load profile of the model
+    MAX_PORTS_QUERIES = 1
+    MAX_NETWORKS_QUERIES = 1
+    MAX_SUBNETS_QUERIES = 3
+
+    def _assert_list_queries(self, resource, max_queries, count):
+        plugin = manager.NeutronManager.get_plugin()
+        ctx = context.get_admin_context()
+        with testlib_api.SqlStatementCounter() as counter:
+            items = getattr(plugin, 'get_%s' % resource)(ctx)
+        self.assertEqual(count, len(items))
+        self.assertThat(counter.count,
+                        matchers.LessThan(max_queries + 1),
+                        counter.statements)
+        return items
+
+    @contextlib.contextmanager
+    def _subnets(self, network, count):
+        with contextlib.nested(*[
+            self.subnet(network=network, cidr='10.0.%d.0/24' % i,
+                        dns_nameservers=['1.2.3.4', '4.3.2.1'],
+                        host_routes=[{'destination': '12.0.0.0/8',
+                                      'nexthop': '10.0.%d.2' % i}])
+            for i in range(count)]) as subnets:
+            yield subnets
+
+    def test_list_networks_query_count(self):
+        with contextlib.nested(self.network(), self.network()) as networks:
+            with self._subnets(networks[0], 3):
+                self._assert_list_queries('networks',
+                                          self.MAX_NETWORKS_QUERIES, 2)
+
+    def test_list_subnets_query_count(self):
+        with self.network() as network:
+            with self._subnets(network, 3):
+                subnets = self._assert_list_queries(
+                    'subnets', self.MAX_SUBNETS_QUERIES, 3)
+                for subnet in subnets:
+                    self.assertEqual(2, len(subnet['dns_nameservers']))
+                    self.assertEqual(1, len(subnet['host_routes']))
+
+    def test_list_ports_query_count(self):
+        with self.subnet() as subnet:
+            with contextlib.nested(*[self.port(subnet=subnet)
+                                     for i in range(3)]):
+                self._assert_list_queries('ports',
+                                          self.MAX_PORTS_QUERIES, 3)
+
+
+class TestCollectionFieldsProjection(NeutronDbPluginV2TestCase):
+    """Check that lists of column attributes select only these columns."""
+
+    def setUp(self):
+        super(TestCollectionFieldsProjection, self).setUp()
+        self.plugin = manager.NeutronManager.get_plugin()
+        # the dict extend functions registered by other plugins are shared
+        mock.patch.object(self.plugin, '_dict_extend_functions',
+                          new={}).start()
+
+    def _list_with_fields(self, resource, fields):
+        ctx = context.get_admin_context()
+        # the full objects are loaded with the load options
+        with mock.patch.object(
+            self.plugin, '_apply_load_options',
+            side_effect=self.plugin._apply_load_options) as load_objects:
+            with testlib_api.SqlStatementCounter() as counter:
+                items = getattr(self.plugin, 'get_%ss' % resource)(
+                    ctx, fields=fields)
+        return items, load_objects, counter
+
+    def test_list_ports_column_fields(self):
+        with self.port() as port:
+            ports, load_objects, counter = self._list_with_fields(
+                'port', ['id', 'mac_address', 'id'])
+            self.assertEqual([{'id': port['port']['id'],
+                               'mac_address': port['port']['mac_address']}],
+                             ports)
+            self.assertFalse(load_objects.called)
+            self.assertEqual(1, counter.count)
+            self.assertNotIn('ipallocations', counter.statements[0])
+
+    def test_list_ports_relationship_fields(self):
+        with self.port() as port:
+            ports, load_objects, counter = self._list_with_fields(
+                'port', ['id', 'fixed_ips'])
+            self.assertEqual([{'id': port['port']['id'],
+                               'fixed_ips': port['port']['fixed_ips']}],
+                             ports)
+            self.assertTrue(load_objects.called)
+
+    def test_list_ports_column_fields_filtered_by_fixed_ip(self):
+        with self.subnet() as subnet:
+            with self.port(subnet=subnet,
+                           fixed_ips=[{'subnet_id': subnet['subnet']['id']},
+                                      {'subnet_id': subnet['subnet']['id']}]):
+                ports = self.plugin.get_ports(
+                    context.get_admin_context(),
+                    filters={'fixed_ips': {
+                        'subnet_id': [subnet['subnet']['id']]}},
+                    fields=['id'])
+                self.assertEqual(1, len(ports))
+
+    def test_list_networks_column_fields(self):
+        with self.network() as network:
+            networks, load_objects, counter = self._list_with_fields(
+                'network', ['id', 'status'])
+            self.assertEqual([{'id': network['network']['id'],
+                               'status': network['network']['status']}],
+                             networks)
+            self.assertFalse(load_objects.called)
+
+    def test_list_subnets_column_fields(self):
+        with self.subnet() as subnet:
+            subnets, load_objects, counter = self._list_with_fields(
+                'subnet', ['cidr'])
+            self.assertEqual([{'cidr': subnet['subnet']['cidr']}], subnets)
+            self.assertFalse(load_objects.called)
+            self.assertEqual(1, counter.count)
+            self.assertNotIn('ipallocationpools', counter.statements[0])
+
+    def test_list_ports_column_fields_dict_extended(self):
+        extend_port_dict = mock.Mock()
+        self.plugin._dict_extend_functions[attributes.PORTS] = [
+            extend_port_dict]
+        with self.port():
+            ports, load_objects, counter = self._list_with_fields('port',
+                                                               ['id'])
+            self.assertTrue(load_objects.called)
+            self.assertTrue(extend_port_dict.called)
+
+    def test_list_networks_column_fields_make_dict_overridden(self):
+        make_network_dict = self.plugin._make_network_dict
+
+        def _make_network_dict(network, fields=None):
+            res = make_network_dict(network, fields)
+            res['status'] = 'OVERRIDDEN'
+            return res
+
+        with self.network() as network:
+            with mock.patch.object(self.plugin, '_make_network_dict',
+                                   new=_make_network_dict):
+                networks, load_objects, counter = self._list_with_fields(
+                    'network', ['id', 'status'])
+            self.assertEqual([{'id': network['network']['id'],
+                               'status': 'OVERRIDDEN'}], networks)
+            self.assertTrue(load_objects.called)
+
+
 class DbModelTestCase(base.BaseTestCase):
     """DB model tests."""
     def test_repr(self):
@@ -3876,6 +4215,184 @@ class TestNeutronDbPluginV2(base.BaseTestCase):
         self.assertEqual(2, generate.call_count)
         rebuild.assert_called_once_with('c', 's')
 
+    def test_generate_macs_retries_macs_in_use(self):
+        macs = ['fa:16:3e:00:00:01', 'fa:16:3e:00:00:02',
+                'fa:16:3e:00:00:03', 'fa:16:3e:00:00:04']
+        with contextlib.nested(
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_get_random_mac', side_effect=macs),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_get_macs_in_use',
+                              side_effect=[set(macs[1:2]), set()])
+        ) as (random_mac, macs_in_use):
+            result = db_base_plugin_v2.NeutronDbPluginV2._generate_macs(
+                'c', 'n', 3)
+
+        self.assertEqual(set([macs[0], macs[2], macs[3]]), set(result))
+        macs_in_use.assert_has_calls([mock.call('c', 'n', set(macs[:3])),
+                                      mock.call('c', 'n', set(macs[3:]))])
+
+    def test_generate_macs_exhausted_retries(self):
+        cfg.CONF.set_override('mac_generation_retries', 2)
+        with contextlib.nested(
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_get_random_mac',
+                              return_value='fa:16:3e:00:00:01'),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_get_macs_in_use',
+                              return_value=set(['fa:16:3e:00:00:01']))
+        ) as (random_mac, macs_in_use):
+            self.assertRaises(
+                n_exc.MacAddressGenerationFailure,
+                db_base_plugin_v2.NeutronDbPluginV2._generate_macs,
+                'c', 'n', 1)
+        self.assertEqual(2, macs_in_use.call_count)
+
+    def _mock_availability_ranges(self, ranges):
+        range_qry = mock.MagicMock()
+        range_qry.limit.return_value = range_qry
+        range_qry.all.side_effect = lambda: ranges[:1]
+        range_qry.__iter__.side_effect = lambda: iter([ranges.pop(0)])
+        return mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                                 '_get_availability_ranges_query',
+                                 return_value=range_qry)
+
+    def test_try_generate_ip(self):
+        ranges = [mock.Mock(first_ip='10.0.0.2', last_ip='10.0.0.254')]
+        subnets = [{'id': 's', 'cidr': '10.0.0.0/24', 'network_id': 'n'}]
+        with contextlib.nested(
+            self._mock_availability_ranges(ranges),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_update_availability_range',
+                              return_value=True)
+        ) as (range_qry, update_range):
+            result = db_base_plugin_v2.NeutronDbPluginV2._try_generate_ip(
+                'c', subnets)
+
+        self.assertEqual({'ip_address': '10.0.0.2', 'subnet_id': 's'},
+                         result)
+        update_range.assert_called_once_with(
+            'c', mock.ANY, netaddr.IPAddress('10.0.0.3'),
+            netaddr.IPAddress('10.0.0.254'))
+
+    def test_split_availability_range(self):
+        split = db_base_plugin_v2.NeutronDbPluginV2._split_availability_range
+        self.assertEqual([(2, 254)], split(2, 254))
+        self.assertEqual([(0, 510)], split(0, 510))
+        self.assertEqual([(0, 255), (256, 511), (512, 767)], split(0, 767))
+        stripes = split(2, 65534)
+        self.assertEqual(db_base_plugin_v2.IP_RANGE_STRIPES, len(stripes))
+        self.assertEqual((2, 65534), (stripes[0][0], stripes[-1][1]))
+        for (_first, last), (first, _last) in zip(stripes, stripes[1:]):
+            self.assertEqual(last + 1, first)
+
+    def test_try_generate_ip_random_range(self):
+        ranges = [mock.Mock(first_ip='10.0.0.5', last_ip='10.0.0.5'),
+                  mock.Mock(first_ip='10.0.1.0', last_ip='10.0.1.255'),
+                  mock.Mock(first_ip='10.0.2.0', last_ip='10.0.2.255')]
+        subnets = [{'id': 's', 'cidr': '10.0.0.0/16', 'network_id': 'n'}]
+        with contextlib.nested(
+            self._mock_availability_ranges(ranges),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_update_availability_range',
+                              return_value=True),
+            mock.patch.object(db_base_plugin_v2.random, 'choice',
+                              side_effect=lambda seq: seq[-1])
+        ) as (range_qry, update_range, choice):
+            range_qry.return_value.all.side_effect = lambda: ranges
+            result = db_base_plugin_v2.NeutronDbPluginV2._try_generate_ip(
+                'c', subnets)
+
+        # the small range is left for when the stripes are exhausted
+        choice.assert_called_once_with(ranges[1:])
+        self.assertEqual({'ip_address': '10.0.2.0', 'subnet_id': 's'},
+                         result)
+
+    def test_try_generate_ip_contention(self):
+        ranges = [mock.Mock(first_ip='10.0.0.2', last_ip='10.0.0.254')]
+        subnets = [{'id': 's', 'cidr': '10.0.0.0/24', 'network_id': 'n'}]
+        with contextlib.nested(
+            self._mock_availability_ranges(ranges),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_update_availability_range',
+                              return_value=False)
+        ) as (range_qry, update_range):
+            # the transaction must be retried to see the concurrent update
+            self.assertRaises(
+                n_exc.IpAddressAllocationContention,
+                db_base_plugin_v2.NeutronDbPluginV2._try_generate_ip,
+                'c', subnets)
+        self.assertEqual(1, update_range.call_count)
+
+    def test_allocate_specific_ip(self):
+        ranges = [mock.Mock(allocation_pool_id='p', first_ip='10.0.0.2',
+                            last_ip='10.0.0.254')]
+        context = mock.Mock()
+        with contextlib.nested(
+            self._mock_availability_ranges(ranges),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_update_availability_range',
+                              return_value=True)
+        ) as (range_qry, update_range):
+            db_base_plugin_v2.NeutronDbPluginV2._allocate_specific_ip(
+                context, 's', '10.0.0.10')
+
+        update_range.assert_called_once_with(
+            context, mock.ANY, netaddr.IPAddress('10.0.0.2'),
+            netaddr.IPAddress('10.0.0.9'))
+        added = context.session.add.call_args[0][0]
+        self.assertEqual(['p', '10.0.0.11', '10.0.0.254'],
+                         [added.allocation_pool_id, added.first_ip,
+                          added.last_ip])
+
+    def test_allocate_specific_ip_contention(self):
+        ranges = [mock.Mock(allocation_pool_id='p', first_ip='10.0.0.2',
+                            last_ip='10.0.0.254')]
+        context = mock.Mock()
+        with contextlib.nested(
+            self._mock_availability_ranges(ranges),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_update_availability_range',
+                              return_value=False)
+        ):
+            self.assertRaises(
+                n_exc.IpAddressAllocationContention,
+                db_base_plugin_v2.NeutronDbPluginV2._allocate_specific_ip,
+                context, 's', '10.0.0.10')
+        self.assertFalse(context.session.add.called)
+
+    def _test_retry_ip_allocation(self, results, is_active=False):
+        context = mock.Mock()
+        context.session.is_active = is_active
+        method = mock.Mock(side_effect=results)
+        method.__name__ = 'create_port'
+        wrapper = db.retry_ip_allocation(method)
+        try:
+            return wrapper('plugin', context, 'port')
+        finally:
+            self.method_calls = method.call_count
+
+    def test_retry_ip_allocation(self):
+        contention = n_exc.IpAddressAllocationContention(subnet_id='s')
+        self.assertEqual('port', self._test_retry_ip_allocation(
+            [contention, contention, 'port']))
+        self.assertEqual(3, self.method_calls)
+
+    def test_retry_ip_allocation_max_retries(self):
+        cfg.CONF.set_override('ip_allocation_retries', 3)
+        contention = n_exc.IpAddressAllocationContention(subnet_id='s')
+        self.assertRaises(n_exc.IpAddressAllocationContention,
+                          self._test_retry_ip_allocation, [contention] * 4)
+        self.assertEqual(3, self.method_calls)
+
+    def test_retry_ip_allocation_in_transaction(self):
+        # the transaction is retried by the caller which started it
+        contention = n_exc.IpAddressAllocationContention(subnet_id='s')
+        self.assertRaises(n_exc.IpAddressAllocationContention,
+                          self._test_retry_ip_allocation,
+                          [contention, 'port'], is_active=True)
+        self.assertEqual(1, self.method_calls)
+
     def test_rebuild_availability_ranges(self):
         pools = [{'id': 'a',
                   'first_ip': '192.168.1.3',
@@ -3884,13 +4401,14 @@ class TestNeutronDbPluginV2(base.BaseTestCase):
                   'first_ip': '192.168.1.100',
                   'last_ip': '192.168.1.120'}]
 
-        allocations = [{'ip_address': '192.168.1.3'},
-                       {'ip_address': '192.168.1.78'},
-                       {'ip_address': '192.168.1.7'},
-                       {'ip_address': '192.168.1.110'},
-                       {'ip_address': '192.168.1.11'},
-                       {'ip_address': '192.168.1.4'},
-                       {'ip_address': '192.168.1.111'}]
+        allocations = [mock.Mock(ip_address=ip_address)
+                       for ip_address in ['192.168.1.3',
+                                          '192.168.1.78',
+                                          '192.168.1.7',
+                                          '192.168.1.110',
+                                          '192.168.1.11',
+                                          '192.168.1.4',
+                                          '192.168.1.111']]
 
         ip_qry = mock.Mock()
         ip_qry.with_lockmode.return_value = ip_qry
@@ -3902,7 +4420,7 @@ class TestNeutronDbPluginV2(base.BaseTestCase):
         pool_qry.filter_by.return_value = pools
 
         def return_queries_side_effect(*args, **kwargs):
-            if args[0] == models_v2.IPAllocation:
+            if args[0] is models_v2.IPAllocation.ip_address:
                 return ip_qry
             if args[0] == models_v2.IPAllocationPool:
                 return pool_qry
@@ -3959,6 +4477,46 @@ class NeutronDbPluginV2AsMixinTestCase(base.BaseTestCase):
         net = self.plugin.create_network(self.context, self.net_data)
         self.assertEqual(net['status'], 'BUILD')
 
+    def test_create_port_bulk_allocates_ips_in_single_pass(self):
+        self.plugin.create_network(self.context, self.net_data)
+        self.plugin.create_subnet(
+            self.context,
+            {'subnet': {'network_id': 'fake-id',
+                        'name': 'subnet1',
+                        'cidr': '10.0.0.0/24',
+                        'ip_version': 4,
+                        'enable_dhcp': True,
+                        'gateway_ip': attributes.ATTR_NOT_SPECIFIED,
+                        'allocation_pools': attributes.ATTR_NOT_SPECIFIED,
+                        'dns_nameservers': attributes.ATTR_NOT_SPECIFIED,
+                        'host_routes': attributes.ATTR_NOT_SPECIFIED,
+                        'ipv6_ra_mode': attributes.ATTR_NOT_SPECIFIED,
+                        'ipv6_address_mode': attributes.ATTR_NOT_SPECIFIED,
+                        'tenant_id': 'test-tenant'}})
+        ports = [{'port': {'network_id': 'fake-id',
+                           'name': 'port%d' % i,
+                           'admin_state_up': True,
+                           'mac_address': attributes.ATTR_NOT_SPECIFIED,
+                           'fixed_ips': attributes.ATTR_NOT_SPECIFIED,
+                           'device_id': '',
+                           'device_owner': '',
+                           'tenant_id': 'test-tenant'}}
+                 for i in range(3)]
+        with contextlib.nested(
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_generate_ips',
+                              wraps=self.plugin._generate_ips),
+            mock.patch.object(db_base_plugin_v2.NeutronDbPluginV2,
+                              '_generate_ip')
+        ) as (generate_ips, generate_ip):
+            result = self.plugin.create_port_bulk(self.context,
+                                                  {'ports': ports})
+
+        self.assertEqual(['10.0.0.2', '10.0.0.3', '10.0.0.4'],
+                         [p['fixed_ips'][0]['ip_address'] for p in result])
+        self.assertEqual(1, generate_ips.call_count)
+        self.assertFalse(generate_ip.called)
+
 
 class TestBasicGetXML(TestBasicGet):
     fmt = 'xml'
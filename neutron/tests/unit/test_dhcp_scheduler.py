@@ -14,6 +14,8 @@
 # limitations under the License.
 
 import mock
+from oslo.config import cfg
+from oslo.db import exception as db_exc
 
 from neutron.common import constants
 from neutron.common import topics
@@ -22,15 +24,16 @@ from neutron.db import agents_db
 from neutron.db import agentschedulers_db
 from neutron.db import api as db
 from neutron.db import models_v2
+from neutron.extensions import dhcpagentscheduler
 from neutron.openstack.common import timeutils
 from neutron.scheduler import dhcp_agent_scheduler
 from neutron.tests import base
 
 
-class DhcpSchedulerTestCase(base.BaseTestCase):
+class DhcpSchedulerBaseTestCase(base.BaseTestCase):
 
     def setUp(self):
-        super(DhcpSchedulerTestCase, self).setUp()
+        super(DhcpSchedulerBaseTestCase, self).setUp()
         db.configure_db()
         self.ctx = context.get_admin_context()
         self.network_id = 'foo_network_id'
@@ -61,6 +64,9 @@ class DhcpSchedulerTestCase(base.BaseTestCase):
             with self.ctx.session.begin(subtransactions=True):
                 self.ctx.session.add(models_v2.Network(id=network_id))
 
+
+class DhcpSchedulerTestCase(DhcpSchedulerBaseTestCase):
+
     def _test_schedule_bind_network(self, agents, network_id):
         scheduler = dhcp_agent_scheduler.ChanceScheduler()
         scheduler._schedule_bind_network(self.ctx, agents, network_id)
@@ -125,3 +131,171 @@ class DhcpSchedulerTestCase(base.BaseTestCase):
             self.ctx.session.query(agentschedulers_db.NetworkDhcpAgentBinding)
             .all())
         self.assertEqual(1, len(results))
+
+
+class LeastNetworksSchedulerTestCase(DhcpSchedulerBaseTestCase):
+
+    def setUp(self):
+        super(LeastNetworksSchedulerTestCase, self).setUp()
+        self.scheduler = dhcp_agent_scheduler.LeastNetworksScheduler()
+        self.plugin = mock.Mock()
+        self.agents = self._get_agents(['host-a', 'host-b', 'host-c'])
+        self._save_agents(self.agents)
+        self.agent_ids = [agent.id for agent in self.agents]
+
+    def _bind(self, network_ids, agent):
+        self._save_networks(set(network_ids) - set([self.network_id]))
+        binding = agentschedulers_db.NetworkDhcpAgentBinding
+        for network_id in network_ids:
+            with self.ctx.session.begin(subtransactions=True):
+                self.ctx.session.add(binding(network_id=network_id,
+                                             dhcp_agent_id=agent.id))
+
+    def _get_loads(self):
+        loads = dict.fromkeys(self.agent_ids, 0)
+        for binding in self.ctx.session.query(
+                agentschedulers_db.NetworkDhcpAgentBinding):
+            loads[binding.dhcp_agent_id] += 1
+        return loads
+
+    def test_schedule_least_loaded_agent(self):
+        self._bind(['net-1', 'net-2'], self.agents[0])
+        self._bind(['net-3'], self.agents[1])
+        agents = self.scheduler.schedule(self.plugin, self.ctx,
+                                         {'id': self.network_id})
+        self.assertEqual([self.agents[2].id], [agent.id for agent in agents])
+
+    def test_schedule_hosted_network(self):
+        self._bind([self.network_id], self.agents[0])
+        self.assertIsNone(self.scheduler.schedule(self.plugin, self.ctx,
+                                                  {'id': self.network_id}))
+
+    def test_schedule_no_active_agents(self):
+        with mock.patch.object(agents_db.AgentDbMixin, 'is_agent_down',
+                               return_value=True):
+            self.assertIsNone(self.scheduler.schedule(
+                self.plugin, self.ctx, {'id': self.network_id}))
+
+    def test_schedule_networks_balances_batch(self):
+        network_ids = ['net-%d' % index for index in range(7)]
+        self._save_networks(network_ids)
+        scheduled = self.scheduler.schedule_networks(
+            self.plugin, self.ctx, [{'id': network_id}
+                                    for network_id in network_ids])
+        self.assertEqual(set(network_ids), set(scheduled))
+        self.assertEqual([2, 2, 3], sorted(self._get_loads().values()))
+
+    def test_schedule_networks_multiple_agents_per_network(self):
+        cfg.CONF.set_override('dhcp_agents_per_network', 2)
+        self._bind([self.network_id], self.agents[0])
+        scheduled = self.scheduler.schedule_networks(
+            self.plugin, self.ctx, [{'id': self.network_id}])
+        self.assertEqual(1, len(scheduled[self.network_id]))
+        self.assertNotEqual(self.agents[0].id,
+                            scheduled[self.network_id][0].id)
+
+    def test_schedule_networks_concurrently_scheduled(self):
+        self._save_networks(['net-1'])
+        flush = self.ctx.session.flush
+        flush_errors = [db_exc.DBDuplicateEntry()]
+
+        def fail_first_flush(*args, **kwargs):
+            if flush_errors:
+                raise flush_errors.pop()
+            return flush(*args, **kwargs)
+
+        with mock.patch.object(self.ctx.session, 'flush',
+                               side_effect=fail_first_flush):
+            scheduled = self.scheduler.schedule_networks(
+                self.plugin, self.ctx, [{'id': self.network_id},
+                                        {'id': 'net-1'}])
+        self.assertEqual(set([self.network_id, 'net-1']), set(scheduled))
+
+    def _get_subnets(self, network_ids):
+        return [{'network_id': network_id, 'enable_dhcp': True}
+                for network_id in network_ids]
+
+    def test_auto_schedule_networks(self):
+        network_ids = ['net-1', 'net-2', self.network_id]
+        self._bind(['net-1'], self.agents[0])
+        self._save_networks(['net-2'])
+        self.plugin.get_subnets.return_value = self._get_subnets(network_ids)
+        self.assertTrue(self.scheduler.auto_schedule_networks(
+            self.plugin, self.ctx, 'host-b'))
+        self.assertEqual({self.agents[0].id: 1, self.agents[1].id: 2,
+                          self.agents[2].id: 0}, self._get_loads())
+
+    def test_auto_schedule_networks_no_networks(self):
+        self.plugin.get_subnets.return_value = []
+        self.assertFalse(self.scheduler.auto_schedule_networks(
+            self.plugin, self.ctx, 'host-a'))
+
+    def test_auto_schedule_networks_inactive_agent(self):
+        self.plugin.get_subnets.return_value = self._get_subnets(
+            [self.network_id])
+        with mock.patch.object(agents_db.AgentDbMixin, 'is_agent_down',
+                               return_value=True):
+            self.assertTrue(self.scheduler.auto_schedule_networks(
+                self.plugin, self.ctx, 'host-a'))
+        self.assertEqual([0, 0, 0], self._get_loads().values())
+
+    def test_auto_schedule_networks_concurrently_scheduled(self):
+        self._save_networks(['net-1'])
+        self.plugin.get_subnets.return_value = self._get_subnets(
+            ['net-1', self.network_id])
+        flush = self.ctx.session.flush
+        flush_errors = [db_exc.DBDuplicateEntry()]
+
+        def fail_first_bindings_flush(*args, **kwargs):
+            if flush_errors and self.ctx.session.new:
+                raise flush_errors.pop()
+            return flush(*args, **kwargs)
+
+        with mock.patch.object(self.ctx.session, 'flush',
+                               side_effect=fail_first_bindings_flush):
+            self.assertTrue(self.scheduler.auto_schedule_networks(
+                self.plugin, self.ctx, 'host-a'))
+        self.assertFalse(flush_errors)
+        self.assertEqual(2, self._get_loads()[self.agents[0].id])
+
+    def test_rebalance(self):
+        self._bind(['net-%d' % index for index in range(5)], self.agents[0])
+        self._bind(['net-5'], self.agents[1])
+        moves = self.scheduler.rebalance(self.plugin, self.ctx)
+        self.assertEqual(3, len(moves))
+        loads = dict.fromkeys(self.agent_ids, 0)
+        loads[self.agents[0].id] = 5
+        loads[self.agents[1].id] = 1
+        for network_id, old_agent_id, new_agent_id in moves:
+            loads[old_agent_id] -= 1
+            loads[new_agent_id] += 1
+            self.plugin.assert_has_calls([
+                mock.call.add_network_to_dhcp_agent(
+                    self.ctx, new_agent_id, network_id),
+                mock.call.remove_network_from_dhcp_agent(
+                    self.ctx, old_agent_id, network_id)])
+        self.assertEqual([2, 2, 2], sorted(loads.values()))
+
+    def test_rebalance_add_fails(self):
+        self._bind(['net-1', 'net-2', 'net-3'], self.agents[0])
+        self.plugin.add_network_to_dhcp_agent.side_effect = (
+            dhcpagentscheduler.NetworkHostedByDHCPAgent(
+                network_id='net-1', agent_id=self.agents[1].id))
+        self.scheduler.rebalance(self.plugin, self.ctx)
+        self.assertTrue(self.plugin.add_network_to_dhcp_agent.called)
+        self.assertFalse(self.plugin.remove_network_from_dhcp_agent.called)
+
+    def test_rebalance_remove_fails(self):
+        self._bind(['net-1', 'net-2', 'net-3'], self.agents[0])
+        self.plugin.remove_network_from_dhcp_agent.side_effect = (
+            dhcpagentscheduler.NetworkNotHostedByDhcpAgent(
+                network_id='net-1', agent_id=self.agents[0].id))
+        moves = self.scheduler.rebalance(self.plugin, self.ctx)
+        self.assertEqual(len(moves),
+                         self.plugin.add_network_to_dhcp_agent.call_count)
+
+    def test_rebalance_balanced(self):
+        self._bind(['net-1'], self.agents[0])
+        self._bind(['net-2'], self.agents[1])
+        self.assertEqual([], self.scheduler.rebalance(self.plugin, self.ctx))
+        self.assertFalse(self.plugin.method_calls)
@@ -19,6 +19,7 @@ import mock
 from oslo.config import cfg
 
 from neutron.agent.common import config as a_cfg
+from neutron.agent.linux import ipset_manager
 from neutron.agent.linux import iptables_firewall
 from neutron.common import constants
 from neutron.tests import base
@@ -30,6 +31,8 @@ FAKE_PREFIX = {'IPv4': '10.0.0.0/24',
                'IPv6': 'fe80::/48'}
 FAKE_IP = {'IPv4': '10.0.0.1',
            'IPv6': 'fe80::1'}
+FAKE_IPSET = {'IPv4': ipset_manager.get_ipset_name('fake_sgid', 'IPv4'),
+              'IPv6': ipset_manager.get_ipset_name('fake_sgid', 'IPv6')}
 
 
 class IptablesFirewallTestCase(base.BaseTestCase):
@@ -264,6 +267,31 @@ class IptablesFirewallTestCase(base.BaseTestCase):
         egress = None
         self._test_prepare_port_filter(rule, ingress, egress)
 
+    def test_filter_ipv4_ingress_remote_group(self):
+        rule = {'ethertype': 'IPv4',
+                'direction': 'ingress',
+                'protocol': 'tcp',
+                'port_range_min': 10,
+                'port_range_max': 10,
+                'remote_group_id': 'fake_sgid'}
+        ingress = mock.call.add_rule('ifake_dev',
+                                     '-p tcp -m tcp --dport 10 '
+                                     '-m set --match-set %s src '
+                                     '-j RETURN' % FAKE_IPSET['IPv4'])
+        egress = None
+        self._test_prepare_port_filter(rule, ingress, egress)
+
+    def test_filter_ipv4_ingress_remote_group_expanded(self):
+        prefix = FAKE_PREFIX['IPv4']
+        rule = {'ethertype': 'IPv4',
+                'direction': 'ingress',
+                'source_ip_prefix': prefix,
+                'remote_group_id': 'fake_sgid'}
+        ingress = mock.call.add_rule('ifake_dev',
+                                     '-s %s -j RETURN' % prefix)
+        egress = None
+        self._test_prepare_port_filter(rule, ingress, egress)
+
     def test_filter_ipv4_egress(self):
         rule = {'ethertype': 'IPv4',
                 'direction': 'egress'}
@@ -602,6 +630,16 @@ class IptablesFirewallTestCase(base.BaseTestCase):
         egress = None
         self._test_prepare_port_filter(rule, ingress, egress)
 
+    def test_filter_ipv6_egress_remote_group(self):
+        rule = {'ethertype': 'IPv6',
+                'direction': 'egress',
+                'remote_group_id': 'fake_sgid'}
+        egress = mock.call.add_rule('ofake_dev',
+                                    '-m set --match-set %s dst '
+                                    '-j RETURN' % FAKE_IPSET['IPv6'])
+        ingress = None
+        self._test_prepare_port_filter(rule, ingress, egress)
+
     def test_filter_ipv6_egress(self):
         rule = {'ethertype': 'IPv6',
                 'direction': 'egress'}
@@ -1036,6 +1074,86 @@ class IptablesFirewallTestCase(base.BaseTestCase):
         self.iptables_inst.assert_has_calls([mock.call.defer_apply_on(),
                                              mock.call.defer_apply_off()])
 
+    def test_update_security_group_members(self):
+        self.firewall.update_security_group_members(
+            'fake_sgid', {'IPv4': ['10.0.0.2', '10.0.1.0/24'],
+                          'IPv6': ['fe80::1']})
+        self.firewall.update_security_group_members(
+            'fake_sgid', {'IPv4': ['10.0.0.3', '10.0.1.0/24'],
+                          'IPv6': ['fe80::1']})
+        calls = [mock.call(['ipset', 'restore', '-exist'],
+                           root_helper=mock.ANY,
+                           process_input='create %(v4)s hash:net '
+                                         'family inet\n'
+                                         'flush %(v4)s\n'
+                                         'add %(v4)s 10.0.0.2/32\n'
+                                         'add %(v4)s 10.0.1.0/24\n' %
+                                         {'v4': FAKE_IPSET['IPv4']}),
+                 mock.call(['ipset', 'restore', '-exist'],
+                           root_helper=mock.ANY,
+                           process_input='create %(v6)s hash:net '
+                                         'family inet6\n'
+                                         'flush %(v6)s\n'
+                                         'add %(v6)s fe80::1/128\n' %
+                                         {'v6': FAKE_IPSET['IPv6']}),
+                 mock.call(['ipset', 'restore', '-exist'],
+                           root_helper=mock.ANY,
+                           process_input='add %(v4)s 10.0.0.3/32\n'
+                                         'del %(v4)s 10.0.0.2/32\n' %
+                                         {'v4': FAKE_IPSET['IPv4']})]
+        self.assertEqual(calls, self.utils_exec.mock_calls)
+
+    def test_remove_port_filter_destroys_unused_ipsets(self):
+        port = self._fake_port()
+        port['security_group_rules'] = []
+        port['security_group_source_groups'] = ['fake_sgid']
+        self.firewall.update_security_group_members(
+            'fake_sgid', {'IPv4': ['10.0.0.2'], 'IPv6': []})
+        self.firewall.prepare_port_filter(port)
+        self.utils_exec.reset_mock()
+        self.firewall.update_port_filter(port)
+        self.assertFalse(self.utils_exec.called)
+
+        self.firewall.remove_port_filter(port)
+        self.utils_exec.assert_has_calls(
+            [mock.call(['ipset', 'destroy', FAKE_IPSET['IPv4']],
+                       root_helper=mock.ANY),
+             mock.call(['ipset', 'destroy', FAKE_IPSET['IPv6']],
+                       root_helper=mock.ANY)])
+        self.assertEqual(set(), self.firewall.sg_members)
+
+    def test_remove_port_filter_keeps_referenced_ipsets(self):
+        port = self._fake_port()
+        port['security_group_rules'] = []
+        self.firewall.update_security_group_members(
+            'fake_sgid', {'IPv4': ['10.0.0.2'], 'IPv6': []})
+        # the ipsets are still referenced by iptables rules
+        self.utils_exec.side_effect = RuntimeError()
+        self.firewall.prepare_port_filter(port)
+        self.assertEqual(set(['fake_sgid']), self.firewall.sg_members)
+        self.assertTrue(self.firewall.ipset.ipset_exists(FAKE_IPSET['IPv4']))
+
+        self.utils_exec.side_effect = None
+        self.utils_exec.reset_mock()
+        self.firewall.remove_port_filter(port)
+        self.utils_exec.assert_has_calls(
+            [mock.call(['ipset', 'destroy', FAKE_IPSET['IPv4']],
+                       root_helper=mock.ANY),
+             mock.call(['ipset', 'destroy', FAKE_IPSET['IPv6']],
+                       root_helper=mock.ANY)])
+        self.assertEqual(set(), self.firewall.sg_members)
+
+    def test_defer_apply_destroys_unused_ipsets_once(self):
+        self.firewall.update_security_group_members(
+            'fake_sgid', {'IPv4': ['10.0.0.2'], 'IPv6': []})
+        self.utils_exec.reset_mock()
+        with self.firewall.defer_apply():
+            port = self._fake_port()
+            port['security_group_rules'] = []
+            self.firewall.prepare_port_filter(port)
+            self.assertFalse(self.utils_exec.called)
+        self.assertEqual(2, self.utils_exec.call_count)
+
     def _mock_chain_applies(self):
         class CopyingMock(mock.MagicMock):
             """Copies arguments so mutable arguments can be asserted on.
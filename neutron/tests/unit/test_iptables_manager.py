@@ -62,6 +62,72 @@ FILTER_DUMP = ('# Generated by iptables_manager\n'
                '# Completed by iptables_manager\n' % IPTABLES_ARG)
 
 
+class IptablesTableTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(IptablesTableTestCase, self).setUp()
+        self.table = iptables_manager.IptablesTable(binary_name='bn')
+        self.table.add_chain('ifake')
+        self.table.add_chain('ofake')
+
+    def _rule_strs(self):
+        return [str(rule) for rule in self.table.rules]
+
+    def test_rules_keep_insertion_order(self):
+        self.table.add_rule('ifake', '-j DROP')
+        self.table.add_rule('ofake', '-j $ifake')
+        self.table.add_rule('ifake', '-s 10.0.0.1 -j DROP', top=True)
+        self.assertEqual(['-A bn-ifake -j DROP',
+                          '-A bn-ofake -j bn-ifake',
+                          '-A bn-ifake -s 10.0.0.1 -j DROP'],
+                         self._rule_strs())
+
+    def test_remove_rule_removes_first_duplicate(self):
+        self.table.add_rule('ifake', '-j DROP', tag='first')
+        self.table.add_rule('ifake', '-j RETURN')
+        self.table.add_rule('ifake', '-j DROP', tag='second')
+        self.table.remove_rule('ifake', '-j DROP')
+        self.assertEqual(['second', None],
+                         sorted((rule.tag for rule in self.table.rules),
+                                reverse=True))
+        self.table.remove_rule('ifake', '-j DROP')
+        self.assertEqual(['-A bn-ifake -j RETURN'], self._rule_strs())
+
+    def test_remove_chain_removes_jumps(self):
+        self.table.add_rule('ifake', '-j DROP')
+        self.table.add_rule('ofake', '-j $ifake')
+        self.table.add_rule('ofake', '-j ACCEPT')
+        self.table.remove_chain('ifake')
+        self.assertEqual(['-A bn-ofake -j ACCEPT'], self._rule_strs())
+        self.assertNotIn('ifake', self.table.chains)
+
+    def test_remove_unwrapped_chain(self):
+        self.table.add_chain('top', wrap=False)
+        self.table.add_rule('top', '-j DROP', wrap=False)
+        self.table.add_rule('FORWARD', '-j top', wrap=False)
+        self.table.add_rule('FORWARD', '-j top-other', wrap=False)
+        self.table.remove_chain('top', wrap=False)
+        self.assertEqual(['-A FORWARD -j top-other'], self._rule_strs())
+        self.assertEqual(set(['top']), self.table.remove_chains)
+        self.assertEqual(['-A top -j DROP', '-A FORWARD -j top'],
+                         [str(rule) for rule in self.table.remove_rules])
+
+    def test_empty_chain(self):
+        self.table.add_rule('ifake', '-j DROP')
+        self.table.add_rule('ofake', '-j DROP')
+        self.table.empty_chain('ifake')
+        self.assertEqual(['-A bn-ofake -j DROP'], self._rule_strs())
+
+    def test_clear_rules_by_tag(self):
+        self.table.add_rule('ifake', '-j DROP', tag='fake')
+        self.table.add_rule('ofake', '-j DROP')
+        self.table.add_rule('ofake', '-j $ifake', tag='fake')
+        self.table.clear_rules_by_tag('fake')
+        self.assertEqual(['-A bn-ofake -j DROP'], self._rule_strs())
+        self.table.clear_rules_by_tag('fake')
+        self.assertEqual(['-A bn-ofake -j DROP'], self._rule_strs())
+
+
 class IptablesManagerStateFulTestCase(base.BaseTestCase):
 
     def setUp(self):
@@ -532,6 +598,204 @@ class IptablesManagerStateFulTestCase(base.BaseTestCase):
             {'wrap': True, 'top': False, 'rule': '-j DROP',
              'chain': 'nonexistent'})
 
+    def _filter_dump_with_filter_chain(self):
+        return ('# Generated by iptables_manager\n'
+                '*filter\n'
+                ':neutron-filter-top - [0:0]\n'
+                ':%(bn)s-FORWARD - [0:0]\n'
+                ':%(bn)s-INPUT - [0:0]\n'
+                ':%(bn)s-local - [0:0]\n'
+                ':%(bn)s-filter - [0:0]\n'
+                ':%(bn)s-OUTPUT - [0:0]\n'
+                '[0:0] -A FORWARD -j neutron-filter-top\n'
+                '[0:0] -A OUTPUT -j neutron-filter-top\n'
+                '[0:0] -A neutron-filter-top -j %(bn)s-local\n'
+                '[0:0] -A INPUT -j %(bn)s-INPUT\n'
+                '[0:0] -A OUTPUT -j %(bn)s-OUTPUT\n'
+                '[0:0] -A FORWARD -j %(bn)s-FORWARD\n'
+                '[0:0] -A %(bn)s-filter -j DROP\n'
+                '[0:0] -A %(bn)s-INPUT -s 0/0 -d 192.168.0.2 -j '
+                '%(bn)s-filter\n'
+                'COMMIT\n'
+                '# Completed by iptables_manager\n'
+                % IPTABLES_ARG)
+
+    def _add_filter_chain(self):
+        self.iptables.ipv4['filter'].add_chain('filter')
+        self.iptables.ipv4['filter'].add_rule('filter', '-j DROP')
+        self.iptables.ipv4['filter'].add_rule('INPUT',
+                                              '-s 0/0 -d 192.168.0.2 -j'
+                                              ' $filter')
+
+    def test_apply_incremental(self):
+        filter_dump_mod = self._filter_dump_with_filter_chain()
+        expected_calls_and_values = [
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             ''),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=NAT_DUMP + FILTER_DUMP,
+                       root_helper=self.root_helper),
+             None),
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             NAT_DUMP + FILTER_DUMP),
+            (mock.call(['iptables-restore', '-n'],
+                       process_input=('*filter\n'
+                                      ':%(bn)s-filter - [0:0]\n'
+                                      '-I %(bn)s-INPUT 1 -s 0/0 '
+                                      '-d 192.168.0.2 -j %(bn)s-filter\n'
+                                      '-A %(bn)s-filter -j DROP\n'
+                                      'COMMIT' % IPTABLES_ARG),
+                       root_helper=self.root_helper),
+             None),
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             NAT_DUMP + filter_dump_mod),
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             NAT_DUMP + filter_dump_mod),
+            (mock.call(['iptables-restore', '-n'],
+                       process_input=('*filter\n'
+                                      '-D %(bn)s-INPUT -s 0/0 '
+                                      '-d 192.168.0.2 -j %(bn)s-filter\n'
+                                      '-F %(bn)s-filter\n'
+                                      '-X %(bn)s-filter\n'
+                                      'COMMIT' % IPTABLES_ARG),
+                       root_helper=self.root_helper),
+             None),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        self.iptables.apply()
+        self._add_filter_chain()
+        self.iptables.apply()
+        # Nothing changed, iptables-restore is not called
+        self.iptables.apply()
+        self.iptables.ipv4['filter'].remove_chain('filter')
+        self.iptables.apply()
+
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+        self.assertEqual(len(expected_calls_and_values),
+                         self.execute.call_count)
+
+    def test_apply_incremental_rule_order_changed(self):
+        table = self.iptables.ipv4['filter']
+        table.add_chain('filter')
+        table.add_rule('filter', '-s 10.0.0.2 -j DROP')
+        table.add_rule('filter', '-s 10.0.0.3 -j DROP')
+        old_state = self.iptables._get_table_state(table)
+        table.remove_rule('filter', '-s 10.0.0.2 -j DROP')
+        table.add_rule('filter', '-s 10.0.0.4 -j DROP')
+        table.add_rule('filter', '-s 10.0.0.2 -j DROP')
+        new_state = self.iptables._get_table_state(table)
+        expected = ['-F %(bn)s-filter',
+                    '-A %(bn)s-filter -s 10.0.0.3 -j DROP',
+                    '-A %(bn)s-filter -s 10.0.0.4 -j DROP',
+                    '-A %(bn)s-filter -s 10.0.0.2 -j DROP']
+        self.assertEqual([command % IPTABLES_ARG for command in expected],
+                         self.iptables._get_table_commands(old_state,
+                                                           new_state))
+
+    def test_apply_incremental_unwrapped_rule_resync(self):
+        table = self.iptables.ipv4['filter']
+        old_state = self.iptables._get_table_state(table)
+        table.add_rule('FORWARD', '-j DROP', wrap=False)
+        new_state = self.iptables._get_table_state(table)
+        self.assertIsNone(self.iptables._get_table_commands(old_state,
+                                                            new_state))
+
+    def test_apply_tampered_resync(self):
+        tampered_dump = FILTER_DUMP.replace(
+            '[0:0] -A INPUT -j %(bn)s-INPUT\n' % IPTABLES_ARG, '')
+        expected_calls_and_values = [
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             ''),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=NAT_DUMP + FILTER_DUMP,
+                       root_helper=self.root_helper),
+             None),
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             NAT_DUMP + tampered_dump),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=mock.ANY,
+                       root_helper=self.root_helper),
+             None),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        self.iptables.apply()
+        self._add_filter_chain()
+        self.iptables.apply()
+
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+        self.assertEqual(len(expected_calls_and_values),
+                         self.execute.call_count)
+
+    def test_apply_tampered_rule_resync(self):
+        # The rule is replaced, the chain keeps the same number of rules
+        tampered_dump = self._filter_dump_with_filter_chain().replace(
+            '-A %(bn)s-filter -j DROP' % IPTABLES_ARG,
+            '-A %(bn)s-filter -j ACCEPT' % IPTABLES_ARG)
+        expected_calls_and_values = [
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             ''),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=mock.ANY,
+                       root_helper=self.root_helper),
+             None),
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             NAT_DUMP + tampered_dump),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=mock.ANY,
+                       root_helper=self.root_helper),
+             None),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        self._add_filter_chain()
+        self.iptables.apply()
+        self.iptables.apply()
+
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+        self.assertEqual(len(expected_calls_and_values),
+                         self.execute.call_count)
+
+    def test_apply_incremental_failure_resync(self):
+        expected_calls_and_values = [
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             ''),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=NAT_DUMP + FILTER_DUMP,
+                       root_helper=self.root_helper),
+             None),
+            (mock.call(['iptables-save', '-c'],
+                       root_helper=self.root_helper),
+             NAT_DUMP + FILTER_DUMP),
+            (mock.call(['iptables-restore', '-n'],
+                       process_input=mock.ANY,
+                       root_helper=self.root_helper),
+             RuntimeError()),
+            (mock.call(['iptables-restore', '-c'],
+                       process_input=mock.ANY,
+                       root_helper=self.root_helper),
+             None),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        self.iptables.apply()
+        self._add_filter_chain()
+        self.iptables.apply()
+
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+        self.assertEqual(len(expected_calls_and_values),
+                         self.execute.call_count)
+
     def test_iptables_failure_with_no_failing_line_number(self):
         with mock.patch.object(iptables_manager, "LOG") as log:
             # generate Runtime errors on iptables-restore calls
@@ -668,7 +932,7 @@ class IptablesManagerStateFulTestCase(base.BaseTestCase):
 
         tools.verify_mock_calls(self.execute, expected_calls_and_values)
 
-    def _test_find_last_entry(self, find_str):
+    def _test_get_last_entries(self):
         filter_list = [':neutron-filter-top - [0:0]',
                        ':%(bn)s-FORWARD - [0:0]',
                        ':%(bn)s-INPUT - [0:0]',
@@ -676,21 +940,27 @@ class IptablesManagerStateFulTestCase(base.BaseTestCase):
                        ':%(wrap)s - [0:0]',
                        ':%(bn)s-OUTPUT - [0:0]',
                        '[0:0] -A FORWARD -j neutron-filter-top',
-                       '[0:0] -A OUTPUT -j neutron-filter-top'
+                       '[0:0] -A OUTPUT -j neutron-filter-top',
+                       '[5:10] -A OUTPUT -j neutron-filter-top'
                        % IPTABLES_ARG]
 
-        return self.iptables._find_last_entry(filter_list, find_str)
+        return self.iptables._get_last_entries(filter_list)
+
+    def test_get_last_entries_old_dup(self):
+        find_str = '-A OUTPUT -j neutron-filter-top'
+        match_str = '[5:10] -A OUTPUT -j neutron-filter-top'
+        entries = self._test_get_last_entries()
+        self.assertEqual(match_str, entries[find_str])
 
-    def test_find_last_entry_old_dup(self):
-        find_str = 'neutron-filter-top'
-        match_str = '[0:0] -A OUTPUT -j neutron-filter-top'
-        ret_str = self._test_find_last_entry(find_str)
-        self.assertEqual(ret_str, match_str)
+    def test_get_last_entries_chain(self):
+        entries = self._test_get_last_entries()
+        self.assertEqual(':neutron-filter-top - [0:0]',
+                         entries[':neutron-filter-top'])
 
-    def test_find_last_entry_none(self):
-        find_str = 'neutron-filter-NOTFOUND'
-        ret_str = self._test_find_last_entry(find_str)
-        self.assertIsNone(ret_str)
+    def test_get_last_entries_none(self):
+        entries = self._test_get_last_entries()
+        self.assertNotIn(':neutron-filter-NOTFOUND', entries)
+        self.assertNotIn('neutron-filter-top', entries)
 
 
 class IptablesManagerStateLessTestCase(base.BaseTestCase):
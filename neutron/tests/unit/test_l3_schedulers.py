@@ -204,3 +204,76 @@ class L3AgentLeastRoutersSchedulerTestCase(L3SchedulerTestCase):
                         agent_id3 = agents[0]['id']
 
                         self.assertNotEqual(agent_id1, agent_id3)
+
+
+class L3AgentLeastLoadedSchedulerTestCase(L3SchedulerTestCase):
+    def setUp(self):
+        cfg.CONF.set_override('router_scheduler_driver',
+                              'neutron.scheduler.l3_agent_scheduler.'
+                              'LeastLoadedScheduler')
+
+        super(L3AgentLeastLoadedSchedulerTestCase, self).setUp()
+        self.scheduler = self.plugin.router_scheduler
+
+    def _create_routers(self, count):
+        return [self._make_router(self.fmt, str(uuid.uuid4()),
+                                  'r%d' % index)['router']['id']
+                for index in range(count)]
+
+    def _get_hosting_agent_ids(self, router_ids):
+        return [agent['id'] for agent in self.get_l3_agents_hosting_routers(
+            self.adminContext, router_ids)]
+
+    def test_schedule_routers_balances_batch(self):
+        router_ids = self._create_routers(4)
+        scheduled = self.scheduler.schedule_routers(
+            self.plugin, self.adminContext, router_ids)
+        self.assertEqual(set(router_ids), set(scheduled))
+        agent_ids = self._get_hosting_agent_ids(router_ids)
+        self.assertEqual(2, len(set(agent_ids)))
+        self.assertEqual(2, agent_ids.count(agent_ids[0]))
+
+    def test_schedule_routers_counts_interfaces(self):
+        with contextlib.nested(self.subnet(cidr='10.0.1.0/24'),
+                               self.subnet(cidr='10.0.2.0/24')) as subnets:
+            router_id = self._create_routers(1)[0]
+            for subnet in subnets:
+                self._router_interface_action(
+                    'add', router_id, subnet['subnet']['id'], None)
+            busy_agent_ids = self._get_hosting_agent_ids([router_id])
+            self.assertEqual(1, len(busy_agent_ids))
+
+            router_ids = self._create_routers(2)
+            self.scheduler.schedule_routers(self.plugin, self.adminContext,
+                                            router_ids)
+            agent_ids = self._get_hosting_agent_ids(router_ids)
+            self.assertEqual(2, len(agent_ids))
+            self.assertNotIn(busy_agent_ids[0], agent_ids)
+
+            for subnet in subnets:
+                self._router_interface_action(
+                    'remove', router_id, subnet['subnet']['id'], None)
+
+    def test_schedule_routers_hosted(self):
+        router_ids = self._create_routers(1)
+        self.scheduler.schedule_routers(self.plugin, self.adminContext,
+                                        router_ids)
+        self.assertEqual({}, self.scheduler.schedule_routers(
+            self.plugin, self.adminContext, router_ids))
+        self.assertEqual(1, len(self._get_hosting_agent_ids(router_ids)))
+
+    def test_schedule_routers_no_active_agents(self):
+        router_ids = self._create_routers(1)
+        with mock.patch.object(agents_db.AgentDbMixin, 'is_agent_down',
+                               return_value=True):
+            self.assertEqual({}, self.scheduler.schedule_routers(
+                self.plugin, self.adminContext, router_ids))
+
+    def test_schedule_with_candidates(self):
+        router_ids = self._create_routers(2)
+        agents = self.plugin.get_l3_agents(self.adminContext)
+        self.scheduler.bind_router(self.adminContext, router_ids[0],
+                                   agents[0])
+        chosen_agent = self.scheduler.schedule(
+            self.plugin, self.adminContext, router_ids[1], agents)
+        self.assertEqual(agents[1].id, chosen_agent.id)
@@ -112,6 +112,41 @@ class TestNeutronContext(base.BaseTestCase):
         self.assertTrue(elevated_ctx.is_admin)
         self.assertEqual(req_id_before, elevated_ctx.request_id)
 
+    def test_neutron_context_get_cached_resource(self):
+        ctx = context.Context('user_id', 'tenant_id')
+        getter = mock.Mock(return_value={'id': 'net_id'})
+        for i in range(2):
+            self.assertEqual({'id': 'net_id'}, ctx.get_cached_resource(
+                'network', 'net_id', getter))
+        getter.assert_called_once_with('net_id')
+        ctx.get_cached_resource('subnet', 'net_id', getter)
+        ctx.get_cached_resource('network', 'other_id', getter)
+        self.assertEqual(3, getter.call_count)
+
+    def test_neutron_context_get_cached_resource_privileges(self):
+        ctx = context.Context('user_id', 'tenant_id')
+        getter = mock.Mock(return_value={'id': 'net_id'})
+        ctx.get_cached_resource('network', 'net_id', getter)
+        ctx.get_cached_resource('network', 'net_id', getter, admin=True)
+        self.assertEqual(2, getter.call_count)
+        ctx.elevated().get_cached_resource('network', 'net_id', getter)
+        self.assertEqual(2, getter.call_count)
+        ctx.elevated().get_cached_resource('network', 'other_id', getter)
+        ctx.get_cached_resource('network', 'other_id', getter)
+        self.assertEqual(4, getter.call_count)
+
+    def test_neutron_context_get_cached_resource_fields(self):
+        ctx = context.Context('user_id', 'tenant_id')
+        getter = mock.Mock(return_value={'id': 'net_id'})
+        ctx.get_cached_resource('network', 'net_id', getter,
+                                fields=['id', 'name'])
+        ctx.get_cached_resource('network', 'net_id', getter,
+                                fields=['name', 'id'])
+        self.assertEqual(1, getter.call_count)
+        ctx.get_cached_resource('network', 'net_id', getter)
+        ctx.get_cached_resource('network', 'net_id', getter, fields=['id'])
+        self.assertEqual(3, getter.call_count)
+
     def test_neutron_context_overwrite(self):
         ctx1 = context.Context('user_id', 'tenant_id')
         self.assertEqual(ctx1.request_id, local.store.context.request_id)
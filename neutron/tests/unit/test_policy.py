@@ -391,6 +391,44 @@ class NeutronPolicyTestCase(base.BaseTestCase):
         self.assertRaises(exceptions.PolicyNotAuthorized, policy.enforce,
                           self.context, action, target, None)
 
+    def test_build_match_rule_cached(self):
+        action = "create_something"
+        target = {'tenant_id': 'fake', 'attr': {'sub_attr_1': 'x'}}
+        match_rule = policy._build_match_rule(action, target)
+        self.assertIs(match_rule, policy._build_match_rule(
+            action, {'tenant_id': 'other', 'attr': {'sub_attr_1': 'y'}}))
+        self.assertIsNot(match_rule, policy._build_match_rule(
+            action, {'tenant_id': 'fake', 'attr': {'sub_attr_1': 'x',
+                                                   'sub_attr_2': 'y'}}))
+        self.assertIsNot(match_rule, policy._build_match_rule(
+            action, {'tenant_id': 'fake'}))
+
+    def test_match_rule_cache_cleared_on_set_rules(self):
+        action = "create_something"
+        target = {'tenant_id': 'fake', 'attr': {'sub_attr_1': 'x'}}
+        match_rule = policy._build_match_rule(action, target)
+        policy._set_rules(json.dumps({'create_something': '@'}))
+        self.assertIsNot(match_rule,
+                         policy._build_match_rule(action, target))
+
+    def test_match_rule_cache_size_bound(self):
+        with mock.patch.object(policy, '_MATCH_RULE_CACHE_SIZE', new=2):
+            for i in range(3):
+                policy._build_match_rule('get_something_%d' % i, {})
+            self.assertEqual(1, len(policy._MATCH_RULE_CACHE))
+
+    def test_check_many(self):
+        target = {'shared': False, 'tenant_id': 'somebody_else'}
+        actions = ['get_network', 'get_network:nonexistent',
+                   'create_network:shared']
+        self.assertEqual([False, True, False],
+                         policy.check_many(self.context, actions, target,
+                                           might_not_exist=True))
+        self.assertEqual([True, True, True],
+                         policy.check_many(context.get_admin_context(),
+                                           actions, target,
+                                           might_not_exist=True))
+
     def test_enforce_regularuser_on_read(self):
         action = "get_network"
         target = {'shared': True, 'tenant_id': 'somebody_else'}
@@ -428,6 +466,20 @@ class NeutronPolicyTestCase(base.BaseTestCase):
             result = policy.enforce(self.context, action, target)
             self.assertTrue(result)
 
+    def test_enforce_tenant_id_check_parent_resource_cached(self):
+        action = "create_port:mac"
+        plugin = manager.NeutronManager.get_instance().plugin
+        with mock.patch.object(plugin, 'get_network',
+                               return_value={'tenant_id': 'fake'}) as f:
+            for i in range(2):
+                target = {'network_id': 'whatever'}
+                self.assertTrue(policy.enforce(self.context, action, target))
+            f.assert_called_once_with(mock.ANY, 'whatever',
+                                      fields=['tenant_id', 'shared'])
+            other_context = context.Context('fake', 'fake', roles=['user'])
+            policy.enforce(other_context, action, {'network_id': 'whatever'})
+            self.assertEqual(2, f.call_count)
+
     def test_enforce_plugin_failure(self):
 
         def fakegetnetwork(*args, **kwargs):
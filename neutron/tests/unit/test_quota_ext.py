@@ -425,6 +425,16 @@ class TestQuotaDriverLoad(base.BaseTestCase):
         self._test_quota_driver('neutron.db.quota_db.DbQuotaDriver',
                                 'ConfDriver', False)
 
+    def test_quota_db_reservation_driver(self):
+        self._test_quota_driver('neutron.db.quota_db.'
+                                'DbReservationQuotaDriver',
+                                'DbReservationQuotaDriver', True)
+
+    def test_quota_db_reservation_driver_fallback_conf_driver(self):
+        self._test_quota_driver('neutron.db.quota_db.'
+                                'DbReservationQuotaDriver',
+                                'ConfDriver', False)
+
     def test_quota_conf_driver(self):
         self._test_quota_driver('neutron.quota.ConfDriver',
                                 'ConfDriver', True)
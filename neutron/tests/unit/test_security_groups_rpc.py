@@ -17,6 +17,7 @@ import contextlib
 
 import mock
 from oslo.config import cfg
+from oslo import messaging
 from testtools import matchers
 import webob.exc
 
@@ -29,10 +30,12 @@ from neutron.common import constants as const
 from neutron.common import ipv6_utils as ipv6
 from neutron.common import rpc as n_rpc
 from neutron import context
+from neutron.db import api as db
 from neutron.db import securitygroups_rpc_base as sg_db_rpc
 from neutron.extensions import allowedaddresspairs as addr_pair
 from neutron.extensions import securitygroup as ext_sg
 from neutron import manager
+from neutron.openstack.common import timeutils
 from neutron.tests import base
 from neutron.tests.unit import test_extension_security_group as test_sg
 
@@ -63,6 +66,8 @@ class SGServerRpcCallBackMixinTestCase(test_sg.SecurityGroupDBTestCase):
                              group='SECURITYGROUP')
         super(SGServerRpcCallBackMixinTestCase, self).setUp(plugin)
         self.rpc = FakeSGCallback()
+        mock.patch.object(sg_db_rpc, 'RULES_CACHE',
+                          sg_db_rpc.SecurityGroupRulesCache()).start()
 
     def _test_security_group_port(self, device_owner, gw_ip,
                                   cidr, ip_version, ip_address):
@@ -377,8 +382,73 @@ class SGServerRpcCallBackMixinTestCase(test_sg.SecurityGroupDBTestCase):
                              'remote_group_id': sg2_id,
                              'security_group_id': sg1_id},
                             ]
-                self.assertEqual(port_rpc['security_group_rules'],
-                                 expected)
+                # The rules are grouped by security group, in any order
+                self.assertEqual(sorted(port_rpc['security_group_rules']),
+                                 sorted(expected))
+                self._delete('ports', port_id1)
+                self._delete('ports', port_id2)
+
+    def test_security_group_info_for_devices_ipv4_source_group(self):
+
+        with self.network() as n:
+            with contextlib.nested(self.subnet(n),
+                                   self.security_group(),
+                                   self.security_group()) as (subnet_v4,
+                                                              sg1,
+                                                              sg2):
+                sg1_id = sg1['security_group']['id']
+                sg2_id = sg2['security_group']['id']
+                rule1 = self._build_security_group_rule(
+                    sg1_id,
+                    'ingress', const.PROTO_NAME_TCP, '24',
+                    '25', remote_group_id=sg2['security_group']['id'])
+                rules = {
+                    'security_group_rules': [rule1['security_group_rule']]}
+                res = self._create_security_group_rule(self.fmt, rules)
+                self.deserialize(self.fmt, res)
+                self.assertEqual(res.status_int, webob.exc.HTTPCreated.code)
+
+                res1 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg1_id])
+                ports_rest1 = self.deserialize(self.fmt, res1)
+                port_id1 = ports_rest1['port']['id']
+                self.rpc.devices = {port_id1: ports_rest1['port']}
+                devices = [port_id1, 'no_exist_device']
+
+                res2 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg2_id])
+                ports_rest2 = self.deserialize(self.fmt, res2)
+                port_id2 = ports_rest2['port']['id']
+                ctx = context.get_admin_context()
+                sg_info = self.rpc.security_group_info_for_devices(
+                    ctx, devices=devices)
+                expected = {sg1_id: [{'direction': 'egress',
+                                      'ethertype': const.IPv4,
+                                      'security_group_id': sg1_id},
+                                     {'direction': 'egress',
+                                      'ethertype': const.IPv6,
+                                      'security_group_id': sg1_id},
+                                     {'direction': u'ingress',
+                                      'protocol': const.PROTO_NAME_TCP,
+                                      'ethertype': const.IPv4,
+                                      'port_range_max': 25,
+                                      'port_range_min': 24,
+                                      'remote_group_id': sg2_id,
+                                      'security_group_id': sg1_id}]}
+                self.assertEqual(expected.keys(),
+                                 sg_info['security_groups'].keys())
+                self.assertEqual(
+                    sorted(expected[sg1_id]),
+                    sorted(sg_info['security_groups'][sg1_id]))
+                self.assertEqual({sg2_id: {const.IPv4: [u'10.0.0.3'],
+                                           const.IPv6: []}},
+                                 sg_info['sg_member_ips'])
+                port_rpc = sg_info['devices'][port_id1]
+                self.assertEqual([sg1_id], port_rpc['security_groups'])
+                self.assertEqual([sg2_id],
+                                 port_rpc['security_group_source_groups'])
                 self._delete('ports', port_id1)
                 self._delete('ports', port_id2)
 
@@ -797,6 +867,8 @@ class SGServerRpcCallBackMixinTestCase(test_sg.SecurityGroupDBTestCase):
                     fixed_ips=[{'subnet_id': subnet_v6['subnet']['id']}],
                     security_groups=[sg2_id])
                 port_id2 = ports_rest2['port']['id']
+                # The addresses of large subnets are allocated at random
+                port_ip2 = ports_rest2['port']['fixed_ips'][0]['ip_address']
 
                 ctx = context.get_admin_context()
                 ports_rpc = self.rpc.security_group_rules_for_devices(
@@ -811,7 +883,7 @@ class SGServerRpcCallBackMixinTestCase(test_sg.SecurityGroupDBTestCase):
                             {'direction': 'egress', 'ethertype': const.IPv6,
                              'security_group_id': sg2_id},
                             {'direction': 'ingress',
-                             'source_ip_prefix': '2001:db8::2/128',
+                             'source_ip_prefix': '%s/128' % port_ip2,
                              'protocol': const.PROTO_NAME_TCP,
                              'ethertype': const.IPv6,
                              'port_range_max': 25, 'port_range_min': 24,
@@ -823,16 +895,256 @@ class SGServerRpcCallBackMixinTestCase(test_sg.SecurityGroupDBTestCase):
                              'source_ip_prefix': fake_gateway,
                              'source_port_range_min': const.ICMPV6_TYPE_RA},
                             ]
-                self.assertEqual(port_rpc['security_group_rules'],
-                                 expected)
+                # The rules are grouped by security group, in any order
+                self.assertEqual(sorted(port_rpc['security_group_rules']),
+                                 sorted(expected))
                 self._delete('ports', port_id1)
                 self._delete('ports', port_id2)
 
+    def test_security_group_rules_for_devices_cached(self):
+        if getattr(self, "notifier", None) is None:
+            self.skipTest("Notifier mock is not set so security group "
+                          "RPC calls can't be tested")
+        cfg.CONF.set_override('enable_rules_cache', True,
+                              group='SECURITYGROUP')
+        with self.network() as n:
+            with contextlib.nested(self.subnet(n),
+                                   self.security_group()) as (subnet_v4,
+                                                              sg1):
+                sg1_id = sg1['security_group']['id']
+                res1 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg1_id])
+                port1 = self.deserialize(self.fmt, res1)['port']
+                res2 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg1_id])
+                port2 = self.deserialize(self.fmt, res2)['port']
+                ctx = context.get_admin_context()
+
+                def get_rules(port):
+                    self.rpc.devices = {port['id']: port.copy()}
+                    ports_rpc = self.rpc.security_group_rules_for_devices(
+                        ctx, devices=[port['id']])
+                    return ports_rpc[port['id']]['security_group_rules']
+
+                with mock.patch.object(
+                    self.rpc, '_select_rules_for_security_groups',
+                    wraps=self.rpc._select_rules_for_security_groups
+                ) as select_rules:
+                    self.assertEqual(2, len(get_rules(port1)))
+                    self.assertEqual(2, len(get_rules(port2)))
+                    self.assertEqual(1, select_rules.call_count)
+
+                    rule = self._build_security_group_rule(
+                        sg1_id, 'ingress', const.PROTO_NAME_TCP, '22', '22')
+                    res = self._create_security_group_rule(self.fmt, rule)
+                    self.assertEqual(res.status_int,
+                                     webob.exc.HTTPCreated.code)
+                    self.assertEqual(3, len(get_rules(port1)))
+                    self.assertEqual(2, select_rules.call_count)
+                self._delete('ports', port1['id'])
+                self._delete('ports', port2['id'])
+
+    def test_security_group_members_cached(self):
+        if getattr(self, "notifier", None) is None:
+            self.skipTest("Notifier mock is not set so security group "
+                          "RPC calls can't be tested")
+        cfg.CONF.set_override('enable_rules_cache', True,
+                              group='SECURITYGROUP')
+        with self.network() as n:
+            with contextlib.nested(self.subnet(n),
+                                   self.security_group(),
+                                   self.security_group()) as (subnet_v4,
+                                                              sg1,
+                                                              sg2):
+                sg1_id = sg1['security_group']['id']
+                sg2_id = sg2['security_group']['id']
+                rule = self._build_security_group_rule(
+                    sg1_id, 'ingress', const.PROTO_NAME_TCP, '24', '25',
+                    remote_group_id=sg2_id)
+                res = self._create_security_group_rule(self.fmt, rule)
+                self.assertEqual(res.status_int, webob.exc.HTTPCreated.code)
+                res1 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg1_id])
+                port1 = self.deserialize(self.fmt, res1)['port']
+                ctx = context.get_admin_context()
+
+                def get_source_ips():
+                    self.rpc.devices = {port1['id']: port1.copy()}
+                    ports_rpc = self.rpc.security_group_rules_for_devices(
+                        ctx, devices=[port1['id']])
+                    return [rule['source_ip_prefix'] for rule in
+                            ports_rpc[port1['id']]['security_group_rules']
+                            if rule.get('remote_group_id')]
+
+                self.assertEqual([], get_source_ips())
+                res2 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg2_id])
+                port2 = self.deserialize(self.fmt, res2)['port']
+                self.assertEqual(
+                    ['%s/32' % port2['fixed_ips'][0]['ip_address']],
+                    get_source_ips())
+                self._delete('ports', port2['id'])
+                self.assertEqual([], get_source_ips())
+                self._delete('ports', port1['id'])
+
+    def test_security_group_delete_invalidates_remote_rules(self):
+        if getattr(self, "notifier", None) is None:
+            self.skipTest("Notifier mock is not set so security group "
+                          "RPC calls can't be tested")
+        cfg.CONF.set_override('enable_rules_cache', True,
+                              group='SECURITYGROUP')
+        with self.network() as n:
+            with contextlib.nested(self.subnet(n),
+                                   self.security_group()) as (subnet_v4,
+                                                              sg1):
+                sg1_id = sg1['security_group']['id']
+                res = self._create_security_group(self.fmt, 'sg2', 'sg2')
+                sg2_id = self.deserialize(self.fmt,
+                                          res)['security_group']['id']
+                rule = self._build_security_group_rule(
+                    sg1_id, 'ingress', const.PROTO_NAME_TCP, '24', '25',
+                    remote_group_id=sg2_id)
+                res = self._create_security_group_rule(self.fmt, rule)
+                self.assertEqual(res.status_int, webob.exc.HTTPCreated.code)
+                res1 = self._create_port(
+                    self.fmt, n['network']['id'],
+                    security_groups=[sg1_id])
+                port1 = self.deserialize(self.fmt, res1)['port']
+                ctx = context.get_admin_context()
+
+                def get_remote_group_ids():
+                    self.rpc.devices = {port1['id']: port1.copy()}
+                    ports_rpc = self.rpc.security_group_info_for_devices(
+                        ctx, devices=[port1['id']])
+                    return [rule.get('remote_group_id') for rule in
+                            ports_rpc['security_groups'][sg1_id]
+                            if rule.get('remote_group_id')]
+
+                self.assertEqual([sg2_id], get_remote_group_ids())
+                self._delete('security-groups', sg2_id)
+                # the rule of sg1 was deleted by cascade
+                self.assertEqual([], get_remote_group_ids())
+                self._delete('ports', port1['id'])
+
 
 class SGServerRpcCallBackMixinTestCaseXML(SGServerRpcCallBackMixinTestCase):
     fmt = 'xml'
 
 
+class SecurityGroupRulesCacheTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(SecurityGroupRulesCacheTestCase, self).setUp()
+        self.cache = sg_db_rpc.SecurityGroupRulesCache()
+        self.build = mock.Mock(
+            side_effect=lambda sg_ids: dict((sg_id, [sg_id + '_rule'])
+                                            for sg_id in sg_ids))
+
+    def test_get_rules_builds_missing_entries(self):
+        self.assertEqual({'sg1': ['sg1_rule']},
+                         self.cache.get_rules(['sg1'], self.build))
+        self.assertEqual({'sg1': ['sg1_rule'], 'sg2': ['sg2_rule']},
+                         self.cache.get_rules(['sg1', 'sg2'], self.build))
+        self.assertEqual([mock.call(set(['sg1'])), mock.call(set(['sg2']))],
+                         self.build.call_args_list)
+
+    def test_invalidate_rules(self):
+        self.cache.get_rules(['sg1', 'sg2'], self.build)
+        self.cache.invalidate_rules(['sg1'])
+        self.cache.get_rules(['sg1', 'sg2'], self.build)
+        self.assertEqual(mock.call(set(['sg1'])), self.build.call_args)
+
+    def test_invalidate_members(self):
+        self.cache.get_rules(['sg1'], self.build)
+        self.cache.get_members(['sg1'], self.build)
+        self.cache.invalidate_members(['sg1'])
+        self.cache.get_rules(['sg1'], self.build)
+        self.cache.get_members(['sg1'], self.build)
+        self.assertEqual(3, self.build.call_count)
+
+    def test_entries_built_during_invalidation_not_stored(self):
+        def build(sg_ids):
+            # The rules are changed while they are read from the database
+            self.cache.invalidate_rules(sg_ids)
+            return self.build(sg_ids)
+
+        self.assertEqual({'sg1': ['sg1_rule']},
+                         self.cache.get_rules(['sg1'], build))
+        self.cache.get_rules(['sg1'], self.build)
+        self.assertEqual(2, self.build.call_count)
+
+
+class SecurityGroupRulesCacheSyncTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(SecurityGroupRulesCacheSyncTestCase, self).setUp()
+        db.configure_db()
+        self.addCleanup(db.clear_db)
+        self.context = context.get_admin_context()
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self.cache = sg_db_rpc.SecurityGroupRulesCache()
+        self.build = mock.Mock(
+            side_effect=lambda sg_ids: dict((sg_id, [sg_id + '_rule'])
+                                            for sg_id in sg_ids))
+        self.cache.sync(self.context)
+        self.cache.get_rules(['sg1', 'sg2'], self.build)
+        self.cache.get_members(['sg1', 'sg2'], self.build)
+        self.build.reset_mock()
+
+    def _get_entries(self):
+        self.cache.get_rules(['sg1', 'sg2'], self.build)
+        self.cache.get_members(['sg1', 'sg2'], self.build)
+        return [call[0][0] for call in self.build.call_args_list]
+
+    def _count_changes(self):
+        return self.context.session.query(
+            sg_db_rpc.SecurityGroupCacheInvalidation).count()
+
+    def test_sync_applies_recorded_changes(self):
+        timeutils.advance_time_seconds(1)
+        # e.g. recorded by another server
+        sg_db_rpc.SecurityGroupRulesCache.record_changes(self.context,
+                                                         ['sg1'])
+        self.cache.sync(self.context)
+        self.assertEqual([set(['sg1']), set(['sg1'])], self._get_entries())
+
+    def test_sync_applies_changes_once(self):
+        sg_db_rpc.SecurityGroupRulesCache.record_changes(self.context,
+                                                         ['sg1'])
+        self.cache.sync(self.context)
+        timeutils.advance_time_seconds(1)
+        self.cache.sync(self.context)
+        self.assertEqual(2, len(self._get_entries()))
+
+    def test_sync_applies_changes_committed_late(self):
+        cfg.CONF.set_override('rules_cache_sync_margin', 10,
+                              group='SECURITYGROUP')
+        recorded_at = timeutils.utcnow()
+        timeutils.advance_time_seconds(5)
+        self.cache.sync(self.context)
+        # a change recorded before the previous sync, but committed after it
+        with self.context.session.begin():
+            self.context.session.add(sg_db_rpc.SecurityGroupCacheInvalidation(
+                security_group_id='sg2', created_at=recorded_at))
+        self.cache.sync(self.context)
+        self.assertEqual([set(['sg2']), set(['sg2'])], self._get_entries())
+
+    def test_sync_prunes_old_changes(self):
+        cfg.CONF.set_override('rules_cache_sync_margin', 10,
+                              group='SECURITYGROUP')
+        sg_db_rpc.SecurityGroupRulesCache.record_changes(self.context,
+                                                         ['sg1', 'sg2'])
+        timeutils.advance_time_seconds(11)
+        self.cache.sync(self.context)
+        self.assertEqual(2, self._count_changes())
+        timeutils.advance_time_seconds(11)
+        self.cache.sync(self.context)
+        self.assertEqual(0, self._count_changes())
+
+
 class SGAgentRpcCallBackMixinTestCase(base.BaseTestCase):
     def setUp(self):
         super(SGAgentRpcCallBackMixinTestCase, self).setUp()
@@ -880,11 +1192,13 @@ class SecurityGroupAgentRpcTestCase(base.BaseTestCase):
         self.agent.root_helper = 'sudo'
         self.agent.init_firewall(defer_refresh_firewall=defer_refresh_firewall)
         self.firewall = mock.Mock()
+        self.firewall.matches_remote_groups = False
         firewall_object = firewall_base.FirewallDriver()
         self.firewall.defer_apply.side_effect = firewall_object.defer_apply
         self.agent.firewall = self.firewall
         rpc = mock.Mock()
         self.agent.plugin_rpc = rpc
+        self.agent.use_enhanced_rpc = False
         self.fake_device = {'device': 'fake_device',
                             'security_groups': ['fake_sgid1', 'fake_sgid2'],
                             'security_group_source_groups': ['fake_sgid2'],
@@ -908,6 +1222,100 @@ class SecurityGroupAgentRpcTestCase(base.BaseTestCase):
                                             self.fake_device),
                                         ])
 
+    def test_prepare_devices_filter_enhanced_rpc(self):
+        self.agent.use_enhanced_rpc = True
+        rule = {'security_group_id': 'fake_sgid1',
+                'direction': 'ingress',
+                'ethertype': const.IPv4,
+                'remote_group_id': 'fake_sgid2'}
+        provider_rule = {'direction': 'ingress',
+                         'ethertype': const.IPv4,
+                         'source_ip_prefix': '10.0.0.2/32'}
+        device = {'device': 'fake_device',
+                  'fixed_ips': ['10.0.0.3'],
+                  'security_groups': ['fake_sgid1'],
+                  'security_group_source_groups': ['fake_sgid2'],
+                  'security_group_rules': [provider_rule]}
+        self.agent.plugin_rpc.security_group_info_for_devices.return_value = {
+            'devices': {'fake_device': device},
+            'security_groups': {'fake_sgid1': [rule]},
+            'sg_member_ips': {'fake_sgid2': {
+                const.IPv4: ['10.0.0.3', '10.0.0.4'],
+                const.IPv6: ['fe80::1']}}}
+        self.agent.prepare_devices_filter(['fake_device'])
+        expected_rule = dict(rule, source_ip_prefix='10.0.0.4/32')
+        self.assertEqual([expected_rule, provider_rule],
+                         device['security_group_rules'])
+        self.firewall.prepare_port_filter.assert_called_once_with(device)
+        self.assertFalse(
+            self.agent.plugin_rpc.security_group_rules_for_devices.called)
+
+    def test_prepare_devices_filter_enhanced_rpc_unsupported(self):
+        self.agent.use_enhanced_rpc = True
+        rpc = self.agent.plugin_rpc
+        rpc.security_group_info_for_devices.side_effect = (
+            messaging.RemoteError('UnsupportedVersion'))
+        self.agent.prepare_devices_filter(['fake_device'])
+        self.agent.prepare_devices_filter(['fake_device'])
+        self.assertFalse(self.agent.use_enhanced_rpc)
+        self.assertEqual(1, rpc.security_group_info_for_devices.call_count)
+        self.assertEqual(2, rpc.security_group_rules_for_devices.call_count)
+        self.firewall.prepare_port_filter.assert_called_with(self.fake_device)
+
+    def test_prepare_devices_filter_enhanced_rpc_remote_error(self):
+        self.agent.use_enhanced_rpc = True
+        rpc = self.agent.plugin_rpc
+        rpc.security_group_info_for_devices.side_effect = (
+            messaging.RemoteError('SecurityGroupNotFound'))
+        self.assertRaises(messaging.RemoteError,
+                          self.agent.prepare_devices_filter, ['fake_device'])
+        self.assertTrue(self.agent.use_enhanced_rpc)
+        self.assertFalse(rpc.security_group_rules_for_devices.called)
+
+    def test_prepare_devices_filter_enhanced_rpc_remote_groups(self):
+        self.agent.use_enhanced_rpc = True
+        self.firewall.matches_remote_groups = True
+        rule = {'security_group_id': 'fake_sgid1',
+                'direction': 'ingress',
+                'ethertype': const.IPv4,
+                'remote_group_id': 'fake_sgid2'}
+        member_ips = {const.IPv4: ['10.0.0.3'], const.IPv6: []}
+        device = {'device': 'fake_device',
+                  'fixed_ips': ['10.0.0.3'],
+                  'security_groups': ['fake_sgid1'],
+                  'security_group_source_groups': ['fake_sgid2'],
+                  'security_group_rules': []}
+        self.agent.plugin_rpc.security_group_info_for_devices.return_value = {
+            'devices': {'fake_device': device},
+            'security_groups': {'fake_sgid1': [rule]},
+            'sg_member_ips': {'fake_sgid2': member_ips}}
+        self.agent.prepare_devices_filter(['fake_device'])
+        self.assertEqual([rule], device['security_group_rules'])
+        self.firewall.assert_has_calls(
+            [mock.call.update_security_group_members('fake_sgid2',
+                                                     member_ips),
+             mock.call.defer_apply(),
+             mock.call.prepare_port_filter(device)])
+
+    def test_security_groups_member_updated_remote_groups(self):
+        self.agent.use_enhanced_rpc = True
+        self.firewall.matches_remote_groups = True
+        member_ips = {const.IPv4: ['10.0.0.3'], const.IPv6: []}
+        rpc = self.agent.plugin_rpc
+        rpc.security_group_info_for_devices.return_value = {
+            'devices': {'fake_device': self.fake_device},
+            'security_groups': {},
+            'sg_member_ips': {'fake_sgid2': member_ips,
+                              'fake_sgid4': member_ips}}
+        self.agent.refresh_firewall = mock.Mock()
+        self.agent.security_groups_member_updated(['fake_sgid2', 'fake_sgid3'])
+        rpc.security_group_info_for_devices.assert_called_once_with(
+            None, ['fake_device'])
+        self.firewall.update_security_group_members.assert_called_once_with(
+            'fake_sgid2', member_ips)
+        self.assertFalse(self.agent.refresh_firewall.called)
+        self.assertFalse(self.agent.devices_to_refilter)
+
     def test_security_groups_rule_updated(self):
         self.agent.refresh_firewall = mock.Mock()
         self.agent.prepare_devices_filter(['fake_port_id'])
@@ -1051,6 +1459,40 @@ class SecurityGroupAgentRpcWithDeferredRefreshTestCase(
         self.agent.security_groups_provider_updated()
         self.assertTrue(self.agent.global_refresh_firewall)
 
+    def test_security_groups_member_updated_remote_groups(self):
+        self.agent.use_enhanced_rpc = True
+        self.firewall.matches_remote_groups = True
+        member_ips = {const.IPv4: ['10.0.0.3'], const.IPv6: []}
+        rpc = self.agent.plugin_rpc
+        rpc.security_group_info_for_devices.return_value = {
+            'devices': {'fake_device': self.fake_device},
+            'security_groups': {},
+            'sg_member_ips': {'fake_sgid2': member_ips}}
+        self.agent.refresh_firewall = mock.Mock()
+        self.agent.security_groups_member_updated(['fake_sgid2', 'fake_sgid3'])
+        # the members are updated by the agent loop
+        self.assertFalse(rpc.security_group_info_for_devices.called)
+        self.assertFalse(self.firewall.update_security_group_members.called)
+        self.assertEqual(set(['fake_sgid2', 'fake_sgid3']),
+                         self.agent.sg_members_to_update)
+        self.assertTrue(self.agent.firewall_refresh_needed())
+
+        self.agent.setup_port_filters(set(), set())
+        self.firewall.update_security_group_members.assert_called_once_with(
+            'fake_sgid2', member_ips)
+        self.assertFalse(self.agent.sg_members_to_update)
+        self.assertFalse(self.agent.refresh_firewall.called)
+
+    def test_setup_port_filters_sg_members_updates_and_global_refresh(self):
+        self.agent.refresh_firewall = mock.Mock()
+        self.agent._security_group_members_updated = mock.Mock()
+        self.agent.sg_members_to_update = set(['fake_sgid2'])
+        self.agent.global_refresh_firewall = True
+        self.agent.setup_port_filters(set(), set())
+        self.assertFalse(self.agent.sg_members_to_update)
+        self.agent.refresh_firewall.assert_called_once_with()
+        self.assertFalse(self.agent._security_group_members_updated.called)
+
     def test_setup_port_filters_new_ports_only(self):
         self.agent.prepare_devices_filter = mock.Mock()
         self.agent.refresh_firewall = mock.Mock()
@@ -1187,6 +1629,16 @@ class SecurityGroupServerRpcApiTestCase(base.BaseTestCase):
              version=sg_rpc.SG_RPC_VERSION,
              topic='fake_topic')])
 
+    def test_security_group_info_for_devices(self):
+        self.rpc.security_group_info_for_devices(None, ['fake_device'])
+        self.rpc.call.assert_called_once_with(
+            None,
+            {'args': {'devices': ['fake_device']},
+             'method': 'security_group_info_for_devices',
+             'namespace': None},
+            version=sg_rpc.SG_INFO_RPC_VERSION,
+            topic='fake_topic')
+
 
 class FakeSGNotifierAPI(n_rpc.RpcProxy,
                         sg_rpc.SecurityGroupAgentRpcApiMixin):
@@ -1832,6 +2284,7 @@ class TestSecurityGroupAgentWithIptables(base.BaseTestCase):
 
         self.rpc = mock.Mock()
         self.agent.plugin_rpc = self.rpc
+        self.agent.use_enhanced_rpc = False
         rule1 = [{'direction': 'ingress',
                   'protocol': const.PROTO_NAME_UDP,
                   'ethertype': const.IPv4,
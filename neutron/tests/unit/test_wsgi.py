@@ -602,6 +602,24 @@ class JSONDictSerializerTest(base.BaseTestCase):
 
         self.assertEqual(result, expected_json)
 
+    def test_serialize_chunks(self):
+        input_dict = {'ports': [{'id': i, 'name': u'\u7f51'}
+                                for i in range(10)],
+                      'ports_links': [{'rel': 'next'}],
+                      'count': 10}
+        serializer = wsgi.JSONDictSerializer()
+        serializer.chunk_size = 20
+        chunks = list(serializer.serialize_chunks(input_dict))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(serializer.serialize(input_dict), ''.join(chunks))
+
+    def test_serialize_chunks_empty(self):
+        serializer = wsgi.JSONDictSerializer()
+        for data in ({}, {'ports': []}, []):
+            self.assertEqual(serializer.serialize(data),
+                             ''.join(serializer.serialize_chunks(data)))
+
 
 class TextDeserializerTest(base.BaseTestCase):
 
@@ -13,9 +13,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from sqlalchemy import event
 import testtools
 
 from neutron.api.v2 import attributes
+from neutron.db import api as db_api
 from neutron.tests import base
 from neutron import wsgi
 
@@ -33,6 +35,38 @@ class ExpectedException(testtools.ExpectedException):
         return False
 
 
+class SqlStatementCounter(object):
+    """Count the SQL statements executed on the engine within a block.
+
+    with SqlStatementCounter() as counter:
+        plugin.get_ports(context)
+    self.assertThat(counter.count, matchers.LessThan(3))
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or db_api.get_engine()
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        # NOTE: oslo.db pings each connection checked out from the pool
+        if statement != 'SELECT 1':
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+
+
 def create_request(path, body, content_type, method='GET',
                    query_string=None, context=None):
     if query_string:
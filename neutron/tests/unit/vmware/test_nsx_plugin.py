@@ -174,6 +174,25 @@ class TestPortsV2(NsxPluginV2TestCase,
                 self.assertEqual(res['port']['fixed_ips'],
                                  data['port']['fixed_ips'])
 
+    def test_update_port_recycles_removed_ips(self):
+        # This test case overrides the default because the security groups
+        # must be removed together with the ip addresses, as in
+        # test_update_port_delete_ip.
+        with self.subnet() as subnet:
+            subnet_id = subnet['subnet']['id']
+            with contextlib.nested(self.port(subnet=subnet),
+                                   self.port(subnet=subnet),
+                                   self.port(subnet=subnet)) as ports:
+                data = {'port': {'fixed_ips': [],
+                                 secgrp.SECURITYGROUPS: []}}
+                self._update('ports', ports[1]['port']['id'], data)
+                self.assertEqual([('10.0.0.3', '10.0.0.3'),
+                                  ('10.0.0.5', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+                self._update('ports', ports[2]['port']['id'], data)
+                self.assertEqual([('10.0.0.3', '10.0.0.254')],
+                                 self._get_availability_ranges(subnet_id))
+
     def test_create_port_name_exceeds_40_chars(self):
         name = 'this_is_a_port_whose_name_is_longer_than_40_chars'
         with self.port(name=name) as port:
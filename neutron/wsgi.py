@@ -390,10 +390,47 @@ class DictSerializer(ActionDispatcher):
 class JSONDictSerializer(DictSerializer):
     """Default JSON request body serialization."""
 
+    # Size of the chunks written by serialize_chunks
+    chunk_size = 64 * 1024
+
+    @staticmethod
+    def _sanitizer(obj):
+        return unicode(obj)
+
     def default(self, data):
-        def sanitizer(obj):
-            return unicode(obj)
-        return jsonutils.dumps(data, default=sanitizer)
+        return jsonutils.dumps(data, default=self._sanitizer)
+
+    def serialize_chunks(self, data):
+        """Serialize data as an iterator over chunks of the JSON document.
+
+        The lists which are values of the data dict, e.g. the resources of
+        a collection, are encoded one item at a time, so that the whole
+        document never needs to be held in memory. Joining the chunks gives
+        the same document as serialize().
+        """
+        if not isinstance(data, dict):
+            yield self.serialize(data)
+            return
+        buf = []
+        size = 0
+        for i, (key, value) in enumerate(data.iteritems()):
+            buf.append('%s%s: ' % ('{' if i == 0 else ', ',
+                                   jsonutils.dumps(key)))
+            if isinstance(value, list):
+                buf.append('[')
+                for j, item in enumerate(value):
+                    chunk = jsonutils.dumps(item, default=self._sanitizer)
+                    buf.append(', ' + chunk if j else chunk)
+                    size += len(chunk)
+                    if size >= self.chunk_size:
+                        yield ''.join(buf)
+                        buf = []
+                        size = 0
+                buf.append(']')
+            else:
+                buf.append(jsonutils.dumps(value, default=self._sanitizer))
+        buf.append('}' if data else '{}')
+        yield ''.join(buf)
 
 
 class XMLDictSerializer(DictSerializer):